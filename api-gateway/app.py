@@ -5,19 +5,35 @@ API网关服务
 为微信小程序提供HTTPS API接口，支持多GPU服务器负载均衡
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, g, request, jsonify, send_file
 from flask_cors import CORS
 import requests
 import os
 import json
+import math
 import time
 from urllib.parse import urljoin
 import logging
 from config import config
 
 # 导入多GPU服务器管理模块
-from backend_manager import backend_manager
+from backend_manager import backend_manager, TASK_FINISHED_STATUSES
 from webhook_routes import register_webhook_routes
+from task_router import task_router
+from notify_dedup import notify_dedup
+from payment_query import payment_query_cache
+from order_reconciler import create_order_reconciler
+from session_store import session_store
+from fair_scheduler import fair_scheduler, QueueFullError
+from rate_limiter import rate_limiter
+from client_ip import client_ip_resolver
+from status_snapshot import status_snapshots
+from metrics import metrics
+from result_cache import result_cache
+from enhance_dedup import enhance_dedup, UploadDigest
+from enhance_failover import enhance_failover
+from upload_stream import SpooledBody, UploadStream, UploadTooLargeError
+from http_pool import wechat_session
 
 # 导入微信支付相关模块
 from wechat_pay_utils import WeChatPayAPI, WeChatPayUtils
@@ -35,6 +51,9 @@ CORS(app)  # 允许跨域请求
 # 注册webhook路由
 register_webhook_routes(app)
 
+# 运行指标中输出各GPU服务器的转发中请求数和可用状态
+metrics.bind_backends(backend_manager.servers)
+
 # 从配置文件获取后端API服务器配置
 BACKEND_TIMEOUT = config.get_timeout()
 
@@ -46,53 +65,379 @@ pay_api = WeChatPayAPI()
 order_manager = OrderManager()
 wechat_auth = WeChatAuth()
 
-@app.route('/api/v1/enhance', methods=['POST'])
-def enhance_image():
+# 后台对账长时间未支付的订单
+order_reconciler = create_order_reconciler(order_manager, pay_api, query_cache=payment_query_cache)
+if config.get_order_reconciler_config()["enabled"]:
+    order_reconciler.start()
+
+# 用户订单列表每页最多返回的订单数
+MAX_ORDERS_PAGE_SIZE = 100
+
+# 支付回调处理成功的应答
+NOTIFY_SUCCESS_XML = WeChatPayUtils.dict_to_xml({
+    'return_code': 'SUCCESS',
+    'return_msg': 'OK'
+})
+
+def _request_token():
+    """请求中携带的登录令牌（Authorization: Bearer <令牌>）"""
+    auth = request.headers.get('Authorization', '')
+    if auth[:7].lower() == 'bearer ':
+        return auth[7:].strip()
+    return None
+
+def authenticate_request(claimed_openid=None):
     """
-    图片增强API - 支持多GPU服务器负载均衡
+    确认请求的用户身份，返回 (openid, 错误响应)
+    携带令牌时按会话确定openid，请求中的openid必须一致；未携带令牌时按配置决定是否信任请求中的openid
+    """
+    token = _request_token()
+    if token:
+        session = session_store.get(token)
+        if session is None:
+            return None, (jsonify({'success': False, 'error': '登录已过期，请重新登录'}), 401)
+        if claimed_openid and claimed_openid != session.openid:
+            return None, (jsonify({'success': False, 'error': '无权访问该用户的数据'}), 403)
+        return session.openid, None
+    if session_store.require_token:
+        return None, (jsonify({'success': False, 'error': '缺少登录令牌'}), 401)
+    return claimed_openid, None
+
+def _client_ip():
+    """客户端IP（来自受信任的代理时取nginx传入的请求头）"""
+    header = client_ip_resolver.header
+    return client_ip_resolver.resolve(request.remote_addr, request.headers.get(header) if header else None)
+
+def _session_openid():
+    """请求携带的登录令牌对应的openid，未登录返回None"""
+    token = _request_token()
+    if token:
+        session = session_store.get(token)
+        if session is not None:
+            return session.openid
+    return None
+
+def _fair_queue_user():
+    """排队使用的用户标识：已登录按openid，未登录按IP和时间窗口"""
+    return fair_scheduler.user_key(_client_ip(), _session_openid())
+
+@app.before_request
+def start_request_metrics():
+    """接口指标：记录开始时间和处理中的请求数（在限流之前，被限流的请求也计入）"""
+    if metrics.enabled:
+        g.metrics_started = time.perf_counter()
+        metrics.request_started(request.endpoint)
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        metrics.request_finished(request.endpoint, request.method, response.status_code,
+                                 time.perf_counter() - started)
+    return response
+
+@app.teardown_request
+def end_request_metrics(error=None):
+    # 未处理的异常不经过after_request，按500计入
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        metrics.request_finished(request.endpoint, request.method, 500, time.perf_counter() - started)
+
+@app.before_request
+def check_rate_limit():
+    """接口限流（规则见 gateway_config.json 的 rate_limit）"""
+    if request.method == 'OPTIONS':
+        return None
+    client_ip = _client_ip()
+    limited = rate_limiter.check(request.endpoint, client_ip, _session_openid)
+    if limited is None:
+        return None
+    logger.warning(f"请求限流({limited['rule']}): {client_ip} {request.path}")
+    response = jsonify({'error': '请求过于频繁，请稍后重试'})
+    response.headers['Retry-After'] = str(max(math.ceil(limited['retry_after']), 1))
+    return response, 429
+
+def _queue_full_response(error):
+    return {'error': str(error)}, 429, {'Retry-After': str(error.retry_after)}
+
+def _upload_size(post_kwargs):
+    """已发送到GPU服务器的图片字节数"""
+    data = post_kwargs.get('data')
+    if isinstance(data, UploadStream):
+        return data.bytes_read
+    files = post_kwargs.get('files')
+    if files:
+        try:
+            return files['file'][1].tell()
+        except (OSError, ValueError):
+            return 0
+    return 0
+
+def _forward_enhance(backend_url, server, post_kwargs, upload=None, claim=None):
     """
+    转发增强请求到GPU服务器，返回 (响应内容, 状态码)
+    server不为空时调用前已计入转发中请求，这里负责结束计数；
+    claim()返回False时（对冲中另一台已受理）不记录返回的任务
+    """
+    full_url = urljoin(backend_url, '/api/v1/enhance')
+    logger.info(f"转发请求到: {full_url}")
+    started = time.time()
+    
     try:
-        logger.info("收到图片增强请求")
-        
-        # 检查是否有文件上传
-        if 'file' not in request.files:
-            return jsonify({'error': '没有上传文件'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': '文件名为空'}), 400
-        
-        # 准备转发到后端的请求
-        files = {'file': (file.filename, file.stream, file.content_type)}
+        try:
+            response = backend_manager.get_session(backend_url).post(
+                full_url,
+                timeout=BACKEND_TIMEOUT,
+                **post_kwargs
+            )
+        except Exception as e:
+            # 超出大小限制时上传被中止，requests可能把异常包装成连接错误
+            if upload is not None and upload.exceeded:
+                backend_manager.report_result(backend_url, 413)
+                return {'error': '文件过大'}, 413
+            if isinstance(e, requests.exceptions.RequestException):
+                backend_manager.report_result(backend_url)
+                metrics.observe_upstream(backend_url, 'enhance', time.time() - started, None)
+            raise
         
-        # 获取其他参数
-        data = {}
-        if 'tile_size' in request.form:
-            data['tile_size'] = request.form['tile_size']
-        if 'quality_level' in request.form:
-            data['quality_level'] = request.form['quality_level']
+        if upload is not None and upload.exceeded:
+            backend_manager.report_result(backend_url, 413)
+            return {'error': '文件过大'}, 413
+        backend_manager.report_result(backend_url, response.status_code)
+        metrics.observe_upstream(backend_url, 'enhance', time.time() - started, response.status_code,
+                                 sent=_upload_size(post_kwargs))
         
+        # 记录任务所属的GPU服务器，后续status/download直接路由过去
+        result = response.json()
+        if isinstance(result, dict) and result.get('task_id'):
+            if claim is not None and not claim():
+                # 不占用该服务器的任务名额，任务不会有客户端查询
+                return result, response.status_code
+            task_router.bind(result['task_id'], backend_url)
+            if server:
+                # 先记录任务再结束转发中计数，避免服务器负载短暂偏低
+                server.track_job(result['task_id'], started)
+        return result, response.status_code
+    finally:
+        if server:
+            server.end_request()
+
+def _select_failover_server(tried):
+    """失败转移时选择一台未尝试过的服务器并计入转发中请求"""
+    if fair_scheduler.active:
+        # 开启排队时不超过每台服务器的任务上限
+        return backend_manager.reserve_server(fair_scheduler.max_jobs_per_server, exclude=tried)
+    server = backend_manager.get_next_server(exclude=tried)
+    if server:
+        server.begin_request()
+    return server
+
+def _forward_with_failover(backend_url, server, replay):
+    """转发缓存的请求体，连接失败或GPU服务器未受理时换服务器重新发送"""
+    return enhance_failover.forward(
+        backend_url, server,
+        lambda url, target, claim: _forward_enhance(url, target, replay(), claim=claim),
+        _select_failover_server
+    )
+
+def _spool_upload(post_kwargs, upload, max_memory, with_digest=False):
+    """
+    缓存整个上传内容（超过max_memory写入临时文件），换服务器重试、对冲、排队后发送时重新读取
+    返回 (缓存的请求体, 生成转发参数的函数, 去重摘要)；with_digest为False或无法计算时摘要为None
+    """
+    body = SpooledBody(max_memory)
+    digest = None
+    try:
+        if upload is not None:
+            if with_digest:
+                boundary = request.mimetype_params.get('boundary', '')
+                digest = UploadDigest(boundary.encode('latin-1') if boundary else None)
+            for chunk in upload:
+                if digest is not None:
+                    digest.feed(chunk)
+                body.write(chunk)
+            if digest is not None:
+                digest.close()
+            chunk_size = upload.chunk_size
+            headers = post_kwargs['headers']
+            
+            def replay():
+                # 带len属性的流，requests按Content-Length分块发送
+                return {'data': body.open(chunk_size), 'headers': headers}
+        else:
+            # 已解析的表单：图片在werkzeug的临时文件中
+            filename, stream, content_type = post_kwargs['files']['file']
+            data = post_kwargs['data']
+            if with_digest:
+                digest = UploadDigest()
+            for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                if digest is not None:
+                    digest.update_image(chunk)
+                body.write(chunk)
+            if digest is not None:
+                for name, value in data.items():
+                    digest.set_field(name, value.encode('utf-8'))
+            
+            def replay():
+                return {'files': {'file': (filename, body.reader(), content_type)}, 'data': data}
+        body.finish()
+    except Exception:
+        body.close()
+        raise
+    return body, replay, digest.hexdigest() if digest is not None else None
+
+def _enqueue_enhance(post_kwargs, upload, body=None, replay=None, user=None):
+    """
+    GPU服务器全部满载：图片缓存在网关排队，返回排队任务号
+    已缓存的请求体（body）由排队任务另外持有一份，调用方照常关闭；user为空时按当前请求识别
+    """
+    if user is None:
+        user = _fair_queue_user()
+    try:
+        fair_scheduler.check_admission(user)
+    except QueueFullError as e:
+        return _queue_full_response(e)
+    
+    if body is None:
+        try:
+            body, replay, _ = _spool_upload(post_kwargs, upload, fair_scheduler.spool_memory)
+        except UploadTooLargeError:
+            return {'error': '文件过大'}, 413
+    else:
+        body.share()
+    
+    try:
+        # 排队任务发送后由调度器关闭请求体
+        job = fair_scheduler.submit(user, body, body.size,
+                                    lambda server: _forward_with_failover(server.url, server, replay))
+    except QueueFullError as e:
+        body.close()
+        return _queue_full_response(e)
+    except Exception:
+        body.close()
+        raise
+    
+    logger.info(f"GPU服务器满载，任务排队: {job.ticket}")
+    _, status = fair_scheduler.resolve(job.ticket)
+    return status, 200
+
+def _dispatch_enhance(post_kwargs, upload, body=None, replay=None, user=None):
+    """
+    选择GPU服务器转发，全部满载时排队；请求体已缓存（replay不为空）时失败可换服务器重试
+    返回 (响应内容, 状态码[, 响应头])，不依赖Flask请求上下文（排队需要user，为空时按当前请求识别）
+    """
+    server = None
+    if fair_scheduler.active:
+        # 有未满载的服务器且没有排队任务时直接转发，否则排队
+        server = fair_scheduler.try_acquire()
+        if server is None and backend_manager.servers.available():
+            return _enqueue_enhance(post_kwargs, upload, body, replay, user)
+    
+    if server:
+        backend_url = server.url
+    else:
         # 使用config.get_backend_url()自动处理负载均衡
         backend_url = config.get_backend_url()
         if not backend_url:
             logger.error("没有可用的后端服务器")
-            return jsonify({'error': '服务暂时不可用，请稍后重试'}), 503
+            return {'error': '服务暂时不可用，请稍后重试'}, 503
         
-        logger.info(f"使用后端地址: {backend_url}")
+        # 统计该服务器正在转发的请求数，供负载均衡策略使用
+        server = backend_manager.get_server_by_url(backend_url)
+        if server:
+            server.begin_request()
+    
+    logger.info(f"使用后端地址: {backend_url}")
+    
+    # 转发请求到后端
+    if replay is not None:
+        result, status_code = _forward_with_failover(backend_url, server, replay)
+    else:
+        result, status_code = _forward_enhance(backend_url, server, post_kwargs, upload)
+    
+    # 返回后端响应
+    return result, status_code
+
+def _enhance_spooled(post_kwargs, body, replay, digest, user=None):
+    """
+    转发已缓存的上传内容：相同图片和参数的任务正在处理或已完成时直接复用，否则选择GPU服务器转发或排队
+    返回 (响应内容, 状态码[, 响应头])，结束后关闭请求体；异步网关在线程池中调用，由调用方提供user
+    """
+    ticket = enhance_dedup.begin(digest) if digest else None
+    if ticket is not None and ticket.response is not None:
+        body.close()
+        return ticket.response, 200
+    
+    response = None
+    try:
+        response = _dispatch_enhance(post_kwargs, None, body, replay, user)
+        return response
+    finally:
+        if ticket is not None:
+            enhance_dedup.finish(ticket, response[0] if response else None, response[1] if response else None)
+        body.close()
+
+@app.route('/api/v1/enhance', methods=['POST'])
+def enhance_image():
+    """
+    图片增强API - 支持多GPU服务器负载均衡
+    GPU服务器全部满载时在网关按用户公平排队；相同图片和参数的请求复用已有任务；
+    转发失败时换一台GPU服务器重新发送
+    """
+    try:
+        logger.info("收到图片增强请求")
         
-        # 转发请求到后端
-        full_url = urljoin(backend_url, '/api/v1/enhance')
-        logger.info(f"转发请求到: {full_url}")
+        upload = None
+        if config.is_streaming_upload_enabled():
+            # 流式转发：不解析multipart，直接把原始请求体分块转发到后端
+            max_file_size = config.get_max_file_size()
+            if request.content_length is not None and request.content_length > max_file_size:
+                return jsonify({'error': '文件过大'}), 413
+            if request.mimetype != 'multipart/form-data':
+                return jsonify({'error': '没有上传文件'}), 400
+            
+            upload = UploadStream(
+                request.stream,
+                max_size=max_file_size,
+                chunk_size=config.get_streaming_upload_config()['chunk_size'],
+                content_length=request.content_length
+            )
+            post_kwargs = {
+                'data': upload,
+                'headers': {'Content-Type': request.content_type}
+            }
+        else:
+            # 检查是否有文件上传
+            if 'file' not in request.files:
+                return jsonify({'error': '没有上传文件'}), 400
+            
+            file = request.files['file']
+            if file.filename == '':
+                return jsonify({'error': '文件名为空'}), 400
+            
+            # 准备转发到后端的请求
+            files = {'file': (file.filename, file.stream, file.content_type)}
+            
+            # 获取其他参数
+            data = {}
+            if 'tile_size' in request.form:
+                data['tile_size'] = request.form['tile_size']
+            if 'quality_level' in request.form:
+                data['quality_level'] = request.form['quality_level']
+            
+            post_kwargs = {'files': files, 'data': data}
         
-        response = requests.post(
-            full_url,
-            files=files,
-            data=data,
-            timeout=BACKEND_TIMEOUT
-        )
+        if not (enhance_dedup.enabled or enhance_failover.enabled):
+            return _dispatch_enhance(post_kwargs, upload)
         
-        # 返回后端响应
-        return jsonify(response.json()), response.status_code
+        # 缓存上传内容：转发失败时换服务器重新发送；相同图片和参数的任务正在处理或已完成时直接复用
+        try:
+            body, replay, digest = _spool_upload(post_kwargs, upload,
+                                                 config.get_streaming_upload_config()['spool_memory'],
+                                                 with_digest=enhance_dedup.enabled)
+        except UploadTooLargeError:
+            return jsonify({'error': '文件过大'}), 413
+        return _enhance_spooled(post_kwargs, body, replay, digest)
         
     except requests.exceptions.Timeout:
         logger.error("请求超时")
@@ -112,8 +457,20 @@ def get_task_status(task_id):
     try:
         logger.info(f"查询任务状态: {task_id}")
         
-        # 使用config.get_backend_url()自动处理负载均衡
-        backend_url = config.get_backend_url()
+        # 已完成且结果已缓存的任务直接应答
+        completed = enhance_dedup.completed_status(task_id)
+        if completed is not None:
+            return jsonify(completed), 200
+        
+        # 排队任务号：仍在排队时返回排队位置，已分配时换成GPU服务器的任务号
+        backend_task_id, queue_status = fair_scheduler.resolve(task_id)
+        if queue_status is not None:
+            if queue_status.get('status') == 'failed':
+                enhance_dedup.forget(task_id)
+            return jsonify(queue_status), 200
+        
+        # 优先路由到处理该任务的GPU服务器，未命中时回退到负载均衡
+        backend_url = task_router.get_backend_url(backend_task_id)
         if not backend_url:
             logger.error("没有可用的后端服务器")
             return jsonify({'error': '服务暂时不可用，请稍后重试'}), 503
@@ -121,13 +478,37 @@ def get_task_status(task_id):
         logger.info(f"使用后端地址: {backend_url}")
         
         # 转发请求到后端
-        full_url = urljoin(backend_url, f'/api/v1/status/{task_id}')
+        full_url = urljoin(backend_url, f'/api/v1/status/{backend_task_id}')
         logger.info(f"转发请求到: {full_url}")
         
-        response = requests.get(full_url, timeout=30)
+        started = time.time()
+        try:
+            response = backend_manager.get_session(backend_url).get(full_url, timeout=30)
+        except requests.exceptions.RequestException:
+            backend_manager.report_result(backend_url)
+            metrics.observe_upstream(backend_url, 'status', time.time() - started, None)
+            raise
+        elapsed = time.time() - started
+        backend_manager.report_result(backend_url, response.status_code, elapsed)
+        metrics.observe_upstream(backend_url, 'status', elapsed, response.status_code)
+        
+        # 任务结束后从该服务器的未完成任务中移除
+        result = response.json()
+        if isinstance(result, dict):
+            finished = result.get('status') in TASK_FINISHED_STATUSES
+            job_seconds = None
+            if finished:
+                job_seconds = backend_manager.finish_job(backend_url, backend_task_id)
+                fair_scheduler.notify()
+            if backend_task_id != task_id and 'task_id' in result:
+                result['task_id'] = task_id
+            if finished:
+                enhance_dedup.task_finished(task_id, result, job_seconds)
+        if response.status_code == 404:
+            enhance_dedup.forget(task_id)
         
         # 返回后端响应
-        return jsonify(response.json()), response.status_code
+        return jsonify(result), response.status_code
         
     except requests.exceptions.Timeout:
         logger.error("请求超时")
@@ -139,16 +520,50 @@ def get_task_status(task_id):
         logger.error(f"查询状态时出错: {str(e)}")
         return jsonify({'error': '服务器内部错误'}), 500
 
+def _result_content_length(headers):
+    """结果的字节数；后端压缩传输时未知"""
+    if headers.get('Content-Encoding') or not headers.get('Content-Length'):
+        return None
+    return int(headers['Content-Length'])
+
+def _cached_result_response(entry, task_id):
+    """
+    从结果缓存发送：配置了X-Accel-Redirect时由nginx发送文件，否则由网关发送
+    文件已被其他worker淘汰时返回None
+    """
+    download_name = f'enhanced_{task_id}.jpg'
+    if result_cache.accel_redirect_prefix:
+        response = app.response_class(mimetype=entry.content_type)
+        response.headers['X-Accel-Redirect'] = result_cache.accel_redirect_path(entry)
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        return response
+    try:
+        return send_file(entry.path, mimetype=entry.content_type, as_attachment=True, download_name=download_name)
+    except FileNotFoundError:
+        result_cache.discard(entry.key)
+        return None
+
 @app.route('/api/v1/download/<task_id>', methods=['GET'])
 def download_result(task_id):
     """
     下载处理结果API - 支持多GPU服务器负载均衡
+    下载过的结果缓存在本地磁盘，再次下载时不请求GPU服务器
     """
     try:
         logger.info(f"下载任务结果: {task_id}")
         
-        # 使用config.get_backend_url()自动处理负载均衡
-        backend_url = config.get_backend_url()
+        cached = result_cache.get(task_id)
+        if cached is not None:
+            response = _cached_result_response(cached, task_id)
+            if response is not None:
+                return response
+        
+        backend_task_id, queue_status = fair_scheduler.resolve(task_id)
+        if queue_status is not None:
+            return jsonify(dict(queue_status, error=queue_status.get('error') or '任务尚未完成')), 404
+        
+        # 优先路由到处理该任务的GPU服务器，未命中时回退到负载均衡
+        backend_url = task_router.get_backend_url(backend_task_id)
         if not backend_url:
             logger.error("没有可用的后端服务器")
             return jsonify({'error': '服务暂时不可用，请稍后重试'}), 503
@@ -156,19 +571,40 @@ def download_result(task_id):
         logger.info(f"使用后端地址: {backend_url}")
         
         # 转发请求到后端
-        full_url = urljoin(backend_url, f'/api/v1/download/{task_id}')
+        full_url = urljoin(backend_url, f'/api/v1/download/{backend_task_id}')
         logger.info(f"转发请求到: {full_url}")
         
-        response = requests.get(full_url, timeout=60, stream=True)
+        started = time.time()
+        try:
+            response = backend_manager.get_session(backend_url).get(full_url, timeout=60, stream=True)
+        except requests.exceptions.RequestException:
+            backend_manager.report_result(backend_url)
+            metrics.observe_upstream(backend_url, 'download', time.time() - started, None)
+            raise
+        backend_manager.report_result(backend_url, response.status_code)
+        # 结果以流的方式转发，耗时为收到响应头的时间，字节数取自Content-Length
+        metrics.observe_upstream(backend_url, 'download', time.time() - started, response.status_code,
+                                 received=int(response.headers.get('Content-Length') or 0))
         
         if response.status_code == 200:
-            # 直接返回文件流
-            return send_file(
-                response.raw,
-                mimetype=response.headers.get('content-type', 'application/octet-stream'),
-                as_attachment=True,
-                download_name=f'enhanced_{task_id}.jpg'
-            )
+            backend_manager.finish_job(backend_url, backend_task_id)
+            fair_scheduler.notify()
+            
+            # 边转发文件流边写入结果缓存
+            content_type = response.headers.get('content-type', 'application/octet-stream')
+            content_length = _result_content_length(response.headers)
+            
+            def stream():
+                try:
+                    yield from result_cache.tee(task_id, response.iter_content(64 * 1024), content_type, content_length)
+                finally:
+                    response.close()
+            
+            result = app.response_class(stream(), mimetype=content_type)
+            result.headers.set('Content-Disposition', 'attachment', filename=f'enhanced_{task_id}.jpg')
+            if content_length is not None:
+                result.headers['Content-Length'] = str(content_length)
+            return result
         else:
             return jsonify(response.json()), response.status_code
         
@@ -182,52 +618,30 @@ def download_result(task_id):
         logger.error(f"下载时出错: {str(e)}")
         return jsonify({'error': '服务器内部错误'}), 500
 
-@app.route('/api/v1/health', methods=['GET'])
-def health_check():
-    """
-    健康检查接口
-    """
-    try:
-        # 检查后端服务是否可用
-        backend_url = config.get_backend_url()
-        if backend_url:
-            full_url = urljoin(backend_url, '/health')
-            response = requests.get(full_url, timeout=5)
-            
-            return jsonify({
-                'status': 'healthy',
-                'backend_status': 'connected',
-                'backend_url': backend_url,
-                'backend_response': response.status_code,
-                'timestamp': time.time()
-            }), 200
-        else:
-            return jsonify({
-                'status': 'healthy',
-                'backend_status': 'no_servers',
-                'backend_url': None,
-                'message': '没有可用的后端服务器',
-                'gateway_status': 'running',
-                'timestamp': time.time()
-            }), 200
-        
-    except Exception as e:
-        # 即使后端不可用，网关本身仍然健康
-        return jsonify({
-            'status': 'healthy',
-            'backend_status': 'disconnected',
-            'backend_url': config.get_backend_url(),
-            'backend_error': str(e),
-            'gateway_status': 'running',
-            'timestamp': time.time()
-        }), 200
+def _health_content():
+    """健康检查内容：后端状态来自健康检测维护的注册表，不请求后端"""
+    backend_url = config.peek_backend_url()
+    if not config.is_multi_backend_enabled():
+        backend_status = 'configured' if backend_url else 'no_servers'
+        servers = None
+    else:
+        available = backend_manager.servers.available()
+        backend_status = 'connected' if available else 'no_servers'
+        servers = {'total': len(backend_manager.servers), 'available': len(available)}
+    content = {
+        'status': 'healthy',
+        'backend_status': backend_status,
+        'backend_url': backend_url,
+        'backend_servers': servers,
+        'gateway_status': 'running'
+    }
+    if backend_status == 'no_servers':
+        content['message'] = '没有可用的后端服务器'
+    return content
 
-@app.route('/api/v1/info', methods=['GET'])
-def api_info():
-    """
-    API信息接口
-    """
-    return jsonify({
+def _info_content():
+    """API信息内容"""
+    return {
         'name': 'PhotoEnhance API Gateway',
         'version': '1.0.0',
         'description': '为微信小程序提供HTTPS API接口，支持多GPU服务器负载均衡',
@@ -254,15 +668,78 @@ def api_info():
                 'servers': '/webhook/servers'
             }
         },
-        'config_info': config.get_config_info()
-    })
+        'config_info': config.get_config_info(live=False)
+    }
+
+def _config_content():
+    """配置信息内容（服务器部分只含状态变化时才会改变的字段，实时统计见 /api/v1/config?live=1）"""
+    return config.get_config_info(live=False)
+
+status_snapshots.register('health', _health_content)
+status_snapshots.register('info', _info_content)
+status_snapshots.register('config', _config_content)
+
+def _snapshot_response(name):
+    """返回状态快照，If-None-Match与ETag相同时返回304"""
+    snapshot = status_snapshots.get(name)
+    headers = {'ETag': f'"{snapshot.etag}"', 'Cache-Control': 'no-cache'}
+    not_modified = request.if_none_match.contains_weak(snapshot.etag)
+    status_snapshots.record(not_modified)
+    if not_modified:
+        return app.response_class(status=304, headers=headers)
+    return app.response_class(snapshot.body, mimetype='application/json', headers=headers)
+
+@app.route('/api/v1/health', methods=['GET'])
+def health_check():
+    """
+    健康检查接口
+    返回健康检测维护的状态快照，不请求后端，也不影响负载均衡
+    """
+    return _snapshot_response('health')
+
+@app.route('/api/v1/info', methods=['GET'])
+def api_info():
+    """
+    API信息接口
+    """
+    return _snapshot_response('info')
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    运行指标接口（Prometheus文本格式），只允许 metrics.allow_ips 中的地址访问
+    """
+    if not metrics.enabled:
+        return jsonify({'error': '运行指标未启用'}), 404
+    # 客户端IP只在连接来自受信任的代理时取自请求头，直接连接伪造X-Real-IP无效
+    if metrics.allow_ips and _client_ip() not in metrics.allow_ips:
+        return jsonify({'error': '禁止访问'}), 403
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/api/v1/config', methods=['GET'])
 def get_config():
     """
     获取配置信息接口
+    默认返回状态快照；live=1时返回实时统计（负载、连接池和各模块的计数，部分需要查询SQLite）
     """
-    return jsonify(config.get_config_info())
+    if request.args.get('live') not in ('1', 'true'):
+        return _snapshot_response('config')
+    
+    config_info = config.get_config_info()
+    config_info['task_affinity'] = task_router.get_stats()
+    config_info['notify_dedup'] = notify_dedup.get_stats()
+    config_info['payment_query'] = payment_query_cache.get_stats()
+    config_info['order_reconciler'] = order_reconciler.get_stats()
+    config_info['auth_session'] = session_store.get_stats()
+    config_info['fair_queue'] = fair_scheduler.get_stats()
+    config_info['rate_limit'] = rate_limiter.get_stats()
+    config_info['status_snapshot'] = status_snapshots.get_stats()
+    config_info['metrics'] = metrics.get_stats()
+    config_info['result_cache'] = result_cache.get_stats()
+    config_info['enhance_dedup'] = enhance_dedup.get_stats()
+    config_info['enhance_failover'] = enhance_failover.get_stats()
+    config_info['wechat_connection_pool'] = wechat_session.stats.to_dict()
+    return jsonify(config_info)
 
 @app.route('/api/v1/config/backend', methods=['POST'])
 def update_backend_config():
@@ -355,15 +832,20 @@ def get_openid():
             }), 400
         
         code = data['code']
-        result = wechat_auth.get_openid(code)
+        # 登录成功后保存会话；同一个code的重复提交共享一次微信请求并返回同一个令牌
+        result = session_store.login(code, wechat_auth.get_openid)
         
         if result['success']:
+            session_data = {
+                'openid': result['data']['openid'],
+                'token': result['data']['token'],
+                'expires_in': result['data']['expires_in']
+            }
+            if session_store.expose_session_key:
+                session_data['session_key'] = result['data']['session_key']
             return jsonify({
                 'success': True,
-                'data': {
-                    'openid': result['data']['openid'],
-                    'session_key': result['data']['session_key']
-                }
+                'data': session_data
             })
         else:
             return jsonify({
@@ -378,6 +860,18 @@ def get_openid():
             'error': '服务器内部错误'
         }), 500
 
+@app.route('/api/wechat/auth/logout', methods=['POST'])
+def logout():
+    """注销登录令牌"""
+    token = _request_token()
+    if not token:
+        return jsonify({
+            'success': False,
+            'error': '缺少登录令牌'
+        }), 400
+    session_store.revoke(token)
+    return jsonify({'success': True})
+
 # ==================== 微信支付相关API ====================
 
 @app.route('/api/wechat/pay/create', methods=['POST'])
@@ -386,8 +880,15 @@ def create_payment():
     try:
         data = request.get_json()
         
+        # 确认用户身份（携带令牌时可以不传openid）
+        openid, error = authenticate_request(data.get('openid'))
+        if error:
+            return error
+        
         # 验证必要参数
-        required_fields = ['openid', 'total_fee', 'body']
+        required_fields = ['total_fee', 'body']
+        if not openid:
+            required_fields.insert(0, 'openid')
         for field in required_fields:
             if field not in data:
                 return jsonify({
@@ -395,7 +896,6 @@ def create_payment():
                     'error': f'缺少必要参数: {field}'
                 }), 400
         
-        openid = data['openid']
         total_fee = int(data['total_fee'])  # 单位：分
         body = data['body']
         attach = data.get('attach', '')
@@ -410,8 +910,8 @@ def create_payment():
         # 创建本地订单
         order = order_manager.create_order(openid, total_fee, body, attach)
         
-        # 调用微信支付API创建订单
-        result = pay_api.create_order(openid, total_fee, body, attach)
+        # 调用微信支付API创建订单（使用本地订单号，回调和查询都按该订单号对应）
+        result = pay_api.create_order(openid, total_fee, body, attach, out_trade_no=order['out_trade_no'])
         
         if result['success']:
             # 更新本地订单的prepay_id
@@ -446,8 +946,12 @@ def create_payment():
 def payment_notify():
     """支付回调通知"""
     try:
-        # 获取回调数据
-        xml_data = request.get_data(as_text=True)
+        # 获取回调数据；与已处理成功的回调完全相同时直接应答，不再解析和验签
+        raw_data = request.get_data()
+        if notify_dedup.seen_body(raw_data):
+            logger.debug("重复的支付回调，已处理过")
+            return NOTIFY_SUCCESS_XML
+        xml_data = raw_data.decode('utf-8')
         logger.info(f"收到支付回调: {xml_data}")
         
         # 解析XML数据
@@ -455,7 +959,7 @@ def payment_notify():
         
         # 验证签名
         sign = callback_data.pop('sign', '')
-        if not WeChatPayUtils.verify_sign(callback_data, sign, WeChatPayConfig.API_KEY):
+        if not pay_api.signer.verify(callback_data, sign):
             logger.error("支付回调签名验证失败")
             return WeChatPayUtils.dict_to_xml({
                 'return_code': 'FAIL',
@@ -468,19 +972,22 @@ def payment_notify():
             transaction_id = callback_data.get('transaction_id')
             time_end = callback_data.get('time_end')
             
+            # 同一笔支付已处理过（重发的通知内容不同），不再更新订单
+            if notify_dedup.is_settled(out_trade_no, transaction_id):
+                notify_dedup.remember(raw_data, out_trade_no, transaction_id)
+                return NOTIFY_SUCCESS_XML
+            
             # 更新订单状态
             if order_manager.mark_order_paid(out_trade_no, transaction_id, time_end):
                 logger.info(f"订单支付成功: {out_trade_no}")
+                notify_dedup.remember(raw_data, out_trade_no, transaction_id)
                 
                 # 这里可以添加业务逻辑，比如：
                 # - 发送支付成功通知
                 # - 更新用户权益
                 # - 记录支付日志
                 
-                return WeChatPayUtils.dict_to_xml({
-                    'return_code': 'SUCCESS',
-                    'return_msg': 'OK'
-                })
+                return NOTIFY_SUCCESS_XML
             else:
                 logger.error(f"更新订单状态失败: {out_trade_no}")
                 return WeChatPayUtils.dict_to_xml({
@@ -513,6 +1020,10 @@ def query_payment(out_trade_no):
                 'error': '订单不存在'
             }), 404
         
+        _, error = authenticate_request(local_order['openid'])
+        if error:
+            return error
+        
         # 如果本地订单已支付，直接返回
         if local_order['status'] == WeChatPayConfig.ORDER_STATUS_PAID:
             return jsonify({
@@ -525,8 +1036,8 @@ def query_payment(out_trade_no):
                 }
             })
         
-        # 查询微信支付状态
-        result = pay_api.query_order(out_trade_no)
+        # 查询微信支付状态（并发查询合并，短时间内复用结果）
+        result = payment_query_cache.query(out_trade_no, pay_api.query_order)
         
         if result['success']:
             trade_state = result['data']['trade_state']
@@ -560,9 +1071,23 @@ def query_payment(out_trade_no):
 
 @app.route('/api/wechat/pay/orders/<openid>', methods=['GET'])
 def get_user_orders(openid):
-    """获取用户订单列表"""
+    """获取用户订单列表（可选分页：limit为每页数量，cursor为上一页返回的next_cursor）"""
     try:
-        orders = order_manager.get_orders_by_openid(openid)
+        _, error = authenticate_request(openid)
+        if error:
+            return error
+        
+        cursor = request.args.get('cursor')
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, MAX_ORDERS_PAGE_SIZE))
+        # 多取一条判断是否还有下一页
+        orders = order_manager.get_orders_by_openid(openid, cursor=cursor,
+                                                    limit=limit + 1 if limit else None)
+        next_cursor = None
+        if limit and len(orders) > limit:
+            orders = orders[:limit]
+            next_cursor = orders[-1]['out_trade_no']
         
         # 只返回必要信息，不包含敏感数据
         safe_orders = []
@@ -578,7 +1103,8 @@ def get_user_orders(openid):
         
         return jsonify({
             'success': True,
-            'data': safe_orders
+            'data': safe_orders,
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步API网关（ASGI）
+/api/v1/enhance、/api/v1/status/<task_id>、/api/v1/download/<task_id> 在事件循环上异步转发，
+等待GPU处理期间不占用工作线程；其余接口（配置、微信登录/支付、webhook）仍由Flask应用处理。
+启用公平排队、去重或失败转移时，上传内容在事件循环上读取并缓存（同时计算去重摘要），
+读完后在线程池中复用Flask应用的去重、排队和失败转移逻辑转发，慢速上传的客户端不占用线程
+
+启动:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+from urllib.parse import urljoin
+
+import aiohttp
+import requests
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from werkzeug.http import parse_options_header
+
+from app import app as flask_app, BACKEND_TIMEOUT, _enhance_spooled
+from backend_manager import backend_manager, TASK_FINISHED_STATUSES
+from client_ip import client_ip_resolver
+from config import config
+from enhance_dedup import enhance_dedup, UploadDigest
+from enhance_failover import enhance_failover
+from fair_scheduler import fair_scheduler, QueueFullError
+from metrics import metrics
+from rate_limiter import rate_limiter
+from result_cache import result_cache
+from session_store import session_store
+from task_router import task_router
+from upload_stream import AsyncUploadStream, SpooledBody, UploadTooLargeError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBackendPools:
+    """每个后端地址一个aiohttp异步连接池"""
+
+    def __init__(self):
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    def get_session(self, url: str) -> aiohttp.ClientSession:
+        """获取后端地址对应的异步会话"""
+        session = self._sessions.get(url)
+        if session is None or session.closed:
+            self._prune()
+            # 不限制并发连接数，让长时间等待的请求都能同时挂在事件循环上，空闲连接30秒后回收
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=0, keepalive_timeout=30)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[url] = session
+        return session
+
+    def _prune(self):
+        """关闭已下线服务器的连接池"""
+        active_urls = set(backend_manager.get_server_urls())
+        active_urls.add(config.config.get("backend_api_base"))
+        for url in [u for u in self._sessions if u not in active_urls]:
+            session = self._sessions.pop(url)
+            asyncio.get_running_loop().create_task(session.close())
+
+    async def aclose(self):
+        """关闭所有连接池"""
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            await session.close()
+
+
+async_pools = AsyncBackendPools()
+
+
+async def _release_response(response: aiohttp.ClientResponse):
+    """文件流发送完毕后把连接归还连接池"""
+    response.release()
+
+
+def _client_ip(request) -> str:
+    """客户端IP（来自受信任的代理时取nginx传入的请求头）"""
+    header = client_ip_resolver.header
+    return client_ip_resolver.resolve(request.client.host if request.client else None,
+                                      request.headers.get(header) if header else None)
+
+
+async def _session_openid(request):
+    """请求携带的登录令牌对应的openid，未登录返回None（会话在SQLite中，在线程池中查找）"""
+    auth = request.headers.get('authorization', '')
+    if auth[:7].lower() != 'bearer ':
+        return None
+    session = await run_in_threadpool(session_store.get, auth[7:].strip())
+    return session.openid if session is not None else None
+
+
+async def _task_backend_url(task_id: str):
+    """处理该任务的后端地址；共享路由表在SQLite中，在线程池中查找"""
+    if task_router.shared:
+        return await run_in_threadpool(task_router.get_backend_url, task_id)
+    return task_router.get_backend_url(task_id)
+
+
+async def _rate_limited(request, endpoint: str):
+    """接口限流，超限时返回429响应"""
+    client_ip = _client_ip(request)
+    # 只有openid规则需要查找会话，在调用check之前查好
+    openid = await _session_openid(request) if rate_limiter.uses_openid(endpoint) else None
+    limited = rate_limiter.check(endpoint, client_ip, lambda: openid)
+    if limited is None:
+        return None
+    logger.warning(f"请求限流({limited['rule']}): {client_ip} {request.url.path}")
+    return JSONResponse({'error': '请求过于频繁，请稍后重试'}, status_code=429,
+                        headers={'Retry-After': str(max(math.ceil(limited['retry_after']), 1))})
+
+
+async def _spool_upload(request, max_size: int, max_memory: int, with_digest: bool):
+    """
+    在事件循环上读取并缓存整个上传内容（超过max_memory写入临时文件），with_digest时同时计算去重摘要
+    返回 (缓存的请求体, 去重摘要)，无法计算摘要时为None
+    """
+    body = SpooledBody(max_memory)
+    digest = None
+    if with_digest:
+        boundary = parse_options_header(request.headers['content-type'])[1].get('boundary', '')
+        digest = UploadDigest(boundary.encode('latin-1') if boundary else None)
+    try:
+        async for chunk in AsyncUploadStream(request.stream(), max_size=max_size):
+            if digest is not None:
+                digest.feed(chunk)
+            body.write(chunk)
+        if digest is not None:
+            digest.close()
+        body.finish()
+    except BaseException:
+        body.close()
+        raise
+    return body, digest.hexdigest() if digest is not None else None
+
+
+async def _enhance_spooled_async(request, max_file_size: int):
+    """
+    启用公平排队、去重或失败转移时的上传：排队准入检查和缓存上传内容在事件循环上进行，
+    去重、选择服务器、转发或排队在线程池中调用Flask应用的同一套逻辑
+    """
+    user = None
+    if fair_scheduler.active:
+        user = fair_scheduler.user_key(_client_ip(request), await _session_openid(request))
+        # 已有排队任务时新请求必然排队，超出排队上限时在读取上传内容之前拒绝
+        try:
+            fair_scheduler.check_admission(user)
+        except QueueFullError as e:
+            return JSONResponse({'error': str(e)}, status_code=429, headers={'Retry-After': str(e.retry_after)})
+
+    try:
+        body, digest = await _spool_upload(request, max_file_size,
+                                           config.get_streaming_upload_config()['spool_memory'],
+                                           with_digest=enhance_dedup.enabled)
+    except UploadTooLargeError:
+        return JSONResponse({'error': '文件过大'}, status_code=413)
+    chunk_size = config.get_streaming_upload_config()['chunk_size']
+    headers = {'Content-Type': request.headers['content-type']}
+
+    def replay():
+        # 带len属性的流，requests按Content-Length分块发送
+        return {'data': body.open(chunk_size), 'headers': headers}
+
+    try:
+        result = await run_in_threadpool(_enhance_spooled, None, body, replay, digest, user)
+    except requests.exceptions.Timeout:
+        logger.error("请求超时")
+        return JSONResponse({'error': '请求超时，请稍后重试'}, status_code=408)
+    except requests.exceptions.ConnectionError:
+        logger.error("连接后端服务失败")
+        return JSONResponse({'error': '服务暂时不可用'}, status_code=503)
+    payload, status_code = result[0], result[1]
+    return JSONResponse(payload, status_code=status_code, headers=result[2] if len(result) > 2 else None)
+
+
+async def enhance_image(request):
+    """
+    图片增强API - 异步流式转发
+    启用公平排队、去重或失败转移时先缓存上传内容，再在线程池中转发或排队
+    """
+    limited = await _rate_limited(request, 'enhance_image')
+    if limited is not None:
+        return limited
+    upload = None
+    try:
+        logger.info("收到图片增强请求")
+
+        max_file_size = config.get_max_file_size()
+        content_length = request.headers.get('content-length')
+        if content_length is not None and int(content_length) > max_file_size:
+            return JSONResponse({'error': '文件过大'}, status_code=413)
+        if not request.headers.get('content-type', '').startswith('multipart/form-data'):
+            return JSONResponse({'error': '没有上传文件'}, status_code=400)
+
+        if fair_scheduler.active or enhance_dedup.enabled or enhance_failover.enabled:
+            return await _enhance_spooled_async(request, max_file_size)
+
+        # 使用config.get_backend_url()自动处理负载均衡
+        backend_url = config.get_backend_url()
+        if not backend_url:
+            logger.error("没有可用的后端服务器")
+            return JSONResponse({'error': '服务暂时不可用，请稍后重试'}, status_code=503)
+
+        logger.info(f"使用后端地址: {backend_url}")
+
+        full_url = urljoin(backend_url, '/api/v1/enhance')
+        logger.info(f"转发请求到: {full_url}")
+
+        headers = {'Content-Type': request.headers['content-type']}
+        if content_length is not None:
+            headers['Content-Length'] = content_length
+
+        # 统计该服务器正在转发的请求数，供负载均衡策略使用
+        server = backend_manager.get_server_by_url(backend_url)
+        if server:
+            server.begin_request()
+        started = time.time()
+
+        upload = AsyncUploadStream(request.stream(), max_size=max_file_size)
+        try:
+            async with async_pools.get_session(backend_url).post(
+                full_url,
+                data=upload,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=BACKEND_TIMEOUT)
+            ) as response:
+                result = await response.json(content_type=None)
+                status_code = response.status
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            backend_manager.report_result(backend_url, 413 if upload.exceeded else None)
+            if not upload.exceeded:
+                metrics.observe_upstream(backend_url, 'enhance', time.time() - started, None)
+            raise
+        finally:
+            if server:
+                server.end_request()
+        backend_manager.report_result(backend_url, status_code)
+        metrics.observe_upstream(backend_url, 'enhance', time.time() - started, status_code, sent=upload.bytes_read)
+
+        # 记录任务所属的GPU服务器，后续status/download直接路由过去
+        if isinstance(result, dict) and result.get('task_id'):
+            if task_router.shared:
+                await run_in_threadpool(task_router.bind, result['task_id'], backend_url)
+            else:
+                task_router.bind(result['task_id'], backend_url)
+            if server:
+                server.track_job(result['task_id'], started)
+
+        return JSONResponse(result, status_code=status_code)
+
+    except asyncio.TimeoutError:
+        logger.error("请求超时")
+        return JSONResponse({'error': '请求超时，请稍后重试'}, status_code=408)
+    except Exception as e:
+        # 超出大小限制时上传被中止，aiohttp可能把异常包装成连接错误
+        if upload is not None and upload.exceeded:
+            return JSONResponse({'error': '文件过大'}, status_code=413)
+        if isinstance(e, aiohttp.ClientConnectionError):
+            logger.error("连接后端服务失败")
+            return JSONResponse({'error': '服务暂时不可用'}, status_code=503)
+        logger.error(f"处理请求时出错: {str(e)}")
+        return JSONResponse({'error': '服务器内部错误'}, status_code=500)
+
+
+async def get_task_status(request):
+    """
+    查询任务状态API - 异步转发
+    """
+    limited = await _rate_limited(request, 'get_task_status')
+    if limited is not None:
+        return limited
+    task_id = request.path_params['task_id']
+    try:
+        logger.info(f"查询任务状态: {task_id}")
+
+        # 已完成且结果已缓存的任务直接应答（去重索引和排队任务号在SQLite中，在线程池中查询）
+        completed = await run_in_threadpool(enhance_dedup.completed_status, task_id)
+        if completed is not None:
+            return JSONResponse(completed)
+
+        # 排队任务号：仍在排队时返回排队位置，已分配时换成GPU服务器的任务号
+        backend_task_id, queue_status = await run_in_threadpool(fair_scheduler.resolve, task_id)
+        if queue_status is not None:
+            if queue_status.get('status') == 'failed':
+                await run_in_threadpool(enhance_dedup.forget, task_id)
+            return JSONResponse(queue_status)
+
+        # 优先路由到处理该任务的GPU服务器，未命中时回退到负载均衡
+        backend_url = await _task_backend_url(backend_task_id)
+        if not backend_url:
+            logger.error("没有可用的后端服务器")
+            return JSONResponse({'error': '服务暂时不可用，请稍后重试'}, status_code=503)
+
+        full_url = urljoin(backend_url, f'/api/v1/status/{backend_task_id}')
+        started = time.time()
+        try:
+            async with async_pools.get_session(backend_url).get(
+                full_url, timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                result = await response.json(content_type=None)
+                status_code = response.status
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+            backend_manager.report_result(backend_url)
+            metrics.observe_upstream(backend_url, 'status', time.time() - started, None)
+            raise
+        elapsed = time.time() - started
+        backend_manager.report_result(backend_url, status_code, elapsed)
+        metrics.observe_upstream(backend_url, 'status', elapsed, status_code)
+
+        # 任务结束后从该服务器的未完成任务中移除
+        if isinstance(result, dict):
+            finished = result.get('status') in TASK_FINISHED_STATUSES
+            job_seconds = None
+            if finished:
+                job_seconds = backend_manager.finish_job(backend_url, backend_task_id)
+                fair_scheduler.notify()
+            if backend_task_id != task_id and 'task_id' in result:
+                result['task_id'] = task_id
+            if finished:
+                await run_in_threadpool(enhance_dedup.task_finished, task_id, result, job_seconds)
+        if status_code == 404:
+            await run_in_threadpool(enhance_dedup.forget, task_id)
+
+        return JSONResponse(result, status_code=status_code)
+
+    except asyncio.TimeoutError:
+        logger.error("请求超时")
+        return JSONResponse({'error': '请求超时'}, status_code=408)
+    except aiohttp.ClientConnectionError:
+        logger.error("连接后端服务失败")
+        return JSONResponse({'error': '服务暂时不可用'}, status_code=503)
+    except Exception as e:
+        logger.error(f"查询状态时出错: {str(e)}")
+        return JSONResponse({'error': '服务器内部错误'}, status_code=500)
+
+
+async def _cached_result_response(entry, task_id: str):
+    """从结果缓存发送，文件已被其他worker淘汰时返回None"""
+    download_name = f'enhanced_{task_id}.jpg'
+    if result_cache.accel_redirect_prefix:
+        return Response(media_type=entry.content_type, headers={
+            'X-Accel-Redirect': result_cache.accel_redirect_path(entry),
+            'Content-Disposition': f'attachment; filename="{download_name}"'
+        })
+    if not os.path.exists(entry.path):
+        await run_in_threadpool(result_cache.discard, entry.key)
+        return None
+    return FileResponse(entry.path, media_type=entry.content_type, filename=download_name)
+
+
+async def download_result(request):
+    """
+    下载处理结果API - 异步流式转发
+    下载过的结果缓存在本地磁盘，再次下载时不请求GPU服务器
+    """
+    limited = await _rate_limited(request, 'download_result')
+    if limited is not None:
+        return limited
+    task_id = request.path_params['task_id']
+    try:
+        logger.info(f"下载任务结果: {task_id}")
+
+        # 结果缓存的索引在SQLite中，在线程池中查询
+        cached = await run_in_threadpool(result_cache.get, task_id)
+        if cached is not None:
+            response = await _cached_result_response(cached, task_id)
+            if response is not None:
+                return response
+
+        backend_task_id, queue_status = await run_in_threadpool(fair_scheduler.resolve, task_id)
+        if queue_status is not None:
+            return JSONResponse(dict(queue_status, error=queue_status.get('error') or '任务尚未完成'),
+                                status_code=404)
+
+        # 优先路由到处理该任务的GPU服务器，未命中时回退到负载均衡
+        backend_url = await _task_backend_url(backend_task_id)
+        if not backend_url:
+            logger.error("没有可用的后端服务器")
+            return JSONResponse({'error': '服务暂时不可用，请稍后重试'}, status_code=503)
+
+        full_url = urljoin(backend_url, f'/api/v1/download/{backend_task_id}')
+        started = time.time()
+        try:
+            response = await async_pools.get_session(backend_url).get(
+                full_url, timeout=aiohttp.ClientTimeout(total=60)
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+            backend_manager.report_result(backend_url)
+            metrics.observe_upstream(backend_url, 'download', time.time() - started, None)
+            raise
+        backend_manager.report_result(backend_url, response.status)
+        metrics.observe_upstream(backend_url, 'download', time.time() - started, response.status,
+                                 received=response.content_length or 0)
+
+        if response.status == 200:
+            backend_manager.finish_job(backend_url, backend_task_id)
+            fair_scheduler.notify()
+
+            # 边转发文件流边写入结果缓存
+            content_type = response.headers.get('content-type', 'application/octet-stream')
+            content_length = None if response.headers.get('Content-Encoding') else response.content_length
+            headers = {'Content-Disposition': f'attachment; filename=enhanced_{task_id}.jpg'}
+            if content_length is not None:
+                headers['Content-Length'] = str(content_length)
+            return StreamingResponse(
+                result_cache.atee(task_id, response.content.iter_chunked(64 * 1024), content_type, content_length),
+                media_type=content_type,
+                headers=headers,
+                background=BackgroundTask(_release_response, response)
+            )
+
+        async with response:
+            return JSONResponse(await response.json(content_type=None), status_code=response.status)
+
+    except asyncio.TimeoutError:
+        logger.error("下载超时")
+        return JSONResponse({'error': '下载超时'}, status_code=408)
+    except aiohttp.ClientConnectionError:
+        logger.error("连接后端服务失败")
+        return JSONResponse({'error': '服务暂时不可用'}, status_code=503)
+    except Exception as e:
+        logger.error(f"下载时出错: {str(e)}")
+        return JSONResponse({'error': '服务器内部错误'}, status_code=500)
+
+
+def _with_metrics(endpoint: str, handler):
+    """异步接口的请求指标，route标签与Flask接口相同"""
+    async def wrapper(request):
+        if not metrics.enabled:
+            return await handler(request)
+        started = time.perf_counter()
+        metrics.request_started(endpoint)
+        status_code = 500
+        try:
+            response = await handler(request)
+            status_code = response.status_code
+            return response
+        finally:
+            metrics.request_finished(endpoint, request.method, status_code, time.perf_counter() - started)
+    return wrapper
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await async_pools.aclose()
+
+
+def create_app() -> Starlette:
+    """创建ASGI应用：代理接口异步处理，其余请求交给Flask"""
+    routes = [
+        Route('/api/v1/status/{task_id}', _with_metrics('get_task_status', get_task_status), methods=['GET']),
+        Route('/api/v1/download/{task_id}', _with_metrics('download_result', download_result), methods=['GET']),
+    ]
+    # 异步模式下上传只能流式转发；关闭流式转发时由Flask按原方式缓冲转发。
+    # 启用公平排队、去重或失败转移时上传内容同样在事件循环上读取缓存，之后在线程池中转发
+    if config.is_streaming_upload_enabled():
+        routes.insert(0, Route('/api/v1/enhance', _with_metrics('enhance_image', enhance_image), methods=['POST']))
+    routes.append(Mount('/', app=WSGIMiddleware(flask_app)))
+
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    import uvicorn
+
+    logger.info("启动异步API网关服务...")
+
+    # 配置SSL证书路径
+    ssl_cert = '/etc/letsencrypt/live/www.gongjuxiang.work/fullchain.pem'
+    ssl_key = '/etc/letsencrypt/live/www.gongjuxiang.work/privkey.pem'
+
+    if os.path.exists(ssl_cert) and os.path.exists(ssl_key):
+        logger.info("使用SSL证书启动HTTPS服务")
+        uvicorn.run(app, host='0.0.0.0', port=8443, ssl_certfile=ssl_cert, ssl_keyfile=ssl_key)
+    else:
+        logger.warning("SSL证书不存在，使用HTTP服务（仅用于开发）")
+        uvicorn.run(app, host='0.0.0.0', port=5000)
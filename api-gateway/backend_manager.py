@@ -6,30 +6,140 @@
 """
 
 import os
+import atexit
 import json
 import logging
+import random
+import sqlite3
 import threading
 import time
-import requests
-from typing import Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Collection, Dict, Any, List, Optional
 from datetime import datetime
+from http_pool import PooledSession, create_backend_session
+from load_balancer import create_strategy
+from server_registry import ServerRegistry
+from shared_state import SharedBackendState
+from metrics import metrics
+from circuit_breaker import (CircuitBreaker, create_circuit_breaker, CLOSED, HALF_OPEN,
+                             FAILURE_CONNECT, FAILURE_5XX, FAILURE_LATENCY)
+from config import config
 
 logger = logging.getLogger(__name__)
 
 # 预设密码
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', 'gpu-server-register-to-api-gateway-2024')
 
+# GPU服务器返回的任务结束状态
+TASK_FINISHED_STATUSES = ('completed', 'failed')
+
 class BackendServer:
     """GPU服务器信息"""
-    def __init__(self, server_id: str, ip: str, port: int):
+    def __init__(self, server_id: str, ip: str, port: int, weight: int = 1):
         self.server_id = server_id
         self.ip = ip
         self.port = port
         self.url = f"http://{ip}:{port}"
+        self.weight = max(int(weight), 1)  # 声明的GPU算力权重
         self.is_healthy = True
         self.fail_count = 0
         self.last_check_time = datetime.now()
         self.last_used_time = datetime.now()
+        self.session = create_backend_session()  # 该服务器专用的长连接池
+        
+        # 负载统计
+        self._load_lock = threading.Lock()
+        self.active_requests = 0  # 正在转发中的请求数
+        self.jobs: Dict[str, float] = {}  # 已提交未完成的任务: task_id -> 提交时间
+        self.job_checked: Dict[str, float] = {}  # 网关自行查询过状态的任务: task_id -> 最近查询时间
+        self.ewma_latency = 0.0  # 任务耗时的指数加权移动平均（秒）
+        
+        # 健康检测调度
+        self.check_interval = 0.0  # 当前检测间隔（秒），由管理器自适应调整
+        self.next_check_at = 0.0  # 下次检测时间（time.monotonic），0表示立即检测
+        self.probe_running = False  # 是否有正在进行的检测
+        self.last_healthy_at = time.time()  # 最近一次检测成功的时间
+        
+        # 被动健康检测：根据真实转发请求的结果熔断
+        self.breaker: CircuitBreaker = create_circuit_breaker()
+    
+    @property
+    def is_available(self) -> bool:
+        """是否可以分配新任务：主动检测健康且未被熔断"""
+        return self.is_healthy and self.breaker.is_available()
+    
+    @property
+    def in_flight(self) -> int:
+        """未完成的请求/任务数"""
+        return self.active_requests + len(self.jobs)
+    
+    def begin_request(self):
+        """开始转发一个请求"""
+        with self._load_lock:
+            self.active_requests += 1
+    
+    def end_request(self):
+        """请求转发结束"""
+        with self._load_lock:
+            self.active_requests = max(self.active_requests - 1, 0)
+    
+    def track_job(self, task_id: str, started: Optional[float] = None):
+        """记录已提交到该服务器的任务"""
+        with self._load_lock:
+            self.jobs[task_id] = started if started is not None else time.time()
+    
+    def finish_job(self, task_id: str, alpha: float, now: Optional[float] = None) -> Optional[float]:
+        """任务完成，用任务耗时更新EWMA；返回任务耗时，未记录该任务时返回None"""
+        with self._load_lock:
+            started = self.jobs.pop(task_id, None)
+            self.job_checked.pop(task_id, None)
+            if started is None:
+                return None
+            elapsed = (now if now is not None else time.time()) - started
+            if self.ewma_latency > 0:
+                self.ewma_latency = alpha * elapsed + (1 - alpha) * self.ewma_latency
+            else:
+                self.ewma_latency = elapsed
+            return elapsed
+    
+    def expire_jobs(self, timeout: float, now: Optional[float] = None):
+        """丢弃超时仍未看到完成状态的任务（客户端可能不再轮询）"""
+        deadline = (now if now is not None else time.time()) - timeout
+        with self._load_lock:
+            # jobs按提交时间顺序插入，只需从头检查
+            while self.jobs:
+                task_id, started = next(iter(self.jobs.items()))
+                if started > deadline:
+                    break
+                del self.jobs[task_id]
+                self.job_checked.pop(task_id, None)
+    
+    def discard_job(self, task_id: str):
+        """GPU服务器上已不存在的任务（如服务器重启），不计入任务耗时"""
+        with self._load_lock:
+            self.jobs.pop(task_id, None)
+            self.job_checked.pop(task_id, None)
+    
+    def jobs_to_check(self, after: float, interval: float, now: Optional[float] = None) -> List[str]:
+        """提交超过after秒、距上次查询超过interval秒的任务，返回前记录为已查询"""
+        now = now if now is not None else time.time()
+        due = []
+        with self._load_lock:
+            for task_id, started in self.jobs.items():
+                if now - started >= after and now - self.job_checked.get(task_id, 0.0) >= interval:
+                    self.job_checked[task_id] = now
+                    due.append(task_id)
+        return due
+    
+    def reset_session(self):
+        """关闭旧连接并重建连接池（服务器重新注册时调用）"""
+        old_session = self.session
+        self.session = create_backend_session()
+        old_session.close()
+    
+    def close(self):
+        """关闭连接池（服务器删除时调用）"""
+        self.session.close()
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -37,44 +147,196 @@ class BackendServer:
             "ip": self.ip,
             "port": self.port,
             "url": self.url,
+            "weight": self.weight,
             "is_healthy": self.is_healthy,
+            "circuit_state": self.breaker.state,
             "fail_count": self.fail_count,
             "last_check_time": self.last_check_time.isoformat(),
             "last_used_time": self.last_used_time.isoformat()
         }
 
+class HealthCheckStats:
+    """健康检测统计：每轮检测耗时、故障发现耗时"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sweeps = 0
+        self.sweep_time_total = 0.0
+        self.last_sweep_duration = 0.0
+        self.max_sweep_duration = 0.0
+        self.deadline_exceeded = 0  # 超过单轮截止时间仍未完成的检测数
+        self.probes = 0
+        self.probe_failures = 0
+        self.failures_detected = 0
+        self.detect_time_total = 0.0
+        self.last_detect_time = 0.0
+        self.max_detect_time = 0.0
+    
+    def record_sweep(self, duration: float):
+        with self._lock:
+            self.sweeps += 1
+            self.sweep_time_total += duration
+            self.last_sweep_duration = duration
+            self.max_sweep_duration = max(self.max_sweep_duration, duration)
+    
+    def record_deadline_exceeded(self, unfinished: int):
+        with self._lock:
+            self.deadline_exceeded += unfinished
+    
+    def record_probe(self, healthy: bool):
+        with self._lock:
+            self.probes += 1
+            if not healthy:
+                self.probe_failures += 1
+    
+    def record_failure_detected(self, detect_time: float):
+        """detect_time: 从最近一次检测成功到标记为不可用的时间"""
+        with self._lock:
+            self.failures_detected += 1
+            self.detect_time_total += detect_time
+            self.last_detect_time = detect_time
+            self.max_detect_time = max(self.max_detect_time, detect_time)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sweeps": self.sweeps,
+                "avg_sweep_duration": round(self.sweep_time_total / self.sweeps, 3) if self.sweeps else 0.0,
+                "last_sweep_duration": round(self.last_sweep_duration, 3),
+                "max_sweep_duration": round(self.max_sweep_duration, 3),
+                "deadline_exceeded": self.deadline_exceeded,
+                "probes": self.probes,
+                "probe_failures": self.probe_failures,
+                "failures_detected": self.failures_detected,
+                "avg_detect_time": round(self.detect_time_total / self.failures_detected, 3) if self.failures_detected else 0.0,
+                "last_detect_time": round(self.last_detect_time, 3),
+                "max_detect_time": round(self.max_detect_time, 3)
+            }
+
+class HealthSweep:
+    """一轮并行检测：最后一个检测完成时记录本轮耗时"""
+    
+    def __init__(self, probes: int, stats: HealthCheckStats):
+        self._lock = threading.Lock()
+        self.stats = stats
+        self.started = time.monotonic()
+        self.remaining = probes
+        self.finished = False
+        self.deadline_exceeded = False
+    
+    def probe_done(self):
+        with self._lock:
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+            self.finished = True
+        self.stats.record_sweep(time.monotonic() - self.started)
+    
+    def mark_deadline_exceeded(self):
+        with self._lock:
+            if self.finished or self.deadline_exceeded:
+                return
+            self.deadline_exceeded = True
+            remaining = self.remaining
+        self.stats.record_deadline_exceeded(remaining)
+
 class BackendManager:
     """后端服务器管理器"""
     
-    def __init__(self):
-        self.servers: Dict[str, BackendServer] = {}
-        self.current_index = 0
-        self.health_check_interval = 3  # 3秒检测间隔
-        self.max_fail_count = 1  # 1次失败后标记为不可用
-        self.auto_cleanup_threshold = 2  # 2次失败后自动删除服务器记录
+    def __init__(self, servers_file: Optional[str] = None):
+        self.servers_file = servers_file or os.getenv(
+            'BACKEND_SERVERS_FILE', os.path.join(os.path.dirname(__file__), "backend_servers.json"))
+        self.servers = ServerRegistry()  # 写时复制的服务器注册表，读取不加锁
         self.health_check_thread = None
         self.running = False
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        
+        # 健康检测：所有到期的服务器并行检测，间隔按服务器状态自适应
+        hc_config = config.get_health_check_config()
+        self.health_check_interval = hc_config["interval"]  # 基础检测间隔
+        self.min_check_interval = hc_config["min_interval"]  # 失败后的检测间隔
+        self.max_check_interval = hc_config["max_interval"]  # 稳定节点退避后的最大间隔
+        self.check_backoff_factor = hc_config["backoff_factor"]
+        self.check_jitter = hc_config["jitter"]
+        self.probe_timeout = hc_config["timeout"]
+        self.sweep_deadline = hc_config["sweep_deadline"]
+        self.probe_pool = ThreadPoolExecutor(max_workers=hc_config["max_workers"], thread_name_prefix="health-probe")
+        self.health_stats = HealthCheckStats()
+        self.max_fail_count = hc_config["fail_threshold"]  # 连续失败多少次后标记为不可用
+        self.auto_cleanup_threshold = hc_config["cleanup_threshold"]  # 连续失败多少次后自动删除服务器记录
+        
+        # 被动健康检测：转发请求失败时立即熔断，不等待下一次主动检测
+        od_config = config.get_outlier_detection_config()
+        self.outlier_detection_enabled = od_config["enabled"]
+        self.max_ejection_percent = od_config["max_ejection_percent"]
+        self.latency_factor = od_config["latency_factor"]
+        self.latency_min = od_config["latency_min"]
+        self.latency_min_samples = od_config["latency_min_samples"]
+        self._ejection_lock = threading.Lock()
+        self.default_session = create_backend_session()  # 非托管后端（如默认地址）使用的连接池
+        
+        # 负载均衡策略
+        lb_config = config.get_load_balancing_config()
+        self.strategy = create_strategy(lb_config["strategy"])
+        self.ewma_alpha = lb_config["ewma_alpha"]
+        self.job_timeout = lb_config["job_timeout"]
+        self.job_check_after = lb_config["job_check_after"]
+        self.job_check_interval = lb_config["job_check_interval"]
+        self.jobs_checked_finished = 0  # 由网关自行查询发现完成的任务数
+        self._reserve_lock = threading.Lock()
+        
+        # 多进程共享模式：服务器列表和健康状态保存在SQLite中，只有持有租约的进程做健康检测
+        ss_config = config.get_shared_state_config()
+        self.shared_state: Optional[SharedBackendState] = None
+        self.shared_version = -1
+        self.sync_interval = ss_config["sync_interval"]
+        self.is_prober = True
+        self.remote_in_flight: Dict[str, int] = {}  # 其他worker在各服务器上的未完成数（共享模式）
+        if ss_config["enabled"]:
+            path = ss_config["path"]
+            if not os.path.isabs(path):
+                path = os.path.join(os.path.dirname(__file__), path)
+            self.shared_state = SharedBackendState(path, lease_ttl=ss_config["lease_ttl"])
+            self.is_prober = False
+            atexit.register(self.shared_state.release_lease)
+            atexit.register(self.shared_state.clear_load)
         
         # 加载已保存的服务器列表
         self.load_servers()
         
+        # 启动共享状态同步（由同步线程竞争健康检测租约）
+        if self.shared_state:
+            threading.Thread(target=self.shared_sync_loop, daemon=True).start()
+        
         # 启动健康检测
         self.start_health_check()
     
     def load_servers(self):
         """加载服务器列表"""
         try:
-            config_file = os.path.join(os.path.dirname(__file__), "backend_servers.json")
-            if os.path.exists(config_file):
+            config_file = self.servers_file
+            if self.shared_state:
+                # 首次启用共享模式时导入已保存的服务器列表，之后以数据库为准
+                data = []
+                if os.path.exists(config_file):
+                    with open(config_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                if self.shared_state.import_servers(data):
+                    logger.info(f"已导入 {len(data)} 台GPU服务器到共享状态")
+                self.sync_from_shared()
+                logger.info(f"从共享状态加载了 {len(self.servers)} 台GPU服务器")
+            elif os.path.exists(config_file):
                 with open(config_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
                     for server_data in data:
                         server = BackendServer(
                             server_id=server_data['server_id'],
                             ip=server_data['ip'],
-                            port=server_data['port']
+                            port=server_data['port'],
+                            weight=server_data.get('weight', 1)
                         )
-                        self.servers[server.server_id] = server
+                        self.servers.put(server)
                 logger.info(f"加载了 {len(self.servers)} 台GPU服务器")
         except Exception as e:
             logger.error(f"加载服务器列表失败: {e}")
@@ -82,10 +344,14 @@ class BackendManager:
     def save_servers(self):
         """保存服务器列表"""
         try:
-            config_file = os.path.join(os.path.dirname(__file__), "backend_servers.json")
-            data = [server.to_dict() for server in self.servers.values()]
-            with open(config_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            config_file = self.servers_file
+            with self.servers.lock:
+                data = [server.to_dict() for server in self.servers.values()]
+                # 先写临时文件再替换，多个进程同时保存时文件也不会损坏
+                tmp_file = f"{config_file}.{os.getpid()}.tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=2, ensure_ascii=False)
+                os.replace(tmp_file, config_file)
             logger.info("服务器列表已保存")
         except Exception as e:
             logger.error(f"保存服务器列表失败: {e}")
@@ -104,7 +370,8 @@ class BackendManager:
                 return server_id
         raise Exception("服务器数量已达上限")
     
-    def add_or_update_server(self, ip: str, port: int, secret: str, server_id: str = None) -> tuple[bool, str]:
+    def add_or_update_server(self, ip: str, port: int, secret: str, server_id: str = None,
+                             weight: Optional[int] = None) -> tuple[bool, str]:
         """添加或更新GPU服务器，返回(是否成功, server_id)"""
         try:
             # 验证密码
@@ -112,41 +379,53 @@ class BackendManager:
                 logger.warning(f"服务器密码验证失败")
                 return False, ""
             
-            # 检查是否已存在相同IP的服务器
-            existing_server = None
-            for sid, server in self.servers.items():
-                if server.ip == ip and server.port == port:
-                    existing_server = sid
-                    break
-            
-            if existing_server:
-                # 更新现有服务器
-                server = self.servers[existing_server]
-                server.ip = ip
-                server.port = port
-                server.url = f"http://{ip}:{port}"
-                server.is_healthy = True
-                server.fail_count = 0
-                logger.info(f"服务器 {existing_server} 已更新: {ip}:{port}")
-                server_id = existing_server
-            else:
-                # 添加新服务器，自动分配ID
-                if not server_id:
-                    server_id = self.generate_server_id()
-                elif server_id in self.servers:
-                    # 如果指定的ID已存在，自动生成新的
-                    server_id = self.generate_server_id()
+            # 查找和添加在同一把锁内完成，避免同一台服务器并发注册时重复添加
+            with self.servers.lock:
+                if self.shared_state:
+                    # 共享模式下由数据库分配server_id，保证所有进程一致
+                    server_id = self.shared_state.register(ip, port, weight, server_id)
+                    stale = self.servers.get(server_id)
+                    if stale and (stale.ip, stale.port) != (ip, port):
+                        self.servers.pop(server_id)
+                        stale.close()
                 
-                server = BackendServer(server_id, ip, port)
-                self.servers[server_id] = server
-                logger.info(f"服务器 {server_id} 已添加: {ip}:{port}")
-            
-            # 保存配置
-            self.save_servers()
+                # 检查是否已存在相同IP的服务器
+                existing_server = self.servers.find_by_address(ip, port)
+                
+                if existing_server:
+                    # 更新现有服务器
+                    server = self.servers[existing_server]
+                    server.is_healthy = True
+                    server.fail_count = 0
+                    if weight is not None:
+                        server.weight = max(int(weight), 1)
+                    server.reset_session()
+                    server.breaker.reset()
+                    self.servers.refresh()
+                    logger.info(f"服务器 {existing_server} 已更新: {ip}:{port}")
+                    server_id = existing_server
+                else:
+                    # 添加新服务器，自动分配ID
+                    if not server_id:
+                        server_id = self.generate_server_id()
+                    elif server_id in self.servers:
+                        # 如果指定的ID已存在，自动生成新的
+                        server_id = self.generate_server_id()
+                    
+                    server = BackendServer(server_id, ip, port, weight if weight is not None else 1)
+                    self.servers.put(server)
+                    logger.info(f"服务器 {server_id} 已添加: {ip}:{port}")
+                
+                # 保存配置
+                self.save_servers()
             
-            # 如果这是第一台服务器，启动健康检测
+            # 如果这是第一台服务器，启动健康检测；否则唤醒检测线程尽快检测新服务器
+            server.check_interval = self.health_check_interval
+            server.next_check_at = 0.0
             if len(self.servers) == 1 and not self.running:
                 self.start_health_check()
+            else:
+                self._wake_event.set()
             
             return True, server_id
         except Exception as e:
@@ -156,8 +435,11 @@ class BackendManager:
     def remove_server(self, server_id: str) -> bool:
         """删除GPU服务器"""
         try:
-            if server_id in self.servers:
-                del self.servers[server_id]
+            if self.shared_state:
+                self.shared_state.unregister(server_id)
+            server = self.servers.pop(server_id)
+            if server:
+                server.close()
                 logger.info(f"服务器 {server_id} 已删除")
                 self.save_servers()
                 
@@ -171,36 +453,199 @@ class BackendManager:
             logger.error(f"删除服务器失败: {e}")
             return False
     
-    def get_next_server(self) -> Optional[BackendServer]:
-        """获取下一个可用的服务器（负载均衡）"""
+    def get_next_server(self, exclude: Optional[Collection[str]] = None) -> Optional[BackendServer]:
+        """获取下一个可用的服务器（负载均衡），exclude为不参与选择的服务器地址（如已转发失败的）"""
         if not self.servers:
             return None
         
-        # 获取所有健康的服务器
-        healthy_servers = [s for s in self.servers.values() if s.is_healthy]
+        # 健康且未被熔断的服务器快照，状态变化时才重新生成
+        healthy_servers = self.servers.available()
+        if exclude:
+            healthy_servers = [server for server in healthy_servers if server.url not in exclude]
         
         if not healthy_servers:
             logger.warning("没有可用的GPU服务器")
             return None
         
-        # 顺序选择服务器（轮询）
-        server = healthy_servers[self.current_index % len(healthy_servers)]
-        self.current_index += 1
+        # 按配置的策略选择服务器
+        server = self.strategy.select(healthy_servers)
         server.last_used_time = datetime.now()
+        if server.breaker.on_selected():
+            # 半开状态的试探请求已发出，在结果返回前不再分配
+            self.servers.refresh()
         
         return server
     
+    def reserve_server(self, max_jobs_per_weight: int,
+                       exclude: Optional[Collection[str]] = None) -> Optional[BackendServer]:
+        """
+        在未满载的服务器中选择一台并计入一个转发中的请求（调用方转发结束后调用end_request）
+        满载指未完成任务数达到 max_jobs_per_weight × 权重；所有服务器都满载时返回None
+        共享模式下未完成数包括其他worker的，在共享数据库的写事务内选择并发布，多个worker合计不超过上限
+        """
+        with self._reserve_lock:
+            if self.shared_state:
+                # 按最近一次同步的数量都已满载时不开写事务（排队调度循环在满载时反复调用）
+                if not self._available_under(max_jobs_per_weight, exclude, self.remote_in_flight):
+                    return None
+                server = None
+                try:
+                    with self.shared_state.reserve_load() as remote:
+                        self.remote_in_flight = remote
+                        server = self._reserve(max_jobs_per_weight, exclude, remote)
+                        if server is not None:
+                            self.shared_state.store_reserved(server.url, server.in_flight)
+                except sqlite3.Error as e:
+                    # 数据库不可用时按最近一次同步的数量预留
+                    logger.error(f"预留共享负载失败: {e}")
+                    if server is None:
+                        server = self._reserve(max_jobs_per_weight, exclude, self.remote_in_flight)
+            else:
+                server = self._reserve(max_jobs_per_weight, exclude, {})
+            if server is None:
+                return None
+        server.last_used_time = datetime.now()
+        if server.breaker.on_selected():
+            self.servers.refresh()
+        return server
+    
+    def _available_under(self, max_jobs_per_weight: int, exclude: Optional[Collection[str]],
+                      remote: Dict[str, int]) -> List[BackendServer]:
+        """未满载的可用服务器"""
+        return [server for server in self.servers.available()
+                if server.in_flight + remote.get(server.url, 0) < max_jobs_per_weight * server.weight
+                and not (exclude and server.url in exclude)]
+    
+    def _reserve(self, max_jobs_per_weight: int, exclude: Optional[Collection[str]],
+                 remote: Dict[str, int]) -> Optional[BackendServer]:
+        """在_reserve_lock内选择未满载的服务器并计入一个转发中的请求"""
+        servers = self._available_under(max_jobs_per_weight, exclude, remote)
+        if not servers:
+            return None
+        server = self.strategy.select(servers)
+        server.begin_request()
+        return server
+    
+    def get_server_by_url(self, url: str) -> Optional[BackendServer]:
+        """根据地址查找服务器"""
+        return self.servers.find_by_url(url)
+    
+    def finish_job(self, url: str, task_id: str) -> Optional[float]:
+        """标记任务在对应服务器上已完成，返回从提交到完成的耗时（未记录该任务时返回None）"""
+        server = self.get_server_by_url(url)
+        if server:
+            return server.finish_job(task_id, self.ewma_alpha)
+        return None
+    
+    def check_jobs(self):
+        """
+        自行查询提交较久的任务状态：客户端不再轮询、或轮询到其他worker时，
+        本进程看不到任务完成，任务会一直占用服务器的名额直到job_timeout
+        """
+        if not self.job_check_after:
+            return
+        now = time.time()
+        for server in list(self.servers.values()):
+            for task_id in server.jobs_to_check(self.job_check_after, self.job_check_interval, now):
+                self.probe_pool.submit(self._check_job, server, task_id)
+    
+    def _check_job(self, server: BackendServer, task_id: str):
+        """查询一个任务的状态，已结束时从未完成任务中移除；查询失败时等下次查询或job_timeout"""
+        try:
+            response = server.session.get(f"{server.url}/api/v1/status/{task_id}", timeout=self.probe_timeout)
+            if response.status_code == 404:
+                server.discard_job(task_id)
+                return
+            result = response.json()
+        except Exception as e:
+            logger.debug(f"查询任务 {task_id} 状态失败: {e}")
+            return
+        if isinstance(result, dict) and result.get('status') in TASK_FINISHED_STATUSES:
+            if server.finish_job(task_id, self.ewma_alpha) is not None:
+                self.jobs_checked_finished += 1
+    
+    def report_result(self, url: str, status_code: Optional[int] = None, latency: Optional[float] = None):
+        """
+        记录转发请求的结果（被动健康检测）
+        status_code为None表示连接失败或超时；latency只在请求大小稳定的接口（如状态查询）上传入
+        """
+        if not self.outlier_detection_enabled:
+            return
+        server = self.get_server_by_url(url)
+        if not server:
+            return
+        breaker = server.breaker
+        
+        if status_code is None:
+            failure = FAILURE_CONNECT
+        elif status_code >= 500:
+            failure = FAILURE_5XX
+        else:
+            if breaker.record_success(latency):
+                self.servers.refresh()
+                logger.info(f"服务器 {server.server_id} 试探请求成功，恢复接收任务")
+            if latency is not None and self._is_latency_outlier(server):
+                failure = FAILURE_LATENCY
+            else:
+                return
+        
+        if breaker.record_failure(failure):
+            self._eject(server, failure)
+    
+    def _is_latency_outlier(self, server: BackendServer) -> bool:
+        """延迟EWMA明显高于其他服务器的中位数"""
+        breaker = server.breaker
+        if breaker.latency_samples < self.latency_min_samples or breaker.latency < self.latency_min:
+            return False
+        others = sorted(s.breaker.latency for s in list(self.servers.values())
+                        if s is not server and s.breaker.latency_samples >= self.latency_min_samples)
+        if not others:
+            return False
+        median = others[len(others) // 2]
+        return breaker.latency > median * self.latency_factor
+    
+    def _eject(self, server: BackendServer, reason: str):
+        """熔断服务器；同时被熔断的服务器数受max_ejection_percent限制，不会剔除所有服务器"""
+        with self._ejection_lock:
+            if server.breaker.state != HALF_OPEN:
+                servers = list(self.servers.values())
+                ejected = sum(1 for s in servers if s.breaker.state != CLOSED)
+                max_ejected = min(max(int(len(servers) * self.max_ejection_percent / 100), 1), len(servers) - 1)
+                if ejected >= max_ejected:
+                    logger.warning(f"服务器 {server.server_id} 请求异常({reason})，但已熔断 {ejected} 台服务器，不再剔除")
+                    return
+            ejection_time = server.breaker.trip()
+            self.servers.refresh()
+        logger.error(f"服务器 {server.server_id} 请求异常({reason})，熔断 {ejection_time:.0f} 秒")
+        
+        # 尽快发起一次主动检测，确认服务器是否已经下线
+        server.next_check_at = 0.0
+        self._wake_event.set()
+    
+    def get_session(self, url: str) -> PooledSession:
+        """获取后端地址对应的连接池会话"""
+        server = self.get_server_by_url(url)
+        return server.session if server else self.default_session
+    
     def check_server_health(self, server: BackendServer) -> bool:
         """检查单个服务器健康状态"""
+        healthy = False
+        started = time.perf_counter()
         try:
             # 尝试访问健康检查端点
-            response = requests.get(f"{server.url}/health", timeout=5)
+            # 单次检测超时不超过每轮检测的截止时间
+            timeout = min(self.probe_timeout, self.sweep_deadline)
+            response = server.session.get(f"{server.url}/health", timeout=timeout)
             
             if response.status_code == 200:
                 # 健康检查成功
+                healthy = True
                 server.fail_count = 0
+                server.last_healthy_at = time.time()
                 if not server.is_healthy:
                     server.is_healthy = True
+                    self.servers.refresh()
+                    self._publish_health(server)
                     logger.info(f"服务器 {server.server_id} 重新上线")
                 return True
             else:
@@ -214,11 +659,17 @@ class BackendManager:
             return False
         finally:
             server.last_check_time = datetime.now()
+            self.health_stats.record_probe(healthy)
+            metrics.observe_health_check(server.url, healthy, time.perf_counter() - started)
+            self._schedule_next_check(server, healthy)
             
             # 如果失败次数达到阈值，标记为不健康
             if server.fail_count >= self.max_fail_count:
                 if server.is_healthy:
                     server.is_healthy = False
+                    self.servers.refresh()
+                    self._publish_health(server)
+                    self.health_stats.record_failure_detected(time.time() - server.last_healthy_at)
                     logger.error(f"服务器 {server.server_id} 已标记为不可用")
             
             # 如果失败次数超过自动清理阈值，自动删除服务器记录
@@ -226,31 +677,161 @@ class BackendManager:
                 logger.warning(f"服务器 {server.server_id} 失败次数达到 {server.fail_count} 次，自动删除服务器记录")
                 self.remove_server(server.server_id)
     
-    def health_check_loop(self):
-        """健康检查循环"""
-        while self.running:
+    def _publish_health(self, server: BackendServer):
+        """共享模式下把健康状态变化写入共享状态，其他进程同步后生效"""
+        if not self.shared_state:
+            return
+        try:
+            self.shared_state.set_health(server.server_id, server.is_healthy, server.fail_count)
+        except Exception as e:
+            logger.error(f"写入共享健康状态失败: {e}")
+    
+    def _schedule_next_check(self, server: BackendServer, healthy: bool):
+        """自适应调整检测间隔：稳定节点逐步退避，失败后立即加快检测"""
+        if healthy:
+            interval = server.check_interval or self.health_check_interval
+            interval = min(interval * self.check_backoff_factor, self.max_check_interval)
+        else:
+            interval = self.min_check_interval
+        server.check_interval = interval
+        
+        # 加入随机抖动，避免所有服务器在同一时刻被检测
+        jitter = random.uniform(1 - self.check_jitter, 1 + self.check_jitter)
+        server.next_check_at = time.monotonic() + interval * jitter
+    
+    def _probe(self, server: BackendServer, sweep: "HealthSweep"):
+        """在线程池中执行的单个检测任务"""
+        try:
+            self.check_server_health(server)
+        finally:
+            server.probe_running = False
+            sweep.probe_done()
+    
+    def run_health_sweep(self, servers: List[BackendServer]):
+        """把一批到期的服务器提交到线程池并行检测，不等待结果"""
+        sweep = HealthSweep(len(servers), self.health_stats)
+        for server in servers:
+            server.probe_running = True
+            self.probe_pool.submit(self._probe, server, sweep)
+        return sweep
+    
+    def health_check_loop(self, stop_event: threading.Event):
+        """健康检查循环：只负责调度，检测在线程池中进行，无响应的服务器不会拖慢其他服务器的检测"""
+        sweeps: List[HealthSweep] = []
+        while not stop_event.is_set():
             try:
-                if self.servers:
-                    for server in list(self.servers.values()):
-                        self.check_server_health(server)
+                now = time.monotonic()
+                servers = list(self.servers.values())
+                
+                # 自行查询提交较久的任务，丢弃长时间没有看到完成状态的任务，避免未完成任务数只增不减
+                self.check_jobs()
+                for server in servers:
+                    server.expire_jobs(self.job_timeout)
                 
-                time.sleep(self.health_check_interval)
+                due = [s for s in servers if s.next_check_at <= now and not s.probe_running]
+                if due:
+                    sweeps.append(self.run_health_sweep(due))
+                
+                # 超过截止时间仍未完成的检测轮次
+                for sweep in [sw for sw in sweeps if sw.finished or now - sw.started > self.sweep_deadline]:
+                    sweeps.remove(sweep)
+                    if not sweep.finished:
+                        sweep.mark_deadline_exceeded()
+                        logger.warning(f"{sweep.remaining} 台服务器的健康检测超过 {self.sweep_deadline} 秒未完成")
+                
+                # 睡眠到最近一台服务器的下次检测时间，有新服务器加入时提前唤醒
+                pending = [s.next_check_at for s in list(self.servers.values()) if not s.probe_running]
+                delay = min(pending) - time.monotonic() if pending else self.health_check_interval
+                self._wake_event.wait(min(max(delay, 0.05), self.min_check_interval))
+                self._wake_event.clear()
             except Exception as e:
                 logger.error(f"健康检查循环出错: {e}")
-                time.sleep(self.health_check_interval)
+                stop_event.wait(self.health_check_interval)
+    
+    def sync_from_shared(self):
+        """把共享状态中的服务器列表和健康状态同步到本进程的注册表"""
+        version = self.shared_state.version()
+        rows = self.shared_state.load()
+        with self.servers.lock:
+            changed = False
+            for row in rows:
+                server = self.servers.get(row['server_id'])
+                if server and (server.ip, server.port) != (row['ip'], row['port']):
+                    self.servers.pop(server.server_id)
+                    server.close()
+                    server = None
+                if server is None:
+                    server = BackendServer(row['server_id'], row['ip'], row['port'], row['weight'])
+                    server.is_healthy = row['is_healthy']
+                    server.fail_count = row['fail_count']
+                    self.servers.put(server)
+                    continue
+                if server.is_healthy != row['is_healthy'] or server.weight != row['weight']:
+                    server.is_healthy = row['is_healthy']
+                    server.weight = row['weight']
+                    changed = True
+                if not self.is_prober:
+                    server.fail_count = row['fail_count']
+            
+            current_ids = {row['server_id'] for row in rows}
+            for server_id in [sid for sid in self.servers.keys() if sid not in current_ids]:
+                self.servers.pop(server_id).close()
+            if changed:
+                self.servers.refresh()
+            self.shared_version = version
+    
+    def shared_sync_loop(self):
+        """共享状态同步循环：竞争健康检测租约，版本号变化时同步服务器列表"""
+        while True:
+            try:
+                is_prober = self.shared_state.try_acquire_lease()
+                if is_prober != self.is_prober:
+                    self.is_prober = is_prober
+                    if is_prober:
+                        logger.info("本进程获得健康检测租约，开始健康检测")
+                        self.start_health_check()
+                    else:
+                        logger.info("健康检测租约已被其他进程持有，停止健康检测")
+                        self.stop_health_check()
+                
+                if self.shared_state.version() != self.shared_version:
+                    self.sync_from_shared()
+                
+                # 发布本进程的负载（包括已结束的请求和已完成的任务），取回其他worker的负载
+                self.remote_in_flight = self.shared_state.publish_load(
+                    {server.url: server.in_flight for server in list(self.servers.values())}
+                )
+                
+                # 健康检测线程负责查询和清理本进程的任务，不做健康检测的进程在这里进行
+                if not self.is_prober:
+                    self.check_jobs()
+                    for server in list(self.servers.values()):
+                        server.expire_jobs(self.job_timeout)
+            except Exception as e:
+                logger.error(f"同步共享状态出错: {e}")
+            time.sleep(self.sync_interval)
     
     def start_health_check(self):
         """启动健康检查"""
-        if self.servers and not self.running:
+        if self.servers and not self.running and self.is_prober:
             self.running = True
-            self.health_check_thread = threading.Thread(target=self.health_check_loop, daemon=True)
+            self._stop_event = threading.Event()
+            self.health_check_thread = threading.Thread(
+                target=self.health_check_loop, args=(self._stop_event,), daemon=True
+            )
             self.health_check_thread.start()
             logger.info("健康检查已启动")
     
     def stop_health_check(self):
         """停止健康检查"""
         self.running = False
-        if self.health_check_thread:
+        self._stop_event.set()
+        self._wake_event.set()
+        
+        # 在检测线程或检测线程池中调用时（如自动删除最后一台服务器）不能等待自身结束
+        current = threading.current_thread()
+        if (self.health_check_thread and current is not self.health_check_thread
+                and not current.name.startswith("health-probe")):
             self.health_check_thread.join(timeout=5)
         logger.info("健康检查已停止")
     
@@ -262,6 +843,26 @@ class BackendManager:
         """获取所有健康服务器的URL列表"""
         return [server.url for server in self.servers.values() if server.is_healthy]
     
+    def get_summary(self) -> Dict[str, Any]:
+        """服务器列表和可用状态，只包含注册、健康或熔断状态变化时才会改变的字段"""
+        servers = list(self.servers.values())
+        available = {server.server_id for server in self.servers.available()}
+        return {
+            "total_servers": len(servers),
+            "healthy_servers": sum(1 for s in servers if s.is_healthy),
+            "available_servers": len(available),
+            "load_balancing_strategy": self.strategy.name,
+            "servers": [
+                {
+                    "server_id": server.server_id,
+                    "url": server.url,
+                    "weight": server.weight,
+                    "is_healthy": server.is_healthy,
+                    "available": server.server_id in available
+                } for server in servers
+            ]
+        }
+    
     def get_stats(self) -> Dict[str, Any]:
         """获取统计信息"""
         total = len(self.servers)
@@ -273,10 +874,34 @@ class BackendManager:
             "healthy_servers": healthy,
             "unhealthy_servers": unhealthy,
             "health_check_running": self.running,
+            "load_balancing_strategy": self.strategy.name,
             "health_check_interval": self.health_check_interval,
+            "health_check": self.health_stats.to_dict(),
+            "shared_state": {
+                "enabled": True,
+                "path": self.shared_state.path,
+                "version": self.shared_version,
+                "is_prober": self.is_prober
+            } if self.shared_state else {"enabled": False},
             "max_fail_count": self.max_fail_count,
             "auto_cleanup_threshold": self.auto_cleanup_threshold,
-            "servers": self.get_all_servers()
+            "servers": self.get_all_servers(),
+            "jobs_checked_finished": self.jobs_checked_finished,
+            "load": {
+                server.server_id: {
+                    "weight": server.weight,
+                    "in_flight": server.in_flight,
+                    "remote_in_flight": self.remote_in_flight.get(server.url, 0),
+                    "active_requests": server.active_requests,
+                    "outstanding_jobs": len(server.jobs),
+                    "ewma_latency": round(server.ewma_latency, 3),
+                    "check_interval": round(server.check_interval, 2),
+                    "circuit_breaker": server.breaker.to_dict()
+                } for server in list(self.servers.values())
+            },
+            "connection_pools": {
+                server.server_id: server.session.stats.to_dict() for server in list(self.servers.values())
+            }
         }
 
 # 全局实例
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同步/异步网关负载测试
+本地启动一个响应很慢的GPU服务器替身，向网关并发发起 /api/v1/status 请求，
+对比同步模式（Flask + gunicorn线程）与异步模式（asgi_app + uvicorn）下
+同时在途的请求数（替身后端观测到的并发峰值）和延迟分位数
+
+用法:
+    python benchmark_async_gateway.py --concurrency 1000 --delay 2
+    python benchmark_async_gateway.py --sync-workers 2 --sync-threads 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+class SlowBackend:
+    """慢速GPU服务器替身：每个请求等待固定时间后返回，统计并发峰值"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.port = None
+        self._ready = threading.Event()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    if line.lower().startswith(b'connection:') and b'close' in line.lower():
+                        keep_alive = False
+
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                try:
+                    await asyncio.sleep(self.delay)
+                finally:
+                    self.in_flight -= 1
+
+                body = json.dumps({'status': 'processing'}).encode()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                    b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle, '127.0.0.1', 0, backlog=4096)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True).start()
+        self._ready.wait()
+
+    def reset(self):
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve_gateway(mode: str, backend_url: str, port: int, workers: int, threads: int):
+    """子进程：以指定模式启动网关"""
+    from config import config
+    config.config['backend_api_base'] = backend_url
+    config.config['multi_backend'] = {'enabled': False, 'fallback_to_default': False}
+    config.config['rate_limit'] = {**config.get_rate_limit_config(), 'enabled': False}  # 压测请求都来自本机，不限流
+
+    import logging
+    logging.disable(logging.INFO)
+
+    if mode == 'async':
+        import uvicorn
+        from asgi_app import app
+        uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+    else:
+        from gunicorn.app.base import BaseApplication
+        from app import app
+
+        class GatewayApplication(BaseApplication):
+            def load_config(self):
+                for key, value in {
+                    'bind': f'127.0.0.1:{port}',
+                    'workers': workers,
+                    'threads': threads,
+                    'worker_class': 'gthread',
+                    'backlog': 4096,
+                    'timeout': 600,
+                    'loglevel': 'warning'
+                }.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return app
+
+        GatewayApplication().run()
+
+
+async def fire(host: str, port: int, concurrency: int, timeout: float):
+    """每个请求单独建立连接并发发起，返回每个请求的(状态码, 延迟)"""
+    async def one(i):
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, limit=1 << 20), timeout)
+            writer.write(
+                f'GET /api/v1/status/bench-{i} HTTP/1.1\r\nHost: {host}\r\n'
+                f'Connection: close\r\n\r\n'.encode()
+            )
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), timeout)
+            await asyncio.wait_for(reader.read(), timeout)
+            writer.close()
+            status = int(status_line.split()[1])
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            status = 0
+        return status, time.perf_counter() - start
+
+    return await asyncio.gather(*(one(i) for i in range(concurrency)))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_mode(mode: str, backend: SlowBackend, args) -> dict:
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve-gateway', mode,
+         '--backend', f'http://127.0.0.1:{backend.port}', '--port', str(port),
+         '--sync-workers', str(args.sync_workers), '--sync-threads', str(args.sync_threads)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        time.sleep(0.5)
+
+        backend.reset()
+        start = time.perf_counter()
+        results = asyncio.run(fire('127.0.0.1', port, args.concurrency, args.timeout))
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency for status, latency in results if status == 200]
+        return {
+            'mode': mode,
+            'ok': len(latencies),
+            'failed': len(results) - len(latencies),
+            'peak_in_flight': backend.peak_in_flight,
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'elapsed': elapsed
+        }
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同步/异步网关负载测试')
+    parser.add_argument('--concurrency', type=int, default=500, help='同时发起的请求数')
+    parser.add_argument('--delay', type=float, default=2.0, help='替身后端每个请求的处理时间(秒)')
+    parser.add_argument('--timeout', type=float, default=120.0, help='客户端请求超时(秒)')
+    parser.add_argument('--sync-workers', type=int, default=2, help='同步模式gunicorn进程数')
+    parser.add_argument('--sync-threads', type=int, default=16, help='同步模式每个进程的线程数')
+    parser.add_argument('--modes', default='sync,async', help='测试的模式，逗号分隔')
+    parser.add_argument('--serve-gateway', help=argparse.SUPPRESS)
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_gateway:
+        serve_gateway(args.serve_gateway, args.backend, args.port, args.sync_workers, args.sync_threads)
+        return
+
+    backend = SlowBackend(args.delay)
+    backend.start()
+
+    print(f"并发请求: {args.concurrency}, 后端处理时间: {args.delay}s, "
+          f"同步模式: {args.sync_workers}进程 x {args.sync_threads}线程")
+    for mode in args.modes.split(','):
+        result = run_mode(mode, backend, args)
+        print(
+            f"{result['mode']:>6}: 成功 {result['ok']} 失败 {result['failed']}  "
+            f"后端并发峰值 {result['peak_in_flight']}  "
+            f"p50 {result['p50']:.2f}s  p99 {result['p99']:.2f}s  总耗时 {result['elapsed']:.2f}s"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重复图片增强请求去重测试
+本地启动一台GPU服务器替身（一个处理线程按提交顺序逐个处理任务，每个任务耗时固定），
+网关以多线程HTTP服务运行，客户端提交图片、轮询状态直到完成、下载结果：
+- 第一轮：每张图片同时提交多份（重试、批量重跑），打乱顺序并发提交
+- 第二轮：全部完成并下载后，每张图片再提交一次
+对比关闭/开启去重时GPU服务器处理的任务数、GPU忙碌时间、全部完成的时间，
+以及只有不重复的图片时开启去重（读完上传内容计算摘要）对提交接口延迟的影响
+
+用法:
+    python benchmark_enhance_dedup.py --images 20 --copies 4 --job-time 0.1 --size-kb 512
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+class GpuHandler(BaseHTTPRequestHandler):
+    """GPU服务器替身：提交立即返回任务号，任务按提交顺序逐个处理"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    return
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self._read_body()
+        self._reply({'task_id': self.server.gpu.submit(), 'status': 'processing'})
+
+    def do_GET(self):
+        gpu = self.server.gpu
+        if self.path == '/health':
+            self._reply({'status': 'healthy'})
+            return
+        task_id = self.path.rsplit('/', 1)[-1]
+        done = task_id in gpu.done
+        if self.path.startswith('/api/v1/download/'):
+            if not done:
+                self._reply({'error': '任务尚未完成'}, 404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(gpu.result)))
+            self.end_headers()
+            self.wfile.write(gpu.result)
+            return
+        self._reply({'task_id': task_id, 'status': 'completed' if done else 'processing',
+                     'progress': 1.0 if done else 0.0})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GpuServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeGpu:
+    """一块GPU：一个处理线程，按提交顺序处理"""
+
+    def __init__(self, job_time: float, result: bytes):
+        self.job_time = job_time
+        self.result = result
+        self.pending = deque()
+        self.done = set()
+        self.jobs = 0
+        self.busy = 0.0
+        self.cond = threading.Condition()
+        self.ids = iter(range(10 ** 9))
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self) -> str:
+        with self.cond:
+            task_id = f"gpu-{next(self.ids)}"
+            self.pending.append(task_id)
+            self.jobs += 1
+            self.cond.notify()
+        return task_id
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                task_id = self.pending.popleft()
+            time.sleep(self.job_time)
+            self.busy += self.job_time
+            self.done.add(task_id)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process(url, image, local):
+    """提交一张图片，轮询到完成后下载，返回 (任务号, 提交耗时, 完成耗时)"""
+    session = getattr(local, 'session', None)
+    if session is None:
+        session = local.session = requests.Session()
+    started = time.perf_counter()
+    response = session.post(f"{url}/api/v1/enhance", files={'file': ('photo.jpg', image, 'image/jpeg')},
+                            data={'tile_size': '400', 'quality_level': 'high'}, timeout=60)
+    submitted = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"提交失败: {response.status_code} {response.text}")
+    task_id = response.json()['task_id']
+    while True:
+        status = session.get(f"{url}/api/v1/status/{task_id}", timeout=30).json()
+        if status.get('status') == 'completed':
+            break
+        if status.get('status') == 'failed':
+            raise RuntimeError(f"任务失败: {status}")
+        time.sleep(0.05)
+    result = session.get(f"{url}/api/v1/download/{task_id}", timeout=60)
+    if result.status_code != 200:
+        raise RuntimeError(f"下载失败: {result.status_code}")
+    return task_id, submitted, time.perf_counter() - started
+
+
+def run_round(url, uploads, clients):
+    local = threading.local()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda image: process(url, image, local), uploads))
+    return time.perf_counter() - start, results
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='重复图片增强请求去重测试')
+    parser.add_argument('--images', type=int, default=20, help='不同图片的数量')
+    parser.add_argument('--copies', type=int, default=4, help='第一轮每张图片同时提交的份数')
+    parser.add_argument('--job-time', type=float, default=0.1, help='每个任务的GPU处理时间（秒）')
+    parser.add_argument('--size-kb', type=int, default=512, help='每张图片的大小（KB）')
+    parser.add_argument('--clients', type=int, default=16, help='并发客户端数')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    data_dir = tempfile.mkdtemp()
+    from config import config
+    config.config['multi_backend'] = {'enabled': True, 'fallback_to_default': False}
+    # 所有请求来自同一个IP（同一个用户），放宽排队人数限制
+    config.config['fair_queue'] = {**config.get_fair_queue_config(), 'max_queue_per_user': 10000,
+                                   'max_queue_total': 10000}
+    config.config['enhance_dedup'] = {**config.get_enhance_dedup_config(),
+                                      'path': os.path.join(data_dir, 'enhance_dedup.db')}
+    # 失败转移同样会缓存请求体，关闭后对比的只是去重本身
+    config.config['enhance_failover'] = {**config.get_enhance_failover_config(), 'enabled': False}
+    config.config['result_cache'] = {**config.get_result_cache_config(),
+                                     'directory': os.path.join(data_dir, 'result_cache')}
+    from backend_manager import backend_manager, WEBHOOK_SECRET
+    backend_manager.servers_file = os.path.join(data_dir, 'backend_servers.json')
+    import app as gateway
+    gateway.rate_limiter.enabled = False  # 压测请求都来自本机，不限流
+    from werkzeug.serving import make_server
+
+    gpu = FakeGpu(args.job_time, os.urandom(args.size_kb * 1024))
+    fake = GpuServer(('127.0.0.1', 0), GpuHandler)
+    fake.gpu = gpu
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    backend_manager.add_or_update_server('127.0.0.1', fake.server_address[1], WEBHOOK_SECRET)
+
+    port = free_port()
+    httpd = make_server('127.0.0.1', port, gateway.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{port}"
+
+    images = [os.urandom(args.size_kb * 1024) for _ in range(args.images)]
+    print(f"{args.images} 张图片 × {args.size_kb}KB, 第一轮每张 {args.copies} 份, 第二轮每张 1 份, "
+          f"每个任务GPU处理 {args.job_time}s, {args.clients} 个并发客户端")
+    try:
+        for name, enabled in (('关闭去重', False), ('开启去重', True)):
+            gateway.enhance_dedup.enabled = enabled
+            jobs_before, busy_before = gpu.jobs, gpu.busy
+            first = [image for image in images for _ in range(args.copies)]
+            random.shuffle(first)
+            elapsed1, results1 = run_round(url, first, args.clients)
+            elapsed2, results2 = run_round(url, images, args.clients)
+            task_ids = {task_id for task_id, _, _ in results1 + results2}
+            print(f"  {name}: GPU任务 {gpu.jobs - jobs_before} 个, GPU忙碌 {gpu.busy - busy_before:.1f}s, "
+                  f"第一轮 {elapsed1:.2f}s, 第二轮 {elapsed2:.2f}s, 不同任务号 {len(task_ids)}")
+            # 换一批图片，两种情况互不影响
+            images = [os.urandom(args.size_kb * 1024) for _ in range(args.images)]
+        print(f"去重统计: {gateway.enhance_dedup.get_stats()}")
+
+        # 只有不重复的图片时计算摘要的开销
+        print("\n不重复的图片，提交接口延迟:")
+        local = threading.local()
+        for name, enabled in (('关闭去重', False), ('开启去重', True)):
+            gateway.enhance_dedup.enabled = enabled
+            latencies = []
+            for _ in range(args.images):
+                _, submitted, _ = process(url, os.urandom(args.size_kb * 1024), local)
+                latencies.append(submitted)
+            print(f"  {name}: p50 {percentile(latencies, 0.5) * 1000:.1f}ms p99 "
+                  f"{percentile(latencies, 0.99) * 1000:.1f}ms")
+    finally:
+        httpd.shutdown()
+        fake.shutdown()
+        gateway.order_reconciler.stop()
+        backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片增强请求失败转移测试（故障注入）
+本地启动多台GPU服务器替身，每次提交随机注入故障：
+- 断开连接：读到请求头（或读完请求体）后直接关闭连接，不返回响应
+- 慢受理：读完请求体后等待slow-time秒才返回任务号
+网关以多线程HTTP服务运行，客户端并发提交图片，对比关闭失败转移、只重试、重试+对冲时
+提交成功率和提交接口延迟（p50/p99）
+
+用法:
+    python benchmark_enhance_failover.py --servers 3 --requests 400 --drop-rate 0.05 --slow-rate 0.05
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+class GpuHandler(BaseHTTPRequestHandler):
+    """GPU服务器替身：提交时按概率断开连接或延迟受理"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    return
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _drop(self):
+        self.server.gpu.count('dropped')
+        self.close_connection = True
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+    def do_POST(self):
+        gpu = self.server.gpu
+        fault = random.random()
+        if fault < gpu.drop_rate / 2:
+            self._drop()
+            return
+        self._read_body()
+        if fault < gpu.drop_rate:
+            self._drop()
+            return
+        if fault < gpu.drop_rate + gpu.slow_rate:
+            gpu.count('slow')
+            time.sleep(gpu.slow_time)
+        self._reply({'task_id': gpu.submit(), 'status': 'processing'})
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply({'status': 'healthy'})
+            return
+        self._reply({'task_id': self.path.rsplit('/', 1)[-1], 'status': 'processing', 'progress': 0.0})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GpuServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeGpu:
+    """一台GPU服务器的故障注入参数和计数"""
+
+    def __init__(self, name: str, drop_rate: float, slow_rate: float, slow_time: float):
+        self.name = name
+        self.drop_rate = drop_rate
+        self.slow_rate = slow_rate
+        self.slow_time = slow_time
+        self.counts = {'accepted': 0, 'dropped': 0, 'slow': 0}
+        self.lock = threading.Lock()
+        self.ids = iter(range(10 ** 9))
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def submit(self) -> str:
+        with self.lock:
+            self.counts['accepted'] += 1
+            return f"{self.name}-{next(self.ids)}"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def submit(url, image, local):
+    """提交一张图片，返回 (是否成功, 耗时)"""
+    session = getattr(local, 'session', None)
+    if session is None:
+        session = local.session = requests.Session()
+    started = time.perf_counter()
+    try:
+        response = session.post(f"{url}/api/v1/enhance", files={'file': ('photo.jpg', image, 'image/jpeg')},
+                                data={'tile_size': '400', 'quality_level': 'high'}, timeout=60)
+        ok = response.status_code == 200 and bool(response.json().get('task_id'))
+    except requests.exceptions.RequestException:
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='图片增强请求失败转移测试（故障注入）')
+    parser.add_argument('--servers', type=int, default=3, help='GPU服务器数量')
+    parser.add_argument('--requests', type=int, default=400, help='每种模式提交的请求数')
+    parser.add_argument('--clients', type=int, default=16, help='并发客户端数')
+    parser.add_argument('--size-kb', type=int, default=256, help='每张图片的大小（KB）')
+    parser.add_argument('--drop-rate', type=float, default=0.05, help='提交时断开连接的概率')
+    parser.add_argument('--slow-rate', type=float, default=0.05, help='提交时慢受理的概率')
+    parser.add_argument('--slow-time', type=float, default=2.0, help='慢受理的等待时间（秒）')
+    parser.add_argument('--hedge-delay', type=float, default=0.3, help='对冲模式的对冲等待时间（秒）')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    data_dir = tempfile.mkdtemp()
+    from config import config
+    config.config['multi_backend'] = {'enabled': True, 'fallback_to_default': False}
+    config.config['fair_queue'] = {**config.get_fair_queue_config(), 'enabled': False}
+    config.config['enhance_dedup'] = {**config.get_enhance_dedup_config(), 'enabled': False,
+                                      'path': os.path.join(data_dir, 'enhance_dedup.db')}
+    config.config['result_cache'] = {**config.get_result_cache_config(),
+                                     'directory': os.path.join(data_dir, 'result_cache')}
+    from backend_manager import backend_manager, WEBHOOK_SECRET
+    backend_manager.servers_file = os.path.join(data_dir, 'backend_servers.json')
+    import app as gateway
+    from enhance_failover import RetryBudget
+    gateway.rate_limiter.enabled = False  # 压测请求都来自本机，不限流
+    from werkzeug.serving import make_server
+
+    gpus, fakes = [], []
+    for i in range(args.servers):
+        gpu = FakeGpu(f"gpu{i}", args.drop_rate, args.slow_rate, args.slow_time)
+        fake = GpuServer(('127.0.0.1', 0), GpuHandler)
+        fake.gpu = gpu
+        threading.Thread(target=fake.serve_forever, daemon=True).start()
+        backend_manager.add_or_update_server('127.0.0.1', fake.server_address[1], WEBHOOK_SECRET)
+        gpus.append(gpu)
+        fakes.append(fake)
+
+    port = free_port()
+    httpd = make_server('127.0.0.1', port, gateway.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{port}"
+
+    failover = gateway.enhance_failover
+    failover_config = config.get_enhance_failover_config()
+    image = os.urandom(args.size_kb * 1024)
+    print(f"{args.servers} 台GPU服务器, 断开连接概率 {args.drop_rate:.0%}, 慢受理概率 {args.slow_rate:.0%} "
+          f"({args.slow_time}s), {args.requests} 个请求 × {args.size_kb}KB, {args.clients} 个并发客户端")
+    try:
+        for name, enabled, hedge_delay in (('关闭失败转移', False, 0.0),
+                                           ('只重试', True, 0.0),
+                                           (f'重试+对冲({args.hedge_delay}s)', True, args.hedge_delay)):
+            failover.enabled = enabled
+            failover.hedge_delay = hedge_delay
+            failover.budget = RetryBudget(failover_config['retry_ratio'], failover_config['min_retries_per_second'],
+                                          failover_config['budget_window'])
+            # 各模式从相同状态开始：上一轮熔断剔除的服务器恢复
+            for server in backend_manager.servers.values():
+                server.breaker.reset()
+            backend_manager.servers.refresh()
+            before = failover.get_stats()
+            local = threading.local()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                results = list(pool.map(lambda _: submit(url, image, local), range(args.requests)))
+            elapsed = time.perf_counter() - started
+            latencies = [latency for _, latency in results]
+            succeeded = sum(1 for ok, _ in results if ok)
+            after = failover.get_stats()
+            delta = {key: after[key] - before[key] for key in ('retries', 'hedges', 'hedge_wins', 'budget_denied')}
+            print(f"  {name}: 成功率 {succeeded / len(results):.1%}, p50 {percentile(latencies, 0.5) * 1000:.0f}ms "
+                  f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms, 耗时 {elapsed:.1f}s, {delta}")
+        time.sleep(args.slow_time)
+        print(f"失败转移统计: {failover.get_stats()}")
+        print(f"GPU服务器: {[gpu.counts for gpu in gpus]}")
+    finally:
+        httpd.shutdown()
+        for fake in fakes:
+            fake.shutdown()
+        failover.stop()
+        gateway.order_reconciler.stop()
+        backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+公平排队模拟测试
+本地启动几台GPU服务器替身（每台按先来先处理的顺序逐个处理任务，每个任务耗时固定），
+一个批量用户一次提交几百张图片，同时若干普通用户各自陆续提交几张图片并轮询状态直到完成。
+对比关闭/开启网关公平排队时：
+- 普通用户从提交到完成的延迟（p50/p99/最大值）
+- 批量用户全部完成的时间，被429拒绝的次数（按Retry-After重试）
+
+用法:
+    python benchmark_fair_queue.py --servers 2 --job-time 0.02 --heavy-images 300 --light-users 20
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class GpuHandler(BaseHTTPRequestHandler):
+    """GPU服务器替身：提交立即返回任务号，任务按提交顺序逐个处理"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    return
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self._read_body()
+        self._reply({'task_id': self.server.gpu.submit(), 'status': 'queued'})
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply({'status': 'healthy'})
+            return
+        task_id = self.path.rsplit('/', 1)[-1]
+        done = task_id in self.server.gpu.done
+        self._reply({'task_id': task_id, 'status': 'completed' if done else 'processing'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GpuServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeGpu:
+    """一块GPU：一个处理线程，按提交顺序处理"""
+
+    def __init__(self, job_time: float):
+        self.job_time = job_time
+        self.pending = deque()
+        self.done = set()
+        self.cond = threading.Condition()
+        self.ids = iter(range(10 ** 9))
+        self.httpd = GpuServer(('127.0.0.1', 0), GpuHandler)
+        self.httpd.gpu = self
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self) -> str:
+        with self.cond:
+            task_id = f"{self.port}-{next(self.ids)}"
+            self.pending.append(task_id)
+            self.cond.notify()
+        return task_id
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                task_id = self.pending[0]
+            time.sleep(self.job_time)
+            with self.cond:
+                self.pending.popleft()
+                self.done.add(task_id)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def run(gateway, fakes, args, enabled):
+    from fair_scheduler import FairScheduler
+
+    scheduler = FairScheduler(
+        gateway.backend_manager,
+        enabled=enabled,
+        max_jobs_per_server=args.max_jobs,
+        max_queue_per_user=args.max_queue,
+        max_queue_total=args.max_queue * (args.light_users + 1),
+        max_wait=600,
+        retry_after=1,
+        quantum=1,
+        cost_unit=4 * 1024 * 1024,
+        user_window=3600,
+        spool_memory=1024 * 1024,
+        dispatch_workers=8,
+        ticket_ttl=3600,
+        max_tickets=100000,
+        path=os.path.join(tempfile.mkdtemp(), 'fair_queue.db'),
+        poll_interval=0.05
+    )
+    gateway.fair_scheduler = scheduler
+    payload = os.urandom(args.image_size)
+    lock = threading.Lock()
+    light_latencies, heavy_done = [], []
+    counters = {'rejected': 0, 'errors': 0, 'max_position': 0}
+
+    def submit(http, ip):
+        """提交一张图片，满载被拒绝时按Retry-After重试，返回 (任务号, 提交开始时间)"""
+        started = time.perf_counter()
+        while True:
+            response = http.post('/api/v1/enhance', headers={'X-Real-IP': ip},
+                                 data={'file': (io.BytesIO(payload), 'photo.jpg')})
+            if response.status_code != 429:
+                break
+            with lock:
+                counters['rejected'] += 1
+            time.sleep(args.retry_delay)
+        body = response.get_json()
+        if response.status_code != 200 or not body.get('task_id'):
+            with lock:
+                counters['errors'] += 1
+            return None, started
+        if body.get('queue_position'):
+            with lock:
+                counters['max_position'] = max(counters['max_position'], body['queue_position'])
+        return body['task_id'], started
+
+    def completed(http, task_id):
+        body = http.get(f'/api/v1/status/{task_id}').get_json()
+        if body.get('status') == 'failed':
+            with lock:
+                counters['errors'] += 1
+            return True
+        return body.get('status') == 'completed'
+
+    start = time.perf_counter()
+    heavy_tasks = deque()
+
+    def heavy_uploader(count):
+        http = gateway.app.test_client()
+        for _ in range(count):
+            task_id, _ = submit(http, '10.0.0.1')
+            if task_id:
+                heavy_tasks.append(task_id)
+
+    def heavy_poller(uploaders):
+        http = gateway.app.test_client()
+        while heavy_tasks or any(t.is_alive() for t in uploaders):
+            if not heavy_tasks:
+                time.sleep(args.poll_interval)
+                continue
+            task_id = heavy_tasks.popleft()
+            if completed(http, task_id):
+                heavy_done.append(time.perf_counter() - start)
+            else:
+                heavy_tasks.append(task_id)
+                time.sleep(args.poll_interval / max(len(heavy_tasks), 1))
+
+    def light_user(index):
+        http = gateway.app.test_client()
+        rng = random.Random(index)
+        time.sleep(rng.uniform(0, args.light_spread))
+        for _ in range(args.light_images):
+            task_id, started = submit(http, f"10.1.0.{index + 1}")
+            while task_id and not completed(http, task_id):
+                time.sleep(args.poll_interval)
+            with lock:
+                light_latencies.append(time.perf_counter() - started)
+            time.sleep(rng.uniform(0, args.light_think))
+
+    per_thread = args.heavy_images // args.heavy_threads
+    uploaders = [threading.Thread(target=heavy_uploader,
+                                  args=(per_thread + (1 if i < args.heavy_images % args.heavy_threads else 0),))
+                 for i in range(args.heavy_threads)]
+    for t in uploaders:
+        t.start()
+    poller = threading.Thread(target=heavy_poller, args=(uploaders,))
+    poller.start()
+    lights = [threading.Thread(target=light_user, args=(i,)) for i in range(args.light_users)]
+    for t in lights:
+        t.start()
+    for t in lights + uploaders + [poller]:
+        t.join()
+
+    stats = scheduler.get_stats()
+    scheduler.stop()
+    return {
+        'light_p50': percentile(light_latencies, 0.5),
+        'light_p99': percentile(light_latencies, 0.99),
+        'light_max': max(light_latencies, default=0.0),
+        'heavy_done': len(heavy_done),
+        'heavy_makespan': max(heavy_done, default=0.0),
+        'stats': stats,
+        **counters
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='公平排队模拟测试')
+    parser.add_argument('--servers', type=int, default=2, help='GPU服务器替身数量')
+    parser.add_argument('--job-time', type=float, default=0.02, help='每个任务的GPU处理时间（秒）')
+    parser.add_argument('--heavy-images', type=int, default=300, help='批量用户提交的图片数')
+    parser.add_argument('--heavy-threads', type=int, default=8, help='批量用户的并发上传数')
+    parser.add_argument('--light-users', type=int, default=20, help='普通用户数')
+    parser.add_argument('--light-images', type=int, default=3, help='每个普通用户依次提交的图片数')
+    parser.add_argument('--light-spread', type=float, default=1.0, help='普通用户在该时间内陆续开始（秒）')
+    parser.add_argument('--light-think', type=float, default=0.2, help='普通用户两次提交之间的最长间隔（秒）')
+    parser.add_argument('--image-size', type=int, default=64 * 1024, help='图片大小（字节）')
+    parser.add_argument('--max-jobs', type=int, default=3, help='每台服务器同时处理的任务数上限')
+    parser.add_argument('--max-queue', type=int, default=50, help='每个用户最多排队的任务数')
+    parser.add_argument('--poll-interval', type=float, default=0.02, help='客户端轮询状态的间隔（秒）')
+    parser.add_argument('--retry-delay', type=float, default=0.1, help='被429拒绝后的重试间隔（秒，模拟Retry-After）')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    from config import config
+    config.config['multi_backend'] = {'enabled': True, 'fallback_to_default': False}
+    from backend_manager import backend_manager, WEBHOOK_SECRET
+    backend_manager.servers_file = os.path.join(tempfile.mkdtemp(), 'backend_servers.json')
+    import app as gateway
+    gateway.rate_limiter.enabled = False  # 只比较排队效果，不限流
+    gateway.enhance_dedup.enabled = False  # 所有图片内容相同，不去重
+
+    print(f"GPU替身 {args.servers} 台（每个任务 {args.job_time * 1000:.0f}ms）, 批量用户 {args.heavy_images} 张, "
+          f"普通用户 {args.light_users} 个 × {args.light_images} 张")
+    for enabled in (False, True):
+        fakes = [FakeGpu(args.job_time) for _ in range(args.servers)]
+        for fake in fakes:
+            backend_manager.add_or_update_server('127.0.0.1', fake.port, WEBHOOK_SECRET)
+        r = run(gateway, fakes, args, enabled)
+        for server_id in list(backend_manager.servers):
+            backend_manager.remove_server(server_id)
+        for fake in fakes:
+            fake.stop()
+        print(f"公平排队{'开启' if enabled else '关闭'}: 普通用户延迟 p50 {r['light_p50'] * 1000:.0f}ms "
+              f"p99 {r['light_p99'] * 1000:.0f}ms 最大 {r['light_max'] * 1000:.0f}ms, "
+              f"批量用户完成 {r['heavy_done']} 张 用时 {r['heavy_makespan']:.2f}s, "
+              f"429拒绝 {r['rejected']}, 失败 {r['errors']}, 最大排队位置 {r['max_position']}, "
+              f"直接转发 {r['stats']['direct']} 排队 {r['stats']['submitted']}")
+    gateway.order_reconciler.stop()
+    backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
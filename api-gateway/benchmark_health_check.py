@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+健康检测测试
+本地启动一组GPU服务器替身（/health 接口），其中一部分无响应（连接建立后不返回）、
+一部分拒绝连接，运行过程中按计划让健康的替身下线再恢复，统计：
+- 每轮检测耗时（串行检测 vs 并行检测）
+- 从替身下线到被标记为不可用的耗时
+- 从替身恢复到被重新标记为可用的耗时
+
+测试期间关闭自动删除（否则下线的服务器被删除后需要重新注册才能恢复）
+
+用法:
+    python benchmark_health_check.py --servers 20 --hanging 3 --refusing 2
+    python benchmark_health_check.py --workers 1   # 串行检测对照
+"""
+
+import argparse
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import config
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        super().finish()
+        self.server.connections.discard(self.connection)
+
+    def do_GET(self):
+        body = b'{"status": "healthy"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGpuServer:
+    """可下线/恢复的GPU服务器替身，端口保持不变"""
+
+    def __init__(self):
+        self.port = free_port()
+        self.httpd = None
+        self.down_at = None
+        self.up_at = None
+
+    def start(self):
+        ThreadingHTTPServer.allow_reuse_address = True
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', self.port), HealthHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.connections = set()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.up_at = time.monotonic()
+
+    def stop(self):
+        """模拟进程退出：停止监听并断开所有keep-alive连接"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for conn in list(self.httpd.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.httpd = None
+        self.down_at = time.monotonic()
+
+
+def hanging_listener():
+    """只监听不accept：连接能建立，但请求永远得不到响应"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    return sock
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='健康检测测试')
+    parser.add_argument('--servers', type=int, default=20, help='健康的替身数量')
+    parser.add_argument('--hanging', type=int, default=3, help='无响应的替身数量')
+    parser.add_argument('--refusing', type=int, default=2, help='拒绝连接的替身数量')
+    parser.add_argument('--flapping', type=int, default=5, help='运行中下线再恢复的替身数量')
+    parser.add_argument('--workers', type=int, default=16, help='并行检测线程数，1为串行检测')
+    parser.add_argument('--timeout', type=float, default=5, help='单次检测超时(秒)')
+    parser.add_argument('--down-after', type=float, default=12, help='启动多少秒后让替身下线')
+    parser.add_argument('--down-for', type=float, default=10, help='替身下线持续时间(秒)')
+    parser.add_argument('--duration', type=float, default=40, help='总测试时间(秒)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    config.config['health_check'] = {**config.get_health_check_config(),
+                                     'max_workers': args.workers, 'timeout': args.timeout}
+
+    from backend_manager import BackendManager, WEBHOOK_SECRET
+    servers_file = os.path.join(tempfile.mkdtemp(), 'backend_servers.json')
+    manager = BackendManager(servers_file=servers_file)
+    manager.auto_cleanup_threshold = float('inf')
+
+    fakes = [FakeGpuServer() for _ in range(args.servers)]
+    for fake in fakes:
+        fake.start()
+    hanging = [hanging_listener() for _ in range(args.hanging)]
+    ports = [fake.port for fake in fakes]
+    ports += [sock.getsockname()[1] for sock in hanging]
+    ports += [free_port() for _ in range(args.refusing)]
+    for port in ports:
+        manager.add_or_update_server('127.0.0.1', port, WEBHOOK_SECRET)
+    by_port = {server.port: server for server in manager.servers.values()}
+
+    flapping = fakes[:args.flapping]
+    detect_down, detect_up = [], []
+    pending_down, pending_up = set(), set()
+    start = time.monotonic()
+    print(f"替身: 健康 {args.servers}, 无响应 {args.hanging}, 拒绝连接 {args.refusing}; "
+          f"检测线程 {args.workers}, 超时 {args.timeout}s")
+
+    while time.monotonic() - start < args.duration:
+        elapsed = time.monotonic() - start
+        if elapsed >= args.down_after and not pending_down and not detect_down and flapping[0].httpd:
+            for fake in flapping:
+                fake.stop()
+                pending_down.add(fake)
+        if elapsed >= args.down_after + args.down_for and not pending_up and not detect_up and not flapping[0].httpd:
+            for fake in flapping:
+                fake.start()
+                pending_up.add(fake)
+
+        now = time.monotonic()
+        for fake in list(pending_down):
+            if not by_port[fake.port].is_healthy:
+                detect_down.append(now - fake.down_at)
+                pending_down.discard(fake)
+        for fake in list(pending_up):
+            if by_port[fake.port].is_healthy:
+                detect_up.append(now - fake.up_at)
+                pending_up.discard(fake)
+        time.sleep(0.02)
+
+    stats = manager.health_stats.to_dict()
+    manager.stop_health_check()
+    manager.probe_pool.shutdown(wait=False, cancel_futures=True)
+
+    print(f"检测轮数 {stats['sweeps']}  每轮耗时: 平均 {stats['avg_sweep_duration']:.2f}s "
+          f"最大 {stats['max_sweep_duration']:.2f}s  超过截止时间 {stats['deadline_exceeded']}")
+    print(f"下线发现耗时: 平均 {sum(detect_down) / max(len(detect_down), 1):.2f}s "
+          f"p99 {percentile(detect_down, 0.99):.2f}s  未发现 {len(pending_down)}")
+    print(f"恢复发现耗时: 平均 {sum(detect_up) / max(len(detect_up), 1):.2f}s "
+          f"p99 {percentile(detect_up, 0.99):.2f}s  未发现 {len(pending_up)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+负载均衡策略仿真测试
+用离散事件仿真模拟一组算力不同的GPU服务器（不同GPU型号、不同并发槽位），
+任务耗时从几秒到几分钟不等，对比各选择策略下任务的排队等待时间
+
+仿真直接使用 load_balancer.py 中的策略和 BackendServer 的未完成任务/EWMA统计，
+不发起任何网络请求
+
+用法:
+    python benchmark_load_balancing.py --jobs 5000 --utilization 0.8
+"""
+
+import argparse
+import heapq
+import random
+from collections import deque
+
+from backend_manager import BackendServer
+from load_balancer import STRATEGIES
+
+# 模拟的GPU服务器: (名称, 相对速度, 并发槽位)
+DEFAULT_FLEET = [
+    ("A100", 4.0, 2),
+    ("A10", 2.0, 1),
+    ("T4-1", 1.0, 1),
+    ("T4-2", 1.0, 1),
+]
+
+
+class SimulatedGpu:
+    """模拟GPU服务器：固定槽位数，超出槽位的任务在服务器本地排队"""
+
+    def __init__(self, server: BackendServer, speed: float, slots: int):
+        self.server = server
+        self.speed = speed
+        self.slots = slots
+        self.busy = 0
+        self.queue = deque()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def simulate(strategy_name: str, fleet, jobs: int, utilization: float, seed: int, alpha: float):
+    rng = random.Random(seed)
+    random.seed(seed)  # power_of_two 使用全局random
+    strategy = STRATEGIES[strategy_name]()
+
+    gpus = []
+    for i, (name, speed, slots) in enumerate(fleet):
+        server = BackendServer(f"GPU-{i + 1:03d}", "127.0.0.1", 9000 + i, weight=round(speed * slots))
+        gpus.append(SimulatedGpu(server, speed, slots))
+    by_id = {gpu.server.server_id: gpu for gpu in gpus}
+
+    # 任务工作量（在速度为1的GPU上的秒数）：对数正态分布，中位数约20秒，长尾到几分钟
+    mean_work = 30.0
+    capacity = sum(speed * slots for _, speed, slots in fleet)
+    arrival_rate = utilization * capacity / mean_work
+
+    events = []  # (时间, 序号, 类型, 数据)
+    seq = 0
+    now = 0.0
+    for job_id in range(jobs):
+        now += rng.expovariate(arrival_rate)
+        work = min(rng.lognormvariate(3.0, 0.9), 600.0)
+        heapq.heappush(events, (now, seq, "arrive", (f"job-{job_id}", work)))
+        seq += 1
+
+    waits = []
+    arrivals = {}
+
+    def start(gpu, task_id, work, t):
+        nonlocal seq
+        gpu.busy += 1
+        waits.append(t - arrivals[task_id])
+        heapq.heappush(events, (t + work / gpu.speed, seq, "finish", (gpu.server.server_id, task_id)))
+        seq += 1
+
+    while events:
+        t, _, kind, data = heapq.heappop(events)
+        if kind == "arrive":
+            task_id, work = data
+            arrivals[task_id] = t
+            gpu = by_id[strategy.select([g.server for g in gpus]).server_id]
+            gpu.server.track_job(task_id, started=t)
+            if gpu.busy < gpu.slots:
+                start(gpu, task_id, work, t)
+            else:
+                gpu.queue.append((task_id, work))
+        else:
+            server_id, task_id = data
+            gpu = by_id[server_id]
+            gpu.busy -= 1
+            gpu.server.finish_job(task_id, alpha, now=t)
+            if gpu.queue:
+                next_id, next_work = gpu.queue.popleft()
+                start(gpu, next_id, next_work, t)
+
+    for gpu in gpus:
+        gpu.server.close()
+
+    return {
+        "strategy": strategy_name,
+        "mean": sum(waits) / len(waits),
+        "p50": percentile(waits, 0.50),
+        "p95": percentile(waits, 0.95),
+        "p99": percentile(waits, 0.99),
+        "max": max(waits)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='负载均衡策略仿真测试')
+    parser.add_argument('--jobs', type=int, default=5000, help='仿真任务数')
+    parser.add_argument('--utilization', type=float, default=0.8, help='集群平均利用率(0-1)')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--ewma-alpha', type=float, default=0.3, help='EWMA平滑系数')
+    parser.add_argument('--strategies', default=','.join(STRATEGIES), help='测试的策略，逗号分隔')
+    args = parser.parse_args()
+
+    fleet_desc = ', '.join(f"{name}(速度{speed}x{slots}槽)" for name, speed, slots in DEFAULT_FLEET)
+    print(f"GPU集群: {fleet_desc}")
+    print(f"任务数: {args.jobs}, 利用率: {args.utilization}")
+    print(f"{'策略':<22}{'平均排队(s)':>12}{'p50':>10}{'p95':>10}{'p99':>10}{'最大':>10}")
+    for name in args.strategies.split(','):
+        result = simulate(name, DEFAULT_FLEET, args.jobs, args.utilization, args.seed, args.ewma_alpha)
+        print(f"{result['strategy']:<24}{result['mean']:>10.1f}{result['p50']:>10.1f}"
+              f"{result['p95']:>10.1f}{result['p99']:>10.1f}{result['max']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
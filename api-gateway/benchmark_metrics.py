@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行指标开销测试
+- 单次记录耗时：计数器、耗时分布、一个接口请求的完整记录（开始+结束），单线程和多线程；
+  对比每次记录都加锁的实现
+- 热路径开销：通过Flask测试客户端请求 /api/v1/health，对比开启/关闭指标时每个请求的耗时
+- 每请求一个线程时线程计数的数量（应保持在上限附近，不随请求数增长）
+- 输出 /metrics 的耗时
+
+用法:
+    python benchmark_metrics.py --seconds 1 --threads 8
+"""
+
+import argparse
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from metrics import GatewayMetrics, Histogram
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+class LockedHistogram:
+    """对比用：所有线程共用一份计数，每次记录加锁"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            cells = self.data.get(labels)
+            if cells is None:
+                cells = self.data[labels] = [0] * (len(self.buckets) + 2)
+            cells[bisect_left(self.buckets, value)] += 1
+            cells[-1] += value
+
+
+def call_rate(func, seconds, threads=1):
+    """每秒调用次数"""
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def worker(n):
+        count = 0
+        while time.perf_counter() < deadline:
+            for _ in range(500):
+                func()
+            count += 500
+        counts[n] = count
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def hot_path(seconds):
+    """通过Flask请求 /api/v1/health，开启/关闭指标时每个请求的平均耗时（微秒）"""
+    import app as gateway
+    gateway.rate_limiter.enabled = False  # 压测请求都来自本机，不限流
+
+    http = gateway.app.test_client()
+    results = {}
+    try:
+        for _ in range(200):
+            http.get('/api/v1/health')
+        # 交替测几轮取最小值，减少机器负载波动的影响
+        for _ in range(5):
+            for name, enabled in (('关闭指标', False), ('开启指标', True)):
+                gateway.metrics.enabled = enabled
+                count = 0
+                start = time.perf_counter()
+                while time.perf_counter() - start < seconds / 5:
+                    for _ in range(50):
+                        http.get('/api/v1/health')
+                    count += 50
+                us = (time.perf_counter() - start) / count * 1e6
+                results[name] = min(results.get(name, us), us)
+    finally:
+        gateway.metrics.enabled = True
+        gateway.order_reconciler.stop()
+        gateway.backend_manager.stop_health_check()
+    return results
+
+
+def thread_churn(requests):
+    """每个请求一个新线程记录一次，返回线程计数数量"""
+    histogram = Histogram('bench_seconds', '', ('route',), BUCKETS)
+    for i in range(requests):
+        t = threading.Thread(target=histogram.observe, args=(('bench',), 0.01))
+        t.start()
+        t.join()
+    shards = histogram.shard_count()
+    total = sum(histogram.collect()[('bench',)][:-1])
+    return shards, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='运行指标开销测试')
+    parser.add_argument('--seconds', type=float, default=1.0, help='每项测试时间（秒）')
+    parser.add_argument('--threads', type=int, default=8, help='多线程测试的线程数')
+    parser.add_argument('--churn', type=int, default=2000, help='线程计数测试的请求（线程）数')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    m = GatewayMetrics(latency_buckets=BUCKETS, store_buckets=BUCKETS)
+    locked = LockedHistogram(BUCKETS)
+
+    def full_request():
+        m.request_started('get_task_status')
+        m.request_finished('get_task_status', 'GET', 200, 0.012)
+
+    cases = [
+        ('计数器 inc', lambda: m.http_requests.inc(('get_task_status', 'GET', '200'))),
+        ('耗时分布 observe', lambda: m.http_duration.observe(('get_task_status',), 0.012)),
+        ('加锁的耗时分布(对比)', lambda: locked.observe(('get_task_status',), 0.012)),
+        ('一个请求(开始+结束)', full_request),
+        ('上游请求 observe_upstream', lambda: m.observe_upstream('http://10.0.0.1:8000', 'status', 0.02, 200)),
+    ]
+    print(f"{'记录':<26}{'单线程(次/秒)':>16}{'单次(ns)':>10}{f'{args.threads}线程(次/秒)':>18}")
+    for name, func in cases:
+        single = call_rate(func, args.seconds)
+        multi = call_rate(func, args.seconds, args.threads)
+        print(f"{name:<26}{single:>16,.0f}{1e9 / single:>12.0f}{multi:>18,.0f}")
+
+    shards, total = thread_churn(args.churn)
+    print(f"\n每请求一个线程 {args.churn} 次: 线程计数 {shards} 份, 汇总计数 {total}")
+
+    # 模拟较多标签组合时的输出耗时
+    for route in range(30):
+        for status in (200, 404, 429, 500, 503):
+            m.http_requests.inc((f"route_{route}", 'GET', str(status)))
+        m.http_duration.observe((f"route_{route}",), 0.05)
+    for backend in range(20):
+        for op in ('enhance', 'status', 'download'):
+            m.observe_upstream(f"http://10.0.0.{backend}:8000", op, 0.1, 200, sent=1024)
+    start = time.perf_counter()
+    for _ in range(20):
+        text = m.render()
+    print(f"输出 /metrics: {(time.perf_counter() - start) / 20 * 1000:.2f}ms, {len(text.splitlines())} 行")
+
+    print("\n热路径（Flask测试客户端请求 /api/v1/health，每个请求耗时）:")
+    results = hot_path(args.seconds)
+    base = results['关闭指标']
+    for name, us in results.items():
+        print(f"  {name}: {us:.1f}us" + ('' if name == '关闭指标' else f"（差 {us - base:+.1f}us）"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+订单查询性能测试
+在N个历史订单上对比原实现（遍历全部订单）与索引实现下：
+- /api/wechat/pay/orders/<openid>：获取某个用户的订单（全部 / 按limit分页）
+- /api/wechat/pay/stats：订单统计
+同时检查索引结果与遍历结果一致
+
+用法:
+    python benchmark_order_indexes.py --sizes 10000,100000,1000000 --queries 200
+"""
+
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+from benchmark_order_store import prefill
+from order_manager import OrderManager
+from wechat_pay_config import WeChatPayConfig
+
+
+def scan_orders_by_openid(orders, openid):
+    """原实现：遍历全部订单后排序"""
+    user_orders = [order for order in orders.values() if order['openid'] == openid]
+    user_orders.sort(key=lambda x: x['create_time'], reverse=True)
+    return user_orders
+
+
+def scan_order_stats(orders):
+    """原实现：遍历全部订单计数（状态按大写比较）"""
+    stats = {'total': len(orders)}
+    for key, status in (('pending', WeChatPayConfig.ORDER_STATUS_PENDING),
+                        ('paid', WeChatPayConfig.ORDER_STATUS_PAID),
+                        ('cancelled', WeChatPayConfig.ORDER_STATUS_CANCELLED),
+                        ('failed', WeChatPayConfig.ORDER_STATUS_FAILED),
+                        ('refunded', WeChatPayConfig.ORDER_STATUS_REFUNDED)):
+        stats[key] = len([o for o in orders.values() if o['status'] == status])
+    return stats
+
+
+def timed(func, args_list):
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) / len(args_list) * 1000
+
+
+def run(count, queries, page_size):
+    data_dir = tempfile.mkdtemp()
+    try:
+        prefill('sqlite', data_dir, count)
+        manager = OrderManager(data_dir=data_dir, backend='sqlite', hot_days=0)
+        # 状态变化：一部分待支付订单变为已支付，检查计数器是否同步更新
+        pending = [no for no, order in manager.orders.items()
+                   if order['status'] == WeChatPayConfig.ORDER_STATUS_PENDING][:100]
+        for out_trade_no in pending:
+            manager.mark_order_paid(out_trade_no, 'bench', '20240101120000')
+
+        rng = random.Random(0)
+        openids = list(manager.orders_by_openid)
+        sample = [(rng.choice(openids),) for _ in range(queries)]
+        scan_sample = sample[:max(1, queries // 20)]
+
+        mismatches = 0
+        for (openid,) in scan_sample:
+            expected = [o['out_trade_no'] for o in scan_orders_by_openid(manager.orders, openid)]
+            got = [o['out_trade_no'] for o in manager.get_orders_by_openid(openid)]
+            # 分页逐页取完应与全部结果相同
+            paged, cursor = [], None
+            while True:
+                page = manager.get_orders_by_openid(openid, cursor=cursor, limit=page_size)
+                paged += [o['out_trade_no'] for o in page]
+                if len(page) < page_size:
+                    break
+                cursor = page[-1]['out_trade_no']
+            mismatches += expected != got or expected != paged
+        mismatches += scan_order_stats(manager.orders) != manager.get_order_stats()
+
+        result = {
+            'per_user': count // len(openids),
+            'scan_list': timed(lambda o: scan_orders_by_openid(manager.orders, o), scan_sample),
+            'index_list': timed(manager.get_orders_by_openid, sample),
+            'index_page': timed(lambda o: manager.get_orders_by_openid(o, limit=page_size), sample),
+            'scan_stats': timed(lambda: scan_order_stats(manager.orders), [()] * 3),
+            'index_stats': timed(manager.get_order_stats, [()] * queries),
+            'mismatches': mismatches
+        }
+        manager.store.close()
+        return result
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='订单查询性能测试')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='历史订单数，逗号分隔')
+    parser.add_argument('--queries', type=int, default=200, help='每种规模下的查询次数（遍历实现只执行1/20）')
+    parser.add_argument('--page-size', type=int, default=20, help='分页查询的limit')
+    args = parser.parse_args()
+
+    print(f"{'订单数':>10}{'每用户':>8}{'用户订单-遍历(ms)':>20}{'用户订单-索引':>16}{'分页-索引':>12}"
+          f"{'统计-遍历(ms)':>16}{'统计-计数器':>14}{'结果不一致':>12}")
+    for count in (int(size) for size in args.sizes.split(',')):
+        r = run(count, args.queries, args.page_size)
+        print(f"{count:>10}{r['per_user']:>10}{r['scan_list']:>22.3f}{r['index_list']:>18.3f}"
+              f"{r['index_page']:>14.3f}{r['scan_stats']:>18.3f}{r['index_stats']:>16.4f}{r['mismatches']:>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+订单内存占用测试
+预先写入N个历史订单（最后一个订单创建于当前时间，每30秒一个），分别在独立进程中加载，对比常驻内存(RSS)：
+- dict: 原方式，每个订单一个dict，全部加载
+- record: OrderRecord紧凑记录，全部加载（hot_days=0）
+- tiered: OrderRecord + 冷热分层，只加载待支付订单和最近hot_days天的订单
+
+用法:
+    python benchmark_order_memory.py --count 1000000 --hot-days 7
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+
+def rss():
+    """当前进程常驻内存（字节，Linux）"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def load_dicts(data_dir):
+    """原OrderManager的内存结构：订单dict + openid索引"""
+    from order_store import SqliteOrderStore
+    store = SqliteOrderStore(os.path.join(data_dir, 'orders.db'))
+    rows = store._conn().execute("SELECT data FROM orders ORDER BY rowid")
+    orders = {order['out_trade_no']: order for order in (json.loads(data) for (data,) in rows)}
+    by_openid = defaultdict(list)
+    for order in orders.values():
+        by_openid[order['openid']].append((order['create_time'], order['out_trade_no']))
+    store.close()
+    return orders, by_openid
+
+
+def measure(mode, data_dir, hot_days, results):
+    import logging
+    logging.disable(logging.CRITICAL)
+    from order_manager import OrderManager
+    gc.collect()
+    base = rss()
+    start = time.perf_counter()
+    if mode == 'dict':
+        held = load_dicts(data_dir)
+        resident = len(held[0])
+    else:
+        held = OrderManager(data_dir=data_dir, backend='sqlite', hot_days=hot_days if mode == 'tiered' else 0)
+        resident = len(held.orders)
+    load_time = time.perf_counter() - start
+    gc.collect()
+    results.put((mode, rss() - base, resident, load_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='订单内存占用测试')
+    parser.add_argument('--count', type=int, default=1000000, help='历史订单数')
+    parser.add_argument('--hot-days', type=float, default=7, help='tiered模式下内存中保留的天数')
+    args = parser.parse_args()
+
+    from benchmark_order_store import prefill
+    data_dir = tempfile.mkdtemp()
+    try:
+        prefill('sqlite', data_dir, args.count, start=datetime.now() - timedelta(seconds=30 * args.count))
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        print(f"{args.count} 个订单（跨度 {args.count * 30 / 86400:.0f} 天）")
+        print(f"{'方式':<8}{'常驻订单':>10}{'RSS增量(MB)':>14}{'每订单(字节)':>14}{'每常驻订单':>12}{'加载(s)':>10}")
+        for mode in ('dict', 'record', 'tiered'):
+            proc = ctx.Process(target=measure, args=(mode, data_dir, args.hot_days, results))
+            proc.start()
+            _, used, resident, load_time = results.get()
+            proc.join()
+            print(f"{mode:<10}{resident:>10}{used / 1048576:>14.1f}{used / args.count:>16.0f}"
+                  f"{used / max(resident, 1):>14.0f}{load_time:>12.2f}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
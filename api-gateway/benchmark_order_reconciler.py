@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+待支付订单对账测试
+预先写入N个待支付订单（创建时间分布在最近 --max-age 秒内），启动本地的微信支付替身
+（/pay/orderquery、/pay/closeorder，可设置响应延迟），各订单在微信侧的状态按订单序号分配：
+    30% 已支付(SUCCESS) / 10% 已关闭(CLOSED) / 10% 微信不存在(ORDERNOTEXIST) /
+    10% 未支付但关单时刚好支付(ORDERPAID) / 40% 未支付(NOTPAY)
+分别用不同的并发数执行对账，检查每个订单的最终状态是否符合预期，并输出吞吐量和剩余积压
+
+用法:
+    python benchmark_order_reconciler.py --orders 2000 --latency 0.02 --workers 1,4,16
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def remote_state(index):
+    """订单在微信侧的状态"""
+    return {0: 'SUCCESS', 1: 'SUCCESS', 2: 'SUCCESS', 3: 'CLOSED', 4: 'ORDERNOTEXIST',
+            5: 'PAID_ON_CLOSE'}.get(index % 10, 'NOTPAY')
+
+
+class FakePayHandler(BaseHTTPRequestHandler):
+    """微信支付orderquery/closeorder接口替身"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        from wechat_pay_utils import WeChatPayUtils
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        out_trade_no = WeChatPayUtils.xml_to_dict(body.decode('utf-8')).get('out_trade_no')
+        server = self.server
+        time.sleep(server.latency)
+
+        with server.lock:
+            server.calls[self.path] += 1
+            state = server.states.get(out_trade_no, 'ORDERNOTEXIST')
+            if self.path.endswith('/closeorder'):
+                if state == 'PAID_ON_CLOSE':
+                    server.states[out_trade_no] = 'SUCCESS'
+                    reply = {'result_code': 'FAIL', 'err_code': 'ORDERPAID', 'err_code_des': '订单已支付'}
+                else:
+                    server.states[out_trade_no] = 'CLOSED'
+                    reply = {'result_code': 'SUCCESS'}
+            elif state == 'ORDERNOTEXIST':
+                reply = {'result_code': 'FAIL', 'err_code': 'ORDERNOTEXIST', 'err_code_des': '此交易订单号不存在'}
+            else:
+                trade_state = 'NOTPAY' if state == 'PAID_ON_CLOSE' else state
+                reply = {'result_code': 'SUCCESS', 'out_trade_no': out_trade_no, 'trade_state': trade_state,
+                         'transaction_id': f"4200{out_trade_no[3:]}" if trade_state == 'SUCCESS' else '',
+                         'time_end': '20240101120000' if trade_state == 'SUCCESS' else ''}
+
+        data = WeChatPayUtils.dict_to_xml({'return_code': 'SUCCESS', **reply}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def expected_status(index, age, min_age, close_after):
+    """一轮对账后订单的预期本地状态"""
+    if age < min_age:
+        return 'PENDING'
+    state = remote_state(index)
+    if state == 'SUCCESS':
+        return 'PAID'
+    if state == 'CLOSED':
+        return 'FAILED'
+    if age < close_after:
+        return 'PENDING'
+    return {'ORDERNOTEXIST': 'FAILED', 'PAID_ON_CLOSE': 'PENDING', 'NOTPAY': 'CANCELLED'}[state]
+
+
+def prefill(data_dir, count, max_age):
+    """直接写入待支付订单，返回 [(out_trade_no, 序号, 创建距今秒数)]"""
+    from order_store import SqliteOrderStore
+    now = datetime.now()
+    store = SqliteOrderStore(os.path.join(data_dir, 'orders.db'))
+    orders, rows = [], []
+    for i in range(count):
+        age = max_age * (i + 0.5) / count
+        created = (now - timedelta(seconds=age)).isoformat()
+        out_trade_no = f"PAY{1700000000 + i}{i:06d}"
+        orders.append((out_trade_no, i, age))
+        rows.append(store._row({
+            'out_trade_no': out_trade_no, 'openid': f"orecon{i % 500:06d}", 'total_fee': 100,
+            'body': '照片增强服务', 'attach': '', 'status': 'PENDING', 'create_time': created,
+            'update_time': created, 'transaction_id': '', 'time_end': '', 'prepay_id': f"wx{i:030d}"
+        }))
+    conn = store._conn()
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO orders (out_trade_no, openid, status, create_time, data) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', '1')")
+    conn.execute("COMMIT")
+    store.close()
+    return orders
+
+
+def run(fake, pay_api, args, workers):
+    from order_manager import OrderManager
+    from order_reconciler import OrderReconciler
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        orders = prefill(data_dir, args.orders, args.max_age)
+        fake.states = {no: remote_state(i) for no, i, _ in orders}
+        fake.calls = Counter()
+        manager = OrderManager(data_dir=data_dir)
+        reconciler = OrderReconciler(manager, pay_api, min_age=args.min_age, close_after=args.close_after,
+                                     batch_size=args.batch_size, max_workers=workers)
+        first = reconciler.run_once()
+        # 对账过程中订单年龄仍在增长，处于边界附近的订单按开始或结束时的年龄判断都算正确
+        drift = first['duration']
+        mismatches = sum(
+            manager.get_order(no)['status'] not in (expected_status(i, age, args.min_age, args.close_after),
+                                                    expected_status(i, age + drift, args.min_age, args.close_after))
+            for no, i, age in orders)
+        calls = dict(fake.calls)
+        # 第二轮：关单时刚好支付的订单应标记为已支付
+        second = reconciler.run_once()
+        stats = reconciler.get_stats()
+        manager.store.close()
+        return first, second, calls, mismatches, stats
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='待支付订单对账测试')
+    parser.add_argument('--orders', type=int, default=2000, help='待支付订单数')
+    parser.add_argument('--max-age', type=float, default=6 * 3600, help='订单创建时间分布范围（秒）')
+    parser.add_argument('--min-age', type=float, default=300, help='对账的最小订单年龄（秒）')
+    parser.add_argument('--close-after', type=float, default=7200, help='关闭未支付订单的年龄（秒）')
+    parser.add_argument('--batch-size', type=int, default=100, help='每批订单数')
+    parser.add_argument('--workers', default='1,4,16', help='并发查询数，逗号分隔')
+    parser.add_argument('--latency', type=float, default=0.02, help='微信接口替身的响应延迟（秒）')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    fake = ThreadingHTTPServer(('127.0.0.1', 0), FakePayHandler)
+    fake.daemon_threads = True
+    fake.lock = threading.Lock()
+    fake.latency = args.latency
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+
+    from wechat_pay_utils import WeChatPayAPI
+    pay_api = WeChatPayAPI()
+    base = f"http://127.0.0.1:{fake.server_address[1]}/pay"
+    pay_api.config.ORDER_QUERY_URL = f"{base}/orderquery"
+    pay_api.config.CLOSE_ORDER_URL = f"{base}/closeorder"
+
+    print(f"{args.orders} 个待支付订单, 创建时间分布在最近 {args.max_age / 3600:.1f} 小时, "
+          f"微信接口延迟 {args.latency * 1000:.0f}ms")
+    for workers in (int(w) for w in args.workers.split(',')):
+        first, second, calls, mismatches, stats = run(fake, pay_api, args, workers)
+        print(f"并发 {workers:>2}: 积压 {first['backlog']} 个, 耗时 {first['duration']:.2f}s, "
+              f"吞吐 {first['throughput']:.0f} 单/秒, 已支付 {first['paid']} 支付失败 {first['failed']} "
+              f"已取消 {first['cancelled']} 仍待支付 {first['pending']} 出错 {first['error']}, "
+              f"查询 {calls.get('/pay/orderquery', 0)} 关单 {calls.get('/pay/closeorder', 0)}, "
+              f"状态不符 {mismatches}; 第二轮 已支付 {second['paid']}, 剩余积压 {stats['backlog']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+订单存储性能测试
+预先写入N个历史订单，对比json后端（每次重写整个orders.json）与sqlite后端（只写入变化的订单）
+下 create_order / update_order 的延迟，以及启动加载耗时
+
+用法:
+    python benchmark_order_store.py --sizes 10000,100000,1000000 --ops 20
+"""
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from order_manager import OrderManager
+from order_store import SqliteOrderStore
+from wechat_pay_config import WeChatPayConfig
+
+STATUSES = [WeChatPayConfig.ORDER_STATUS_PAID] * 8 + [
+    WeChatPayConfig.ORDER_STATUS_PENDING, WeChatPayConfig.ORDER_STATUS_FAILED]
+
+
+def make_orders(count, start=None):
+    """生成历史订单（每30秒一个）"""
+    start = start or datetime(2024, 1, 1)
+    for i in range(count):
+        created = (start + timedelta(seconds=i * 30)).isoformat()
+        out_trade_no = f"PAY{1700000000 + i}{i % 1000000:06d}"
+        yield {
+            'out_trade_no': out_trade_no,
+            'openid': f"o{i % 50000:08d}wechatopenidxxxxxxx",
+            'total_fee': 100 + i % 900,
+            'body': '照片增强服务',
+            'attach': '',
+            'status': STATUSES[i % len(STATUSES)],
+            'create_time': created,
+            'update_time': created,
+            'transaction_id': f"4200{i:024d}",
+            'time_end': '20240101120000',
+            'prepay_id': f"wx{i:030d}"
+        }
+
+
+def prefill(backend, data_dir, count, start=None):
+    """直接写入存储文件，不经过OrderManager"""
+    if backend == 'json':
+        orders = {order['out_trade_no']: order for order in make_orders(count, start)}
+        with open(os.path.join(data_dir, 'orders.json'), 'w', encoding='utf-8') as f:
+            json.dump(orders, f, ensure_ascii=False, indent=2)
+    else:
+        store = SqliteOrderStore(os.path.join(data_dir, 'orders.db'))
+        conn = store._conn()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO orders (out_trade_no, openid, status, create_time, data) VALUES (?, ?, ?, ?, ?)",
+            (store._row(order) for order in make_orders(count, start))
+        )
+        conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', '1')")
+        conn.execute("COMMIT")
+        store.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def run(backend, count, ops):
+    data_dir = tempfile.mkdtemp()
+    try:
+        prefill(backend, data_dir, count)
+        gc.collect()
+
+        start = time.perf_counter()
+        manager = OrderManager(data_dir=data_dir, backend=backend)
+        load_time = time.perf_counter() - start
+
+        create, update = [], []
+        for i in range(ops):
+            start = time.perf_counter()
+            order = manager.create_order(f"obench{i:06d}", 100, '照片增强服务')
+            create.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            manager.update_order(order['out_trade_no'], prepay_id=f"wxbench{i}")
+            update.append(time.perf_counter() - start)
+
+        manager.store.close()
+        del manager
+        gc.collect()
+        return {
+            'load': load_time,
+            'create_mean': sum(create) / len(create),
+            'create_p99': percentile(create, 0.99),
+            'update_mean': sum(update) / len(update),
+            'update_p99': percentile(update, 0.99)
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='订单存储性能测试')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='历史订单数，逗号分隔')
+    parser.add_argument('--ops', type=int, default=20, help='每种规模下创建/更新的订单数')
+    parser.add_argument('--json-max-ops', type=int, default=3, help='json后端在100万订单时的操作数（每次要重写整个文件）')
+    parser.add_argument('--backends', default='json,sqlite', help='测试的后端，逗号分隔')
+    args = parser.parse_args()
+
+    print(f"{'后端':<8}{'订单数':>10}{'加载(s)':>10}{'创建均值(ms)':>14}{'创建p99':>10}{'更新均值(ms)':>14}{'更新p99':>10}")
+    for count in (int(size) for size in args.sizes.split(',')):
+        for backend in args.backends.split(','):
+            ops = args.ops if backend != 'json' or count < 1000000 else args.json_max_ops
+            result = run(backend, count, ops)
+            print(f"{backend:<10}{count:>10}{result['load']:>10.2f}"
+                  f"{result['create_mean'] * 1000:>14.2f}{result['create_p99'] * 1000:>12.2f}"
+                  f"{result['update_mean'] * 1000:>14.2f}{result['update_p99'] * 1000:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
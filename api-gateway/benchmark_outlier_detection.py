@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+被动健康检测测试
+本地启动几台GPU服务器替身，多个线程持续通过网关查询任务状态，运行中让其中一台替身下线，
+对比开启/关闭被动健康检测（熔断）时下线后失败的请求数和错误持续时间
+
+用法:
+    python benchmark_outlier_detection.py --servers 3 --clients 8
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class GpuHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        super().finish()
+        self.server.connections.discard(self.connection)
+
+    def do_GET(self):
+        if self.path == '/health':
+            body = {'status': 'healthy'}
+        else:
+            body = {'task_id': self.path.rsplit('/', 1)[-1], 'status': 'processing'}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGpuServer:
+    """GPU服务器替身，stop() 模拟进程退出"""
+
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), GpuHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.connections = set()
+        self.httpd.handle_error = lambda request, client_address: None
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for conn in list(self.httpd.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def run(enabled: bool, args) -> dict:
+    from app import app
+    from backend_manager import backend_manager, WEBHOOK_SECRET
+
+    backend_manager.outlier_detection_enabled = enabled
+    fakes = [FakeGpuServer() for _ in range(args.servers)]
+    for fake in fakes:
+        backend_manager.add_or_update_server('127.0.0.1', fake.port, WEBHOOK_SECRET)
+
+    results = []  # (时间, 状态码)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def client(n):
+        http = app.test_client()
+        i = 0
+        while not stop.is_set():
+            response = http.get(f'/api/v1/status/bench-{n}-{i}')
+            with lock:
+                results.append((time.monotonic(), response.status_code))
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(n,), daemon=True) for n in range(args.clients)]
+    for t in threads:
+        t.start()
+    time.sleep(args.kill_after)
+    killed_at = time.monotonic()
+    fakes[0].stop()
+    time.sleep(args.observe)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    for server_id in list(backend_manager.servers):
+        backend_manager.remove_server(server_id)
+    for fake in fakes[1:]:
+        fake.stop()
+
+    after = [(t, status) for t, status in results if t >= killed_at]
+    errors = [t for t, status in after if status != 200]
+    return {
+        'requests': len(after),
+        'errors': len(errors),
+        'burst': (max(errors) - killed_at) if errors else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='被动健康检测测试')
+    parser.add_argument('--servers', type=int, default=3, help='GPU服务器替身数量')
+    parser.add_argument('--clients', type=int, default=8, help='并发查询线程数')
+    parser.add_argument('--kill-after', type=float, default=2, help='多少秒后让一台替身下线')
+    parser.add_argument('--observe', type=float, default=8, help='下线后继续观察的时间(秒)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    from config import config
+    config.config['multi_backend'] = {'enabled': True, 'fallback_to_default': False}
+    config.config['rate_limit'] = {**config.get_rate_limit_config(), 'enabled': False}  # 压测请求都来自本机，不限流
+    from backend_manager import backend_manager
+    backend_manager.servers_file = os.path.join(tempfile.mkdtemp(), 'backend_servers.json')
+
+    print(f"替身 {args.servers} 台, 查询线程 {args.clients}, 第 {args.kill_after}s 下线一台")
+    for enabled in (False, True):
+        result = run(enabled, args)
+        print(f"被动检测{'开启' if enabled else '关闭'}: 下线后请求 {result['requests']}, "
+              f"失败 {result['errors']}, 错误持续 {result['burst']:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
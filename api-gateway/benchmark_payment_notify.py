@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+支付回调重放测试
+为N个待支付订单构造签名正确的支付成功回调，每个回调重复发送R次（模拟微信重发），
+通过Flask测试客户端调用 /api/wechat/pay/notify，统计：
+- 吞吐量（次/秒）
+- 订单存储写入次数、进程写入字节数（/proc/self/io 的 wchar）
+- 订单最终状态是否正确
+
+两种重发方式：
+- same: 每次重发的请求体完全相同
+- resigned: 每次重发使用新的nonce_str并重新签名
+
+用法:
+    python benchmark_payment_notify.py --orders 200 --repeat 20 --backend sqlite
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+
+def written_bytes():
+    """进程累计写入字节数（Linux）"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def build_notify(pay_config, order, nonce):
+    from wechat_pay_utils import WeChatPayUtils
+    params = {
+        'appid': pay_config.APPID,
+        'mch_id': pay_config.MCH_ID,
+        'nonce_str': nonce,
+        'return_code': 'SUCCESS',
+        'result_code': 'SUCCESS',
+        'openid': order['openid'],
+        'out_trade_no': order['out_trade_no'],
+        'transaction_id': f"4200{order['out_trade_no'][3:]}",
+        'total_fee': str(order['total_fee']),
+        'time_end': '20240101120000'
+    }
+    params['sign'] = WeChatPayUtils.sign_md5(params, pay_config.API_KEY)
+    return WeChatPayUtils.dict_to_xml(params).encode('utf-8')
+
+
+def run(gateway, backend, orders_count, repeat, mode, history):
+    from benchmark_order_store import prefill
+    from order_manager import OrderManager
+    from wechat_pay_config import WeChatPayConfig
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        if history:
+            prefill(backend, data_dir, history)
+        manager = OrderManager(data_dir=data_dir, backend=backend)
+        gateway.order_manager = manager
+        orders = [manager.create_order(f"onotify{i:06d}", 100, '照片增强服务') for i in range(orders_count)]
+
+        # 统计存储写入次数
+        writes = [0]
+        save = manager.store.save
+
+        def counting_save(*args, **kwargs):
+            writes[0] += 1
+            return save(*args, **kwargs)
+        manager.store.save = counting_save
+
+        bodies = []
+        for r in range(repeat):
+            for i, order in enumerate(orders):
+                nonce = 'n' * 32 if mode == 'same' else f"{r:08d}{i:024d}"
+                bodies.append(build_notify(gateway.pay_api.config, order, nonce))
+
+        client = gateway.app.test_client()
+        wchar = written_bytes()
+        failures = 0
+        start = time.perf_counter()
+        for body in bodies:
+            response = client.post('/api/wechat/pay/notify', data=body, content_type='text/xml')
+            failures += b'SUCCESS' not in response.data
+        elapsed = time.perf_counter() - start
+        wchar = written_bytes() - wchar
+
+        paid = sum(manager.get_order(o['out_trade_no'])['status'] == WeChatPayConfig.ORDER_STATUS_PAID
+                   for o in orders)
+        manager.store.close()
+        return {
+            'requests': len(bodies),
+            'rate': len(bodies) / elapsed,
+            'writes': writes[0],
+            'wchar': wchar,
+            'failures': failures,
+            'paid': paid
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='支付回调重放测试')
+    parser.add_argument('--orders', type=int, default=200, help='订单数')
+    parser.add_argument('--repeat', type=int, default=20, help='每个回调发送的次数')
+    parser.add_argument('--backend', default='sqlite', help='订单存储后端（sqlite/json）')
+    parser.add_argument('--history', type=int, default=10000, help='预先写入的历史订单数')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    # 未配置商户密钥时使用测试密钥（回调签名和验签使用同一个密钥）
+    os.environ.setdefault('WECHAT_API_KEY', 'benchmark-api-key-0123456789abcdef')
+    import app as gateway
+
+    print(f"{args.orders} 个订单, 每个回调发送 {args.repeat} 次, 后端 {args.backend}, 历史订单 {args.history}")
+    print(f"{'重发方式':<10}{'请求数':>8}{'吞吐(次/秒)':>14}{'存储写入':>10}{'写入(KB)':>12}{'失败':>6}{'已支付':>8}")
+    for mode in ('same', 'resigned'):
+        r = run(gateway, args.backend, args.orders, args.repeat, mode, args.history)
+        print(f"{mode:<12}{r['requests']:>10}{r['rate']:>14.0f}{r['writes']:>12}"
+              f"{r['wchar'] / 1024:>14.1f}{r['failures']:>8}{r['paid']:>8}")
+    gateway.backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+支付状态轮询压力测试
+启动一个本地的微信支付替身（/pay/orderquery，可设置响应延迟，统计收到的查询数），
+N个客户端线程同时轮询 /api/wechat/pay/query/<out_trade_no>（多个客户端轮询同一个订单），
+订单在 --pay-after 秒后变为已支付。对比关闭/开启查询合并时：
+- 发往微信的查询数，以及每个订单每秒的查询数
+- 客户端轮询延迟
+- 订单支付后客户端看到已支付的最长延迟
+
+用法:
+    python benchmark_payment_query.py --clients 100 --orders 10 --duration 10 --pay-after 6
+"""
+
+import argparse
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakePayHandler(BaseHTTPRequestHandler):
+    """微信支付orderquery接口替身"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        from wechat_pay_utils import WeChatPayUtils
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        out_trade_no = WeChatPayUtils.xml_to_dict(body.decode('utf-8')).get('out_trade_no')
+        with self.server.lock:
+            self.server.queries[out_trade_no] += 1
+        time.sleep(self.server.latency)
+
+        paid = self.server.paid_at is not None and time.time() >= self.server.paid_at
+        data = WeChatPayUtils.dict_to_xml({
+            'return_code': 'SUCCESS',
+            'result_code': 'SUCCESS',
+            'out_trade_no': out_trade_no,
+            'trade_state': 'SUCCESS' if paid else 'NOTPAY',
+            'transaction_id': f"4200{out_trade_no[3:]}" if paid else '',
+            'total_fee': '100',
+            'time_end': '20240101120000' if paid else ''
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def run(gateway, fake, args, coalesce):
+    from order_manager import OrderManager
+    from payment_query import PaymentQueryCache
+    from config import config
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        manager = OrderManager(data_dir=data_dir)
+        gateway.order_manager = manager
+        query_config = config.get_payment_query_config()
+        gateway.payment_query_cache = PaymentQueryCache(
+            enabled=coalesce,
+            pending_ttl=query_config["pending_ttl"],
+            error_ttl=query_config["error_ttl"],
+            terminal_ttl=query_config["terminal_ttl"],
+            max_entries=query_config["max_entries"],
+            wait_timeout=query_config["wait_timeout"]
+        )
+        orders = [manager.create_order(f"opoll{i:04d}", 100, '照片增强服务')['out_trade_no']
+                  for i in range(args.orders)]
+
+        fake.queries = Counter()
+        start = time.time()
+        fake.paid_at = start + args.pay_after
+        stop = start + args.duration
+        latencies, seen_paid = [], {}
+        lock = threading.Lock()
+
+        def client(index):
+            out_trade_no = orders[index % len(orders)]
+            http = gateway.app.test_client()
+            local = []
+            while time.time() < stop:
+                t0 = time.perf_counter()
+                response = http.get(f'/api/wechat/pay/query/{out_trade_no}')
+                local.append(time.perf_counter() - t0)
+                data = response.get_json() or {}
+                state = (data.get('data') or {})
+                if state.get('status') == 'PAID' or state.get('trade_state') == 'SUCCESS':
+                    seen_paid.setdefault(index, time.time())
+                time.sleep(args.interval)
+            with lock:
+                latencies.extend(local)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        upstream = sum(fake.queries.values())
+        visible = [seen_paid[i] - fake.paid_at for i in range(args.clients) if i in seen_paid]
+        manager.store.close()
+        return {
+            'requests': len(latencies),
+            'upstream': upstream,
+            'per_order_rate': upstream / len(orders) / args.duration,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'saw_paid': len(visible),
+            'paid_lag': max(visible) if visible else float('nan'),
+            'stats': gateway.payment_query_cache.get_stats()
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='支付状态轮询压力测试')
+    parser.add_argument('--clients', type=int, default=100, help='轮询客户端数')
+    parser.add_argument('--orders', type=int, default=10, help='订单数（客户端平均分配到各订单）')
+    parser.add_argument('--interval', type=float, default=0.05, help='每个客户端的轮询间隔（秒）')
+    parser.add_argument('--duration', type=float, default=10, help='测试时间（秒）')
+    parser.add_argument('--pay-after', type=float, default=6, help='订单在第几秒变为已支付')
+    parser.add_argument('--latency', type=float, default=0.1, help='微信接口替身的响应延迟（秒）')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    fake = ThreadingHTTPServer(('127.0.0.1', 0), FakePayHandler)
+    fake.daemon_threads = True
+    fake.lock = threading.Lock()
+    fake.latency = args.latency
+    fake.paid_at = None
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+
+    import app as gateway
+    gateway.rate_limiter.enabled = False  # 压测请求都来自本机，不限流
+    gateway.pay_api.config.ORDER_QUERY_URL = f"http://127.0.0.1:{fake.server_address[1]}/pay/orderquery"
+
+    print(f"{args.clients} 个客户端轮询 {args.orders} 个订单, 间隔 {args.interval}s, "
+          f"微信接口延迟 {args.latency}s, 第 {args.pay_after}s 支付")
+    for coalesce in (False, True):
+        r = run(gateway, fake, args, coalesce)
+        stats = r['stats']
+        print(f"{'开启合并' if coalesce else '关闭合并'}: 轮询 {r['requests']} 次, 发往微信 {r['upstream']} 次 "
+              f"(每订单 {r['per_order_rate']:.1f} 次/秒), 缓存命中 {stats['cache_hits']}, 合并 {stats['coalesced']}, "
+              f"延迟 p50 {r['p50'] * 1000:.1f}ms p99 {r['p99'] * 1000:.1f}ms, "
+              f"看到已支付 {r['saw_paid']}/{args.clients} 最长滞后 {r['paid_lag']:.2f}s")
+    gateway.backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+接口限流开销测试
+- 单次检查耗时：进程内存储 / 共享存储（内存映射文件），不同活跃key数，单线程和多线程
+- 热路径开销：通过Flask测试客户端请求 /api/v1/info，对比不限流和匹配一条规则时每个请求的耗时；
+  各情况预热后轮流测多轮（每轮换一次先后顺序），报告每个请求耗时的中位数，以及同一轮内与不限流之差的中位数和四分位范围
+- 每个活跃key的内存占用（tracemalloc）
+- 多进程准确性：多个进程同时对同一个key取令牌，放行总数应接近 burst + 速率 × 时间；
+  进程内存储每个进程各自计数，放行数随进程数成倍增加
+
+用法:
+    python benchmark_rate_limit.py --seconds 1 --keys 10,10000,100000 --processes 4 --rounds 15
+"""
+
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from rate_limiter import MemoryBucketStore, RateLimiter, RateRule, SharedBucketStore
+
+
+def make_limiter(store):
+    # 速率足够大，测试中不会触发限流
+    rules = [RateRule('bench_ip', ['bench'], 'ip', 1e9, 1, 1e9),
+             RateRule('bench_all', ['bench'], 'global', 1e9, 1, 1e9)]
+    return RateLimiter(rules, store)
+
+
+def check_rate(limiter, keys, seconds, threads=1):
+    """每秒检查次数"""
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(keys)]
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def worker(n):
+        count, i = 0, n
+        no_openid = lambda: None
+        while time.perf_counter() < deadline:
+            for _ in range(200):
+                limiter.check('bench', ips[i % keys], no_openid)
+                i += threads
+            count += 200
+        counts[n] = count
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def memory_per_key(keys):
+    """进程内存储每个活跃key的内存占用（字节）"""
+    store = MemoryBucketStore(max_entries=keys * 2)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    now = time.time()
+    for i in range(keys):
+        store.acquire(f"bench_ip:10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 1.0, 10.0, now)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used / keys
+
+
+def _quartiles(values):
+    """中位数和四分位范围 (p25, p50, p75)"""
+    if len(values) < 2:
+        return values[0], values[0], values[0]
+    p25, p50, p75 = statistics.quantiles(values, n=4, method='inclusive')
+    return p25, p50, p75
+
+
+def hot_path(seconds, rounds):
+    """
+    通过Flask请求 /api/v1/info：返回 {情况: 每个请求耗时的中位数(us)} 和
+    {情况: 同一轮内与不限流之差的 (p25, p50, p75)(us)}
+    """
+    logging.disable(logging.CRITICAL)
+    import app as gateway
+
+    http = gateway.app.test_client()
+    headers = {'X-Real-IP': '10.0.0.1'}
+    results = {}
+    original = gateway.rate_limiter
+    cases = [
+        ('不限流', RateLimiter([], MemoryBucketStore(1000), enabled=False)),
+        ('进程内存储', RateLimiter([RateRule('info_ip', ['api_info'], 'ip', 1e9, 1, 1e9)], MemoryBucketStore(1000))),
+    ]
+    path = os.path.join(tempfile.mkdtemp(), 'rate_limit')
+    shared = SharedBucketStore(path, 1024)
+    cases.append(('共享存储', RateLimiter([RateRule('info_ip', ['api_info'], 'ip', 1e9, 1, 1e9)], shared)))
+    samples = {name: [] for name, _ in cases}
+    try:
+        # 预热：每种情况先请求一段时间（建立桶、填充缓存），不计入结果
+        for _, limiter in cases:
+            gateway.rate_limiter = limiter
+            for _ in range(500):
+                http.get('/api/v1/info', headers=headers)
+        # 各情况在同一轮内相邻测量，每轮轮换先后顺序，机器负载波动对各情况的影响相近；
+        # 测量期间关闭垃圾回收，避免回收停顿随机落在某一种情况上
+        gc.collect()
+        gc.disable()
+        for r in range(rounds):
+            order = cases[r % len(cases):] + cases[:r % len(cases)]
+            for name, limiter in order:
+                gateway.rate_limiter = limiter
+                count = 0
+                start = time.perf_counter()
+                while time.perf_counter() - start < seconds / rounds:
+                    for _ in range(50):
+                        http.get('/api/v1/info', headers=headers)
+                    count += 50
+                samples[name].append((time.perf_counter() - start) / count * 1e6)
+    finally:
+        gc.enable()
+        gateway.rate_limiter = original
+        shared.close()
+        gateway.order_reconciler.stop()
+        gateway.backend_manager.stop_health_check()
+
+    base = samples['不限流']
+    results = {name: statistics.median(values) for name, values in samples.items()}
+    diffs = {name: _quartiles([us - b for us, b in zip(values, base)])
+             for name, values in samples.items() if name != '不限流'}
+    return results, diffs
+
+
+def _hammer(backend, path, limit, burst, seconds, start_at, queue):
+    """子进程：持续对同一个key取令牌，返回放行次数"""
+    store = SharedBucketStore(path, 1024) if backend == 'shared' else MemoryBucketStore(1000)
+    limiter = RateLimiter([RateRule('bench_all', ['bench'], 'global', limit, 1, burst)], store)
+    while time.time() < start_at:
+        time.sleep(0.001)
+    allowed = 0
+    while time.time() < start_at + seconds:
+        if limiter.check('bench', '', lambda: None) is None:
+            allowed += 1
+    queue.put(allowed)
+
+
+def multi_process(backend, processes, limit, burst, seconds):
+    path = os.path.join(tempfile.mkdtemp(), 'rate_limit')
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    start_at = time.time() + 0.5
+    procs = [ctx.Process(target=_hammer, args=(backend, path, limit, burst, seconds, start_at, queue))
+             for _ in range(processes)]
+    for p in procs:
+        p.start()
+    allowed = sum(queue.get() for _ in procs)
+    for p in procs:
+        p.join()
+    return allowed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='接口限流开销测试')
+    parser.add_argument('--seconds', type=float, default=1.0, help='每项测试时间（秒）')
+    parser.add_argument('--keys', default='10,10000,100000', help='活跃key数，逗号分隔')
+    parser.add_argument('--threads', type=int, default=8, help='多线程测试的线程数')
+    parser.add_argument('--processes', type=int, default=4, help='多进程测试的进程数')
+    parser.add_argument('--limit', type=float, default=1000, help='多进程测试的速率（次/秒）')
+    parser.add_argument('--burst', type=float, default=100, help='多进程测试的桶容量')
+    parser.add_argument('--rounds', type=int, default=15, help='热路径测试的轮数（各情况共用--seconds）')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'rate_limit')
+    print(f"{'存储':<8}{'活跃key':>10}{'单线程(次/秒)':>16}{'单次(us)':>10}{f'{args.threads}线程(次/秒)':>16}")
+    for keys in (int(k) for k in args.keys.split(',')):
+        for name, store in (('进程内', MemoryBucketStore(max_entries=keys * 2)),
+                            ('共享', SharedBucketStore(path, keys * 4))):
+            limiter = make_limiter(store)
+            single = check_rate(limiter, keys, args.seconds)
+            multi = check_rate(limiter, keys, args.seconds, args.threads)
+            print(f"{name:<8}{keys:>12}{single:>16,.0f}{1e6 / single:>12.2f}{multi:>16,.0f}")
+            if isinstance(store, SharedBucketStore):
+                store.close()
+
+    keys = max(int(k) for k in args.keys.split(','))
+    print(f"\n每个活跃key的内存: 进程内 {memory_per_key(keys):.0f}B, 共享 {SharedBucketStore._SLOT.size}B（固定槽位）")
+
+    print(f"\n热路径（Flask测试客户端请求 /api/v1/info，{args.rounds} 轮中位数）:")
+    results, diffs = hot_path(args.seconds, args.rounds)
+    for name, us in results.items():
+        line = f"  {name}: {us:.1f}us"
+        if name in diffs:
+            p25, p50, p75 = diffs[name]
+            # 四分位范围包含0时差异在测量噪声以内
+            line += f"（差 {p50:+.1f}us，四分位 {p25:+.1f} ~ {p75:+.1f}us）"
+        print(line)
+
+    expected = args.burst + args.limit * args.seconds
+    print(f"\n{args.processes} 个进程同时取同一个key的令牌 {args.seconds}s（速率 {args.limit:.0f}/s, 容量 {args.burst:.0f}, "
+          f"预期放行约 {expected:.0f}）:")
+    for backend in ('memory', 'shared'):
+        allowed = multi_process(backend, args.processes, args.limit, args.burst, args.seconds)
+        print(f"  {'进程内存储' if backend == 'memory' else '共享存储'}: 放行 {allowed}（{allowed / expected:.2f}倍）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结果缓存下载测试
+本地启动一台GPU服务器替身（/api/v1/download/<task_id> 返回固定大小的图片，可限制每个下载的发送速率，
+统计发出的字节数），网关以多线程HTTP服务运行，若干客户端并发下载一批任务的结果，每个结果下载多次。
+对比：
+- 关闭缓存：每次下载都从GPU服务器转发
+- 缓存（冷）：第一次下载，边转发边写入磁盘
+- 缓存（热）：再次下载，由网关从磁盘发送
+统计下载吞吐量（MB/s）、每次下载的延迟、GPU服务器出口流量
+（配置X-Accel-Redirect后热缓存由nginx发送，本测试不包含nginx）
+
+用法:
+    python benchmark_result_cache.py --tasks 50 --size-kb 2048 --clients 8 --backend-mbps 200
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+class GpuHandler(BaseHTTPRequestHandler):
+    """GPU服务器替身：返回固定大小的结果，按设定的带宽发送"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/health':
+            data = b'{"status": "healthy"}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        payload = server.payload
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        chunk = 64 * 1024
+        started = time.perf_counter()
+        for offset in range(0, len(payload), chunk):
+            self.wfile.write(payload[offset:offset + chunk])
+            with server.lock:
+                server.sent += min(chunk, len(payload) - offset)
+            if server.bytes_per_second:
+                # 按带宽限速
+                delay = (offset + chunk) / server.bytes_per_second - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GpuServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def download_round(url, tasks, clients, repeat):
+    """每个任务下载repeat次，返回 (耗时, 字节数, 延迟列表)"""
+    local = threading.local()
+    latencies = []
+    lock = threading.Lock()
+
+    def download(task_id):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        response = session.get(f"{url}/api/v1/download/{task_id}", timeout=60)
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(f"下载失败: {response.status_code}")
+        with lock:
+            latencies.append(elapsed)
+        return len(response.content)
+
+    jobs = [task for task in tasks for _ in range(repeat)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        total = sum(pool.map(download, jobs))
+    return time.perf_counter() - start, total, latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='结果缓存下载测试')
+    parser.add_argument('--tasks', type=int, default=50, help='任务数')
+    parser.add_argument('--size-kb', type=int, default=2048, help='每个结果的大小（KB）')
+    parser.add_argument('--clients', type=int, default=8, help='并发下载数')
+    parser.add_argument('--repeat', type=int, default=3, help='每个结果的下载次数（热缓存测试）')
+    parser.add_argument('--backend-mbps', type=float, default=200, help='GPU服务器每个下载的发送速率（Mbit/s，0为不限）')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    from config import config
+    config.config['multi_backend'] = {'enabled': True, 'fallback_to_default': False}
+    from backend_manager import backend_manager, WEBHOOK_SECRET
+    backend_manager.servers_file = os.path.join(tempfile.mkdtemp(), 'backend_servers.json')
+    import app as gateway
+    gateway.rate_limiter.enabled = False  # 压测请求都来自本机，不限流
+    from result_cache import ResultCache
+    from werkzeug.serving import make_server
+
+    gpu = GpuServer(('127.0.0.1', 0), GpuHandler)
+    gpu.payload = os.urandom(args.size_kb * 1024)
+    gpu.bytes_per_second = args.backend_mbps * 1e6 / 8
+    gpu.lock = threading.Lock()
+    gpu.sent = 0
+    threading.Thread(target=gpu.serve_forever, daemon=True).start()
+    backend_manager.add_or_update_server('127.0.0.1', gpu.server_address[1], WEBHOOK_SECRET)
+
+    port = free_port()
+    httpd = make_server('127.0.0.1', port, gateway.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{port}"
+
+    print(f"{args.tasks} 个任务 × {args.size_kb}KB, {args.clients} 个并发下载, "
+          f"GPU每个下载 {args.backend_mbps or '不限'}Mbit/s")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cases = [('关闭缓存', False, args.repeat), ('缓存（冷）', True, 1), ('缓存（热）', True, args.repeat)]
+        cache = None
+        for name, enabled, repeat in cases:
+            if cache is None or cache.enabled != enabled:
+                cache = ResultCache(cache_dir, max_bytes=10 * 1024 ** 3, max_entry_bytes=1024 ** 3,
+                                    ttl=3600, enabled=enabled)
+                gateway.result_cache = cache
+            sent_before = gpu.sent
+            tasks = [f"task-{i}" for i in range(args.tasks)]
+            elapsed, total, latencies = download_round(url, tasks, args.clients, repeat)
+            egress = gpu.sent - sent_before
+            print(f"  {name}: {len(latencies)} 次下载 {elapsed:.2f}s, {total / elapsed / 1024 / 1024:.1f}MB/s, "
+                  f"p50 {percentile(latencies, 0.5) * 1000:.1f}ms p99 {percentile(latencies, 0.99) * 1000:.1f}ms, "
+                  f"GPU出口 {egress / 1024 / 1024:.1f}MB")
+        stats = gateway.result_cache.get_stats()
+        print(f"缓存统计: 命中 {stats['hits']}, 未命中 {stats['misses']}, 写入 {stats['fills']}, "
+              f"{stats['entries']} 个 {stats['bytes'] / 1024 / 1024:.1f}MB")
+    finally:
+        httpd.shutdown()
+        gpu.shutdown()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        gateway.order_reconciler.stop()
+        backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+服务器注册表并发压力测试
+多个线程同时注册/注销GPU服务器、选择服务器、按地址查找、读取统计信息，
+健康检测线程同时在运行，检查：
+- 是否出现异常（如 "dictionary changed size during iteration"）
+- 注册表索引是否一致（同一地址只有一台服务器，按地址/URL都能找到）
+- 选择服务器的吞吐量
+
+所有服务器替身共用一个监听 0.0.0.0 的 /health 接口，用 127.0.0.x 区分地址
+
+用法:
+    python benchmark_server_registry.py --duration 10 --addresses 50
+"""
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"status": "healthy"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ErrorCounter(logging.Handler):
+    """统计backend_manager记录的错误日志（其方法内部捕获异常后只记录日志）"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        # 服务器被熔断/标记不可用属于正常业务日志
+        if '失败' in message or '出错' in message:
+            self.records.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='服务器注册表并发压力测试')
+    parser.add_argument('--duration', type=float, default=10, help='测试时间(秒)')
+    parser.add_argument('--addresses', type=int, default=50, help='参与注册的地址数量')
+    parser.add_argument('--registers', type=int, default=4, help='注册线程数')
+    parser.add_argument('--unregisters', type=int, default=4, help='注销线程数')
+    parser.add_argument('--selectors', type=int, default=8, help='选择服务器的线程数')
+    parser.add_argument('--readers', type=int, default=2, help='读取统计信息的线程数')
+    args = parser.parse_args()
+
+    httpd = ThreadingHTTPServer(('0.0.0.0', 0), HealthHandler)
+    httpd.daemon_threads = True
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    from backend_manager import BackendManager, WEBHOOK_SECRET
+    errors = ErrorCounter()
+    logging.getLogger('backend_manager').addHandler(errors)
+    logging.getLogger('backend_manager').propagate = False
+    manager = BackendManager(servers_file=os.path.join(tempfile.mkdtemp(), 'backend_servers.json'))
+
+    addresses = [f'127.0.0.{i}' for i in range(1, args.addresses + 1)]
+    stop = threading.Event()
+    counters = {'register': 0, 'unregister': 0, 'select': 0, 'lookup': 0, 'stats': 0}
+    exceptions = []
+    lock = threading.Lock()
+
+    def worker(kind):
+        rng = random.Random()
+        count = 0
+        try:
+            while not stop.is_set():
+                ip = rng.choice(addresses)
+                if kind == 'register':
+                    success, _ = manager.add_or_update_server(ip, port, WEBHOOK_SECRET, weight=rng.randint(1, 4))
+                    if not success:
+                        exceptions.append('注册失败')
+                elif kind == 'unregister':
+                    server_id = manager.servers.find_by_address(ip, port)
+                    if server_id:
+                        manager.remove_server(server_id)
+                elif kind == 'select':
+                    server = manager.get_next_server()
+                    if server:
+                        manager.get_server_by_url(server.url)
+                        server.begin_request()
+                        server.end_request()
+                elif kind == 'lookup':
+                    manager.get_server_urls()
+                else:
+                    manager.get_stats()
+                count += 1
+        except Exception as e:
+            exceptions.append(f'{kind}: {type(e).__name__}: {e}')
+        with lock:
+            counters[kind] += count
+
+    threads = []
+    for kind, n in (('register', args.registers), ('unregister', args.unregisters),
+                    ('select', args.selectors), ('lookup', args.readers), ('stats', args.readers)):
+        threads += [threading.Thread(target=worker, args=(kind,), daemon=True) for _ in range(n)]
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    manager.stop_health_check()
+
+    # 索引一致性检查
+    inconsistent = []
+    seen = {}
+    for server_id, server in manager.servers.items():
+        address = (server.ip, server.port)
+        if address in seen:
+            inconsistent.append(f'地址重复: {address} -> {seen[address]}, {server_id}')
+        seen[address] = server_id
+        if manager.servers.find_by_address(server.ip, server.port) != server_id:
+            inconsistent.append(f'地址索引不一致: {server_id}')
+        if manager.get_server_by_url(server.url) is not server:
+            inconsistent.append(f'URL索引不一致: {server_id}')
+
+    print(f"{args.duration:.0f}秒, {args.addresses}个地址, "
+          f"注册{args.registers}/注销{args.unregisters}/选择{args.selectors}/读取{args.readers * 2}线程")
+    for kind, count in counters.items():
+        print(f"  {kind:<11}{count:>10} 次  {count / args.duration:>10.0f} 次/秒")
+    print(f"异常: {len(exceptions)}  错误日志: {len(errors.records)}  索引不一致: {len(inconsistent)}  "
+          f"剩余服务器: {len(manager.servers)}  健康检测轮数: {manager.health_stats.to_dict()['sweeps']}")
+    for message in (exceptions + errors.records + inconsistent)[:10]:
+        print(f"  {message}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程共享状态测试
+模拟gunicorn多worker部署：启动多个进程，每个进程导入 backend_manager（与worker相同），
+对比独立模式（默认）与共享模式（shared_state.enabled）下：
+- 健康检测流量：所有GPU服务器替身共用一个 /health 接口，统计每秒收到的检测请求数
+- 注册传播：通过第一个进程注册新服务器，统计其余进程看到新服务器的耗时
+
+用法:
+    python benchmark_shared_state.py --workers 8 --servers 10 --register 5
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.probes += 1
+        body = b'{"status": "healthy"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def worker(index, shared, workdir, commands, results):
+    """模拟一个gunicorn worker"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    os.environ['BACKEND_SERVERS_FILE'] = os.path.join(workdir, 'backend_servers.json')
+    from config import config
+    config.config['shared_state'] = {**config.get_shared_state_config(),
+                                     'enabled': shared, 'path': os.path.join(workdir, 'backend_state.db')}
+    from backend_manager import backend_manager, WEBHOOK_SECRET
+
+    results.put(('ready', index, None, time.time()))
+    seen = set()
+    while True:
+        try:
+            command = commands.get(timeout=0.002)
+        except queue.Empty:
+            command = None
+        if command == 'stop':
+            break
+        if command:
+            ip, port = command
+            backend_manager.add_or_update_server(ip, port, WEBHOOK_SECRET)
+        for server in list(backend_manager.servers.values()):
+            if server.ip not in seen:
+                seen.add(server.ip)
+                results.put(('seen', index, server.ip, time.time()))
+    results.put(('prober', index, backend_manager.running, time.time()))
+
+
+def run(shared: bool, args, port: int, httpd) -> dict:
+    workdir = tempfile.mkdtemp()
+    # 启动前已保存的服务器（所有worker启动时加载）
+    preloaded = [{'server_id': f'GPU-{i:03d}', 'ip': f'127.0.0.{i}', 'port': port, 'weight': 1}
+                 for i in range(1, args.servers + 1)]
+    with open(os.path.join(workdir, 'backend_servers.json'), 'w') as f:
+        json.dump(preloaded, f)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    commands = [ctx.Queue() for _ in range(args.workers)]
+    procs = [ctx.Process(target=worker, args=(i, shared, workdir, commands[i], results), daemon=True)
+             for i in range(args.workers)]
+    for proc in procs:
+        proc.start()
+
+    events = []
+    ready = 0
+    while ready < args.workers:
+        event = results.get(timeout=60)
+        events.append(event)
+        ready += event[0] == 'ready'
+
+    # 稳定后统计健康检测流量
+    time.sleep(args.warmup)
+    httpd.probes = 0
+    time.sleep(args.observe)
+    probe_rate = httpd.probes / args.observe
+
+    # 通过第一个worker注册新服务器
+    registered = {}
+    for i in range(args.register):
+        ip = f'127.0.1.{i + 1}'
+        registered[ip] = time.time()
+        commands[0].put((ip, port))
+        time.sleep(0.2)
+    time.sleep(args.propagation_wait)
+
+    for q in commands:
+        q.put('stop')
+    probers = 0
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            event = results.get(timeout=1)
+        except queue.Empty:
+            continue
+        events.append(event)
+        if event[0] == 'prober':
+            probers += bool(event[2])
+            if sum(e[0] == 'prober' for e in events) == args.workers:
+                break
+    for proc in procs:
+        proc.join(timeout=10)
+
+    latencies = []
+    for kind, index, ip, at in events:
+        if kind == 'seen' and ip in registered:
+            latencies.append(at - registered[ip])
+    expected = args.register * args.workers
+    latencies.sort()
+    return {
+        'probe_rate': probe_rate,
+        'probers': probers,
+        'propagated': len(latencies),
+        'expected': expected,
+        'p50': latencies[len(latencies) // 2] if latencies else 0.0,
+        'max': latencies[-1] if latencies else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多进程共享状态测试')
+    parser.add_argument('--workers', type=int, default=8, help='worker进程数')
+    parser.add_argument('--servers', type=int, default=10, help='启动前已保存的GPU服务器数')
+    parser.add_argument('--register', type=int, default=5, help='运行中新注册的服务器数')
+    parser.add_argument('--warmup', type=float, default=3, help='统计检测流量前的等待时间(秒)')
+    parser.add_argument('--observe', type=float, default=10, help='统计检测流量的时间(秒)')
+    parser.add_argument('--propagation-wait', type=float, default=3, help='注册后等待传播的时间(秒)')
+    args = parser.parse_args()
+
+    httpd = ThreadingHTTPServer(('0.0.0.0', 0), HealthHandler)
+    httpd.daemon_threads = True
+    httpd.probes = 0
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    print(f"worker {args.workers} 个, 已保存服务器 {args.servers} 台, 运行中通过worker 0注册 {args.register} 台")
+    for shared in (False, True):
+        result = run(shared, args, port, httpd)
+        print(f"{'共享模式' if shared else '独立模式'}: 健康检测 {result['probe_rate']:.1f} 次/秒 "
+              f"(负责检测的进程 {result['probers']} 个), "
+              f"注册传播 {result['propagated']}/{result['expected']} "
+              f"p50 {result['p50'] * 1000:.0f}ms 最大 {result['max'] * 1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
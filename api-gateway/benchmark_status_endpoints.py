@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+健康检查/API信息接口开销测试
+本地启动几台GPU服务器替身（统计收到的 /health 请求数），通过Flask测试客户端反复请求
+/api/v1/health 和 /api/v1/info，对比：
+- 原方式：每次健康检查选一台服务器（推进轮询位置）并同步请求它的 /health；
+  API信息每次调用get_backend_url并序列化所有服务器的实时统计
+- 状态快照：返回健康检测维护的快照，带If-None-Match时返回304
+统计每个请求的耗时、发往后端的请求数、负载均衡轮询位置被推进的次数，
+以及不经过Flask时生成响应内容的耗时（Flask测试客户端本身每个请求有几百微秒的固定开销）
+
+用法:
+    python benchmark_status_endpoints.py --servers 8 --requests 2000
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin
+
+
+class GpuHandler(BaseHTTPRequestHandler):
+    """GPU服务器替身：只响应 /health"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits += 1
+        data = json.dumps({'status': 'healthy'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GpuServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def register_legacy_routes(gateway):
+    """原方式的两个接口，挂在 /legacy 下用于对比"""
+    from flask import jsonify
+
+    config = gateway.config
+    backend_manager = gateway.backend_manager
+
+    @gateway.app.route('/legacy/health')
+    def legacy_health():
+        backend_url = config.get_backend_url()
+        response = backend_manager.get_session(backend_url).get(urljoin(backend_url, '/health'), timeout=5)
+        return jsonify({
+            'status': 'healthy',
+            'backend_status': 'connected',
+            'backend_url': backend_url,
+            'backend_response': response.status_code,
+            'timestamp': time.time()
+        })
+
+    @gateway.app.route('/legacy/info')
+    def legacy_info():
+        info = config.get_config_info()
+        info['backend_url'] = config.get_backend_url()
+        return jsonify({'config_info': info, 'task_affinity': gateway.task_router.get_stats()})
+
+
+def cursor_position(backend_manager):
+    """轮询计数器的当前位置（读取本身会推进一次，调用方扣除）"""
+    return next(backend_manager.strategy.counter)
+
+
+def measure(gateway, fakes, path, requests, conditional=False):
+    http = gateway.app.test_client()
+    headers = {}
+    if conditional:
+        headers['If-None-Match'] = http.get(path).headers['ETag']
+    hits_before = sum(f.hits for f in fakes)
+    cursor_before = cursor_position(gateway.backend_manager)
+    statuses = set()
+    start = time.perf_counter()
+    for _ in range(requests):
+        statuses.add(http.get(path, headers=headers).status_code)
+    elapsed = time.perf_counter() - start
+    return {
+        'us': elapsed / requests * 1e6,
+        'backend_hits': sum(f.hits for f in fakes) - hits_before,
+        'cursor': cursor_position(gateway.backend_manager) - cursor_before - 1,
+        'statuses': sorted(statuses)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='健康检查/API信息接口开销测试')
+    parser.add_argument('--servers', type=int, default=8, help='GPU服务器替身数量')
+    parser.add_argument('--requests', type=int, default=2000, help='每项测试的请求数')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    from config import config
+    config.config['multi_backend'] = {'enabled': True, 'fallback_to_default': False}
+    config.config['load_balancing'] = {**config.config.get('load_balancing', {}), 'strategy': 'round_robin'}
+    from backend_manager import backend_manager, WEBHOOK_SECRET
+    backend_manager.servers_file = os.path.join(tempfile.mkdtemp(), 'backend_servers.json')
+    import app as gateway
+    gateway.rate_limiter.enabled = False  # 压测请求都来自本机，不限流
+    register_legacy_routes(gateway)
+
+    fakes = []
+    for _ in range(args.servers):
+        fake = GpuServer(('127.0.0.1', 0), GpuHandler)
+        fake.lock = threading.Lock()
+        fake.hits = 0
+        threading.Thread(target=fake.serve_forever, daemon=True).start()
+        backend_manager.add_or_update_server('127.0.0.1', fake.server_address[1], WEBHOOK_SECRET)
+        fakes.append(fake)
+
+    time.sleep(0.5)  # 等待新注册服务器的首次检测完成
+    # 停止主动健康检测，后端收到的请求只来自被测接口
+    backend_manager.stop_health_check()
+    time.sleep(0.5)
+
+    print(f"GPU替身 {args.servers} 台, 每项 {args.requests} 个请求, 负载均衡策略 {backend_manager.strategy.name}")
+    cases = [
+        ('原方式 /health', '/legacy/health', False),
+        ('快照 /health', '/api/v1/health', False),
+        ('快照 /health 304', '/api/v1/health', True),
+        ('原方式 /info', '/legacy/info', False),
+        ('快照 /info', '/api/v1/info', False),
+        ('快照 /info 304', '/api/v1/info', True),
+    ]
+    for name, path, conditional in cases:
+        r = measure(gateway, fakes, path, args.requests, conditional)
+        print(f"  {name:<18}{r['us']:>10.1f}us/请求, 后端请求 {r['backend_hits']}, "
+              f"轮询位置推进 {r['cursor']}, 状态码 {r['statuses']}")
+
+    # 不经过Flask，只看生成响应内容本身的耗时
+    print("\n响应内容（不含Flask请求处理）:")
+    for name, func in (('实时统计 get_config_info', config.get_config_info),
+                       ('快照 status_snapshots.get', lambda: gateway.status_snapshots.get('info'))):
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            func()
+        print(f"  {name:<28}{(time.perf_counter() - start) / args.requests * 1e6:>8.2f}us")
+
+    # 状态变化后快照重新生成，ETag随之变化
+    http = gateway.app.test_client()
+    etag = http.get('/api/v1/health').headers['ETag']
+    backend_manager.remove_server(next(iter(backend_manager.servers)))
+    response = http.get('/api/v1/health', headers={'If-None-Match': etag})
+    print(f"\n注销一台服务器后带旧ETag请求: {response.status_code}, "
+          f"可用服务器 {response.get_json()['backend_servers']['available']}")
+    print(f"快照统计: {gateway.status_snapshots.get_stats()}")
+
+    for fake in fakes:
+        fake.shutdown()
+        fake.server_close()
+    gateway.order_reconciler.stop()
+    backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上传内存基准测试
+并发上传多个大文件到本地网关（后端为本地替身服务），
+分别记录缓冲转发和流式转发两种模式下网关进程的峰值内存（RSS）
+
+用法:
+    python benchmark_upload_memory.py --clients 8 --size-mb 50
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+BOUNDARY = "----PhotoEnhanceBenchmarkBoundary"
+CHUNK = 1024 * 1024
+
+
+class StandInBackendHandler(BaseHTTPRequestHandler):
+    """GPU服务器替身：分块读取并丢弃上传内容，返回task_id"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _discard_body(self) -> int:
+        total = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                while size > 0:
+                    data = self.rfile.read(min(size, CHUNK))
+                    size -= len(data)
+                    total += len(data)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, CHUNK))
+                if not data:
+                    break
+                remaining -= len(data)
+                total += len(data)
+        return total
+
+    def do_POST(self):
+        received = self._discard_body()
+        body = json.dumps({'task_id': f'bench-{time.time_ns()}', 'received': received}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SyntheticUpload:
+    """按块生成multipart请求体，客户端本身不占用大量内存"""
+
+    def __init__(self, size: int):
+        self.head = (
+            f'--{BOUNDARY}\r\n'
+            f'Content-Disposition: form-data; name="file"; filename="bench.jpg"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n'
+        ).encode()
+        self.tail = f'\r\n--{BOUNDARY}--\r\n'.encode()
+        self.size = size
+        self.len = len(self.head) + size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        block = b'\xff' * CHUNK
+        remaining = self.size
+        while remaining > 0:
+            n = min(remaining, CHUNK)
+            yield block[:n]
+            remaining -= n
+        yield self.tail
+
+
+def read_memory_kb(pid: int) -> dict:
+    """读取进程当前RSS和峰值RSS（仅Linux）"""
+    result = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                key, value = line.split(':', 1)
+                result[key] = int(value.split()[0])
+    return result
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve_gateway(mode: str, backend_url: str, port: int):
+    """子进程：以指定模式启动网关"""
+    from config import config
+    config.config['backend_api_base'] = backend_url
+    config.config['multi_backend'] = {'enabled': False, 'fallback_to_default': False}
+    config.config['rate_limit'] = {**config.get_rate_limit_config(), 'enabled': False}  # 压测请求都来自本机，不限流
+    config.config['max_file_size'] = 1024 * 1024 * 1024
+    config.config['streaming_upload'] = {
+        **config.get_streaming_upload_config(),
+        'enabled': mode == 'streaming'
+    }
+
+    import logging
+    from app import app
+    from werkzeug.serving import make_server
+    logging.getLogger().setLevel(logging.WARNING)
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def run_mode(mode: str, backend_url: str, clients: int, size: int) -> dict:
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve-gateway', mode,
+         '--backend', backend_url, '--port', str(port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        url = f'http://127.0.0.1:{port}/api/v1/enhance'
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        before = read_memory_kb(proc.pid)
+
+        def upload(_):
+            response = requests.post(
+                url,
+                data=SyntheticUpload(size),
+                headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'},
+                timeout=600
+            )
+            return response.status_code
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            statuses = list(pool.map(upload, range(clients)))
+        elapsed = time.time() - start
+
+        after = read_memory_kb(proc.pid)
+        return {
+            'mode': mode,
+            'ok': statuses.count(200),
+            'failed': len(statuses) - statuses.count(200),
+            'elapsed_s': round(elapsed, 2),
+            'rss_before_mb': round(before['VmRSS'] / 1024, 1),
+            'rss_peak_mb': round(after['VmHWM'] / 1024, 1),
+            'rss_growth_mb': round((after['VmHWM'] - before['VmRSS']) / 1024, 1)
+        }
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='网关上传内存基准测试')
+    parser.add_argument('--clients', type=int, default=8, help='并发上传数')
+    parser.add_argument('--size-mb', type=int, default=50, help='每个文件大小(MB)')
+    parser.add_argument('--modes', default='buffered,streaming', help='测试的模式，逗号分隔')
+    parser.add_argument('--serve-gateway', help=argparse.SUPPRESS)
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_gateway:
+        serve_gateway(args.serve_gateway, args.backend, args.port)
+        return
+
+    backend = ThreadingHTTPServer(('127.0.0.1', 0), StandInBackendHandler)
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+    backend_url = f'http://127.0.0.1:{backend.server_port}'
+
+    print(f"并发数: {args.clients}, 文件大小: {args.size_mb}MB")
+    for mode in args.modes.split(','):
+        result = run_mode(mode, backend_url, args.clients, args.size_mb * 1024 * 1024)
+        print(
+            f"{result['mode']:>10}: 成功 {result['ok']} 失败 {result['failed']} "
+            f"耗时 {result['elapsed_s']}s  RSS 启动 {result['rss_before_mb']}MB "
+            f"峰值 {result['rss_peak_mb']}MB  增长 {result['rss_growth_mb']}MB"
+        )
+
+    backend.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信登录突发压力测试
+启动一个本地的微信登录替身（/sns/jscode2session，可设置响应延迟；与微信一致，同一个code只能使用一次，
+重复使用返回40163），N个客户端同时登录（其中一部分重复提交同一个code），每个客户端随后调用M次订单列表接口。
+对比两种方式：
+- 原方式：每次登录请求都调用jscode2session；之后的每次调用前都重新登录（wx.login换新code）获取openid
+- 会话令牌：登录一次，之后的调用携带令牌，由网关按令牌查找会话
+统计登录/接口延迟、发往微信的请求数和失败数
+
+用法:
+    python benchmark_wechat_login.py --clients 200 --calls 5 --duplicate 0.3 --latency 0.1
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeAuthHandler(BaseHTTPRequestHandler):
+    """微信jscode2session接口替身"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        code = parse_qs(urlparse(self.path).query).get('js_code', [''])[0]
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.calls += 1
+            reused = code in server.used
+            server.used.add(code)
+        if reused:
+            reply = {'errcode': 40163, 'errmsg': 'code been used'}
+        else:
+            # code格式：code-<用户>-<序号>
+            reply = {'openid': f"o{code.split('-')[1]}", 'session_key': f"sk{random.getrandbits(64):016x}"}
+        data = json.dumps(reply).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAuthServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 登录突发时同时建立大量连接
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def legacy_login(store):
+    """原方式：每次登录请求都调用jscode2session"""
+    def login(code, exchange):
+        result = exchange(code)
+        if result['success']:
+            return store._create(result['data'], time.time())
+        return result
+    return login
+
+
+def run(gateway, fake, args, use_token):
+    from order_manager import OrderManager
+    from session_store import SessionStore
+    from config import config
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        manager = OrderManager(data_dir=data_dir)
+        gateway.order_manager = manager
+        session_config = config.get_auth_session_config()
+        store = SessionStore(
+            path=os.path.join(data_dir, 'auth_sessions.db'),
+            ttl=session_config["ttl"],
+            max_entries=session_config["max_entries"],
+            code_ttl=session_config["code_ttl"],
+            require_token=False,
+            expose_session_key=False
+        )
+        if not use_token:
+            store.login = legacy_login(store)
+        gateway.session_store = store
+        for i in range(args.clients):
+            manager.create_order(f"o{i:05d}", 100, '照片增强服务')
+
+        fake.calls = 0
+        fake.used = set()
+        rng = random.Random(0)
+        duplicates = {i for i in range(args.clients) if rng.random() < args.duplicate}
+        login_latencies, call_latencies = [], []
+        failures = Counter()
+        lock = threading.Lock()
+        barrier = threading.Barrier(args.clients)
+
+        def login(http, code, out):
+            t0 = time.perf_counter()
+            response = http.post('/api/wechat/auth/openid', json={'code': code})
+            out.append((time.perf_counter() - t0, response.status_code, response.get_json()))
+
+        def client(index):
+            http = gateway.app.test_client()
+            logins, calls = [], []
+            seq = 0
+
+            def do_login():
+                nonlocal seq
+                code = f"code-{index:05d}-{seq}"
+                seq += 1
+                results = []
+                # 重复提交：两个请求同时使用同一个code
+                threads = [threading.Thread(target=login, args=(gateway.app.test_client(), code, results))
+                           for _ in range(2 if index in duplicates and seq == 1 else 1)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                ok = None
+                for latency, status, body in results:
+                    logins.append(latency)
+                    if status == 200:
+                        ok = body['data']
+                    else:
+                        failures['登录失败'] += 1
+                return ok
+
+            barrier.wait()
+            session = do_login()
+            for _ in range(args.calls):
+                if not use_token:
+                    session = do_login() or session
+                if session is None:
+                    failures['未登录'] += 1
+                    continue
+                headers = {'Authorization': f"Bearer {session['token']}"} if use_token else {}
+                t0 = time.perf_counter()
+                response = http.get(f"/api/wechat/pay/orders/{session['openid']}", headers=headers)
+                calls.append(time.perf_counter() - t0)
+                if response.status_code != 200 or len(response.get_json()['data']) != 1:
+                    failures['接口失败'] += 1
+            with lock:
+                login_latencies.extend(logins)
+                call_latencies.extend(calls)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        manager.store.close()
+        return {
+            'elapsed': elapsed,
+            'upstream': fake.calls,
+            'logins': len(login_latencies),
+            'login_p50': percentile(login_latencies, 0.5),
+            'login_p99': percentile(login_latencies, 0.99),
+            'calls': len(call_latencies),
+            'call_p50': percentile(call_latencies, 0.5),
+            'call_p99': percentile(call_latencies, 0.99),
+            'failures': dict(failures),
+            'stats': store.get_stats()
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='微信登录突发压力测试')
+    parser.add_argument('--clients', type=int, default=200, help='同时登录的客户端数')
+    parser.add_argument('--calls', type=int, default=5, help='每个客户端登录后的接口调用次数')
+    parser.add_argument('--duplicate', type=float, default=0.3, help='重复提交登录请求的客户端比例')
+    parser.add_argument('--latency', type=float, default=0.1, help='微信登录接口替身的响应延迟（秒）')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    fake = FakeAuthServer(('127.0.0.1', 0), FakeAuthHandler)
+    fake.lock = threading.Lock()
+    fake.latency = args.latency
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+
+    import app as gateway
+    gateway.rate_limiter.enabled = False  # 压测请求都来自本机，不限流
+    gateway.wechat_auth.session_url = f"http://127.0.0.1:{fake.server_address[1]}/sns/jscode2session"
+
+    print(f"{args.clients} 个客户端同时登录（{args.duplicate:.0%} 重复提交）, 每个客户端调用 {args.calls} 次订单接口, "
+          f"微信接口延迟 {args.latency * 1000:.0f}ms")
+    for use_token in (False, True):
+        r = run(gateway, fake, args, use_token)
+        print(f"{'会话令牌' if use_token else '原方式'}: 耗时 {r['elapsed']:.2f}s, 发往微信 {r['upstream']} 次, "
+              f"登录 {r['logins']} 次 p50 {r['login_p50'] * 1000:.1f}ms p99 {r['login_p99'] * 1000:.1f}ms, "
+              f"接口 {r['calls']} 次 p50 {r['call_p50'] * 1000:.2f}ms p99 {r['call_p99'] * 1000:.2f}ms, "
+              f"失败 {r['failures'] or 0}, 合并 {r['stats']['coalesced']}")
+    gateway.order_reconciler.stop()
+    gateway.backend_manager.stop_health_check()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信支付签名/验签吞吐量测试
+对比原实现（每次排序参数、拼接字符串、HMAC重新由密钥初始化）与 WeChatPaySigner：
+- 签名 unifiedorder请求（MD5 / HMAC-SHA256）
+- 验证支付回调签名
+- 批量签名/验签
+并用微信支付文档中的示例参数检查签名结果
+
+用法:
+    python benchmark_wechat_sign.py --seconds 1 --batch 1000
+"""
+
+import argparse
+import hashlib
+import hmac
+import time
+
+from wechat_pay_utils import WeChatPaySigner
+
+API_KEY = '192006250b4c09247ec02edce69f6a2d'
+
+# 微信支付文档中的签名示例
+DOC_PARAMS = {'appid': 'wxd930ea5d5a258f4f', 'mch_id': '10000100', 'device_info': '1000',
+              'body': 'test', 'nonce_str': 'ibuaiVcKdpRxkhJA'}
+DOC_SIGNS = {'MD5': '9A0A8659F005D6984697E2CA0A9CF3B7',
+             'HMAC-SHA256': '6A9AE1657590FD6257D693A078E1C3E4BB6BA4DC30B23E0EE2496E54170DACD6'}
+
+UNIFIED_ORDER = {
+    'appid': 'wx1234567890abcdef', 'mch_id': '1900000109', 'nonce_str': 'n' * 32,
+    'body': '照片增强服务', 'out_trade_no': 'PAY1703123456123456', 'total_fee': 100,
+    'spbill_create_ip': '127.0.0.1', 'notify_url': 'https://example.com/api/wechat/pay/notify',
+    'trade_type': 'JSAPI', 'openid': 'oUpF8uMuAJO_M2pxb1Q9zNjWeS6o', 'attach': ''
+}
+NOTIFY = {
+    'appid': 'wx1234567890abcdef', 'attach': '', 'bank_type': 'CFT', 'fee_type': 'CNY', 'is_subscribe': 'Y',
+    'mch_id': '1900000109', 'nonce_str': '5d2b6c2a8db53831f7eda20af46e531c', 'openid': 'oUpF8uMuAJO_M2pxb1Q9zNjWeS6o',
+    'out_trade_no': 'PAY1703123456123456', 'result_code': 'SUCCESS', 'return_code': 'SUCCESS',
+    'time_end': '20140903131540', 'total_fee': '1', 'coupon_fee': '10', 'coupon_count': '1',
+    'trade_type': 'JSAPI', 'transaction_id': '1004400740201409030005092168'
+}
+
+
+def legacy_sign_md5(params, api_key):
+    """原实现"""
+    sorted_params = sorted(params.items())
+    string_a = '&'.join([f"{k}={v}" for k, v in sorted_params if v])
+    string_sign_temp = f"{string_a}&key={api_key}"
+    return hashlib.md5(string_sign_temp.encode('utf-8')).hexdigest().upper()
+
+
+def legacy_sign_hmac_sha256(params, api_key):
+    """原实现（每次由密钥初始化HMAC）"""
+    sorted_params = sorted(params.items())
+    string_a = '&'.join([f"{k}={v}" for k, v in sorted_params if v])
+    return hmac.new(api_key.encode('utf-8'), string_a.encode('utf-8'), hashlib.sha256).hexdigest().upper()
+
+
+def legacy_verify(data, sign, api_key):
+    """原实现（普通字符串比较）"""
+    return legacy_sign_md5(data, api_key) == sign
+
+
+def rate(func, seconds, ops_per_call=1):
+    """每秒操作数"""
+    count, batch = 0, 100
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            func()
+        count += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count * ops_per_call / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='微信支付签名/验签吞吐量测试')
+    parser.add_argument('--seconds', type=float, default=1.0, help='每项测试时间（秒）')
+    parser.add_argument('--batch', type=int, default=1000, help='批量签名/验签的数量')
+    args = parser.parse_args()
+
+    signer = WeChatPaySigner(API_KEY)
+    for sign_type, expected in DOC_SIGNS.items():
+        actual = signer.sign(DOC_PARAMS, sign_type)
+        print(f"文档示例 {sign_type}: {'一致' if actual == expected else '不一致 ' + actual}")
+    print(f"原HMAC-SHA256实现与文档示例{'一致' if legacy_sign_hmac_sha256(DOC_PARAMS, API_KEY) == DOC_SIGNS['HMAC-SHA256'] else '不一致（签名串缺少&key=）'}")
+    assert signer.sign(UNIFIED_ORDER) == legacy_sign_md5(UNIFIED_ORDER, API_KEY)
+
+    notify_sign = signer.sign(NOTIFY)
+    bad_sign = notify_sign[:-1] + ('0' if notify_sign[-1] != '0' else '1')
+    batch = [dict(NOTIFY, out_trade_no=f"PAY{i:016d}") for i in range(args.batch)]
+    batch_signs = signer.sign_many(batch)
+    batch_items = list(zip(batch, batch_signs))
+    assert all(signer.verify_many(batch_items)) and not signer.verify(NOTIFY, bad_sign)
+
+    cases = [
+        ('MD5签名 unifiedorder',
+         lambda: legacy_sign_md5(UNIFIED_ORDER, API_KEY), lambda: signer.sign(UNIFIED_ORDER), 1),
+        ('HMAC-SHA256签名 unifiedorder',
+         lambda: legacy_sign_hmac_sha256(UNIFIED_ORDER, API_KEY),
+         lambda: signer.sign(UNIFIED_ORDER, 'HMAC-SHA256'), 1),
+        ('验签 支付回调',
+         lambda: legacy_verify(NOTIFY, notify_sign, API_KEY), lambda: signer.verify(NOTIFY, notify_sign), 1),
+        (f'批量签名 {args.batch}个',
+         lambda: [legacy_sign_md5(p, API_KEY) for p in batch], lambda: signer.sign_many(batch), args.batch),
+        (f'批量验签 {args.batch}个',
+         lambda: [legacy_verify(d, s, API_KEY) for d, s in batch_items],
+         lambda: signer.verify_many(batch_items), args.batch),
+    ]
+    print(f"\n{'测试项':<28}{'原实现(次/秒)':>14}{'签名器(次/秒)':>14}{'加速':>8}")
+    for name, old, new, ops in cases:
+        old_rate = rate(old, args.seconds, ops)
+        new_rate = rate(new, args.seconds, ops)
+        print(f"{name:<26}{old_rate:>16,.0f}{new_rate:>16,.0f}{new_rate / old_rate:>9.2f}x")
+
+    # 常量时间比较：第一个字符错误与最后一个字符错误的验签耗时相同
+    first_wrong = ('0' if notify_sign[0] != '0' else '1') + notify_sign[1:]
+    print(f"\n验签耗时（错误签名）: 首字符错误 {1e6 / rate(lambda: signer.verify(NOTIFY, first_wrong), args.seconds):.2f}us, "
+          f"末字符错误 {1e6 / rate(lambda: signer.verify(NOTIFY, bad_sign), args.seconds):.2f}us")
+
+
+if __name__ == '__main__':
+    main()
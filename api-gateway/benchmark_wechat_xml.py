@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信支付XML编解码微基准测试
+对比原实现（字符串累加拼接 + ElementTree解析）与 wechat_xml 模块，报文为：
+- unifiedorder 请求（序列化）
+- unifiedorder / orderquery 响应、支付回调通知（解析）
+输出每秒操作数、每次操作的峰值内存分配（tracemalloc），并检查：
+- 随机报文的解析结果与 ElementTree 一致
+- 实体展开、外部实体、嵌套元素等恶意/非法报文的处理
+
+用法:
+    python benchmark_wechat_xml.py --seconds 1 --fuzz 2000
+"""
+
+import argparse
+import random
+import string
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import wechat_xml
+
+
+def legacy_dumps(data):
+    """原实现：字符串累加"""
+    xml = "<xml>"
+    for key, value in data.items():
+        xml += f"<{key}><![CDATA[{value}]]></{key}>"
+    xml += "</xml>"
+    return xml
+
+
+def legacy_loads(xml_str):
+    """原实现：ElementTree解析"""
+    root = ET.fromstring(xml_str)
+    result = {}
+    for child in root:
+        result[child.tag] = child.text
+    return result
+
+
+UNIFIED_ORDER = {
+    'appid': 'wx1234567890abcdef', 'mch_id': '1900000109', 'nonce_str': 'n' * 32,
+    'body': '照片增强服务', 'out_trade_no': 'PAY1703123456123456', 'total_fee': 100,
+    'spbill_create_ip': '127.0.0.1', 'notify_url': 'https://example.com/api/wechat/pay/notify',
+    'trade_type': 'JSAPI', 'openid': 'oUpF8uMuAJO_M2pxb1Q9zNjWeS6o', 'attach': '',
+    'sign': 'C380BEC2BFD727A4B6845133519F3AD6'
+}
+UNIFIED_ORDER_RESPONSE = legacy_dumps({
+    'return_code': 'SUCCESS', 'return_msg': 'OK', 'appid': 'wx1234567890abcdef',
+    'mch_id': '1900000109', 'nonce_str': 'IITRi8Iabbblz1Jc', 'sign': '7921E432F65EB8ED0CE9755F0E86D72F',
+    'result_code': 'SUCCESS', 'prepay_id': 'wx201411101639507cbf6ffd8b0779950874', 'trade_type': 'JSAPI'
+})
+ORDER_QUERY_RESPONSE = legacy_dumps({
+    'return_code': 'SUCCESS', 'return_msg': 'OK', 'appid': 'wx1234567890abcdef', 'mch_id': '1900000109',
+    'nonce_str': 'TN55wO9Pba5yENl8', 'sign': 'BDF0099C15FF7BC6B1585FBB110AB635', 'result_code': 'SUCCESS',
+    'openid': 'oUpF8uMuAJO_M2pxb1Q9zNjWeS6o', 'is_subscribe': 'Y', 'trade_type': 'JSAPI', 'bank_type': 'CMC',
+    'total_fee': '100', 'fee_type': 'CNY', 'transaction_id': '1008450740201411110005820873',
+    'out_trade_no': 'PAY1703123456123456', 'attach': '', 'time_end': '20141111170043', 'trade_state': 'SUCCESS'
+})
+# 回调中数字字段不使用CDATA
+NOTIFY = (
+    '<xml><appid><![CDATA[wx1234567890abcdef]]></appid><attach><![CDATA[]]></attach>'
+    '<bank_type><![CDATA[CFT]]></bank_type><fee_type><![CDATA[CNY]]></fee_type>'
+    '<is_subscribe><![CDATA[Y]]></is_subscribe><mch_id><![CDATA[1900000109]]></mch_id>'
+    '<nonce_str><![CDATA[5d2b6c2a8db53831f7eda20af46e531c]]></nonce_str>'
+    '<openid><![CDATA[oUpF8uMuAJO_M2pxb1Q9zNjWeS6o]]></openid>'
+    '<out_trade_no><![CDATA[PAY1703123456123456]]></out_trade_no><result_code><![CDATA[SUCCESS]]></result_code>'
+    '<return_code><![CDATA[SUCCESS]]></return_code><sign><![CDATA[B552ED6B279343CB493C5DD0D78AB241]]></sign>'
+    '<time_end><![CDATA[20140903131540]]></time_end><total_fee>1</total_fee>'
+    '<coupon_fee><![CDATA[10]]></coupon_fee><coupon_count><![CDATA[1]]></coupon_count>'
+    '<trade_type><![CDATA[JSAPI]]></trade_type>'
+    '<transaction_id><![CDATA[1004400740201409030005092168]]></transaction_id></xml>'
+)
+
+MALICIOUS = {
+    '实体展开(billion laughs)': (
+        '<?xml version="1.0"?><!DOCTYPE lolz [<!ENTITY lol "lol">'
+        '<!ENTITY lol1 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">'
+        '<!ENTITY lol2 "&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;">]>'
+        '<xml><a>&lol2;</a></xml>'),
+    '外部实体(XXE)': '<!DOCTYPE x [<!ENTITY e SYSTEM "file:///etc/passwd">]><xml><a>&e;</a></xml>',
+    '嵌套元素': '<xml><a><b>1</b></a></xml>',
+    '属性': '<xml><a x="1">1</a></xml>',
+    '未定义实体': '<xml><a>&foo;</a></xml>',
+    '缺少结束标签': '<xml><a>1</a>',
+    '未闭合CDATA(60KB)': '<xml>' + '<a><![CDATA[' * 5000 + '</xml>',
+    '超大报文(240KB)': '<xml>' + '<a><![CDATA[' * 20000 + '</xml>',
+}
+
+
+def rate(func, arg, seconds):
+    """每秒操作数"""
+    count, batch = 0, 1000
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            func(arg)
+        count += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def peak_alloc(func, arg):
+    """单次操作的峰值内存分配（字节）"""
+    func(arg)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    result = func(arg)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def random_value(rng):
+    alphabet = string.ascii_letters + string.digits + ' &<>"\']]>照片增强' + '\n'
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+
+
+def fuzz(count):
+    """随机扁平报文：wechat_xml与ElementTree的解析结果对比，返回不一致数"""
+    rng = random.Random(0)
+    mismatches = 0
+    for _ in range(count):
+        data = {f"k{i}_{rng.randint(0, 99)}": random_value(rng) for i in range(rng.randint(1, 20))}
+        xml = wechat_xml.dumps(data)
+        expected = legacy_loads(xml)
+        # 数字字段不使用CDATA，文本中的字符需要转义
+        plain = '<xml>' + ''.join(f"<{k}>{v.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')}</{k}>"
+                                  for k, v in data.items()) + '</xml>'
+        if (wechat_xml.loads(xml) != expected or expected != {k: v or None for k, v in data.items()}
+                or wechat_xml.loads(plain) != legacy_loads(plain)):
+            mismatches += 1
+    return mismatches
+
+
+def check(loads, xml):
+    start = time.perf_counter()
+    try:
+        result = loads(xml)
+    except Exception as e:
+        return f"拒绝({type(e).__name__}, {(time.perf_counter() - start) * 1000:.1f}ms)"
+    return f"接受 {str(result)[:40]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='微信支付XML编解码微基准测试')
+    parser.add_argument('--seconds', type=float, default=1.0, help='每项测试时间（秒）')
+    parser.add_argument('--fuzz', type=int, default=2000, help='随机报文一致性检查次数')
+    args = parser.parse_args()
+
+    cases = [
+        ('序列化 unifiedorder请求', legacy_dumps, wechat_xml.dumps, UNIFIED_ORDER),
+        ('解析 unifiedorder响应', legacy_loads, wechat_xml.loads, UNIFIED_ORDER_RESPONSE),
+        ('解析 orderquery响应', legacy_loads, wechat_xml.loads, ORDER_QUERY_RESPONSE),
+        ('解析 支付回调', legacy_loads, wechat_xml.loads, NOTIFY),
+    ]
+    print(f"{'测试项':<24}{'原实现(次/秒)':>14}{'新实现(次/秒)':>14}{'加速':>8}{'原峰值分配':>12}{'新峰值分配':>12}")
+    for name, old, new, arg in cases:
+        assert old(arg) == new(arg), name
+        old_rate, new_rate = rate(old, arg, args.seconds), rate(new, arg, args.seconds)
+        print(f"{name:<22}{old_rate:>16,.0f}{new_rate:>16,.0f}{new_rate / old_rate:>9.1f}x"
+              f"{peak_alloc(old, arg):>13}B{peak_alloc(new, arg):>13}B")
+
+    print(f"\n随机报文一致性检查 {args.fuzz} 次, 与ElementTree不一致: {fuzz(args.fuzz)}")
+    print("\n恶意/非法报文:")
+    for name, xml in MALICIOUS.items():
+        print(f"  {name}: 原实现 {check(legacy_loads, xml)}; 新实现 {check(wechat_xml.loads, xml)}")
+
+
+if __name__ == '__main__':
+    main()
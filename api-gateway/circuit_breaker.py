@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+熔断器模块
+根据转发给GPU服务器的真实请求结果（连接错误、连续5xx、延迟异常）被动剔除异常服务器，
+不必等到下一次 /health 检测：
+- closed: 正常接收请求
+- open: 已剔除，剔除时间结束前不再分配新任务
+- half_open: 剔除时间结束，只放行一个试探请求，成功则恢复，失败则再次剔除（剔除时间翻倍）
+"""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from config import config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 失败类型
+FAILURE_CONNECT = "connect"  # 连接失败/超时
+FAILURE_5XX = "5xx"  # 后端返回5xx
+FAILURE_LATENCY = "latency"  # 延迟明显高于其他服务器
+
+
+class CircuitBreaker:
+    """单台GPU服务器的熔断器"""
+
+    def __init__(self, consecutive_errors: int = 1, consecutive_5xx: int = 3,
+                 base_ejection_time: float = 10, max_ejection_time: float = 300,
+                 latency_alpha: float = 0.3):
+        self._lock = threading.Lock()
+        self.consecutive_errors = consecutive_errors
+        self.consecutive_5xx = consecutive_5xx
+        self.base_ejection_time = base_ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.latency_alpha = latency_alpha
+
+        self.state = CLOSED
+        self.error_count = 0  # 连续连接失败次数
+        self.error_5xx_count = 0  # 连续5xx次数
+        self.ejection_count = 0  # 连续剔除次数，决定剔除时长
+        self.total_ejections = 0
+        self.open_until = 0.0  # 剔除结束时间（time.monotonic）
+        self.trial_in_flight = False  # 半开状态下是否已有试探请求
+        self.trial_started = 0.0
+
+        self.latency = 0.0  # 请求延迟EWMA（秒）
+        self.latency_samples = 0
+
+    def available_at(self) -> float:
+        """可以再次分配新请求的时间（time.monotonic），0表示现在即可"""
+        if self.state == OPEN:
+            return self.open_until
+        if self.state == HALF_OPEN and self.trial_in_flight:
+            # 试探请求长时间没有结果（例如客户端中途断开）时允许再次试探
+            return self.trial_started + self.max_ejection_time
+        return 0.0
+
+    def is_available(self, now: Optional[float] = None) -> bool:
+        """是否可以分配新请求（不改变状态）"""
+        return self.available_at() <= (now if now is not None else time.monotonic())
+
+    def on_selected(self, now: Optional[float] = None) -> bool:
+        """被负载均衡选中：剔除时间已过的服务器转为半开，本次请求作为试探请求；返回状态是否变化"""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            now = now if now is not None else time.monotonic()
+            if self.state == OPEN and now >= self.open_until:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                self.trial_in_flight = True
+                self.trial_started = now
+            return True
+
+    def record_success(self, latency: Optional[float] = None) -> bool:
+        """记录成功的请求，返回是否从半开恢复为关闭"""
+        with self._lock:
+            self.error_count = 0
+            self.error_5xx_count = 0
+            if latency is not None:
+                self._update_latency(latency)
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self.trial_in_flight = False
+                self.ejection_count = max(self.ejection_count - 1, 0)
+                return True
+            return False
+
+    def record_failure(self, kind: str) -> bool:
+        """记录失败的请求，返回是否达到剔除条件"""
+        with self._lock:
+            if kind == FAILURE_5XX:
+                self.error_5xx_count += 1
+            elif kind == FAILURE_CONNECT:
+                self.error_count += 1
+            if self.state == HALF_OPEN:
+                # 试探请求失败，直接再次剔除
+                return True
+            if self.state == OPEN:
+                return False
+            return (kind == FAILURE_LATENCY
+                    or self.error_count >= self.consecutive_errors
+                    or self.error_5xx_count >= self.consecutive_5xx)
+
+    def record_latency(self, latency: float):
+        """只记录延迟（用于延迟异常检测）"""
+        with self._lock:
+            self._update_latency(latency)
+
+    def _update_latency(self, latency: float):
+        if self.latency_samples:
+            self.latency = self.latency_alpha * latency + (1 - self.latency_alpha) * self.latency
+        else:
+            self.latency = latency
+        self.latency_samples += 1
+
+    def trip(self, now: Optional[float] = None) -> float:
+        """剔除服务器，返回剔除时长（秒）"""
+        with self._lock:
+            now = now if now is not None else time.monotonic()
+            self.ejection_count += 1
+            self.total_ejections += 1
+            ejection_time = min(self.base_ejection_time * 2 ** (self.ejection_count - 1), self.max_ejection_time)
+            self.state = OPEN
+            self.open_until = now + ejection_time
+            self.trial_in_flight = False
+            self.error_count = 0
+            self.error_5xx_count = 0
+            # 恢复后重新积累延迟样本
+            self.latency = 0.0
+            self.latency_samples = 0
+            return ejection_time
+
+    def reset(self):
+        """恢复为关闭状态（服务器重新注册时调用）"""
+        with self._lock:
+            self.state = CLOSED
+            self.error_count = 0
+            self.error_5xx_count = 0
+            self.ejection_count = 0
+            self.trial_in_flight = False
+            self.latency = 0.0
+            self.latency_samples = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_errors": self.error_count,
+            "consecutive_5xx": self.error_5xx_count,
+            "ejections": self.total_ejections,
+            "ejected_for": round(max(self.open_until - time.monotonic(), 0.0), 1) if self.state == OPEN else 0.0,
+            "latency": round(self.latency, 3)
+        }
+
+
+def create_circuit_breaker() -> CircuitBreaker:
+    """按配置创建熔断器"""
+    settings = config.get_outlier_detection_config()
+    return CircuitBreaker(
+        consecutive_errors=settings["consecutive_errors"],
+        consecutive_5xx=settings["consecutive_5xx"],
+        base_ejection_time=settings["base_ejection_time"],
+        max_ejection_time=settings["max_ejection_time"]
+    )
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+客户端IP识别
+经nginx转发时连接地址是nginx，客户端IP取自nginx设置的请求头（X-Real-IP）。
+请求头只在连接来自受信任的代理（trusted_proxies）时采用，否则任何客户端直接连接网关端口
+都可以伪造请求头，每次换一个IP绕过按IP限流，或冒充127.0.0.1访问 /metrics
+"""
+
+import ipaddress
+import logging
+from typing import Any, Dict, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class ClientIpResolver:
+    """按连接地址和受信任代理列表确定客户端IP"""
+
+    def __init__(self, header: str, trusted_proxies: List[str]):
+        self.header = header
+        self.trusted_proxies = []
+        for proxy in trusted_proxies:
+            try:
+                # 支持单个地址和网段（如 10.0.0.0/8）
+                self.trusted_proxies.append(ipaddress.ip_network(proxy, strict=False))
+            except ValueError:
+                logger.warning(f"无效的受信任代理地址: {proxy}")
+
+    def is_trusted(self, remote_addr: Optional[str]) -> bool:
+        """连接地址是否为受信任的代理"""
+        if not remote_addr:
+            return False
+        try:
+            address = ipaddress.ip_address(remote_addr)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted_proxies)
+
+    def resolve(self, remote_addr: Optional[str], header_value: Optional[str]) -> str:
+        """
+        客户端IP：连接来自受信任的代理且带有请求头时取请求头，否则取连接地址
+        请求头为逗号分隔的列表时（X-Forwarded-For）取最后一个，即受信任代理自己添加的地址
+        """
+        if self.header and header_value and self.is_trusted(remote_addr):
+            client_ip = header_value.split(',')[-1].strip()
+            if client_ip:
+                return client_ip
+        return remote_addr or ''
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取配置信息"""
+        return {
+            "header": self.header,
+            "trusted_proxies": [str(network) for network in self.trusted_proxies]
+        }
+
+
+def create_client_ip_resolver(ci_config: Dict[str, Any]) -> ClientIpResolver:
+    """按配置创建客户端IP识别"""
+    return ClientIpResolver(header=ci_config["header"], trusted_proxies=ci_config["trusted_proxies"])
+
+
+# 全局实例
+client_ip_resolver = create_client_ip_resolver(config.get_client_ip_config())
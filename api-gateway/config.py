@@ -27,6 +27,180 @@ DEFAULT_CONFIG = {
     "multi_backend": {
         "enabled": True,  # 是否启用多GPU服务器模式
         "fallback_to_default": False,  # 没有GPU服务器时不回退，直接报错
+    },
+    # 任务亲和路由配置（status/download路由到处理该任务的GPU服务器）
+    "task_affinity": {
+        "ttl": 6 * 3600,  # 任务记录保留时间（秒），每次访问刷新
+        "max_entries": 100000  # 最多保留的任务记录数，超出后淘汰最久未访问的
+    },
+    # 流式上传转发配置（不在网关内存中缓存整个图片）
+    "streaming_upload": {
+        "enabled": True,  # 是否直接把原始请求体分块转发到GPU服务器
+        "chunk_size": 64 * 1024,  # 每次读取/转发的分块大小（字节）
+        # 去重或失败转移需要缓存请求体时，在内存中缓存的大小上限，超出后写入临时文件（字节）
+        "spool_memory": 1024 * 1024
+    },
+    # HTTP连接池配置（长连接复用）
+    "connection_pool": {
+        "backend_pool_size": 32,  # 每台GPU服务器的最大空闲连接数
+        "wechat_pool_size": 16  # 微信接口共享的最大空闲连接数
+    },
+    # 负载均衡配置
+    "load_balancing": {
+        # 选择策略: round_robin / weighted_round_robin / least_outstanding / power_of_two / ewma_latency
+        "strategy": "round_robin",
+        "ewma_alpha": 0.3,  # 任务耗时EWMA的平滑系数
+        "job_timeout": 1800,  # 超过该时间仍未看到完成状态的任务不再计入未完成任务数（秒）
+        "job_check_after": 15,  # 任务提交超过该时间后网关自行查询GPU服务器上的任务状态，完成即释放名额（秒），0表示不查询
+        "job_check_interval": 5  # 网关自行查询每个任务状态的间隔（秒）
+    },
+    # 健康检测配置（所有到期服务器并行检测，间隔自适应）
+    "health_check": {
+        "interval": 3,  # 基础检测间隔（秒）
+        "min_interval": 1,  # 检测失败后的检测间隔（秒）
+        "max_interval": 6,  # 稳定节点退避后的最大检测间隔（秒）
+        "backoff_factor": 1.5,  # 每次检测成功后间隔的放大倍数
+        "jitter": 0.2,  # 检测时间的随机抖动比例
+        "timeout": 5,  # 单次检测超时（秒）
+        "sweep_deadline": 5,  # 每轮检测最多等待的时间（秒）
+        "max_workers": 16,  # 并行检测的线程数
+        "fail_threshold": 2,  # 连续检测失败多少次后标记为不可用
+        "cleanup_threshold": 5  # 连续检测失败多少次后自动删除服务器记录
+    },
+    # 被动健康检测（根据真实转发请求的结果熔断异常服务器）
+    "outlier_detection": {
+        "enabled": True,
+        "consecutive_errors": 1,  # 连续连接失败/超时多少次后剔除
+        "consecutive_5xx": 3,  # 连续返回5xx多少次后剔除
+        "base_ejection_time": 10,  # 首次剔除时长（秒），连续剔除时翻倍
+        "max_ejection_time": 300,  # 最长剔除时长（秒）
+        "max_ejection_percent": 50,  # 最多同时剔除的服务器比例（%），至少保留一台
+        "latency_factor": 3.0,  # 请求延迟超过其他服务器中位数的倍数时视为延迟异常
+        "latency_min": 1.0,  # 延迟低于该值（秒）时不判定为异常
+        "latency_min_samples": 5  # 判定延迟异常所需的最少样本数
+    },
+    # 多进程共享状态（gunicorn多worker部署时开启）
+    "shared_state": {
+        "enabled": False,
+        "path": "backend_state.db",  # SQLite数据库路径，相对路径相对于api-gateway目录
+        "sync_interval": 0.5,  # 检查共享状态变化的间隔（秒）
+        "lease_ttl": 10  # 健康检测租约有效期（秒），负责检测的进程退出后由其他进程接管
+    },
+    # 订单存储配置
+    "order_store": {
+        "backend": "sqlite",  # sqlite: data/orders.db，每次只写入变化的订单；json: 每次重写data/orders.json
+        "synchronous": "NORMAL",  # sqlite刷盘策略: NORMAL 检查点批量fsync / FULL 每次提交fsync
+        "hot_days": 7,  # sqlite后端只在内存中保留待支付订单和最近N天的订单，更早的已结束订单按需读取；0表示全部加载
+        "evict_interval": 300  # 每隔N秒把过期的已结束订单移出内存
+    },
+    # 支付回调去重（微信会重发回调，重复通知直接应答成功）
+    "notify_dedup": {
+        "ttl": 25 * 3600,  # 记录保留时间（秒），覆盖微信约24小时的重发周期
+        "max_entries": 20000  # 最多保留的记录数（每个回调两条），超出后淘汰最早的
+    },
+    # 支付状态查询（合并并发查询，缓存微信orderquery结果，每个订单每个有效期最多查询一次）
+    "payment_query": {
+        "enabled": True,
+        "pending_ttl": 2,  # 未支付/支付中结果的缓存时间（秒）
+        "error_ttl": 1,  # 查询失败结果的缓存时间（秒）
+        "terminal_ttl": 300,  # 已结束交易状态（SUCCESS/CLOSED等）的缓存时间（秒）
+        "max_entries": 10000,  # 最多缓存的订单数
+        "wait_timeout": 35  # 等待其他请求的查询结果的最长时间（秒），大于微信接口超时
+    },
+    # 待支付订单对账（后台定期向微信查询长时间未支付的订单）
+    "order_reconciler": {
+        "enabled": True,
+        "interval": 60,  # 对账间隔（秒）
+        "min_age": 300,  # 只对账创建超过该时间的待支付订单（秒），微信要求下单5分钟后才能关单
+        "close_after": 7200,  # 创建超过该时间仍未支付的订单关闭（秒），与prepay_id有效期一致
+        "batch_size": 100,  # 每批查询的订单数
+        "max_workers": 4  # 并发查询数
+    },
+    # 微信登录会话（登录后返回令牌，后续请求按令牌查找openid，不再访问微信）
+    "auth_session": {
+        "path": "data/auth_sessions.db",  # 会话的SQLite数据库路径（多个worker共用），相对路径相对于api-gateway目录
+        "ttl": 7 * 86400,  # 令牌有效期（秒），过期后小程序需要重新登录
+        "max_entries": 100000,  # 最多保留的会话数，超出后淘汰最久未使用的
+        "code_ttl": 300,  # 同一个code重试时直接返回已有令牌的时间（秒），与code有效期一致
+        "require_token": False,  # 支付、订单接口是否必须携带令牌（False时兼容只传openid的旧客户端）
+        "expose_session_key": True  # 登录接口是否仍返回session_key（兼容需要在客户端解密数据的旧版本）
+    },
+    # 客户端IP识别：经nginx转发时取nginx设置的请求头，只信任来自trusted_proxies的连接
+    "client_ip": {
+        "header": "X-Real-IP",  # nginx传入客户端IP的请求头，为空时总是使用连接地址
+        "trusted_proxies": ["127.0.0.1", "::1"]  # 受信任的代理地址或网段，其他连接的请求头被忽略
+    },
+    # 图片增强公平排队（多GPU服务器模式下生效）：GPU满载时请求在网关排队，按用户轮流分配
+    "fair_queue": {
+        "enabled": True,
+        "max_jobs_per_server": 3,  # 每台服务器（每单位权重）同时处理的任务数上限（多worker部署需开启shared_state才是合计上限），满载后新请求排队（任务完成要等客户端轮询到或网关自行查询到才释放，留一点余量让GPU不空闲）
+        "max_queue_per_user": 50,  # 每个用户最多排队的任务数，超出返回429
+        "max_queue_total": 1000,  # 网关最多排队的任务数，超出返回429
+        "max_wait": 1800,  # 排队超过该时间仍未分配的任务按失败处理（秒）
+        "retry_after": 10,  # 拒绝排队时建议客户端重试的间隔（秒，Retry-After）
+        "quantum": 1,  # 每个用户每轮获得的额度（差额轮询），单位为cost_unit
+        "cost_unit": 4 * 1024 * 1024,  # 按图片大小计算任务开销，每cost_unit字节计为1（至少为1）
+        "user_window": 3600,  # 未登录用户按 user_{IP}_{时间窗口} 识别，时间窗口长度（秒）
+        "spool_memory": 1024 * 1024,  # 排队图片在内存中缓存的大小上限，超出后写入临时文件（字节）
+        "dispatch_workers": 8,  # 向GPU服务器提交排队任务的线程数
+        "ticket_ttl": 21600,  # 排队任务号到GPU任务号映射的保留时间（秒），与task_affinity.ttl一致
+        "max_tickets": 100000,  # 最多保留的排队任务号映射
+        "path": "data/fair_queue.db"  # 排队任务号状态的SQLite数据库路径（多个worker共用），相对路径相对于api-gateway目录
+    },
+    # 接口限流：每条规则一个令牌桶，每period秒补充limit个令牌，最多积累burst个（与nginx limit_req的rate/burst相同）
+    "rate_limit": {
+        "enabled": True,
+        "backend": "memory",  # memory: 进程内；shared: 同一台机器上的所有worker共享（内存映射文件）
+        "shared_path": "",  # 共享存储文件路径，为空时使用 /dev/shm/photo_enhance_rate_limit
+        "shared_slots": 131072,  # 共享存储的槽位数（每个活跃key一个，16字节）
+        "max_entries": 100000,  # 进程内存储最多保留的活跃key数
+        # endpoints为Flask接口函数名；key: ip/openid/global（openid规则只对携带登录令牌的请求生效）
+        "rules": [
+            {"name": "enhance_ip", "endpoints": ["enhance_image"], "key": "ip", "limit": 100, "period": 3600, "burst": 20},
+            {"name": "enhance_user", "endpoints": ["enhance_image"], "key": "openid", "limit": 100, "period": 3600, "burst": 20},
+            {"name": "enhance_all", "endpoints": ["enhance_image"], "key": "global", "limit": 20, "period": 1, "burst": 100},
+            {"name": "poll_ip", "endpoints": ["get_task_status", "download_result"], "key": "ip", "limit": 10, "period": 1, "burst": 50},
+            {"name": "login_ip", "endpoints": ["get_openid"], "key": "ip", "limit": 30, "period": 60, "burst": 10},
+            {"name": "pay_ip", "endpoints": ["create_payment", "query_payment", "get_user_orders"], "key": "ip", "limit": 60, "period": 60, "burst": 20}
+        ]
+    },
+    # 运行指标：/metrics 输出Prometheus文本格式
+    "metrics": {
+        "enabled": True,
+        "allow_ips": ["127.0.0.1", "::1"],  # 允许访问 /metrics 的客户端IP（按client_ip识别），为空时不限制
+        # 接口、转发和健康检测耗时的分布区间（秒）
+        "latency_buckets": [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300],
+        # 订单存储操作耗时的分布区间（秒）
+        "store_buckets": [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1]
+    },
+    # 处理结果缓存：第一次下载时写入本地磁盘，之后的下载不再请求GPU服务器
+    "result_cache": {
+        "enabled": True,
+        "directory": "",  # 缓存目录，为空时使用 data/result_cache
+        "max_bytes": 2 * 1024 * 1024 * 1024,  # 缓存总大小上限（所有worker合计），超出时淘汰最久未下载的结果
+        "max_entry_bytes": 50 * 1024 * 1024,  # 超过该大小的结果不缓存
+        "ttl": 7 * 24 * 3600,  # 结果保留时间（秒）
+        # nginx内部location的路径前缀（如 "/_result_cache/"），配置后命中时由nginx直接发送文件；为空时由网关发送
+        "accel_redirect_prefix": ""
+    },
+    # 重复图片增强请求去重：相同图片和参数的请求复用处理中或已完成的任务
+    "enhance_dedup": {
+        "enabled": True,
+        "path": "data/enhance_dedup.db",  # 去重索引的SQLite数据库路径，相对路径相对于api-gateway目录
+        "ttl": 24 * 3600,  # 已完成任务的复用期限（秒），结果还需在结果缓存中
+        "inflight_ttl": 1800,  # 处理中任务的复用期限（秒），超过后视为任务丢失，重新处理
+        "max_entries": 100000,  # 最多保留的记录数，超出时删除最旧的记录
+        "wait_timeout": 60  # 相同图片同时上传时，等待第一个请求拿到任务号的最长时间（秒）
+    },
+    # 图片增强请求失败转移：连接失败或5xx时把缓存的请求体发送到另一台GPU服务器
+    "enhance_failover": {
+        "enabled": True,
+        "max_attempts": 3,  # 每个请求最多发送到几台服务器（含第一次和对冲）
+        "retry_ratio": 0.2,  # 重试预算：窗口内重试次数不超过请求数的比例
+        "min_retries_per_second": 1,  # 请求很少时每秒至少允许的重试次数
+        "budget_window": 10,  # 重试预算的统计窗口（秒）
+        "hedge_delay": 0,  # 超过该时间（秒）仍未受理时同时发送到另一台服务器，0表示不对冲（提交接口不是幂等的，默认关闭）
+        "attempt_workers": 64  # 对冲时执行发送的线程数
     }
 }
 
@@ -37,6 +211,7 @@ class GatewayConfig:
     """API网关配置管理类"""
     
     def __init__(self):
+        self.version = 0  # 配置版本号，每次保存配置时加1
         self.config = self.load_config()
         self.backend_manager = None  # 延迟导入避免循环依赖
     
@@ -61,6 +236,7 @@ class GatewayConfig:
         try:
             with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
                 json.dump(config, f, indent=2, ensure_ascii=False)
+            self.version += 1
             logger.info(f"配置文件已保存: {CONFIG_FILE}")
             return True
         except Exception as e:
@@ -111,6 +287,24 @@ class GatewayConfig:
             logger.error("没有可用的GPU服务器且未启用回退模式")
             return None
     
+    def peek_backend_url(self) -> Optional[str]:
+        """
+        查看当前会使用的后端地址：多GPU服务器模式下为第一台可用服务器
+        与get_backend_url不同，不推进负载均衡的选择位置，也不更新服务器的使用时间，供状态查询接口使用
+        """
+        if not self.is_multi_backend_enabled():
+            return self.config.get("backend_api_base") or None
+        
+        backend_manager = self._get_backend_manager()
+        if backend_manager:
+            available = backend_manager.servers.available()
+            if available:
+                return available[0].url
+        
+        if self.is_fallback_enabled():
+            return self.config.get("backend_api_base") or None
+        return None
+    
     def get_all_backend_urls(self) -> List[str]:
         """获取所有可用的后端服务器地址"""
         backend_manager = self._get_backend_manager()
@@ -188,6 +382,91 @@ class GatewayConfig:
         """获取支持的端点"""
         return self.config.get("supported_endpoints", DEFAULT_CONFIG["supported_endpoints"])
     
+    def get_task_affinity_config(self) -> Dict[str, int]:
+        """获取任务亲和路由配置"""
+        return {**DEFAULT_CONFIG["task_affinity"], **self.config.get("task_affinity", {})}
+    
+    def get_streaming_upload_config(self) -> Dict[str, Any]:
+        """获取流式上传转发配置"""
+        return {**DEFAULT_CONFIG["streaming_upload"], **self.config.get("streaming_upload", {})}
+    
+    def is_streaming_upload_enabled(self) -> bool:
+        """检查是否启用流式上传转发"""
+        return bool(self.get_streaming_upload_config().get("enabled", False))
+    
+    def get_connection_pool_config(self) -> Dict[str, int]:
+        """获取HTTP连接池配置"""
+        return {**DEFAULT_CONFIG["connection_pool"], **self.config.get("connection_pool", {})}
+    
+    def get_load_balancing_config(self) -> Dict[str, Any]:
+        """获取负载均衡配置"""
+        return {**DEFAULT_CONFIG["load_balancing"], **self.config.get("load_balancing", {})}
+    
+    def get_health_check_config(self) -> Dict[str, Any]:
+        """获取健康检测配置"""
+        return {**DEFAULT_CONFIG["health_check"], **self.config.get("health_check", {})}
+    
+    def get_outlier_detection_config(self) -> Dict[str, Any]:
+        """获取被动健康检测配置"""
+        return {**DEFAULT_CONFIG["outlier_detection"], **self.config.get("outlier_detection", {})}
+    
+    def get_shared_state_config(self) -> Dict[str, Any]:
+        """获取多进程共享状态配置"""
+        return {**DEFAULT_CONFIG["shared_state"], **self.config.get("shared_state", {})}
+    
+    def get_order_store_config(self) -> Dict[str, Any]:
+        """获取订单存储配置"""
+        return {**DEFAULT_CONFIG["order_store"], **self.config.get("order_store", {})}
+    
+    def get_notify_dedup_config(self) -> Dict[str, int]:
+        """获取支付回调去重配置"""
+        return {**DEFAULT_CONFIG["notify_dedup"], **self.config.get("notify_dedup", {})}
+    
+    def get_payment_query_config(self) -> Dict[str, Any]:
+        """获取支付状态查询配置"""
+        return {**DEFAULT_CONFIG["payment_query"], **self.config.get("payment_query", {})}
+    
+    def get_order_reconciler_config(self) -> Dict[str, Any]:
+        """获取待支付订单对账配置"""
+        return {**DEFAULT_CONFIG["order_reconciler"], **self.config.get("order_reconciler", {})}
+    
+    def get_auth_session_config(self) -> Dict[str, Any]:
+        """获取微信登录会话配置"""
+        return {**DEFAULT_CONFIG["auth_session"], **self.config.get("auth_session", {})}
+    
+    def get_fair_queue_config(self) -> Dict[str, Any]:
+        """获取公平排队配置"""
+        return {**DEFAULT_CONFIG["fair_queue"], **self.config.get("fair_queue", {})}
+    
+    def get_rate_limit_config(self) -> Dict[str, Any]:
+        """获取接口限流配置"""
+        return {**DEFAULT_CONFIG["rate_limit"], **self.config.get("rate_limit", {})}
+    
+    def get_metrics_config(self) -> Dict[str, Any]:
+        """获取运行指标配置"""
+        return {**DEFAULT_CONFIG["metrics"], **self.config.get("metrics", {})}
+    
+    def get_result_cache_config(self) -> Dict[str, Any]:
+        """获取处理结果缓存配置"""
+        return {**DEFAULT_CONFIG["result_cache"], **self.config.get("result_cache", {})}
+    
+    def get_enhance_dedup_config(self) -> Dict[str, Any]:
+        """获取图片增强去重配置"""
+        return {**DEFAULT_CONFIG["enhance_dedup"], **self.config.get("enhance_dedup", {})}
+    
+    def get_enhance_failover_config(self) -> Dict[str, Any]:
+        """获取图片增强失败转移配置"""
+        return {**DEFAULT_CONFIG["enhance_failover"], **self.config.get("enhance_failover", {})}
+    
+    def get_client_ip_config(self) -> Dict[str, Any]:
+        """获取客户端IP识别配置"""
+        ci_config = {**DEFAULT_CONFIG["client_ip"], **self.config.get("client_ip", {})}
+        # 兼容旧配置：请求头原来在fair_queue.client_ip_header中设置
+        legacy_header = self.config.get("fair_queue", {}).get("client_ip_header")
+        if legacy_header is not None and "header" not in self.config.get("client_ip", {}):
+            ci_config["header"] = legacy_header
+        return ci_config
+    
     def is_multi_backend_enabled(self) -> bool:
         """检查是否启用多GPU服务器模式"""
         return self.config.get("multi_backend", {}).get("enabled", False)
@@ -196,18 +475,22 @@ class GatewayConfig:
         """检查是否启用回退模式"""
         return self.config.get("multi_backend", {}).get("fallback_to_default", False)
     
-    def get_config_info(self) -> Dict[str, Any]:
-        """获取配置信息"""
+    def get_config_info(self, live: bool = True) -> Dict[str, Any]:
+        """
+        获取配置信息
+        live为False时服务器部分只包含状态变化时才会改变的字段（不含负载、连接池等实时统计），用于状态快照
+        """
         backend_manager = self._get_backend_manager()
         backend_stats = None
         if backend_manager:
-            backend_stats = backend_manager.get_stats()
+            backend_stats = backend_manager.get_stats() if live else backend_manager.get_summary()
         
         return {
-            "backend_url": self.get_backend_url(),
+            "backend_url": self.peek_backend_url(),
             "default_backend_url": self.config.get("backend_api_base"),
             "timeout": self.get_timeout(),
             "max_file_size": self.get_max_file_size(),
+            "streaming_upload": self.get_streaming_upload_config(),
             "endpoints": self.get_endpoints(),
             "config_file": CONFIG_FILE,
             "multi_backend": {
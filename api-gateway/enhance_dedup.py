@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重复图片增强请求去重
+用户经常重复提交同一张图片（重试、前端批量重跑），每次都会占用一个GPU任务。
+按 图片内容 + tile_size/quality_level 计算摘要：
+- 相同内容的任务正在处理：直接返回该任务的任务号，不再转发
+- 相同内容的任务已完成且结果在结果缓存中：直接返回该任务号，查询状态和下载都不再请求GPU服务器
+- 同一时刻多个相同请求：只转发第一个，其余等待它拿到任务号后共用（single-flight）
+
+摘要 -> 任务号 的索引保存在SQLite数据库中（多个worker共用，重启后保留），内存中只有正在转发的请求；
+超过ttl的记录和超出max_entries的最旧记录定期删除。
+节省的GPU时间按任务从提交到GPU服务器到查询到完成的时间估计（与负载均衡的任务耗时相同），
+包含在GPU服务器上等待和轮询间隔的时间，是上限
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from config import config
+from metrics import metrics
+from result_cache import result_cache
+
+logger = logging.getLogger(__name__)
+
+# 参与摘要的表单参数（与转发给GPU服务器的参数一致）
+DIGEST_FIELDS = ('tile_size', 'quality_level')
+
+# 表单参数的长度上限，超出时不去重
+_MAX_FIELD_BYTES = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    digest TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    response TEXT NOT NULL,
+    status TEXT,
+    created REAL NOT NULL,
+    finished REAL,
+    gpu_seconds REAL,
+    attached INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_task_id ON tasks (task_id);
+CREATE INDEX IF NOT EXISTS tasks_created ON tasks (created);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class UploadDigest:
+    """
+    上传内容的摘要：图片内容 + tile_size/quality_level
+    流式转发时原始请求体的multipart分隔符每次都不同，边读取边解析，只对图片内容和参数计算摘要
+    """
+
+    def __init__(self, boundary: Optional[bytes] = None):
+        self._image = hashlib.sha256()
+        self._fields: Dict[str, bytes] = {}
+        self._images = 0
+        self._part = None  # 当前部分 (是否为图片, 参数名)
+        self._decoder = MultipartDecoder(boundary) if boundary else None
+        self._complete = self._decoder is None
+        self.failed = False
+
+    def feed(self, chunk: bytes):
+        """解析一段原始请求体"""
+        if self.failed or self._decoder is None:
+            return
+        try:
+            self._decoder.receive_data(chunk)
+            self._drain()
+        except ValueError as e:
+            logger.debug(f"解析上传内容失败，不去重: {e}")
+            self.failed = True
+
+    def close(self):
+        """请求体读取完毕"""
+        self.feed(None)
+
+    def _drain(self):
+        while True:
+            event = self._decoder.next_event()
+            if isinstance(event, NeedData):
+                return
+            if isinstance(event, Epilogue):
+                self._complete = True
+                return
+            if isinstance(event, File):
+                self._part = (event.name == 'file', None)
+                if event.name == 'file':
+                    self._images += 1
+            elif isinstance(event, Field):
+                name = event.name if event.name in DIGEST_FIELDS else None
+                self._part = (False, name)
+                if name is not None:
+                    self._fields[name] = b''
+            elif isinstance(event, Data) and self._part is not None:
+                is_image, name = self._part
+                if is_image:
+                    self._image.update(event.data)
+                elif name is not None:
+                    self.set_field(name, self._fields[name] + event.data)
+
+    def update_image(self, chunk: bytes):
+        """已解析的表单：累加图片内容"""
+        self._images = 1
+        self._image.update(chunk)
+
+    def set_field(self, name: str, value: bytes):
+        if len(value) > _MAX_FIELD_BYTES:
+            self.failed = True
+        self._fields[name] = value
+
+    def hexdigest(self) -> Optional[str]:
+        """摘要；请求体不完整、格式错误或图片不止一张时返回None（不去重）"""
+        if self.failed or not self._complete or self._images != 1:
+            return None
+        digest = hashlib.sha256(self._image.digest())
+        for name in DIGEST_FIELDS:
+            digest.update(b'\0' + self._fields.get(name, b''))
+        return digest.hexdigest()
+
+
+class DedupTicket:
+    """一次去重查询的结果：response不为None时直接返回给客户端；leader为True时转发完成后需调用finish"""
+
+    __slots__ = ('digest', 'response', 'leader')
+
+    def __init__(self, digest: str, response: Optional[Dict[str, Any]] = None, leader: bool = False):
+        self.digest = digest
+        self.response = response
+        self.leader = leader
+
+
+class EnhanceDeduplicator:
+    """按内容摘要复用图片增强任务"""
+
+    PRUNE_EVERY = 100  # 每记录N个任务清理一次过期记录
+
+    def __init__(self, path: str, ttl: float, inflight_ttl: float, max_entries: int,
+                 wait_timeout: float, enabled: bool = True):
+        self.enabled = enabled
+        self.path = path
+        self.ttl = ttl
+        self.inflight_ttl = inflight_ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self._local = threading.local()
+        self._flights: Dict[str, threading.Event] = {}  # 正在转发的摘要，同一内容只转发一次
+        self._lock = threading.Lock()
+        self._records = 0
+
+        # 统计计数
+        self.inflight_hits = 0  # 附加到处理中的任务
+        self.completed_hits = 0  # 直接返回已完成的任务
+        self.misses = 0  # 转发为新任务
+        self.coalesced = 0  # 等待同时到达的相同请求拿到任务号
+        self.wait_timeouts = 0  # 等待超时后自行转发
+        self.status_hits = 0  # 已完成任务的状态查询直接应答
+        self.gpu_seconds_saved = 0.0  # 本进程统计的节省GPU时间
+
+        if enabled:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def begin(self, digest: str) -> DedupTicket:
+        """
+        查找相同内容的任务：找到时返回带response的结果；
+        否则登记为正在转发（leader），同一内容的后续请求等待它完成转发
+        """
+        deadline = time.time() + self.wait_timeout
+        waited = False
+        while True:
+            with self._lock:
+                event = self._flights.get(digest)
+            if event is not None:
+                # 相同内容正在转发：等待它拿到任务号，失败时由等待的请求重新转发
+                remaining = deadline - time.time()
+                if remaining <= 0 or not event.wait(remaining):
+                    self.wait_timeouts += 1
+                    logger.warning(f"等待相同图片的请求转发超时，自行转发: {digest[:12]}")
+                    return DedupTicket(digest)
+                waited = True
+                continue
+
+            response = self._lookup(digest)
+            if response is not None:
+                if waited:
+                    self.coalesced += 1
+                return DedupTicket(digest, response=response)
+
+            with self._lock:
+                if digest in self._flights:
+                    continue
+                self._flights[digest] = threading.Event()
+            # 查询与登记之间相同内容的请求可能刚好完成转发
+            response = self._lookup(digest)
+            if response is not None:
+                self._release(digest)
+                return DedupTicket(digest, response=response)
+            self.misses += 1
+            metrics.observe_dedup('miss')
+            return DedupTicket(digest, leader=True)
+
+    def _lookup(self, digest: str) -> Optional[Dict[str, Any]]:
+        """读取可复用的任务，返回给客户端的响应"""
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            "SELECT task_id, response, status, finished, gpu_seconds, created FROM tasks WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        if row["status"] is None:
+            if now - row["created"] >= self.inflight_ttl:
+                return None
+            # 任务完成时按附加的请求数计入节省的GPU时间
+            if conn.execute("UPDATE tasks SET attached = attached + 1 WHERE digest = ? AND status IS NULL",
+                            (digest,)).rowcount == 0:
+                # 刚好完成，按已完成的任务处理
+                row = conn.execute("SELECT task_id, response, status, finished, gpu_seconds, created FROM tasks "
+                                   "WHERE digest = ?", (digest,)).fetchone()
+                if row is None or row["status"] is None:
+                    return None
+            else:
+                self.inflight_hits += 1
+                metrics.observe_dedup('inflight')
+                logger.info(f"相同图片的任务正在处理，复用任务: {row['task_id']}")
+                return dict(json.loads(row["response"]), deduplicated=True)
+
+        if now - row["finished"] >= self.ttl or not result_cache.contains(row["task_id"]):
+            return None
+        gpu_seconds = row["gpu_seconds"]
+        self._add_saved(conn, gpu_seconds)
+        self.completed_hits += 1
+        metrics.observe_dedup('completed', gpu_seconds)
+        logger.info(f"相同图片的任务已完成，复用结果: {row['task_id']}")
+        status = json.loads(row["status"])
+        return dict(json.loads(row["response"]), status=status.get("status", "completed"), deduplicated=True)
+
+    def _add_saved(self, conn: sqlite3.Connection, gpu_seconds: float):
+        """累计节省的GPU时间（本进程和数据库中的合计）"""
+        if gpu_seconds <= 0:
+            return
+        self.gpu_seconds_saved += gpu_seconds
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('gpu_seconds_saved', ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS REAL) + excluded.value",
+            (gpu_seconds,)
+        )
+
+    def _release(self, digest: str):
+        with self._lock:
+            event = self._flights.pop(digest, None)
+        if event is not None:
+            event.set()
+
+    def finish(self, ticket: DedupTicket, result: Optional[Dict[str, Any]], status_code: Optional[int]):
+        """转发完成：记录任务号，唤醒等待相同内容的请求"""
+        if not ticket.leader:
+            return
+        try:
+            if status_code == 200 and isinstance(result, dict) and result.get("task_id") \
+                    and result.get("status") != "failed":
+                now = time.time()
+                self._conn().execute(
+                    "INSERT OR REPLACE INTO tasks (digest, task_id, response, created) VALUES (?, ?, ?, ?)",
+                    (ticket.digest, result["task_id"], json.dumps(result, ensure_ascii=False), now)
+                )
+                self._records += 1
+                if self._records % self.PRUNE_EVERY == 0:
+                    self._prune(now)
+        except sqlite3.Error as e:
+            logger.warning(f"记录去重索引失败: {e}")
+        finally:
+            self._release(ticket.digest)
+
+    def completed_status(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """已完成且结果在结果缓存中的任务，返回记录的状态（不再请求GPU服务器）"""
+        if not self.enabled:
+            return None
+        row = self._conn().execute(
+            "SELECT status, finished FROM tasks WHERE task_id = ? AND status IS NOT NULL", (task_id,)
+        ).fetchone()
+        if row is None or time.time() - row["finished"] >= self.ttl or not result_cache.contains(task_id):
+            return None
+        self.status_hits += 1
+        return dict(json.loads(row["status"]), task_id=task_id)
+
+    def task_finished(self, task_id: str, result: Dict[str, Any], job_seconds: Optional[float] = None):
+        """
+        状态查询返回任务结束：完成时记录状态和任务耗时（job_seconds，未知时按记录以来的时间），
+        附加到该任务的请求计入节省的GPU时间；失败时删除记录，相同内容下次重新处理
+        """
+        if not self.enabled:
+            return
+        if result.get("status") != "completed":
+            self.forget(task_id)
+            return
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM tasks WHERE task_id = ? AND status IS NULL", (task_id,)).fetchone() is None:
+            return
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT digest, created, attached FROM tasks WHERE task_id = ? AND status IS NULL", (task_id,)
+            ).fetchone()
+            if row is not None:
+                if job_seconds is None:
+                    job_seconds = now - row["created"]
+                conn.execute(
+                    "UPDATE tasks SET status = ?, finished = ?, gpu_seconds = ?, attached = 0 WHERE digest = ?",
+                    (json.dumps(result, ensure_ascii=False), now, job_seconds, row["digest"])
+                )
+                gpu_seconds = job_seconds * row["attached"]
+                self._add_saved(conn, gpu_seconds)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is not None and row["attached"]:
+            metrics.observe_dedup_saved(gpu_seconds)
+
+    def forget(self, task_id: str):
+        """任务失败或GPU服务器上已不存在：删除未完成的记录"""
+        if self.enabled:
+            self._conn().execute("DELETE FROM tasks WHERE task_id = ? AND status IS NULL", (task_id,))
+
+    def _prune(self, now: float):
+        """删除过期记录和超出容量的最旧记录"""
+        conn = self._conn()
+        expired = conn.execute(
+            "DELETE FROM tasks WHERE (status IS NULL AND created < ?) OR (status IS NOT NULL AND finished < ?)",
+            (now - self.inflight_ttl, now - self.ttl)
+        ).rowcount
+        excess = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM tasks WHERE digest IN (SELECT digest FROM tasks ORDER BY created LIMIT ?)", (excess,)
+            )
+        if expired or excess > 0:
+            logger.info(f"清理去重索引: 过期 {expired} 条, 超出容量 {max(excess, 0)} 条")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        stats = {
+            "enabled": self.enabled,
+            "inflight_hits": self.inflight_hits,
+            "completed_hits": self.completed_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "wait_timeouts": self.wait_timeouts,
+            "status_hits": self.status_hits,
+            "gpu_seconds_saved": round(self.gpu_seconds_saved, 1)
+        }
+        if self.enabled:
+            conn = self._conn()
+            stats["entries"] = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            row = conn.execute("SELECT value FROM meta WHERE key = 'gpu_seconds_saved'").fetchone()
+            # 所有worker、重启前后的合计
+            stats["gpu_seconds_saved_total"] = round(float(row["value"]), 1) if row else 0.0
+        return stats
+
+
+def create_enhance_deduplicator(ed_config: Dict[str, Any]) -> EnhanceDeduplicator:
+    """按配置创建去重索引"""
+    path = ed_config["path"]
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(__file__), path)
+    return EnhanceDeduplicator(
+        path=path,
+        ttl=ed_config["ttl"],
+        inflight_ttl=ed_config["inflight_ttl"],
+        max_entries=ed_config["max_entries"],
+        wait_timeout=ed_config["wait_timeout"],
+        enabled=ed_config["enabled"]
+    )
+
+
+# 全局实例
+enhance_dedup = create_enhance_deduplicator(config.get_enhance_dedup_config())
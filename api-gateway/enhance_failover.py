@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片增强请求失败转移
+转发到GPU服务器时连接失败或返回5xx（任务未被受理），换一台服务器重新发送缓存的请求体，
+客户端不会因为一台服务器故障收到503：
+- 重试受重试预算限制：窗口内的重试次数不超过请求数×retry_ratio（至少每秒min_retries_per_second次），
+  大面积故障时不会因为重试把请求量放大几倍
+- 对冲（默认关闭）：超过hedge_delay秒仍未受理时同时发送到另一台服务器，先受理的为准（同样占用重试预算）。
+  提交接口不是幂等的，较慢的一台之后也可能受理，重复处理同一张图片；只有先受理的请求认领任务
+  （记录任务路由和服务器的未完成任务），较慢的任务不占用服务器的任务名额，计入orphans
+"""
+
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+import requests
+
+from config import config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RetryBudget:
+    """重试预算：按秒分桶统计最近window秒的请求数和重试数"""
+
+    def __init__(self, ratio: float, min_per_second: float, window: int = 10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._seconds = [0] * window  # 每个桶对应的秒数，过期的桶重新计数
+        self._requests = [0] * window
+        self._retries = [0] * window
+        self._lock = threading.Lock()
+
+    def _slot(self, now: float) -> int:
+        """当前秒的桶（调用方需持有锁）"""
+        second = int(now)
+        slot = second % self.window
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._requests[slot] = 0
+            self._retries[slot] = 0
+        return slot
+
+    def _totals(self, now: float) -> Tuple[int, int]:
+        oldest = int(now) - self.window
+        requests_, retries = 0, 0
+        for second, count, retry in zip(self._seconds, self._requests, self._retries):
+            if second > oldest:
+                requests_ += count
+                retries += retry
+        return requests_, retries
+
+    def record_request(self):
+        with self._lock:
+            self._requests[self._slot(time.time())] += 1
+
+    def try_acquire(self) -> bool:
+        """申请一次重试，超出预算时返回False"""
+        now = time.time()
+        with self._lock:
+            slot = self._slot(now)
+            requests_, retries = self._totals(now)
+            if retries >= max(requests_ * self.ratio, self.min_per_second * self.window):
+                return False
+            self._retries[slot] += 1
+            return True
+
+    def release(self):
+        """退还一次申请到但没有发出的重试"""
+        with self._lock:
+            slot = self._slot(time.time())
+            if self._retries[slot] > 0:
+                self._retries[slot] -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests_, retries = self._totals(time.time())
+        return {"window_requests": requests_, "window_retries": retries}
+
+
+def _always_claim() -> bool:
+    return True
+
+
+class _Claim:
+    """对冲的几个请求中，第一个受理的请求认领任务"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.owner: Optional[int] = None
+
+    def take(self, attempt_no: int) -> bool:
+        """认领任务，返回该请求是否为认领者（认领者重复调用同样返回True）"""
+        with self._lock:
+            if self.owner is None:
+                self.owner = attempt_no
+            return self.owner == attempt_no
+
+
+class EnhanceFailover:
+    """转发失败时换服务器重试，迟迟未受理时对冲"""
+
+    def __init__(self, max_attempts: int, hedge_delay: float, budget: RetryBudget,
+                 attempt_workers: int = 64, enabled: bool = True):
+        self.enabled = enabled
+        self.max_attempts = max(1, max_attempts)
+        self.hedge_delay = hedge_delay
+        self.budget = budget
+        self.attempt_workers = attempt_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+        # 统计计数
+        self.requests = 0
+        self.retries = 0  # 失败后换服务器重试
+        self.hedges = 0  # 对冲请求
+        self.hedge_wins = 0  # 对冲请求先受理
+        self.recovered = 0  # 失败后重试成功
+        self.exhausted = 0  # 重试后仍失败
+        self.budget_denied = 0  # 超出重试预算未重试
+        self.no_server = 0  # 没有其他可用服务器未重试
+        self.orphans = 0  # 对冲中较慢的一台也受理了任务（未认领，已丢弃）
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.attempt_workers,
+                                                    thread_name_prefix='enhance-attempt')
+            return self._executor
+
+    @staticmethod
+    def _accepted(status_code: int) -> bool:
+        return status_code < 500
+
+    @staticmethod
+    def _retryable(error: BaseException) -> bool:
+        """连接失败可以换服务器重试；读取超时时任务可能已被受理，不重试"""
+        return isinstance(error, requests.exceptions.ConnectionError)
+
+    def forward(self, backend_url: str, server, attempt: Callable[[str, Any, Callable[[], bool]], Tuple[Any, int]],
+                select: Callable[[Set[str]], Any]) -> Tuple[Any, int]:
+        """
+        转发一个请求：attempt(url, server, claim) 发送一次并返回 (响应内容, 状态码)，负责结束server的转发中计数；
+        GPU服务器返回任务号时attempt调用claim()，返回True才记录该任务（对冲时只有第一个受理的请求返回True）；
+        select(已尝试的地址) 选择另一台服务器并计入转发中请求，没有时返回None
+        """
+        if not self.enabled:
+            return attempt(backend_url, server, _always_claim)
+        self.requests += 1
+        self.budget.record_request()
+        if self.hedge_delay > 0:
+            return self._forward_hedged(backend_url, server, attempt, select)
+
+        tried = {backend_url}
+        failed = False
+        while True:
+            try:
+                result, status_code = attempt(backend_url, server, _always_claim)
+                if self._accepted(status_code):
+                    if failed:
+                        self.recovered += 1
+                    return result, status_code
+                outcome = (result, status_code)
+                logger.warning(f"GPU服务器 {backend_url} 未受理任务: {status_code}")
+            except Exception as e:
+                if not self._retryable(e):
+                    raise
+                outcome = e
+                logger.warning(f"转发到GPU服务器 {backend_url} 失败: {e}")
+            failed = True
+            server = self._next_server(len(tried), tried, select)
+            if server is None:
+                self.exhausted += 1
+                if isinstance(outcome, BaseException):
+                    raise outcome
+                return outcome
+            backend_url = server.url
+            tried.add(backend_url)
+            self.retries += 1
+            metrics.observe_failover('retry')
+
+    def _next_server(self, attempts: int, tried: Set[str], select: Callable[[Set[str]], Any]):
+        """申请重试预算并选择一台未尝试过的服务器"""
+        if attempts >= self.max_attempts:
+            return None
+        if not self.budget.try_acquire():
+            self.budget_denied += 1
+            metrics.observe_failover('budget_denied')
+            return None
+        server = select(tried)
+        if server is None:
+            self.budget.release()
+            self.no_server += 1
+        return server
+
+    def _forward_hedged(self, backend_url: str, server, attempt, select) -> Tuple[Any, int]:
+        """每次发送在线程池中进行，超过hedge_delay仍未返回时再发送到另一台服务器"""
+        executor = self._get_executor()
+        claim = _Claim()
+        numbers = itertools.count()
+        tried = {backend_url}
+        pending: Dict[Any, Tuple[bool, Any, int]] = {}  # future -> (是否为对冲请求, 服务器, 序号)
+
+        def submit(url, target, hedged):
+            attempt_no = next(numbers)
+            future = executor.submit(attempt, url, target, lambda: claim.take(attempt_no))
+            pending[future] = (hedged, target, attempt_no)
+
+        submit(backend_url, server, False)
+        outcome = None
+        failed = False
+        hedging = True
+        while pending:
+            timeout = self.hedge_delay if hedging and len(tried) < self.max_attempts else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                server = self._next_server(len(tried), tried, select)
+                if server is None:
+                    # 无法对冲，只等待已发出的请求
+                    hedging = False
+                    continue
+                tried.add(server.url)
+                self.hedges += 1
+                metrics.observe_failover('hedge')
+                logger.info(f"{self.hedge_delay}秒内未受理，对冲发送到 {server.url}")
+                submit(server.url, server, True)
+                continue
+
+            for future in done:
+                hedged, _, attempt_no = pending.pop(future)
+                try:
+                    result, status_code = future.result()
+                except Exception as e:
+                    outcome = e
+                    failed = True
+                    logger.warning(f"转发到GPU服务器失败: {e}")
+                    continue
+                if not self._accepted(status_code):
+                    outcome = (result, status_code)
+                    failed = True
+                    continue
+                if not claim.take(attempt_no):
+                    # 另一个请求已认领任务，不再对冲，等待它返回
+                    self._orphan(result)
+                    hedging = False
+                    continue
+                # 已受理：不再等待其余请求，仍在发送的随请求体关闭而中止
+                for other, (_, other_server, _) in pending.items():
+                    if other.cancel():
+                        # 还没开始发送，由这里结束转发中计数
+                        if other_server:
+                            other_server.end_request()
+                    else:
+                        other.add_done_callback(self._check_orphan)
+                if hedged:
+                    self.hedge_wins += 1
+                if failed:
+                    self.recovered += 1
+                return result, status_code
+
+            if not pending and not (isinstance(outcome, BaseException) and not self._retryable(outcome)):
+                server = self._next_server(len(tried), tried, select)
+                if server is not None:
+                    tried.add(server.url)
+                    self.retries += 1
+                    metrics.observe_failover('retry')
+                    submit(server.url, server, False)
+
+        self.exhausted += 1
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    def _check_orphan(self, future):
+        """对冲中较慢的请求也受理了任务：该任务未被认领，不会有客户端查询"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        result, status_code = future.result()
+        if self._accepted(status_code):
+            self._orphan(result)
+
+    def _orphan(self, result: Any):
+        if isinstance(result, dict) and result.get('task_id'):
+            self.orphans += 1
+            metrics.observe_failover('orphan')
+            logger.warning(f"对冲请求重复受理，已丢弃任务 {result['task_id']}")
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            "enabled": self.enabled,
+            "max_attempts": self.max_attempts,
+            "hedge_delay": self.hedge_delay,
+            "requests": self.requests,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "recovered": self.recovered,
+            "exhausted": self.exhausted,
+            "budget_denied": self.budget_denied,
+            "no_server": self.no_server,
+            "orphans": self.orphans,
+            **self.budget.get_stats()
+        }
+
+
+def create_enhance_failover(ef_config: Dict[str, Any]) -> EnhanceFailover:
+    """按配置创建失败转移"""
+    budget = RetryBudget(
+        ratio=ef_config["retry_ratio"],
+        min_per_second=ef_config["min_retries_per_second"],
+        window=ef_config["budget_window"]
+    )
+    return EnhanceFailover(
+        max_attempts=ef_config["max_attempts"],
+        hedge_delay=ef_config["hedge_delay"],
+        budget=budget,
+        attempt_workers=ef_config["attempt_workers"],
+        enabled=ef_config["enabled"]
+    )
+
+
+# 全局实例
+enhance_failover = create_enhance_failover(config.get_enhance_failover_config())
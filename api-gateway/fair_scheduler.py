@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片增强公平排队模块
+原来每个增强请求都立即转发到GPU服务器，批量上传的用户可以占满所有GPU，其他用户只能排在后面。
+网关在转发前做准入控制：
+- 每台服务器同时处理的任务数有上限（max_jobs_per_server × 权重），有空闲且没有排队任务时直接转发
+- 全部满载时图片缓存在网关（内存/临时文件），立即返回排队任务号；客户端照常轮询
+  /api/v1/status/<任务号>，排队期间返回 status=queued 和 queue_position，分配后透明转为GPU任务状态
+- 每个用户一个队列，按差额轮询（DRR）分配：每个用户每轮获得quantum额度，按图片大小扣减，
+  批量上传的用户只占自己的轮次，不会让其他用户等到它的任务全部处理完
+- 单个用户或全局排队数超出上限时立即返回429（Retry-After），不读取上传内容
+用户按登录令牌对应的openid识别，未登录时按 user_{IP}_{时间窗口} 识别
+
+排队的图片保存在接收请求的worker中，由该worker分配；排队任务号的状态（排队中/GPU任务号/失败）
+同时写入SQLite数据库（多个worker共用），客户端轮询到其他worker时同样可以查询和下载
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from backend_manager import backend_manager
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 排队任务状态
+QUEUED = 'queued'  # 在网关排队
+DISPATCHING = 'dispatching'  # 正在提交到GPU服务器
+DISPATCHED = 'dispatched'  # 已提交，之后按GPU任务号查询
+FAILED = 'failed'  # 排队超时或提交失败
+
+# 排队任务号前缀，与GPU服务器的任务号区分
+TICKET_PREFIX = 'queue-'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    ticket TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    task_id TEXT,
+    error TEXT,
+    position INTEGER NOT NULL DEFAULT 0,
+    submitted_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS tickets_submitted_at ON tickets (submitted_at);
+"""
+
+
+class QueueFullError(Exception):
+    """排队数超出上限"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueuedJob:
+    """一个在网关排队的增强任务"""
+
+    __slots__ = ('ticket', 'user', 'cost', 'seq', 'body', 'dispatch', 'submitted_at',
+                 'state', 'task_id', 'error', 'finished_at')
+
+    def __init__(self, ticket: str, user: str, cost: int, seq: int, body: Any,
+                 dispatch: Callable[[Any], Tuple[Any, int]], submitted_at: float):
+        self.ticket = ticket
+        self.user = user
+        self.cost = cost
+        self.seq = seq  # 在该用户队列中的序号
+        self.body = body  # 缓存的图片，提交后关闭
+        self.dispatch = dispatch  # dispatch(server) -> (响应内容, 状态码)
+        self.submitted_at = submitted_at
+        self.state = QUEUED
+        self.task_id: Optional[str] = None  # GPU服务器返回的任务号
+        self.error: Optional[str] = None
+        self.finished_at = 0.0
+
+
+class _UserQueue:
+    """一个用户的排队任务和DRR额度"""
+
+    __slots__ = ('jobs', 'deficit', 'in_turn', 'next_seq')
+
+    def __init__(self):
+        self.jobs: Deque[QueuedJob] = deque()
+        self.deficit = 0
+        self.in_turn = False  # 本轮额度已发放
+        self.next_seq = 0
+
+
+class FairScheduler:
+    """按用户差额轮询的增强任务调度器"""
+
+    PRUNE_EVERY = 100  # 每排队N个任务清理一次数据库中过期的排队任务号
+
+    def __init__(self, backend_manager, enabled: bool, max_jobs_per_server: int, max_queue_per_user: int,
+                 max_queue_total: int, max_wait: float, retry_after: int, quantum: int, cost_unit: int,
+                 user_window: int, spool_memory: int, dispatch_workers: int,
+                 ticket_ttl: float, max_tickets: int, path: str, poll_interval: float = 0.5):
+        self.backend_manager = backend_manager
+        self.enabled = enabled
+        self.path = path
+        self.max_jobs_per_server = max_jobs_per_server
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue_total = max_queue_total
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.quantum = max(int(quantum), 1)
+        self.cost_unit = max(int(cost_unit), 1)
+        self.user_window = max(int(user_window), 1)
+        self.spool_memory = spool_memory
+        self.dispatch_workers = dispatch_workers
+        self.ticket_ttl = ticket_ttl
+        self.max_tickets = max_tickets
+        self.poll_interval = poll_interval  # 满载时检查是否有服务器空闲的间隔（任务完成时会立即唤醒）
+
+        # 有排队任务的用户，按轮询顺序排列，第一个是当前轮到的用户
+        self._users: "OrderedDict[str, _UserQueue]" = OrderedDict()
+        # 排队任务号 -> 任务，按提交时间排序
+        self._tickets: "OrderedDict[str, QueuedJob]" = OrderedDict()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stopping = False
+        self._next_expire = 0.0
+        self._local = threading.local()
+
+        # 统计计数
+        self.direct = 0  # 有空闲直接转发
+        self.submitted = 0  # 进入排队
+        self.dispatched = 0  # 排队后提交成功
+        self.failed = 0  # 排队后提交失败
+        self.expired = 0  # 排队超时
+        self.rejected = 0  # 超出排队上限被拒绝
+        self.peak_queued = 0  # 排队数峰值
+        self.shared_lookups = 0  # 其他worker排队的任务号，从数据库查到
+
+        if enabled:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @property
+    def active(self) -> bool:
+        """是否启用排队：需要多GPU服务器模式提供每台服务器的负载"""
+        return self.enabled and config.is_multi_backend_enabled()
+
+    def user_key(self, client_ip: str, openid: Optional[str] = None, now: Optional[float] = None) -> str:
+        """排队使用的用户标识"""
+        if openid:
+            return f"openid_{openid}"
+        window = int((now if now is not None else time.time()) // self.user_window)
+        return f"user_{client_ip}_{window}"
+
+    def try_acquire(self):
+        """
+        没有排队任务且有未满载的服务器时，返回已计入一个转发中请求的服务器（转发后需调用end_request），
+        否则返回None（需要排队）
+        """
+        if self._queued:
+            return None
+        server = self.backend_manager.reserve_server(self.max_jobs_per_server)
+        if server is not None:
+            self.direct += 1
+        return server
+
+    def job_cost(self, size: int) -> int:
+        """按图片大小计算的任务开销"""
+        return max(-(-size // self.cost_unit), 1)
+
+    def _check_admission(self, user: str):
+        """排队数超出上限时抛出QueueFullError（调用方需持有锁）"""
+        if self._queued >= self.max_queue_total:
+            self.rejected += 1
+            raise QueueFullError("当前排队人数较多，请稍后重试", self.retry_after)
+        queue = self._users.get(user)
+        if queue is not None and len(queue.jobs) >= self.max_queue_per_user:
+            self.rejected += 1
+            raise QueueFullError(f"您已有 {len(queue.jobs)} 张图片在排队，请等待处理完成后再提交", self.retry_after)
+
+    def check_admission(self, user: str):
+        """在读取上传内容之前检查是否还能排队"""
+        with self._cond:
+            self._check_admission(user)
+
+    def submit(self, user: str, body: Any, size: int, dispatch: Callable[[Any], Tuple[Any, int]]) -> QueuedJob:
+        """加入用户的队列，返回排队任务"""
+        now = time.time()
+        with self._cond:
+            self._check_admission(user)
+            queue = self._users.get(user)
+            if queue is None:
+                # 新用户排在轮询顺序的最后
+                queue = self._users[user] = _UserQueue()
+            ticket = f"{TICKET_PREFIX}{uuid.uuid4().hex}"
+            job = QueuedJob(ticket, user, self.job_cost(size), queue.next_seq, body, dispatch, now)
+            queue.next_seq += 1
+            queue.jobs.append(job)
+            self._tickets[ticket] = job
+            self._purge_tickets(now)
+            self._queued += 1
+            self.submitted += 1
+            self._save_ticket(job, self.position(job))
+            self.peak_queued = max(self.peak_queued, self._queued)
+            self._ensure_started()
+            self._cond.notify()
+        return job
+
+    def _ensure_started(self):
+        """首次排队时启动分配线程（调用方需持有锁）"""
+        if self._thread is None:
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=self.dispatch_workers,
+                                                thread_name_prefix="fair-dispatch")
+            self._thread = threading.Thread(target=self._dispatch_loop, args=(self._executor,),
+                                            name="fair-scheduler", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """服务器上有任务完成，唤醒分配线程"""
+        if self._queued:
+            with self._cond:
+                self._cond.notify()
+
+    def get(self, ticket: str) -> Optional[QueuedJob]:
+        """按排队任务号查找任务"""
+        if not ticket.startswith(TICKET_PREFIX):
+            return None
+        with self._cond:
+            return self._tickets.get(ticket)
+
+    def position(self, job: QueuedJob) -> int:
+        """
+        预计排队位置（从1开始，已分配返回0）
+        按每个用户每轮分配一个任务估算：排在前面的是自己队列中更早的任务，
+        加上其他用户在这些轮次中分配的任务
+        """
+        with self._cond:
+            if job.state != QUEUED:
+                return 0
+            queue = self._users[job.user]
+            rounds = job.seq - queue.jobs[0].seq
+            ahead = rounds
+            before = True
+            for other in self._users.values():
+                if other is queue:
+                    before = False
+                    continue
+                ahead += min(len(other.jobs), rounds + 1 if before else rounds)
+            return ahead + 1
+
+    def _save_ticket(self, job: QueuedJob, position: int = 0):
+        """把排队任务号的状态写入数据库（调用方需持有锁）"""
+        if not self.enabled:
+            return
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO tickets (ticket, state, task_id, error, position, submitted_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job.ticket, job.state, job.task_id, job.error, position, job.submitted_at, job.finished_at or None)
+            )
+            if job.state == QUEUED and self.submitted % self.PRUNE_EVERY == 0:
+                self._prune_tickets(conn, job.submitted_at)
+        except sqlite3.Error as e:
+            logger.warning(f"记录排队任务号 {job.ticket} 失败: {e}")
+
+    def _prune_tickets(self, conn: sqlite3.Connection, now: float):
+        """删除数据库中过期和超出容量的已结束任务号"""
+        conn.execute("DELETE FROM tickets WHERE finished_at < ?", (now - self.ticket_ttl,))
+        # 仍在排队的任务号（包括worker退出后遗留的）超过max_wait后不会再分配
+        conn.execute("DELETE FROM tickets WHERE finished_at IS NULL AND submitted_at < ?",
+                     (now - self.max_wait - self.ticket_ttl,))
+        excess = conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0] - self.max_tickets
+        if excess > 0:
+            conn.execute("DELETE FROM tickets WHERE ticket IN "
+                         "(SELECT ticket FROM tickets ORDER BY submitted_at LIMIT ?)", (excess,))
+
+    def _shared_status(self, task_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """本进程没有的排队任务号，从数据库查询其他worker记录的状态"""
+        if not self.enabled or not task_id.startswith(TICKET_PREFIX):
+            return task_id, None
+        try:
+            row = self._conn().execute(
+                "SELECT state, task_id, error, position FROM tickets WHERE ticket = ?", (task_id,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"查询排队任务号 {task_id} 失败: {e}")
+            return task_id, None
+        if row is None:
+            return task_id, None
+        self.shared_lookups += 1
+        if row["state"] == DISPATCHED:
+            return row["task_id"], None
+        if row["state"] == FAILED:
+            return task_id, {'task_id': task_id, 'status': 'failed', 'error': row["error"]}
+        # 排队位置只有排队的worker知道，这里是提交时的位置
+        return task_id, {
+            'task_id': task_id,
+            'status': 'queued',
+            'queue_position': row["position"],
+            'message': f"排队中，前面还有 {max(row['position'] - 1, 0)} 个任务"
+        }
+
+    def resolve(self, task_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        把客户端使用的任务号转换为GPU任务号
+        返回 (GPU任务号, None)；任务仍在排队或已失败时返回 (task_id, 直接返回给客户端的状态)
+        """
+        job = self.get(task_id)
+        if job is None:
+            return self._shared_status(task_id)
+        if job.state == DISPATCHED:
+            return job.task_id, None
+        if job.state == FAILED:
+            return task_id, {'task_id': task_id, 'status': 'failed', 'error': job.error}
+        position = self.position(job)
+        return task_id, {
+            'task_id': task_id,
+            'status': 'queued',
+            'queue_position': position,
+            'queue_length': self._queued,
+            'message': f"排队中，前面还有 {max(position - 1, 0)} 个任务"
+        }
+
+    def _next_job(self) -> Optional[QueuedJob]:
+        """按差额轮询取出下一个任务（调用方需持有锁）"""
+        while self._users:
+            user, queue = next(iter(self._users.items()))
+            if not queue.in_turn:
+                queue.deficit += self.quantum
+                queue.in_turn = True
+            job = queue.jobs[0]
+            if job.cost <= queue.deficit:
+                queue.deficit -= job.cost
+                queue.jobs.popleft()
+                self._queued -= 1
+                if not queue.jobs:
+                    # 队列清空后不保留额度，下次排队重新开始
+                    del self._users[user]
+                return job
+            # 额度不够，本轮结束，轮到下一个用户
+            queue.in_turn = False
+            self._users.move_to_end(user)
+        return None
+
+    def _finish(self, job: QueuedJob, state: str, error: Optional[str] = None):
+        """任务结束排队，释放缓存的图片"""
+        job.state = state
+        job.error = error
+        job.finished_at = time.time()
+        job.dispatch = None
+        self._save_ticket(job)
+        body, job.body = job.body, None
+        if body is not None:
+            try:
+                body.close()
+            except Exception:
+                pass
+
+    def _expire(self, now: float):
+        """排队超过max_wait的任务按失败处理（调用方需持有锁）"""
+        deadline = now - self.max_wait
+        for user in list(self._users):
+            queue = self._users[user]
+            # 每个用户的队列按提交时间排序，只需检查队首
+            while queue.jobs and queue.jobs[0].submitted_at < deadline:
+                job = queue.jobs.popleft()
+                self._queued -= 1
+                self.expired += 1
+                self._finish(job, FAILED, '排队超时，请重新提交')
+            if not queue.jobs:
+                del self._users[user]
+
+    def _purge_tickets(self, now: float):
+        """清理过期的任务号映射（调用方需持有锁）"""
+        while self._tickets:
+            job = next(iter(self._tickets.values()))
+            if job.state in (QUEUED, DISPATCHING):
+                break
+            if now - job.finished_at < self.ticket_ttl and len(self._tickets) <= self.max_tickets:
+                break
+            self._tickets.popitem(last=False)
+
+    def _dispatch_loop(self, executor: ThreadPoolExecutor):
+        """有空闲服务器时按公平顺序提交排队任务"""
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.time()
+                    if now >= self._next_expire:
+                        self._expire(now)
+                        self._next_expire = now + 1.0
+                    if self._queued:
+                        break
+                    self._cond.wait(self.poll_interval)
+                if self._stopping:
+                    return
+
+            server = self.backend_manager.reserve_server(self.max_jobs_per_server)
+            if server is None:
+                # 全部满载，等待任务完成或下次检查
+                with self._cond:
+                    self._cond.wait(self.poll_interval)
+                continue
+
+            with self._cond:
+                job = self._next_job()
+                if job is not None:
+                    job.state = DISPATCHING
+            if job is None:
+                server.end_request()
+                continue
+            try:
+                executor.submit(self._run, job, server)
+            except RuntimeError:
+                # 调度器已停止
+                server.end_request()
+                with self._cond:
+                    self.failed += 1
+                    self._finish(job, FAILED, '服务暂时不可用')
+                return
+
+    def _run(self, job: QueuedJob, server):
+        """提交一个排队任务到选中的服务器"""
+        state, error = FAILED, '服务暂时不可用'
+        try:
+            result, status_code = job.dispatch(server)
+            task_id = result.get('task_id') if isinstance(result, dict) else None
+            if status_code < 400 and task_id:
+                job.task_id = task_id
+                state, error = DISPATCHED, None
+            else:
+                if isinstance(result, dict) and result.get('error'):
+                    error = result['error']
+                logger.warning(f"排队任务 {job.ticket} 提交失败: {status_code}")
+        except Exception as e:
+            logger.error(f"排队任务 {job.ticket} 提交到 {server.url} 失败: {e}")
+        finally:
+            # dispatch负责记录GPU任务并结束转发中计数；这里只更新排队状态
+            with self._cond:
+                if state == DISPATCHED:
+                    self.dispatched += 1
+                else:
+                    self.failed += 1
+                self._finish(job, state, error)
+                self._cond.notify()
+
+    def stop(self):
+        """停止分配线程"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread, self._thread = self._thread, None
+            executor, self._executor = self._executor, None
+        if thread:
+            thread.join(timeout=5)
+        if executor:
+            executor.shutdown(wait=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        with self._cond:
+            return {
+                "enabled": self.active,
+                "queued": self._queued,
+                "users": len(self._users),
+                "peak_queued": self.peak_queued,
+                "direct": self.direct,
+                "submitted": self.submitted,
+                "dispatched": self.dispatched,
+                "failed": self.failed,
+                "expired": self.expired,
+                "rejected": self.rejected,
+                "shared_lookups": self.shared_lookups
+            }
+
+
+# 全局实例
+_fq_config = config.get_fair_queue_config()
+_fq_path = _fq_config["path"]
+if not os.path.isabs(_fq_path):
+    _fq_path = os.path.join(os.path.dirname(__file__), _fq_path)
+fair_scheduler = FairScheduler(
+    backend_manager,
+    enabled=_fq_config["enabled"],
+    max_jobs_per_server=_fq_config["max_jobs_per_server"],
+    max_queue_per_user=_fq_config["max_queue_per_user"],
+    max_queue_total=_fq_config["max_queue_total"],
+    max_wait=_fq_config["max_wait"],
+    retry_after=_fq_config["retry_after"],
+    quantum=_fq_config["quantum"],
+    cost_unit=_fq_config["cost_unit"],
+    user_window=_fq_config["user_window"],
+    spool_memory=_fq_config["spool_memory"],
+    dispatch_workers=_fq_config["dispatch_workers"],
+    ticket_ttl=_fq_config["ticket_ttl"],
+    max_tickets=_fq_config["max_tickets"],
+    path=_fq_path
+)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP连接池模块
+为每台GPU服务器和微信接口提供长连接复用的requests会话，
+并统计连接复用率和建连耗时分布
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Any
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 建连耗时直方图的桶上限（毫秒）
+CONNECT_TIME_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class ConnectionStats:
+    """连接池统计：请求数、新建连接数、建连耗时直方图"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connects = 0
+        self.connect_time_total = 0.0
+        self.connect_time_buckets = [0] * (len(CONNECT_TIME_BUCKETS_MS) + 1)
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_connect(self, seconds: float):
+        elapsed_ms = seconds * 1000
+        index = len(CONNECT_TIME_BUCKETS_MS)
+        for i, bound in enumerate(CONNECT_TIME_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                index = i
+                break
+        with self._lock:
+            self.connects += 1
+            self.connect_time_total += seconds
+            self.connect_time_buckets[index] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            reused = max(self.requests - self.connects, 0)
+            histogram = {f"le_{bound}ms": count
+                         for bound, count in zip(CONNECT_TIME_BUCKETS_MS, self.connect_time_buckets)}
+            histogram["gt_%dms" % CONNECT_TIME_BUCKETS_MS[-1]] = self.connect_time_buckets[-1]
+            return {
+                "requests": self.requests,
+                "new_connections": self.connects,
+                "reused_connections": reused,
+                "reuse_ratio": round(reused / self.requests, 4) if self.requests else 0.0,
+                "avg_connect_ms": round(self.connect_time_total * 1000 / self.connects, 2) if self.connects else 0.0,
+                "connect_time_histogram": histogram
+            }
+
+
+def _instrumented_pool_class(base, stats: ConnectionStats):
+    """生成会记录建连耗时的连接池类"""
+
+    class InstrumentedPool(base):
+        def _new_conn(self):
+            conn = super()._new_conn()
+            original_connect = conn.connect
+
+            def timed_connect():
+                start = time.perf_counter()
+                try:
+                    return original_connect()
+                finally:
+                    stats.record_connect(time.perf_counter() - start)
+
+            conn.connect = timed_connect
+            return conn
+
+    return InstrumentedPool
+
+
+class PooledAdapter(HTTPAdapter):
+    """带统计的连接池适配器"""
+
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _instrumented_pool_class(HTTPConnectionPool, self.stats),
+            "https": _instrumented_pool_class(HTTPSConnectionPool, self.stats)
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.record_request()
+        return super().send(request, **kwargs)
+
+
+class PooledSession(requests.Session):
+    """长连接复用的requests会话"""
+
+    def __init__(self, pool_maxsize: int = 10):
+        super().__init__()
+        self.stats = ConnectionStats()
+        adapter = PooledAdapter(self.stats, pool_connections=4, pool_maxsize=pool_maxsize)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+
+def create_backend_session() -> PooledSession:
+    """创建GPU服务器使用的连接池会话"""
+    return PooledSession(pool_maxsize=config.get_connection_pool_config()["backend_pool_size"])
+
+
+# 微信接口共享的连接池会话
+wechat_session = PooledSession(pool_maxsize=config.get_connection_pool_config()["wechat_pool_size"])
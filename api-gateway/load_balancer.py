@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+负载均衡策略模块
+提供可插拔的GPU服务器选择策略，在 gateway_config.json 的 load_balancing.strategy 中配置：
+- round_robin: 顺序轮询（默认）
+- weighted_round_robin: 按声明的GPU算力(weight)平滑加权轮询
+- least_outstanding: 选择未完成任务数/权重最小的服务器
+- power_of_two: 随机取两台，选择未完成任务数/权重较小的一台
+- ewma_latency: 按任务耗时EWMA × (未完成任务数+1) / 权重 选择得分最低的服务器
+"""
+
+import itertools
+import logging
+import random
+import threading
+from typing import Dict, Optional, Sequence, Type
+
+logger = logging.getLogger(__name__)
+
+
+def _load(server) -> float:
+    """按权重归一化的负载（计入即将分配的这个请求，使算力大的服务器在空闲时优先）"""
+    return (server.in_flight + 1) / server.weight
+
+
+class SelectionStrategy:
+    """选择策略基类"""
+
+    name = ""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def select(self, servers: Sequence) -> Optional[object]:
+        """从健康服务器快照（列表或元组）中选择一台，servers不为空"""
+        raise NotImplementedError
+
+
+class RoundRobinStrategy(SelectionStrategy):
+    """顺序轮询"""
+
+    name = "round_robin"
+
+    def __init__(self):
+        super().__init__()
+        # itertools.count的next()在解释器内原子执行，多线程选择无需加锁
+        self.counter = itertools.count()
+
+    def select(self, servers):
+        return servers[next(self.counter) % len(servers)]
+
+
+class WeightedRoundRobinStrategy(SelectionStrategy):
+    """平滑加权轮询（与nginx相同的算法），权重高的服务器按比例获得更多请求且分布均匀"""
+
+    name = "weighted_round_robin"
+
+    def __init__(self):
+        super().__init__()
+        self.current_weights: Dict[str, float] = {}
+
+    def select(self, servers):
+        with self._lock:
+            total = 0
+            best = None
+            for server in servers:
+                current = self.current_weights.get(server.server_id, 0) + server.weight
+                self.current_weights[server.server_id] = current
+                total += server.weight
+                if best is None or current > self.current_weights[best.server_id]:
+                    best = server
+            self.current_weights[best.server_id] -= total
+
+            # 清理已下线服务器的状态
+            if len(self.current_weights) > len(servers):
+                active = {server.server_id for server in servers}
+                for server_id in [sid for sid in self.current_weights if sid not in active]:
+                    del self.current_weights[server_id]
+        return best
+
+
+class LeastOutstandingStrategy(SelectionStrategy):
+    """最少未完成任务"""
+
+    name = "least_outstanding"
+
+    def __init__(self):
+        super().__init__()
+        self.counter = itertools.count()
+
+    def select(self, servers):
+        # 负载相同时从轮转的起点开始比较，避免总是选中列表中第一台
+        start = next(self.counter) % len(servers)
+        rotated = servers[start:] + servers[:start]
+        return min(rotated, key=_load)
+
+
+class PowerOfTwoChoicesStrategy(SelectionStrategy):
+    """随机两选一：开销固定，避免所有网关线程同时涌向同一台负载最低的服务器"""
+
+    name = "power_of_two"
+
+    def select(self, servers):
+        if len(servers) == 1:
+            return servers[0]
+        # 按权重抽取两台不同的候选服务器，算力小的服务器被抽中的概率也小
+        weights = [server.weight for server in servers]
+        first = random.choices(range(len(servers)), weights=weights)[0]
+        weights[first] = 0
+        second = random.choices(range(len(servers)), weights=weights)[0]
+        first, second = servers[first], servers[second]
+        return first if _load(first) <= _load(second) else second
+
+
+class EwmaLatencyStrategy(SelectionStrategy):
+    """按任务耗时EWMA感知的选择策略"""
+
+    name = "ewma_latency"
+
+    def select(self, servers):
+        # 还没有耗时样本的服务器使用已知样本的平均值，既能被探测到又不会独占流量
+        known = [server.ewma_latency for server in servers if server.ewma_latency > 0]
+        default_latency = sum(known) / len(known) if known else 1.0
+
+        def score(server):
+            latency = server.ewma_latency if server.ewma_latency > 0 else default_latency
+            return latency * (server.in_flight + 1) / server.weight
+
+        return min(servers, key=score)
+
+
+STRATEGIES: Dict[str, Type[SelectionStrategy]] = {
+    strategy.name: strategy
+    for strategy in (
+        RoundRobinStrategy,
+        WeightedRoundRobinStrategy,
+        LeastOutstandingStrategy,
+        PowerOfTwoChoicesStrategy,
+        EwmaLatencyStrategy
+    )
+}
+
+
+def create_strategy(name: str) -> SelectionStrategy:
+    """根据名称创建选择策略，未知名称回退到顺序轮询"""
+    strategy_class = STRATEGIES.get(name)
+    if strategy_class is None:
+        logger.warning(f"未知的负载均衡策略 {name}，使用 {RoundRobinStrategy.name}")
+        strategy_class = RoundRobinStrategy
+    return strategy_class()
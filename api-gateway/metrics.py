@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行指标
+统计接口请求数和耗时、转发到GPU服务器的请求耗时和错误、转发字节数、并发请求数、
+健康检测结果和订单存储操作耗时，由 /metrics 按Prometheus文本格式输出。
+
+记录时不加锁：每个线程只写自己的一份计数，输出时汇总所有线程的计数；
+线程退出后它的计数合并到公共部分（输出时或线程数超过上限时），每请求一个线程的部署方式也不会无限增长
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import config
+
+# 线程计数超过该数量时合并已退出线程的计数
+_MAX_SHARDS = 64
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """指标基类：每个线程一份 标签值 -> 计数 的字典"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict]] = []
+        self._retired: Dict[Tuple, Any] = {}  # 已退出线程的计数合计
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict:
+        """当前线程的计数字典，线程第一次记录时注册"""
+        try:
+            return self._local.data
+        except AttributeError:
+            pass
+        data = {}
+        with self._lock:
+            if len(self._shards) >= _MAX_SHARDS:
+                self._retire_dead()
+            self._shards.append((threading.current_thread(), data))
+        self._local.data = data
+        return data
+
+    def _retire_dead(self):
+        """把已退出线程的计数合并到公共部分（锁内调用）"""
+        alive = []
+        for thread, data in self._shards:
+            if thread.is_alive():
+                alive.append((thread, data))
+                continue
+            for key, value in data.items():
+                self._retired[key] = self._merge(self._retired.get(key), value)
+        self._shards = alive
+
+    def _merge(self, total, value):
+        return value if total is None else total + value
+
+    def collect(self) -> Dict[Tuple, Any]:
+        """汇总所有线程的计数"""
+        with self._lock:
+            self._retire_dead()
+            total = dict(self._retired)
+            shards = [data for _, data in self._shards]
+        for data in shards:
+            # 其他线程可能同时写入：复制一份再合并，读到的是某一时刻前后的值
+            for key, value in list(data.items()):
+                total[key] = self._merge(total.get(key), value)
+        return total
+
+    def shard_count(self) -> int:
+        return len(self._shards)
+
+    def expose(self, lines: List[str]):
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+
+
+class Counter(_Metric):
+    """只增计数"""
+
+    kind = 'counter'
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        data = self._shard()
+        data[labels] = data.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """可增可减的当前值（各线程的增减量之和）"""
+
+    kind = 'gauge'
+
+    def dec(self, labels: Tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    """耗时分布：每个标签一组区间计数和总和"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str], buckets: Iterable[float]):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels: Tuple, value: float):
+        data = self._shard()
+        cells = data.get(labels)
+        if cells is None:
+            # 各区间的计数（最后一个为超过最大区间的计数），末尾为总和
+            cells = data[labels] = [0] * (len(self.buckets) + 2)
+        cells[bisect_left(self.buckets, value)] += 1
+        cells[-1] += value
+
+    def _merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def expose(self, lines: List[str]):
+        bounds = self.buckets + (float('inf'),)
+        for labels, cells in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(bounds, cells):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(float(cells[-1]))}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+
+
+class CallbackGauge(_Metric):
+    """输出时才读取的当前值（如各服务器的转发中请求数），记录时没有开销"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str],
+                 callback: Callable[[], Dict[Tuple, float]]):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def collect(self) -> Dict[Tuple, Any]:
+        return self.callback() if self.callback else {}
+
+
+class GatewayMetrics:
+    """网关的全部指标"""
+
+    def __init__(self, enabled: bool = True, allow_ips: Optional[List[str]] = None,
+                 latency_buckets: Iterable[float] = (), store_buckets: Iterable[float] = ()):
+        self.enabled = enabled
+        self.allow_ips = set(allow_ips or [])
+        self._backends = None  # 服务器注册表，输出时读取各服务器的状态
+
+        self.http_requests = Counter(
+            'gateway_http_requests_total', '接口请求数', ('route', 'method', 'status'))
+        self.http_duration = Histogram(
+            'gateway_http_request_duration_seconds', '接口处理耗时（秒）', ('route',), latency_buckets)
+        self.http_in_flight = Gauge(
+            'gateway_http_requests_in_flight', '正在处理的接口请求数', ('route',))
+        self.upstream_duration = Histogram(
+            'gateway_upstream_request_duration_seconds', '转发到GPU服务器的请求耗时（秒）',
+            ('backend', 'operation'), latency_buckets)
+        self.upstream_errors = Counter(
+            'gateway_upstream_errors_total', '转发到GPU服务器的请求失败数（connection: 连接失败或超时，5xx: 服务器错误）',
+            ('backend', 'operation', 'kind'))
+        self.proxied_bytes = Counter(
+            'gateway_proxied_bytes_total', '转发的图片字节数（upload: 上传到GPU服务器，download: 下载结果）',
+            ('backend', 'direction'))
+        self.backend_in_flight = CallbackGauge(
+            'gateway_backend_in_flight', 'GPU服务器未完成的请求和任务数', ('backend',), self._backend_in_flight)
+        self.backend_available = CallbackGauge(
+            'gateway_backend_available', 'GPU服务器是否可用（健康且未被熔断）', ('backend',), self._backend_available)
+        self.health_checks = Counter(
+            'gateway_health_checks_total', 'GPU服务器主动健康检测次数', ('backend', 'result'))
+        self.health_check_duration = Histogram(
+            'gateway_health_check_duration_seconds', 'GPU服务器健康检测耗时（秒）', ('backend',), latency_buckets)
+        self.order_store_duration = Histogram(
+            'gateway_order_store_operation_duration_seconds', '订单存储操作耗时（秒）', ('operation',), store_buckets)
+        self.enhance_dedup = Counter(
+            'gateway_enhance_dedup_total',
+            '图片增强请求去重结果（inflight: 复用处理中的任务，completed: 复用已完成的任务，miss: 转发为新任务）',
+            ('result',))
+        self.dedup_gpu_seconds_saved = Counter(
+            'gateway_enhance_dedup_gpu_seconds_saved_total', '重复请求节省的GPU时间估计（秒）')
+        self.enhance_failover = Counter(
+            'gateway_enhance_failover_total',
+            '图片增强请求失败转移（retry: 换服务器重试，hedge: 对冲发送，budget_denied: 超出重试预算，'
+            'orphan: 对冲请求重复受理）',
+            ('event',))
+
+        self._metrics: List[_Metric] = [
+            self.http_requests, self.http_duration, self.http_in_flight,
+            self.upstream_duration, self.upstream_errors, self.proxied_bytes,
+            self.backend_in_flight, self.backend_available,
+            self.health_checks, self.health_check_duration,
+            self.order_store_duration,
+            self.enhance_dedup, self.dedup_gpu_seconds_saved,
+            self.enhance_failover
+        ]
+        self.renders = 0
+
+    def bind_backends(self, servers):
+        """设置服务器注册表（ServerRegistry），输出各服务器的转发中请求数和可用状态"""
+        self._backends = servers
+
+    def _backend_in_flight(self) -> Dict[Tuple, float]:
+        if self._backends is None:
+            return {}
+        return {(server.url,): server.in_flight for server in list(self._backends.values())}
+
+    def _backend_available(self) -> Dict[Tuple, float]:
+        if self._backends is None:
+            return {}
+        available = {server.url for server in self._backends.available()}
+        return {(server.url,): 1 if server.url in available else 0 for server in list(self._backends.values())}
+
+    # 记录
+    def request_started(self, route: Optional[str]):
+        if self.enabled:
+            self.http_in_flight.inc((route or 'unmatched',))
+
+    def request_finished(self, route: Optional[str], method: str, status: int, seconds: float):
+        if self.enabled:
+            route = route or 'unmatched'
+            self.http_in_flight.dec((route,))
+            self.http_requests.inc((route, method, str(status)))
+            self.http_duration.observe((route,), seconds)
+
+    def observe_upstream(self, backend: str, operation: str, seconds: float, status_code: Optional[int],
+                         sent: int = 0, received: int = 0):
+        """记录一次转发；status_code为None表示连接失败或超时"""
+        if not self.enabled:
+            return
+        self.upstream_duration.observe((backend, operation), seconds)
+        if status_code is None:
+            self.upstream_errors.inc((backend, operation, 'connection'))
+        elif status_code >= 500:
+            self.upstream_errors.inc((backend, operation, '5xx'))
+        if sent:
+            self.proxied_bytes.inc((backend, 'upload'), sent)
+        if received:
+            self.proxied_bytes.inc((backend, 'download'), received)
+
+    def observe_health_check(self, backend: str, healthy: bool, seconds: float):
+        if self.enabled:
+            self.health_checks.inc((backend, 'ok' if healthy else 'fail'))
+            self.health_check_duration.observe((backend,), seconds)
+
+    def observe_order_store(self, operation: str, seconds: float):
+        if self.enabled:
+            self.order_store_duration.observe((operation,), seconds)
+
+    def observe_dedup(self, result: str, gpu_seconds_saved: float = 0.0):
+        if self.enabled:
+            self.enhance_dedup.inc((result,))
+            if gpu_seconds_saved > 0:
+                self.dedup_gpu_seconds_saved.inc((), gpu_seconds_saved)
+
+    def observe_dedup_saved(self, gpu_seconds: float):
+        """处理中时被复用的任务完成，按附加的请求数计入节省的GPU时间"""
+        if self.enabled and gpu_seconds > 0:
+            self.dedup_gpu_seconds_saved.inc((), gpu_seconds)
+
+    def observe_failover(self, event: str):
+        if self.enabled:
+            self.enhance_failover.inc((event,))
+
+    # 输出
+    def render(self) -> str:
+        """Prometheus文本格式"""
+        self.renders += 1
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            metric.expose(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            "enabled": self.enabled,
+            "renders": self.renders,
+            "thread_shards": {metric.name: metric.shard_count() for metric in self._metrics
+                              if not isinstance(metric, CallbackGauge)}
+        }
+
+
+def create_gateway_metrics(m_config: Dict[str, Any]) -> GatewayMetrics:
+    """按配置创建指标"""
+    return GatewayMetrics(
+        enabled=m_config["enabled"],
+        allow_ips=m_config["allow_ips"],
+        latency_buckets=m_config["latency_buckets"],
+        store_buckets=m_config["store_buckets"]
+    )
+
+
+# 全局实例
+metrics = create_gateway_metrics(config.get_metrics_config())
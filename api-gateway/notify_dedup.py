@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+支付回调去重模块
+微信支付在收到成功应答前会反复重发回调通知（最长持续约24小时），重发的内容通常完全相同。
+记录最近已处理成功的回调，重复通知直接应答成功：
+- 请求体完全相同：不解析XML、不验证签名、不读写订单
+- 请求体不同但订单已按同一个transaction_id处理过：验证签名后直接应答，不写入存储
+只有验证签名并处理成功的回调才会被记录，伪造的请求体无法命中缓存
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from config import config
+
+
+class NotifyDeduplicator:
+    """最近处理成功的支付回调（TTL过期 + 容量上限）"""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 键为 ("body", 请求体摘要) 或 ("order", out_trade_no)，值为 (transaction_id, 记录时间)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Optional[str], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计计数
+        self.body_hits = 0  # 请求体完全相同的重复回调
+        self.order_hits = 0  # 订单已处理过的重复回调
+        self.misses = 0  # 需要完整处理的回调
+        self.evictions = 0  # 超出容量淘汰
+
+    @staticmethod
+    def _digest(body: bytes) -> str:
+        return hashlib.sha256(body).hexdigest()
+
+    def _get(self, key: Tuple[str, str], now: float) -> Optional[Tuple[Optional[str], float]]:
+        """读取未过期的记录（调用方需持有锁）"""
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[1] >= self.ttl:
+            del self._entries[key]
+            entry = None
+        return entry
+
+    def seen_body(self, body: bytes) -> bool:
+        """请求体是否与已处理成功的回调完全相同"""
+        key = ("body", self._digest(body))
+        with self._lock:
+            if self._get(key, time.time()) is None:
+                return False
+            self.body_hits += 1
+            return True
+
+    def is_settled(self, out_trade_no: str, transaction_id: str) -> bool:
+        """订单是否已按该transaction_id处理成功"""
+        with self._lock:
+            entry = self._get(("order", out_trade_no), time.time())
+            if entry is not None and entry[0] == transaction_id:
+                self.order_hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def remember(self, body: bytes, out_trade_no: str, transaction_id: str):
+        """记录处理成功的回调"""
+        now = time.time()
+        with self._lock:
+            for key in (("body", self._digest(body)), ("order", out_trade_no)):
+                self._entries[key] = (transaction_id, now)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+                "max_entries": self.max_entries,
+                "body_hits": self.body_hits,
+                "order_hits": self.order_hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+# 全局实例
+_dedup_config = config.get_notify_dedup_config()
+notify_dedup = NotifyDeduplicator(
+    ttl=_dedup_config["ttl"],
+    max_entries=_dedup_config["max_entries"]
+)
@@ -1,39 +1,125 @@
 # 订单管理模块
-import json
 import os
+import threading
 import time
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
 from datetime import datetime
 from wechat_pay_config import WeChatPayConfig
+from config import config
+from order_store import create_order_store
+from order_record import OrderRecord, iso_to_micros, micros_to_iso
+from metrics import metrics
 
 class OrderManager:
     """订单管理类"""
     
-    def __init__(self):
-        self.orders_file = os.path.join(os.path.dirname(__file__), "data", "orders.json")
+    def __init__(self, data_dir=None, backend=None, hot_days=None):
+        self.data_dir = data_dir or os.path.join(os.path.dirname(__file__), "data")
         self._ensure_data_dir()
+        
+        store_config = config.get_order_store_config()
+        self.store = create_order_store(
+            backend or store_config["backend"],
+            self.data_dir,
+            synchronous=store_config["synchronous"]
+        )
+        
+        # 冷热分层：只有sqlite后端支持按需读取，json后端的订单总是全部在内存中
+        if hot_days is None:
+            hot_days = store_config["hot_days"]
+        self.hot_window = int(hot_days * 86400 * 1000000) if hot_days and self.store.supports_cold else None
+        self.evict_interval = store_config["evict_interval"]
         self._load_orders()
     
     def _ensure_data_dir(self):
         """确保数据目录存在"""
-        data_dir = os.path.dirname(self.orders_file)
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
     
     def _load_orders(self):
-        """加载订单数据"""
-        if os.path.exists(self.orders_file):
-            try:
-                with open(self.orders_file, 'r', encoding='utf-8') as f:
-                    self.orders = json.load(f)
-            except:
-                self.orders = {}
+        """加载订单数据（开启分层时只加载热订单）并建立索引"""
+        self._lock = threading.RLock()
+        self._last_evict = time.time()
+        # 早于该时间（微秒时间戳）创建的已结束订单不在内存中
+        self.cold_before = None
+        started = time.perf_counter()
+        if self.hot_window is not None:
+            self.cold_before = self._now() - self.hot_window
+            self.orders = self.store.load(
+                cold_before=micros_to_iso(self.cold_before),
+                pending_status=WeChatPayConfig.ORDER_STATUS_PENDING
+            )
+            self.status_counts = Counter(self.store.count_by_status())
+        else:
+            self.orders = self.store.load()
+            self.status_counts = Counter(order.status for order in self.orders.values())
+        metrics.observe_order_store('load', time.perf_counter() - started)
+        
+        # 二级索引：openid -> 按(创建时间, 订单号)排序的列表（只包含内存中的订单）；各状态的订单数
+        self.orders_by_openid = defaultdict(list)
+        for order in self.orders.values():
+            self.orders_by_openid[order.openid].append(self._sort_key(order))
+        for entries in self.orders_by_openid.values():
+            entries.sort()
+        
+        # 待支付订单：订单号 -> 创建时间，按创建时间排列（待支付订单总是在内存中）
+        pending = sorted((order.created_at, order.out_trade_no) for order in self.orders.values()
+                         if order.status == WeChatPayConfig.ORDER_STATUS_PENDING)
+        self.pending_orders = {out_trade_no: created_at for created_at, out_trade_no in pending}
+    
+    @staticmethod
+    def _now():
+        return iso_to_micros(datetime.now().isoformat())
+    
+    @staticmethod
+    def _sort_key(order):
+        return (order.created_at, order.out_trade_no)
+    
+    def _is_cold(self, order):
+        """已结束且创建时间早于分层时间点的订单"""
+        return (self.cold_before is not None
+                and order.status != WeChatPayConfig.ORDER_STATUS_PENDING
+                and order.created_at < self.cold_before)
+    
+    def _maybe_evict(self):
+        """定期把变冷的订单移出内存（数据库中已有最新数据）"""
+        if self.hot_window is None or time.time() - self._last_evict < self.evict_interval:
+            return
+        with self._lock:
+            self._last_evict = time.time()
+            self.cold_before = self._now() - self.hot_window
+            for out_trade_no, order in list(self.orders.items()):
+                if self._is_cold(order):
+                    del self.orders[out_trade_no]
+                    self._unindex(order.openid, self._sort_key(order))
+    
+    def _index_order(self, order):
+        """把新订单加入索引（新订单的创建时间最大，通常直接追加到末尾）"""
+        entries = self.orders_by_openid[order.openid]
+        key = self._sort_key(order)
+        if not entries or entries[-1] <= key:
+            entries.append(key)
         else:
-            self.orders = {}
+            insort(entries, key)
+        self.status_counts[order.status] += 1
+        if order.status == WeChatPayConfig.ORDER_STATUS_PENDING:
+            self.pending_orders[order.out_trade_no] = order.created_at
     
-    def _save_orders(self):
-        """保存订单数据"""
-        with open(self.orders_file, 'w', encoding='utf-8') as f:
-            json.dump(self.orders, f, ensure_ascii=False, indent=2)
+    def _unindex(self, openid, key):
+        """从openid索引中删除一个订单"""
+        entries = self.orders_by_openid.get(openid, [])
+        i = bisect_left(entries, key)
+        if i < len(entries) and entries[i] == key:
+            del entries[i]
+        if not entries:
+            self.orders_by_openid.pop(openid, None)
+    
+    def _save_order(self, snapshot):
+        """保存单个订单（sqlite后端只写入这一条，json后端重写整个文件）；snapshot在持有锁时生成"""
+        started = time.perf_counter()
+        self.store.save(snapshot)
+        metrics.observe_order_store('save', time.perf_counter() - started)
     
     def create_order(self, openid, total_fee, body, attach=""):
         """创建订单"""
@@ -41,7 +127,7 @@ class OrderManager:
         
         out_trade_no = WeChatPayUtils.generate_out_trade_no()
         
-        order = {
+        order = OrderRecord({
             'out_trade_no': out_trade_no,
             'openid': openid,
             'total_fee': total_fee,
@@ -52,39 +138,115 @@ class OrderManager:
             'update_time': datetime.now().isoformat(),
             'transaction_id': '',
             'time_end': ''
-        }
+        })
         
-        self.orders[out_trade_no] = order
-        self._save_orders()
+        with self._lock:
+            self.orders[out_trade_no] = order
+            self._index_order(order)
+            snapshot = self.store.snapshot(order, self.orders)
+        self._save_order(snapshot)
+        self._maybe_evict()
         
         return order
     
     def update_order(self, out_trade_no, **kwargs):
         """更新订单"""
-        if out_trade_no in self.orders:
-            self.orders[out_trade_no].update(kwargs)
-            self.orders[out_trade_no]['update_time'] = datetime.now().isoformat()
-            self._save_orders()
+        order = self.get_order(out_trade_no)
+        if order:
+            with self._lock:
+                old_status = order.status
+                old_key = (order.openid, self._sort_key(order))
+                order.update(kwargs)
+                order['update_time'] = datetime.now().isoformat()
+                # 冷订单不在内存索引中，只需更新计数
+                if out_trade_no in self.orders and (order.openid, self._sort_key(order)) != old_key:
+                    self._unindex(*old_key)
+                    insort(self.orders_by_openid[order.openid], self._sort_key(order))
+                if order.status != old_status:
+                    self.status_counts[old_status] -= 1
+                    self.status_counts[order.status] += 1
+                if order.status == WeChatPayConfig.ORDER_STATUS_PENDING:
+                    self.pending_orders[out_trade_no] = order.created_at
+                else:
+                    self.pending_orders.pop(out_trade_no, None)
+                snapshot = self.store.snapshot(order, self.orders)
+            self._save_order(snapshot)
+            self._maybe_evict()
             return True
         return False
     
     def get_order(self, out_trade_no):
         """获取订单"""
-        return self.orders.get(out_trade_no)
+        order = self.orders.get(out_trade_no)
+        if order is None:
+            # 冷订单，或多进程部署时由其他进程创建的订单，从存储中读取；冷订单不放入内存
+            started = time.perf_counter()
+            order = self.store.get(out_trade_no)
+            metrics.observe_order_store('get', time.perf_counter() - started)
+            if order is not None and not self._is_cold(order):
+                with self._lock:
+                    if out_trade_no not in self.orders:
+                        self.orders[out_trade_no] = order
+                        self._index_order(order)
+                    order = self.orders[out_trade_no]
+        return order
     
-    def get_orders_by_openid(self, openid):
-        """根据openid获取订单列表"""
-        user_orders = []
-        for order in self.orders.values():
-            if order['openid'] == openid:
-                user_orders.append(order)
+    def get_orders_by_openid(self, openid, cursor=None, limit=None):
+        """
+        根据openid获取订单列表（按创建时间倒序）
+        cursor为上一页最后一个订单的订单号，limit为每页数量（不指定则返回全部）
+        """
+        before = None
+        if cursor:
+            cursor_order = self.get_order(cursor)
+            if cursor_order is None or cursor_order.openid != openid:
+                return []
+            before = self._sort_key(cursor_order)
         
-        # 按创建时间倒序排列
-        user_orders.sort(key=lambda x: x['create_time'], reverse=True)
-        return user_orders
+        with self._lock:
+            cold_before = self.cold_before
+            entries = self.orders_by_openid.get(openid, [])
+            end = len(entries) if before is None else bisect_left(entries, before)
+            start = 0 if limit is None else max(end - limit, 0)
+            orders = [self.orders[out_trade_no] for _, out_trade_no in reversed(entries[start:end])]
+        if cold_before is None:
+            return orders
+        
+        # 合并数据库中的冷订单（刚变冷还未移出内存的订单两边都有，以内存中的为准）
+        started = time.perf_counter()
+        cold = self.store.list_cold_by_openid(
+            openid, micros_to_iso(cold_before), WeChatPayConfig.ORDER_STATUS_PENDING,
+            before=(cursor_order['create_time'], cursor) if before else None, limit=limit
+        )
+        metrics.observe_order_store('list_cold', time.perf_counter() - started)
+        if not cold:
+            return orders
+        hot = {order.out_trade_no for order in orders}
+        orders += [order for order in cold if order.out_trade_no not in hot]
+        orders.sort(key=self._sort_key, reverse=True)
+        return orders[:limit] if limit is not None else orders
+    
+    def get_pending_orders(self, older_than=0, limit=None, from_store=False):
+        """
+        创建时间早于older_than秒之前的待支付订单号，按创建时间排列
+        from_store时从存储中读取（多进程共用sqlite数据库时包括其他进程创建的订单），json后端仍从内存读取
+        """
+        cutoff = self._now() - int(older_than * 1000000)
+        if from_store and self.store.shared:
+            started = time.perf_counter()
+            due = self.store.list_pending(WeChatPayConfig.ORDER_STATUS_PENDING, micros_to_iso(cutoff), limit)
+            metrics.observe_order_store('list_pending', time.perf_counter() - started)
+            return due
+        with self._lock:
+            due = [out_trade_no for out_trade_no, created_at in self.pending_orders.items() if created_at < cutoff]
+        return due[:limit] if limit is not None else due
     
     def mark_order_paid(self, out_trade_no, transaction_id, time_end):
-        """标记订单为已支付"""
+        """标记订单为已支付（重复通知同一笔支付时不再写入存储）"""
+        order = self.get_order(out_trade_no)
+        if (order is not None and order.status == WeChatPayConfig.ORDER_STATUS_PAID
+                and order['transaction_id'] == transaction_id):
+            return True
         return self.update_order(
             out_trade_no,
             status=WeChatPayConfig.ORDER_STATUS_PAID,
@@ -94,32 +256,26 @@ class OrderManager:
     
     def mark_order_cancelled(self, out_trade_no):
         """标记订单为已取消"""
-        return self.update_order(
-            out_trade_no,
-            status=WeChatPayConfig.ORDER_STATUS_CANCELLED
-        )
+        return self._mark_status(out_trade_no, WeChatPayConfig.ORDER_STATUS_CANCELLED)
     
     def mark_order_failed(self, out_trade_no):
         """标记订单为支付失败"""
-        return self.update_order(
-            out_trade_no,
-            status=WeChatPayConfig.ORDER_STATUS_FAILED
-        )
+        return self._mark_status(out_trade_no, WeChatPayConfig.ORDER_STATUS_FAILED)
+    
+    def _mark_status(self, out_trade_no, status):
+        """更新订单状态，状态未变化时不写入存储"""
+        order = self.get_order(out_trade_no)
+        if order is not None and order.status == status:
+            return True
+        return self.update_order(out_trade_no, status=status)
     
     def get_order_stats(self):
         """获取订单统计信息"""
-        stats = {
-            'total': len(self.orders),
-            'pending': 0,
-            'paid': 0,
-            'cancelled': 0,
-            'failed': 0,
-            'refunded': 0
+        return {
+            'total': sum(self.status_counts.values()),
+            'pending': self.status_counts[WeChatPayConfig.ORDER_STATUS_PENDING],
+            'paid': self.status_counts[WeChatPayConfig.ORDER_STATUS_PAID],
+            'cancelled': self.status_counts[WeChatPayConfig.ORDER_STATUS_CANCELLED],
+            'failed': self.status_counts[WeChatPayConfig.ORDER_STATUS_FAILED],
+            'refunded': self.status_counts[WeChatPayConfig.ORDER_STATUS_REFUNDED]
         }
-        
-        for order in self.orders.values():
-            status = order['status']
-            if status in stats:
-                stats[status] += 1
-        
-        return stats
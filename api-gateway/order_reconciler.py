@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+待支付订单对账模块
+待支付订单原先只有在客户端轮询或收到支付回调时才会更新状态，用户放弃支付的订单会一直停留在待支付。
+后台线程定期取出创建时间超过min_age的待支付订单，分批并发（max_workers）向微信查询：
+- 已支付：标记为已支付（补上丢失的支付回调）
+- 已关闭/已撤销/支付失败：标记为支付失败
+- 仍未支付且超过close_after：调用微信关单接口关闭订单，标记为已取消
+- 微信不存在该订单且超过close_after（下单未成功）：标记为支付失败
+gunicorn多worker部署时每个worker都会启动对账线程，通过订单数据库中的租约只由一个worker对账，
+该worker从数据库读取所有worker创建的待支付订单；它退出后租约过期，由其他worker接管
+"""
+
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from config import config
+from wechat_pay_config import WeChatPayConfig
+
+logger = logging.getLogger(__name__)
+
+# 对账结果
+OUTCOMES = ('paid', 'failed', 'cancelled', 'pending', 'skipped', 'error')
+
+# 订单数据库中的对账租约名
+LEASE_NAME = 'order_reconciler'
+
+
+class OrderReconciler:
+    """后台对账待支付订单"""
+
+    def __init__(self, order_manager, pay_api, query_cache=None, interval: float = 60,
+                 min_age: float = 300, close_after: float = 7200, batch_size: int = 100,
+                 max_workers: int = 4):
+        self.order_manager = order_manager
+        self.pay_api = pay_api
+        self.query_cache = query_cache  # 与客户端轮询共享查询合并
+        self.interval = interval
+        self.min_age = min_age
+        self.close_after = close_after
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="order-reconcile")
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._run_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # 每轮对账前和每批之间续期，持有者停止续期超过3个对账间隔后由其他进程接管
+        self.lease_ttl = interval * 3
+        self.is_leader = False
+
+        # 统计
+        self.runs = 0
+        self.totals = {outcome: 0 for outcome in OUTCOMES}
+        self.last_run: Dict[str, Any] = {}
+
+    def start(self):
+        """启动后台对账线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="order-reconciler", daemon=True)
+        self._thread.start()
+        atexit.register(self._release_lease)
+        logger.info(f"订单对账已启动，每{self.interval}秒检查创建超过{self.min_age}秒的待支付订单")
+
+    def stop(self):
+        """停止后台对账线程"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._release_lease()
+
+    def _loop(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                if self._acquire_lease():
+                    self.run_once()
+            except Exception as e:
+                logger.error(f"订单对账出错: {str(e)}")
+
+    def _acquire_lease(self) -> bool:
+        """获取或续期对账租约，返回本进程是否负责对账"""
+        leader = self.order_manager.store.try_acquire_lease(LEASE_NAME, self.owner, self.lease_ttl)
+        if leader != self.is_leader:
+            self.is_leader = leader
+            if leader:
+                logger.info("本进程获得订单对账租约，开始对账")
+            else:
+                logger.info("订单对账租约已被其他进程持有，停止对账")
+        return leader
+
+    def _release_lease(self):
+        """停止或进程退出时释放租约，其他worker可以立即接管"""
+        if self.is_leader:
+            try:
+                self.order_manager.store.release_lease(LEASE_NAME, self.owner)
+            except Exception as e:
+                logger.warning(f"释放订单对账租约失败: {str(e)}")
+            self.is_leader = False
+
+    def _query(self, out_trade_no: str) -> Dict[str, Any]:
+        if self.query_cache is not None:
+            return self.query_cache.query(out_trade_no, self.pay_api.query_order)
+        return self.pay_api.query_order(out_trade_no)
+
+    def reconcile_order(self, out_trade_no: str) -> str:
+        """对账一个订单，返回对账结果"""
+        order = self.order_manager.get_order(out_trade_no)
+        if order is None or order['status'] != WeChatPayConfig.ORDER_STATUS_PENDING:
+            return 'skipped'
+        age = time.time() - order.created_at / 1000000
+
+        result = self._query(out_trade_no)
+        if not result['success']:
+            # 下单未成功的订单在微信不存在，超过close_after后不可能再支付
+            if result.get('err_code') == 'ORDERNOTEXIST':
+                if age < self.close_after:
+                    return 'pending'
+                self.order_manager.mark_order_failed(out_trade_no)
+                return 'failed'
+            logger.warning(f"对账查询订单 {out_trade_no} 失败: {result['error']}")
+            return 'error'
+
+        trade_state = result['data']['trade_state']
+        if trade_state == 'SUCCESS':
+            self.order_manager.mark_order_paid(
+                out_trade_no,
+                result['data']['transaction_id'],
+                result['data']['time_end']
+            )
+            logger.info(f"对账发现订单已支付: {out_trade_no}")
+            return 'paid'
+        if trade_state in ('CLOSED', 'REVOKED', 'PAYERROR'):
+            self.order_manager.mark_order_failed(out_trade_no)
+            return 'failed'
+        if trade_state == 'NOTPAY' and age >= self.close_after:
+            return self._close(out_trade_no)
+        return 'pending'
+
+    def _close(self, out_trade_no: str) -> str:
+        """关闭超时未支付的订单"""
+        result = self.pay_api.close_order(out_trade_no)
+        if result['success'] or result.get('err_code') == 'ORDERCLOSED':
+            self.order_manager.mark_order_cancelled(out_trade_no)
+            logger.info(f"关闭超时未支付订单: {out_trade_no}")
+            return 'cancelled'
+        if result.get('err_code') == 'ORDERPAID':
+            # 关单前刚好支付，下一轮查询会标记为已支付
+            return 'pending'
+        logger.warning(f"关闭订单 {out_trade_no} 失败: {result['error']}")
+        return 'error'
+
+    def run_once(self) -> Dict[str, Any]:
+        """对账一轮：处理所有到期的待支付订单（包括其他worker创建的），每批之前续期租约，租约失效时停止"""
+        with self._run_lock:
+            start = time.time()
+            due = self.order_manager.get_pending_orders(older_than=self.min_age, from_store=True)
+            counts = {outcome: 0 for outcome in OUTCOMES}
+            for i in range(0, len(due), self.batch_size):
+                if self._stop_event.is_set():
+                    break
+                if i and not self._acquire_lease():
+                    break
+                for outcome in self._pool.map(self._safe_reconcile, due[i:i + self.batch_size]):
+                    counts[outcome] += 1
+
+            duration = time.time() - start
+            processed = sum(counts.values())
+            run = {
+                "started_at": start,
+                "duration": round(duration, 3),
+                "backlog": len(due),
+                "processed": processed,
+                "throughput": round(processed / duration, 2) if duration > 0 else 0.0,
+                **counts
+            }
+            with self._lock:
+                self.runs += 1
+                for outcome, count in counts.items():
+                    self.totals[outcome] += count
+                self.last_run = run
+            if processed:
+                logger.info(f"订单对账完成: {run}")
+            return run
+
+    def _safe_reconcile(self, out_trade_no: str) -> str:
+        try:
+            return self.reconcile_order(out_trade_no)
+        except Exception as e:
+            logger.error(f"对账订单 {out_trade_no} 出错: {str(e)}")
+            return 'error'
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        with self._lock:
+            return {
+                "running": bool(self._thread and self._thread.is_alive()),
+                "leader": self.is_leader,
+                "interval": self.interval,
+                "min_age": self.min_age,
+                "close_after": self.close_after,
+                "pending": len(self.order_manager.pending_orders),
+                "backlog": len(self.order_manager.get_pending_orders(older_than=self.min_age)),
+                "runs": self.runs,
+                "totals": dict(self.totals),
+                "last_run": dict(self.last_run)
+            }
+
+
+def create_order_reconciler(order_manager, pay_api, query_cache=None) -> OrderReconciler:
+    """根据配置创建订单对账器"""
+    reconciler_config = config.get_order_reconciler_config()
+    return OrderReconciler(
+        order_manager,
+        pay_api,
+        query_cache=query_cache,
+        interval=reconciler_config["interval"],
+        min_age=reconciler_config["min_age"],
+        close_after=reconciler_config["close_after"],
+        batch_size=reconciler_config["batch_size"],
+        max_workers=reconciler_config["max_workers"]
+    )
@@ -0,0 +1,112 @@
+# 紧凑的订单记录
+# 订单原先以dict保存（每个订单一个哈希表，时间为ISO字符串），内存中保留大量历史订单时占用很高。
+# OrderRecord 使用 __slots__ 保存固定字段：
+# - openid/body/attach/status 等取值重复很多的字段使用驻留字符串，所有订单共享同一对象
+# - create_time/update_time 保存为整数（微秒时间戳），读取时还原为原来的ISO字符串
+# 对外仍按dict方式访问（order['status']、order.get()、order.update()、dict(order)），调用方无需修改
+import sys
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_MISSING = object()
+
+# 字段顺序与原订单dict一致，序列化结果不变
+FIELDS = ('out_trade_no', 'openid', 'total_fee', 'body', 'attach', 'status',
+          'create_time', 'update_time', 'transaction_id', 'time_end', 'prepay_id')
+_FIELD_SET = frozenset(FIELDS)
+_INTERNED = frozenset(('openid', 'body', 'attach', 'status'))
+_TIMESTAMPS = frozenset(('create_time', 'update_time'))
+
+
+def iso_to_micros(value):
+    """datetime.isoformat() 生成的本地时间字符串转为微秒时间戳，其他格式原样返回"""
+    if isinstance(value, str) and len(value) in (19, 26) and value[10:11] == 'T':
+        try:
+            return (datetime.fromisoformat(value) - _EPOCH) // _MICROSECOND
+        except ValueError:
+            pass
+    return value
+
+
+def micros_to_iso(value):
+    """微秒时间戳还原为ISO字符串"""
+    if isinstance(value, int):
+        return (_EPOCH + timedelta(microseconds=value)).isoformat()
+    return value
+
+
+class OrderRecord(MutableMapping):
+    """单个订单"""
+
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, data=None, **kwargs):
+        self._extra = None
+        if kwargs:
+            data = {**(data or {}), **kwargs}
+        # 启动时要构造大量订单，这里展开 __setitem__ 的逻辑，避免逐个字段的方法调用开销
+        for key, value in (data or {}).items():
+            if key in _TIMESTAMPS:
+                value = iso_to_micros(value)
+            elif key in _INTERNED:
+                if isinstance(value, str):
+                    value = sys.intern(value)
+            elif key not in _FIELD_SET:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+                continue
+            setattr(self, key, value)
+
+    @property
+    def created_at(self):
+        """创建时间（微秒时间戳），用于排序"""
+        value = getattr(self, 'create_time', 0)
+        return value if isinstance(value, int) else 0
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key, _MISSING)
+            if value is _MISSING:
+                raise KeyError(key)
+            return micros_to_iso(value) if key in _TIMESTAMPS else value
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            if key in _TIMESTAMPS:
+                value = iso_to_micros(value)
+            elif key in _INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            if getattr(self, key, _MISSING) is _MISSING:
+                raise KeyError(key)
+            delattr(self, key)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key in FIELDS:
+            if getattr(self, key, _MISSING) is not _MISSING:
+                yield key
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"OrderRecord({dict(self)!r})"
@@ -0,0 +1,268 @@
+# 订单存储模块
+# OrderManager在内存中保存订单，由存储后端负责持久化：
+# - sqlite（默认）：每次创建/更新只写入一条订单，WAL模式下提交不逐次fsync，由检查点批量刷盘
+# - json：原有方式，每次写入重写整个orders.json（改为先写临时文件再替换，写入中途崩溃不会损坏文件）
+# sqlite后端支持冷热分层：已结束（非待支付）且创建时间早于cold_before的订单不加载到内存，按需从数据库读取
+# 写入分两步：OrderManager持有订单锁时调用snapshot()生成要写入的内容（带序号），释放锁后调用save()写入；
+# 多个线程的写入顺序与生成顺序不同时，较旧的内容不会覆盖较新的
+# sqlite后端可以由多个worker进程共用，后台任务（如订单对账）通过数据库中的租约只在一个进程中运行
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from order_record import OrderRecord
+
+logger = logging.getLogger(__name__)
+
+
+class JsonOrderStore:
+    """整个订单表保存为一个JSON文件"""
+
+    name = "json"
+    supports_cold = False
+    shared = False  # 只支持单进程
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._written = 0  # 已写入文件的最新序号
+
+    def _read(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.error(f"加载订单数据失败: {e}")
+        return {}
+
+    def load(self, cold_before=None, pending_status=None):
+        """加载所有订单（json后端不分层）"""
+        return {out_trade_no: OrderRecord(order) for out_trade_no, order in self._read().items()}
+
+    def get(self, out_trade_no):
+        """内存中没有的订单（json后端的订单总是全部在内存中）"""
+        return None
+
+    def snapshot(self, order, orders):
+        """复制整个订单表（调用方需持有订单锁，复制时不会有其他线程修改）"""
+        return next(self._seq), {out_trade_no: dict(o) for out_trade_no, o in orders.items()}
+
+    def save(self, snapshot):
+        """保存订单（重写整个文件）；已写入更新的订单表时跳过"""
+        seq, orders = snapshot
+        with self._lock:
+            if seq <= self._written:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(orders, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+            self._written = seq
+
+    def try_acquire_lease(self, name, owner, ttl):
+        """单进程存储，总是持有租约"""
+        return True
+
+    def release_lease(self, name, owner):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteOrderStore:
+    """每个订单一行，创建/更新只写入变化的订单"""
+
+    name = "sqlite"
+    supports_cold = True
+    shared = True  # 多个进程可以共用同一个数据库
+
+    def __init__(self, path, synchronous="NORMAL", legacy_json=None):
+        self.path = path
+        # WAL模式下NORMAL只在检查点fsync（批量刷盘），崩溃不会损坏数据库；FULL每次提交都fsync
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._seq = itertools.count(1)
+        self._latest = {}  # 订单号 -> 尚未写入的最新序号
+        self._latest_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                out_trade_no TEXT PRIMARY KEY,
+                openid TEXT,
+                status TEXT,
+                create_time TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS orders_openid ON orders (openid, create_time);
+            CREATE INDEX IF NOT EXISTS orders_status ON orders (status, create_time);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        """)
+        if legacy_json:
+            self._import_json(legacy_json)
+
+    def _conn(self):
+        """每个线程一个连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+        return conn
+
+    def _import_json(self, json_path):
+        """首次使用时导入原有的orders.json"""
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+            return
+        orders = JsonOrderStore(json_path)._read()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO orders (out_trade_no, openid, status, create_time, data) VALUES (?, ?, ?, ?, ?)",
+                (self._row(order) for order in orders.values())
+            )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', '1')")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if orders:
+            logger.info(f"已从 {json_path} 导入 {len(orders)} 个订单")
+
+    @staticmethod
+    def _row(order):
+        return (
+            order['out_trade_no'],
+            order.get('openid'),
+            order.get('status'),
+            order.get('create_time'),
+            json.dumps(dict(order), ensure_ascii=False, separators=(',', ':'))
+        )
+
+    def load(self, cold_before=None, pending_status=None):
+        """加载订单；指定cold_before时跳过已结束且创建时间早于cold_before的冷订单"""
+        if cold_before is None:
+            rows = self._conn().execute("SELECT data FROM orders ORDER BY rowid")
+        else:
+            rows = self._conn().execute(
+                "SELECT data FROM orders WHERE status = ? OR create_time >= ? ORDER BY rowid",
+                (pending_status, cold_before)
+            )
+        return {order['out_trade_no']: order for order in (OrderRecord(json.loads(data)) for (data,) in rows)}
+
+    def count_by_status(self):
+        """各状态的订单数（包括未加载的冷订单）"""
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM orders GROUP BY status"))
+
+    def get(self, out_trade_no):
+        """读取一个订单（冷订单，或由同一数据库上的其他进程创建的订单）"""
+        row = self._conn().execute("SELECT data FROM orders WHERE out_trade_no = ?", (out_trade_no,)).fetchone()
+        return OrderRecord(json.loads(row[0])) if row else None
+
+    def list_pending(self, pending_status, created_before, limit=None):
+        """创建时间早于created_before的待支付订单号（包括其他进程创建的），按创建时间排列"""
+        sql = "SELECT out_trade_no FROM orders WHERE status = ? AND create_time < ? ORDER BY create_time"
+        params = [pending_status, created_before]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [out_trade_no for (out_trade_no,) in self._conn().execute(sql, params)]
+
+    def try_acquire_lease(self, name, owner, ttl):
+        """获取或续期名为name的租约，返回owner是否持有；持有者超过ttl秒未续期时可被其他进程接管"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+                (name, owner, now + ttl, now)
+            )
+            acquired = conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0] == owner
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def release_lease(self, name, owner):
+        """释放租约，其他进程可以立即接管"""
+        self._conn().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def list_cold_by_openid(self, openid, cold_before, pending_status, before=None, limit=None):
+        """
+        按创建时间倒序读取某个用户的冷订单
+        before为(create_time, out_trade_no)，只返回排在它之后的订单
+        """
+        sql = "SELECT data FROM orders WHERE openid = ? AND status != ? AND create_time < ?"
+        params = [openid, pending_status, cold_before]
+        if before is not None:
+            sql += " AND (create_time, out_trade_no) < (?, ?)"
+            params += before
+        sql += " ORDER BY create_time DESC, out_trade_no DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [OrderRecord(json.loads(data)) for (data,) in self._conn().execute(sql, params)]
+
+    def snapshot(self, order, orders=None):
+        """生成一个订单的行（调用方需持有订单锁）"""
+        seq = next(self._seq)
+        row = self._row(order)
+        with self._latest_lock:
+            self._latest[row[0]] = seq
+        return seq, row
+
+    def save(self, snapshot):
+        """保存一个订单；同一订单已生成更新的行时跳过，由更新的行写入"""
+        seq, row = snapshot
+        out_trade_no = row[0]
+        with self._write_lock:
+            with self._latest_lock:
+                if self._latest.get(out_trade_no) != seq:
+                    return
+            self._conn().execute(
+                "INSERT INTO orders (out_trade_no, openid, status, create_time, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (out_trade_no) DO UPDATE SET openid = excluded.openid, status = excluded.status, "
+                "data = excluded.data",
+                row
+            )
+            with self._latest_lock:
+                if self._latest.get(out_trade_no) == seq:
+                    del self._latest[out_trade_no]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_order_store(backend, data_dir, synchronous="NORMAL"):
+    """根据配置创建订单存储后端"""
+    json_path = os.path.join(data_dir, "orders.json")
+    if backend == JsonOrderStore.name:
+        return JsonOrderStore(json_path)
+    if backend != SqliteOrderStore.name:
+        logger.warning(f"未知的订单存储后端 {backend}，使用 {SqliteOrderStore.name}")
+    return SqliteOrderStore(os.path.join(data_dir, "orders.db"), synchronous=synchronous, legacy_json=json_path)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+支付状态查询合并模块
+小程序在支付页面会频繁轮询 /api/wechat/pay/query，每次轮询都会向微信发起一次签名的orderquery请求。
+对同一个订单的上游查询：
+- 合并：并发的查询共享同一次上游请求（single-flight）
+- 缓存：最近一次查询结果在短时间内直接复用，未支付/查询失败的结果只缓存很短时间
+- 限流：缓存有效期内不会再向微信发起查询，即每个订单每个有效期最多一次上游请求
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import config
+
+# 不会再变化的交易状态，缓存时间更长
+TERMINAL_TRADE_STATES = frozenset(('SUCCESS', 'REFUND', 'CLOSED', 'REVOKED', 'PAYERROR'))
+
+
+class _Call:
+    """一次进行中的上游查询"""
+
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+
+
+class PaymentQueryCache:
+    """订单查询结果缓存 + 并发查询合并"""
+
+    def __init__(self, enabled: bool, pending_ttl: float, error_ttl: float,
+                 terminal_ttl: float, max_entries: int, wait_timeout: float):
+        self.enabled = enabled
+        self.pending_ttl = pending_ttl
+        self.error_ttl = error_ttl
+        self.terminal_ttl = terminal_ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        # out_trade_no -> (查询结果, 过期时间)，按写入时间排序，最旧的在最前面
+        self._results: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._inflight: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+        # 统计计数
+        self.requests = 0  # 查询次数
+        self.upstream_calls = 0  # 实际发往微信的查询
+        self.cache_hits = 0  # 直接使用缓存结果
+        self.coalesced = 0  # 等待其他请求的上游查询结果
+        self.evictions = 0  # 超出容量淘汰
+
+    def _ttl_for(self, result: Dict[str, Any]) -> float:
+        if not result.get('success'):
+            return self.error_ttl
+        if result['data'].get('trade_state') in TERMINAL_TRADE_STATES:
+            return self.terminal_ttl
+        return self.pending_ttl
+
+    def query(self, out_trade_no: str, fetch: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+        """查询订单状态，fetch为实际的上游查询函数"""
+        if not self.enabled:
+            with self._lock:
+                self.requests += 1
+                self.upstream_calls += 1
+            return fetch(out_trade_no)
+
+        now = time.time()
+        with self._lock:
+            self.requests += 1
+            cached = self._results.get(out_trade_no)
+            if cached is not None:
+                if now < cached[1]:
+                    self.cache_hits += 1
+                    return cached[0]
+                del self._results[out_trade_no]
+
+            call = self._inflight.get(out_trade_no)
+            leader = call is None
+            if leader:
+                call = self._inflight[out_trade_no] = _Call()
+                self.upstream_calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if call.done.wait(self.wait_timeout) and call.result is not None:
+                return call.result
+            return {'success': False, 'error': '查询超时'}
+
+        result = None
+        try:
+            result = fetch(out_trade_no)
+            return result
+        finally:
+            if result is None:
+                result = {'success': False, 'error': '查询失败'}
+            with self._lock:
+                self._results[out_trade_no] = (result, time.time() + self._ttl_for(result))
+                self._results.move_to_end(out_trade_no)
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+                    self.evictions += 1
+                del self._inflight[out_trade_no]
+            call.result = result
+            call.done.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._results),
+                "inflight": len(self._inflight),
+                "requests": self.requests,
+                "upstream_calls": self.upstream_calls,
+                "cache_hits": self.cache_hits,
+                "coalesced": self.coalesced,
+                "upstream_ratio": round(self.upstream_calls / self.requests, 4) if self.requests else 0.0,
+                "evictions": self.evictions
+            }
+
+
+# 全局实例
+_query_config = config.get_payment_query_config()
+payment_query_cache = PaymentQueryCache(
+    enabled=_query_config["enabled"],
+    pending_ttl=_query_config["pending_ttl"],
+    error_ttl=_query_config["error_ttl"],
+    terminal_ttl=_query_config["terminal_ttl"],
+    max_entries=_query_config["max_entries"],
+    wait_timeout=_query_config["wait_timeout"]
+)
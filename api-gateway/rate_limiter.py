@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求限流模块
+按规则对接口限流，每条规则是一个令牌桶：每 period 秒补充 limit 个令牌，最多积累 burst 个（与nginx limit_req的rate/burst含义相同）。
+规则的key可以是：
+- ip: 每个客户端IP一个桶
+- openid: 每个登录用户一个桶（请求未携带有效令牌时跳过该规则）
+- global: 整个接口共用一个桶
+令牌桶用GCRA的等价形式实现：每个桶只保存“理论到达时间”一个时间戳，不需要记录请求历史。
+时间戳不晚于当前时间的桶已经装满，与从未出现过的key相同，可以直接丢弃（空闲淘汰）。
+
+两种存储：
+- memory: 进程内字典，按最近使用排序，超出max_entries时淘汰最久未使用的key
+- shared: 多worker共享的内存映射文件（默认在/dev/shm），固定大小的哈希表，每个key占16字节，
+  按分组加文件区间锁（fcntl），同一台机器上的所有gunicorn worker共用同一组计数
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 规则的key类型
+KEY_IP = 'ip'
+KEY_OPENID = 'openid'
+KEY_GLOBAL = 'global'
+KEY_TYPES = (KEY_IP, KEY_OPENID, KEY_GLOBAL)
+
+
+class RateRule:
+    """一条限流规则"""
+
+    __slots__ = ('name', 'endpoints', 'key', 'interval', 'capacity_time')
+
+    def __init__(self, name: str, endpoints: List[str], key: str, limit: float, period: float, burst: float):
+        if key not in KEY_TYPES:
+            raise ValueError(f"限流规则 {name} 的key必须是 {'/'.join(KEY_TYPES)} 之一")
+        if limit <= 0 or period <= 0 or burst < 1:
+            raise ValueError(f"限流规则 {name} 的limit/period必须大于0，burst不小于1")
+        self.name = name
+        self.endpoints = list(endpoints)
+        self.key = key
+        self.interval = period / limit  # 补充一个令牌的时间
+        self.capacity_time = self.interval * burst  # 桶从空到满的时间
+
+
+class MemoryBucketStore:
+    """进程内的令牌桶存储"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # key -> 理论到达时间，按最近放行排序，最久未使用的在最前面
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0  # 超出容量淘汰的未满的桶
+
+    def acquire(self, key: str, interval: float, capacity_time: float, now: float) -> float:
+        """取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        with self._lock:
+            tat = self._tats.get(key, now)
+            new_tat = (tat if tat > now else now) + interval
+            wait = new_tat - now - capacity_time
+            if wait > 0:
+                return wait
+            self._tats[key] = new_tat
+            self._tats.move_to_end(key)
+
+            # 最久未使用的桶已经装满时直接丢弃；超出容量时淘汰（相当于重置为满桶）
+            tats = self._tats
+            while tats:
+                oldest_key, oldest_tat = next(iter(tats.items()))
+                if oldest_tat > now and len(tats) <= self.max_entries:
+                    break
+                if oldest_tat > now:
+                    self.evictions += 1
+                del tats[oldest_key]
+            return 0.0
+
+    def __len__(self) -> int:
+        return len(self._tats)
+
+
+class SharedBucketStore:
+    """
+    多进程共享的令牌桶存储
+    哈希表按8个槽位分组，key只能放在它所属的分组中，分组内的槽位用同一把锁保护；
+    分组已满时淘汰最接近装满的桶
+    """
+
+    GROUP_SIZE = 8
+    _SLOT = struct.Struct('<Qd')  # key哈希（0表示空槽）、理论到达时间
+    _GROUP = struct.Struct('<' + 'Qd' * GROUP_SIZE)
+
+    def __init__(self, path: str, slots: int, stripes: int = 64):
+        import fcntl
+        import mmap
+
+        self._fcntl = fcntl
+        self.path = path
+        self.groups = max(slots // self.GROUP_SIZE, 1)
+        self.stripes = min(stripes, self.groups)
+        size = self.groups * self._GROUP.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        # 文件区间锁只在进程之间互斥，同一进程的线程还需要线程锁
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self.evictions = 0
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # 各worker的hash()随机化种子不同，需要稳定的哈希
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+    def acquire(self, key: str, interval: float, capacity_time: float, now: float) -> float:
+        """取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        key_hash = self._hash(key)
+        group = key_hash % self.groups
+        stripe = group % self.stripes
+        base = group * self._GROUP.size
+        lockf = self._fcntl.lockf
+        with self._locks[stripe]:
+            lockf(self._fd, self._fcntl.LOCK_EX, 1, stripe)
+            try:
+                # 分组内为 [哈希, 时间戳, 哈希, 时间戳, ...]，时间戳是远小于哈希值的浮点数，不会误匹配
+                values = self._GROUP.unpack_from(self._map, base)
+                try:
+                    index = values.index(key_hash)
+                    tat = values[index + 1]
+                except ValueError:
+                    index = -1
+                    tat = now
+
+                new_tat = (tat if tat > now else now) + interval
+                wait = new_tat - now - capacity_time
+                if wait > 0:
+                    return wait
+                if index < 0:
+                    index = self._free_slot(values, now)
+                self._SLOT.pack_into(self._map, base + index * self._SLOT.size // 2, key_hash, new_tat)
+                return 0.0
+            finally:
+                lockf(self._fd, self._fcntl.LOCK_UN, 1, stripe)
+
+    def _free_slot(self, values, now: float) -> int:
+        """新key使用的槽位：空槽或已装满的桶，都没有时淘汰最接近装满的桶"""
+        victim, victim_tat = 0, float('inf')
+        for index in range(0, len(values), 2):
+            slot_hash, slot_tat = values[index], values[index + 1]
+            if slot_hash == 0 or slot_tat <= now:
+                return index
+            if slot_tat < victim_tat:
+                victim, victim_tat = index, slot_tat
+        self.evictions += 1
+        return victim
+
+    def __len__(self) -> int:
+        """仍在计数中（未装满）的桶数"""
+        now = time.time()
+        values = struct.unpack_from('<' + 'Qd' * (self.groups * self.GROUP_SIZE), self._map)
+        return sum(1 for i in range(0, len(values), 2) if values[i] and values[i + 1] > now)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class RateLimiter:
+    """按接口匹配限流规则"""
+
+    def __init__(self, rules: List[RateRule], store, enabled: bool = True):
+        self.enabled = enabled
+        self.store = store
+        self.rules = rules
+        # 接口 -> 规则，按ip/openid/global排序：单个客户端超限时不消耗整个接口的令牌
+        order = {KEY_IP: 0, KEY_OPENID: 1, KEY_GLOBAL: 2}
+        self._by_endpoint: Dict[str, List[RateRule]] = {}
+        for rule in sorted(rules, key=lambda r: order[r.key]):
+            for endpoint in rule.endpoints:
+                self._by_endpoint.setdefault(endpoint, []).append(rule)
+        self._lock = threading.Lock()
+
+        # 统计计数
+        self.checks = 0  # 匹配到规则的请求
+        self.limited: Dict[str, int] = {rule.name: 0 for rule in rules}  # 每条规则拒绝的请求
+
+    def uses_openid(self, endpoint: Optional[str]) -> bool:
+        """该接口是否有openid规则（需要按令牌查找会话）"""
+        return self.enabled and any(rule.key == KEY_OPENID for rule in self._by_endpoint.get(endpoint, ()))
+
+    def check(self, endpoint: Optional[str], client_ip: str,
+              get_openid: Callable[[], Optional[str]]) -> Optional[Dict[str, Any]]:
+        """
+        检查请求是否超限，未超限返回None，否则返回 {'rule': 规则名, 'retry_after': 秒}
+        get_openid只在有openid规则的接口上调用
+        """
+        if not self.enabled:
+            return None
+        rules = self._by_endpoint.get(endpoint)
+        if not rules:
+            return None
+        now = time.time()
+        self.checks += 1
+        for rule in rules:
+            if rule.key == KEY_IP:
+                key = f"{rule.name}:{client_ip}"
+            elif rule.key == KEY_OPENID:
+                openid = get_openid()
+                if not openid:
+                    continue
+                key = f"{rule.name}:{openid}"
+            else:
+                key = rule.name
+            wait = self.store.acquire(key, rule.interval, rule.capacity_time, now)
+            if wait > 0:
+                with self._lock:
+                    self.limited[rule.name] += 1
+                return {'rule': rule.name, 'retry_after': wait}
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        with self._lock:
+            limited = dict(self.limited)
+        return {
+            "enabled": self.enabled,
+            "backend": "shared" if isinstance(self.store, SharedBucketStore) else "memory",
+            "checks": self.checks,
+            "limited": limited,
+            "evictions": self.store.evictions
+        }
+
+
+def create_rate_limiter(rl_config: Dict[str, Any]) -> RateLimiter:
+    """按配置创建限流器；共享存储不可用时回退到进程内存储"""
+    rules = [
+        RateRule(rule["name"], rule["endpoints"], rule["key"], rule["limit"], rule["period"], rule["burst"])
+        for rule in rl_config["rules"]
+    ]
+    store = None
+    if rl_config["backend"] == "shared":
+        path = rl_config["shared_path"]
+        if not path:
+            shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(shm_dir, 'photo_enhance_rate_limit')
+        try:
+            store = SharedBucketStore(path, rl_config["shared_slots"])
+        except (ImportError, OSError) as e:
+            logger.warning(f"共享限流存储不可用({e})，使用进程内存储")
+    if store is None:
+        store = MemoryBucketStore(rl_config["max_entries"])
+    return RateLimiter(rules, store, enabled=rl_config["enabled"])
+
+
+# 全局实例
+rate_limiter = create_rate_limiter(config.get_rate_limit_config())
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+处理结果缓存
+第一次下载时把GPU服务器返回的结果边转发边写入本地磁盘，之后的下载直接从磁盘发送，
+不再请求GPU服务器（服务器被销毁后结果仍然可以下载）。
+
+- 按任务号缓存，文件名为任务号的哈希，不受任务号内容影响
+- 总大小超过max_bytes时淘汰最久未下载的结果；超过ttl的结果删除
+- 写入临时文件，完整收到后才改名为正式文件，下载中断或长度不符时丢弃，不会发送不完整的结果
+- 配置了accel_redirect_prefix时只返回 X-Accel-Redirect 响应头，由nginx用sendfile直接发送文件；
+  否则由网关发送文件（gunicorn等支持wsgi.file_wrapper的服务器同样使用sendfile）
+
+多个worker共用同一个目录和同一个索引（目录下的SQLite数据库，WAL模式）：
+其他worker写入的结果同样可以命中，max_bytes是所有worker合计的上限，淘汰按所有worker的下载顺序进行
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = '.index.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    content_type TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+"""
+
+
+class CachedResult:
+    """一个已缓存的结果"""
+
+    __slots__ = ('key', 'name', 'path', 'size', 'content_type', 'created')
+
+    def __init__(self, key: str, name: str, path: str, size: int, content_type: str, created: float):
+        self.key = key
+        self.name = name  # 相对缓存目录的路径
+        self.path = path
+        self.size = size
+        self.content_type = content_type
+        self.created = created
+
+
+class CacheFill:
+    """一次写入：数据先写入临时文件，commit时校验长度并改名"""
+
+    def __init__(self, cache: "ResultCache", key: str, content_type: str, expected_size: Optional[int]):
+        self.cache = cache
+        self.key = key
+        self.content_type = content_type
+        self.expected_size = expected_size
+        self.size = 0
+        self.closed = False
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, prefix='.fill-')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk: bytes):
+        if self.closed:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_entry_bytes:
+            self.abort()
+            return
+        self.file.write(chunk)
+
+    def commit(self):
+        if self.closed:
+            return
+        if self.expected_size is not None and self.size != self.expected_size:
+            logger.warning(f"结果长度不符({self.size}/{self.expected_size})，不缓存: {self.key}")
+            self.abort()
+            return
+        self.closed = True
+        try:
+            self.file.close()
+            self.cache._commit(self)
+        except OSError as e:
+            logger.warning(f"缓存结果失败: {e}")
+            self._remove_temp()
+        finally:
+            self.cache._fill_done(self.key)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        self._remove_temp()
+        self.cache._fill_done(self.key, aborted=True)
+
+    def _remove_temp(self):
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+class ResultCache:
+    """按任务号缓存处理结果的磁盘LRU缓存"""
+
+    SWEEP_INTERVAL = 300  # 清理过期结果的最短间隔（秒）
+    TOUCH_INTERVAL = 60  # 最近下载时间的更新间隔（秒），避免每次命中都写索引
+
+    def __init__(self, directory: str, max_bytes: int, max_entry_bytes: int, ttl: float,
+                 accel_redirect_prefix: str = '', enabled: bool = True):
+        self.enabled = enabled
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.accel_redirect_prefix = accel_redirect_prefix.rstrip('/') + '/' if accel_redirect_prefix else ''
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self._local = threading.local()
+        self._filling = set()  # 正在写入的任务号，同一个任务同时只写入一份
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.fill_aborted = 0
+        self.evictions = 0
+        self.expired = 0
+        self.bytes_served = 0
+
+        if enabled:
+            os.makedirs(directory, mode=0o755, exist_ok=True)
+            self._conn().executescript(_SCHEMA)
+            self._load()
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _name(key: str) -> str:
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return f"{digest[:2]}/{digest}"
+
+    def _entry(self, row: sqlite3.Row) -> CachedResult:
+        return CachedResult(row["key"], row["name"], os.path.join(self.directory, row["name"]),
+                            row["size"], row["content_type"], row["created"])
+
+    def _load(self):
+        """
+        启动时核对索引与磁盘：删除中断写入留下的临时文件和没有索引的残留文件，
+        补录磁盘上有、索引中没有的结果（旧版本写入的缓存），删除文件已不存在的索引记录
+        """
+        conn = self._conn()
+        indexed = {row["name"] for row in conn.execute("SELECT name FROM entries")}
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if filename.startswith(INDEX_NAME):
+                    continue
+                if filename.startswith('.fill-'):
+                    self._unlink(path)
+                elif filename.endswith('.meta'):
+                    name = os.path.relpath(path[:-5], self.directory)
+                    if name in indexed:
+                        indexed.discard(name)
+                        continue
+                    entry = self._read_entry(path[:-5])
+                    if entry is not None:
+                        found.append((entry, os.stat(entry.path).st_atime))
+                elif not os.path.exists(path + '.meta'):
+                    self._unlink(path)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO entries (key, name, size, content_type, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(e.key, e.name, e.size, e.content_type, e.created, atime) for e, atime in found]
+            )
+            # 剩下的是文件已不存在的记录
+            conn.executemany("DELETE FROM entries WHERE name = ?", [(name,) for name in indexed])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        row = conn.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM entries").fetchone()
+        if row["entries"]:
+            logger.info(f"加载结果缓存: {row['entries']} 个, {row['bytes'] / 1024 / 1024:.1f}MB")
+
+    def _read_entry(self, path: str) -> Optional[CachedResult]:
+        """读取磁盘上的结果，数据或元数据缺失时删除残留文件"""
+        try:
+            with open(path + '.meta', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            size = os.stat(path).st_size
+        except (OSError, ValueError):
+            self._unlink(path)
+            self._unlink(path + '.meta')
+            return None
+        name = os.path.relpath(path, self.directory)
+        return CachedResult(meta['key'], name, path, size, meta['content_type'], meta['created'])
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _remove_files(self, entries: List[CachedResult]):
+        for entry in entries:
+            self._unlink(entry.path)
+            self._unlink(entry.path + '.meta')
+
+    def _lookup(self, key: str) -> Optional[sqlite3.Row]:
+        return self._conn().execute(
+            "SELECT key, name, size, content_type, created, last_access FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        """查找缓存的结果，没有或已过期返回None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        entry = None
+        try:
+            row = self._lookup(key)
+            if row is not None:
+                entry = self._entry(row)
+                if now - entry.created > self.ttl:
+                    self.discard(key)
+                    self.expired += 1
+                    entry = None
+                elif not os.path.exists(entry.path):
+                    self.discard(key)
+                    entry = None
+                elif now - row["last_access"] >= self.TOUCH_INTERVAL:
+                    self._conn().execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.warning(f"读取结果缓存索引失败: {e}")
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_served += entry.size
+        return entry
+
+    def contains(self, key: str) -> bool:
+        """是否缓存了该结果（不计入命中统计，不影响淘汰顺序）"""
+        if not self.enabled:
+            return False
+        try:
+            row = self._lookup(key)
+        except sqlite3.Error:
+            return False
+        if row is None or time.time() - row["created"] > self.ttl:
+            return False
+        return os.path.exists(os.path.join(self.directory, row["name"]))
+
+    def discard(self, key: str):
+        """删除缓存的结果"""
+        try:
+            row = self._lookup(key)
+            if row is None:
+                return
+            self._conn().execute("DELETE FROM entries WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"删除结果缓存失败: {e}")
+            return
+        self._remove_files([self._entry(row)])
+
+    def accel_redirect_path(self, entry: CachedResult) -> str:
+        """nginx内部location中的文件路径"""
+        return self.accel_redirect_prefix + entry.name
+
+    def begin_fill(self, key: str, content_type: str, content_length: Optional[int]) -> Optional[CacheFill]:
+        """开始写入一个结果；未启用、过大或已在写入时返回None"""
+        if not self.enabled:
+            return None
+        if content_length is not None and content_length > self.max_entry_bytes:
+            return None
+        with self._lock:
+            if key in self._filling:
+                return None
+            self._filling.add(key)
+        try:
+            return CacheFill(self, key, content_type, content_length)
+        except OSError as e:
+            logger.warning(f"创建结果缓存文件失败: {e}")
+            self._fill_done(key)
+            return None
+
+    def _fill_done(self, key: str, aborted: bool = False):
+        with self._lock:
+            self._filling.discard(key)
+            if aborted:
+                self.fill_aborted += 1
+
+    def _commit(self, fill: CacheFill):
+        """写入完成：写元数据，再把临时文件改名为正式文件（数据文件存在即表示完整），最后写入索引"""
+        name = self._name(fill.key)
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        created = time.time()
+        meta_temp = fill.temp_path + '.meta'
+        with open(meta_temp, 'w', encoding='utf-8') as f:
+            json.dump({'key': fill.key, 'content_type': fill.content_type, 'created': created}, f)
+        # nginx以其他用户运行，需要可读
+        os.chmod(fill.temp_path, 0o644)
+        os.replace(meta_temp, path + '.meta')
+        os.replace(fill.temp_path, path)
+
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO entries (key, name, size, content_type, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (fill.key, name, fill.size, fill.content_type, created, created)
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"写入结果缓存索引失败: {e}")
+            self._remove_files([CachedResult(fill.key, name, path, fill.size, fill.content_type, created)])
+            return
+        with self._lock:
+            self.fills += 1
+        self._evict(fill.key, created)
+
+    def _evict(self, key: str, now: float):
+        """淘汰过期和超出总大小的结果（按索引中所有worker的合计大小）"""
+        with self._lock:
+            sweep = now - self._last_sweep >= min(self.SWEEP_INTERVAL, self.ttl)
+            if sweep:
+                self._last_sweep = now
+        conn = self._conn()
+        removed = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if sweep:
+                    rows = conn.execute("SELECT key, name, size, content_type, created FROM entries "
+                                        "WHERE created < ?", (now - self.ttl,)).fetchall()
+                    conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+                    removed.extend(self._entry(row) for row in rows)
+                    self.expired += len(rows)
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                if total > self.max_bytes:
+                    # 按最近下载时间从旧到新删除，刚写入的结果不删除
+                    evicted = []
+                    rows = conn.execute("SELECT key, name, size, content_type, created FROM entries "
+                                        "WHERE key != ? ORDER BY last_access, created", (key,))
+                    for row in rows:
+                        if total <= self.max_bytes:
+                            break
+                        evicted.append(row)
+                        total -= row["size"]
+                    conn.executemany("DELETE FROM entries WHERE key = ?", [(row["key"],) for row in evicted])
+                    removed.extend(self._entry(row) for row in evicted)
+                    self.evictions += len(evicted)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning(f"淘汰结果缓存失败: {e}")
+            return
+        self._remove_files(removed)
+
+    def tee(self, key: str, chunks: Iterator[bytes], content_type: str,
+            content_length: Optional[int]) -> Iterator[bytes]:
+        """转发结果的同时写入缓存；客户端中途断开时丢弃已写入的部分"""
+        fill = self.begin_fill(key, content_type, content_length)
+        if fill is None:
+            yield from chunks
+            return
+        try:
+            for chunk in chunks:
+                fill.write(chunk)
+                yield chunk
+            fill.commit()
+        finally:
+            fill.abort()
+
+    async def atee(self, key: str, chunks: AsyncIterator[bytes], content_type: str,
+                   content_length: Optional[int]) -> AsyncIterator[bytes]:
+        """
+        tee的异步版本：数据写入页缓存很快，直接在事件循环中写文件；
+        提交（写索引、淘汰时删除文件）和中止在线程中进行，不阻塞事件循环
+        """
+        fill = self.begin_fill(key, content_type, content_length)
+        if fill is None:
+            async for chunk in chunks:
+                yield chunk
+            return
+        try:
+            async for chunk in chunks:
+                fill.write(chunk)
+                yield chunk
+            await asyncio.to_thread(fill.commit)
+        finally:
+            if not fill.closed:
+                await asyncio.to_thread(fill.abort)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息（entries和bytes为所有worker合计，其余为本进程计数）"""
+        entries, total_bytes = 0, 0
+        if self.enabled:
+            row = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            entries, total_bytes = row[0], row[1]
+        return {
+            "enabled": self.enabled,
+            "directory": self.directory,
+            "accel_redirect": bool(self.accel_redirect_prefix),
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "fills": self.fills,
+            "fill_aborted": self.fill_aborted,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "bytes_served": self.bytes_served
+        }
+
+
+def create_result_cache(rc_config: Dict[str, Any]) -> ResultCache:
+    """按配置创建结果缓存"""
+    directory = rc_config["directory"] or os.path.join(os.path.dirname(__file__), "data", "result_cache")
+    return ResultCache(
+        directory=directory,
+        max_bytes=rc_config["max_bytes"],
+        max_entry_bytes=rc_config["max_entry_bytes"],
+        ttl=rc_config["ttl"],
+        accel_redirect_prefix=rc_config["accel_redirect_prefix"],
+        enabled=rc_config["enabled"]
+    )
+
+
+# 全局实例
+result_cache = create_result_cache(config.get_result_cache_config())
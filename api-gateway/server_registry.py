@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPU服务器注册表
+写时复制：注册/注销/状态变化时在锁内生成新的字典和可用服务器元组，再整体替换引用；
+负载均衡、状态查询等读操作不加锁，直接读取当前快照，不会遇到
+"dictionary changed size during iteration"
+"""
+
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+_NEVER = float("inf")
+
+
+class ServerRegistry:
+    """
+    server_id -> BackendServer 的只读映射（写操作通过 put/pop 完成）
+
+    额外维护 (ip, port) -> server_id、url -> BackendServer 索引和可用服务器快照，
+    查找和选择服务器都不需要遍历
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # 以下对象发布后不再修改，写操作总是生成新对象并替换引用
+        self._servers: Dict[str, object] = {}
+        self._by_address: Dict[Tuple[str, int], str] = {}
+        self._by_url: Dict[str, object] = {}
+        self._available: Tuple = ()
+        self._next_refresh = _NEVER  # 最近一台被熔断服务器恢复可用的时间
+        self._version = 0  # 每次发布新快照加1，状态快照据此判断是否需要重新生成
+
+    @property
+    def version(self) -> int:
+        """注册表版本号：注册、注销、健康或熔断状态变化时递增"""
+        return self._version
+
+    @property
+    def lock(self) -> threading.RLock:
+        """写锁：需要"查找后修改"的复合操作在锁内完成"""
+        return self._lock
+
+    # 只读映射接口，读取一次引用后在同一个快照上操作
+    def __len__(self) -> int:
+        return len(self._servers)
+
+    def __contains__(self, server_id) -> bool:
+        return server_id in self._servers
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._servers)
+
+    def __getitem__(self, server_id: str):
+        return self._servers[server_id]
+
+    def __bool__(self) -> bool:
+        return bool(self._servers)
+
+    def get(self, server_id: str, default=None):
+        return self._servers.get(server_id, default)
+
+    def keys(self):
+        return self._servers.keys()
+
+    def values(self):
+        return self._servers.values()
+
+    def items(self):
+        return self._servers.items()
+
+    def find_by_address(self, ip: str, port: int) -> Optional[str]:
+        """根据IP和端口查找server_id"""
+        return self._by_address.get((ip, port))
+
+    def find_by_url(self, url: str):
+        """根据地址查找服务器"""
+        return self._by_url.get(url)
+
+    # 写操作
+    def put(self, server):
+        """添加或替换服务器"""
+        with self._lock:
+            servers = dict(self._servers)
+            old = servers.get(server.server_id)
+            servers[server.server_id] = server
+            self._publish(servers)
+            return old
+
+    def pop(self, server_id: str, default=None):
+        """删除服务器，返回被删除的服务器"""
+        with self._lock:
+            if server_id not in self._servers:
+                return default
+            servers = dict(self._servers)
+            server = servers.pop(server_id)
+            self._publish(servers)
+            return server
+
+    def refresh(self):
+        """服务器健康/熔断状态变化后重新生成可用服务器快照"""
+        with self._lock:
+            self._publish(self._servers)
+
+    def _publish(self, servers: Dict[str, object]):
+        now = time.monotonic()
+        available = []
+        next_refresh = _NEVER
+        for server in servers.values():
+            if not server.is_healthy:
+                continue
+            available_at = server.breaker.available_at()
+            if available_at <= now:
+                available.append(server)
+            else:
+                next_refresh = min(next_refresh, available_at)
+
+        self._by_address = {(s.ip, s.port): s.server_id for s in servers.values()}
+        self._by_url = {s.url: s for s in servers.values()}
+        self._available = tuple(available)
+        self._next_refresh = next_refresh
+        self._servers = servers
+        self._version += 1
+
+    def available(self, now: Optional[float] = None) -> Tuple:
+        """健康且未被熔断的服务器快照"""
+        if (now if now is not None else time.monotonic()) >= self._next_refresh:
+            self.refresh()
+        return self._available
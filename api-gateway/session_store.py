@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信登录会话模块
+小程序登录时网关用code向微信换取openid/session_key（jscode2session），之后的请求只携带openid，
+网关无法确认请求确实来自该用户，session_key也直接返回给了客户端。
+登录成功后在网关保存会话，返回不透明的令牌：
+- 后续请求携带 Authorization: Bearer <令牌>，网关按令牌查找会话得到openid（O(1)，不访问微信）
+- 会话有效期ttl，超出max_entries时淘汰最久未使用的会话
+- 同一个code的并发登录（重复提交）共享一次jscode2session请求，code_ttl内重试为同一个会话签发新的令牌，不再访问微信
+  （微信的code只能使用一次，重复使用会返回40163）
+会话保存在SQLite数据库中（WAL模式），多个worker共用，任意worker签发的令牌在其他worker上同样有效，重启后保留；
+数据库中只保存令牌的摘要，不保存明文令牌（code只记录对应会话的令牌摘要）。
+同一个code的并发登录只在同一个worker内合并（共享同一个令牌），其他worker上的重试按记录的会话签发新令牌
+"""
+
+import hashlib
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token_hash TEXT PRIMARY KEY,
+    openid TEXT NOT NULL,
+    session_key TEXT NOT NULL,
+    unionid TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used);
+CREATE TABLE IF NOT EXISTS login_codes (
+    code TEXT PRIMARY KEY,
+    token_hash TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+DROP TABLE IF EXISTS codes;
+"""
+
+
+class Session:
+    """一个登录会话"""
+
+    __slots__ = ('openid', 'session_key', 'unionid', 'expires_at')
+
+    def __init__(self, openid: str, session_key: str, unionid: str, expires_at: float):
+        self.openid = openid
+        self.session_key = session_key
+        self.unionid = unionid
+        self.expires_at = expires_at
+
+
+class _Login:
+    """一次进行中的jscode2session请求"""
+
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+
+
+class SessionStore:
+    """令牌 -> 会话，带TTL和LRU淘汰"""
+
+    PRUNE_EVERY = 100  # 每创建N个会话清理一次过期记录
+    TOUCH_INTERVAL = 60  # 最近使用时间的更新间隔（秒），避免每次查找都写数据库
+
+    def __init__(self, path: str, ttl: float, max_entries: int, code_ttl: float, require_token: bool,
+                 expose_session_key: bool, wait_timeout: float = 15):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.code_ttl = code_ttl
+        self.require_token = require_token
+        self.expose_session_key = expose_session_key
+        self.wait_timeout = wait_timeout
+        self._local = threading.local()
+        self._inflight: Dict[str, _Login] = {}
+        self._lock = threading.Lock()
+        self._created = 0
+
+        # 统计计数
+        self.logins = 0  # 登录请求数
+        self.upstream_calls = 0  # 实际发往微信的jscode2session请求
+        self.code_hits = 0  # 同一个code重试，按已有会话签发令牌
+        self.coalesced = 0  # 等待同一个code的进行中请求
+        self.lookups = 0  # 按令牌查找会话
+        self.misses = 0  # 令牌不存在或已过期
+        self.evictions = 0  # 超出容量淘汰
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _hash(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _create(self, data: Dict[str, Any], now: float) -> Dict[str, Any]:
+        token = secrets.token_urlsafe(32)
+        session = Session(data['openid'], data.get('session_key', ''), data.get('unionid', ''), now + self.ttl)
+        self._conn().execute(
+            "INSERT INTO sessions (token_hash, openid, session_key, unionid, expires_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self._hash(token), session.openid, session.session_key, session.unionid, session.expires_at, now)
+        )
+        with self._lock:
+            self._created += 1
+            prune = self._created % self.PRUNE_EVERY == 0
+        if prune:
+            self._prune(now)
+        return {
+            'success': True,
+            'data': {
+                'token': token,
+                'expires_in': int(self.ttl),
+                'openid': session.openid,
+                'session_key': session.session_key,
+                'unionid': session.unionid
+            }
+        }
+
+    def _prune(self, now: float):
+        """删除过期的会话和code，超出容量时删除最久未使用的会话"""
+        conn = self._conn()
+        try:
+            conn.execute("DELETE FROM login_codes WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            excess = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM sessions WHERE token_hash IN "
+                    "(SELECT token_hash FROM sessions ORDER BY last_used LIMIT ?)", (excess,)
+                )
+                with self._lock:
+                    self.evictions += excess
+        except sqlite3.Error as e:
+            logger.warning(f"清理登录会话失败: {e}")
+
+    def _cached_login(self, code: str, now: float) -> Optional[Dict[str, Any]]:
+        """code_ttl内同一个code已登录成功（可能在其他worker上），为同一个会话签发新的令牌"""
+        row = self._conn().execute(
+            "SELECT s.openid, s.session_key, s.unionid FROM login_codes c "
+            "JOIN sessions s ON s.token_hash = c.token_hash "
+            "WHERE c.code = ? AND c.expires_at > ? AND s.expires_at > ?", (code, now, now)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._create(dict(row), now)
+
+    def login(self, code: str, exchange: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+        """用code登录，exchange为实际的jscode2session请求函数；返回值与exchange相同，data中增加token"""
+        now = time.time()
+        cached = self._cached_login(code, now)
+        with self._lock:
+            self.logins += 1
+            if cached is not None:
+                self.code_hits += 1
+                return cached
+
+            call = self._inflight.get(code)
+            leader = call is None
+            if leader:
+                call = self._inflight[code] = _Login()
+                self.upstream_calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if call.done.wait(self.wait_timeout) and call.result is not None:
+                return call.result
+            return {'success': False, 'error': '登录超时'}
+
+        result = None
+        cached = False
+        try:
+            # 查询缓存与登记之间，同一个code的登录可能刚好完成
+            result = self._cached_login(code, time.time())
+            if result is not None:
+                cached = True
+                return result
+            result = exchange(code)
+            if result['success']:
+                result = self._create(result['data'], time.time())
+            return result
+        finally:
+            if result is None:
+                result = {'success': False, 'error': '登录失败'}
+            # 只缓存成功的登录，失败（网络错误等）可以用同一个code重试
+            if result['success'] and self.code_ttl > 0 and not cached:
+                try:
+                    now = time.time()
+                    conn = self._conn()
+                    conn.execute("DELETE FROM login_codes WHERE expires_at <= ?", (now,))
+                    conn.execute(
+                        "INSERT OR REPLACE INTO login_codes (code, token_hash, expires_at) VALUES (?, ?, ?)",
+                        (code, self._hash(result['data']['token']), now + self.code_ttl)
+                    )
+                except sqlite3.Error as e:
+                    logger.warning(f"记录登录结果失败: {e}")
+            with self._lock:
+                del self._inflight[code]
+                if cached:
+                    self.upstream_calls -= 1
+                    self.code_hits += 1
+            call.result = result
+            call.done.set()
+
+    def get(self, token: str) -> Optional[Session]:
+        """按令牌查找有效的会话"""
+        now = time.time()
+        token_hash = self._hash(token)
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT openid, session_key, unionid, expires_at, last_used FROM sessions WHERE token_hash = ?",
+            (token_hash,)
+        ).fetchone()
+        with self._lock:
+            self.lookups += 1
+            if row is None or now >= row["expires_at"]:
+                self.misses += 1
+                return None
+        if now - row["last_used"] >= self.TOUCH_INTERVAL:
+            conn.execute("UPDATE sessions SET last_used = ? WHERE token_hash = ?", (now, token_hash))
+        return Session(row["openid"], row["session_key"], row["unionid"], row["expires_at"])
+
+    def revoke(self, token: str) -> bool:
+        """注销会话（所有worker立即生效）"""
+        return self._conn().execute(
+            "DELETE FROM sessions WHERE token_hash = ?", (self._hash(token),)
+        ).rowcount > 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息（sessions为所有worker合计）"""
+        sessions = self._conn().execute("SELECT COUNT(*) FROM sessions WHERE expires_at > ?",
+                                        (time.time(),)).fetchone()[0]
+        with self._lock:
+            return {
+                "sessions": sessions,
+                "require_token": self.require_token,
+                "logins": self.logins,
+                "upstream_calls": self.upstream_calls,
+                "code_hits": self.code_hits,
+                "coalesced": self.coalesced,
+                "lookups": self.lookups,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+def create_session_store(session_config: Dict[str, Any]) -> SessionStore:
+    """按配置创建会话存储"""
+    path = session_config["path"]
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(__file__), path)
+    return SessionStore(
+        path=path,
+        ttl=session_config["ttl"],
+        max_entries=session_config["max_entries"],
+        code_ttl=session_config["code_ttl"],
+        require_token=session_config["require_token"],
+        expose_session_key=session_config["expose_session_key"]
+    )
+
+
+# 全局实例
+session_store = create_session_store(config.get_auth_session_config())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程共享的GPU服务器状态
+gunicorn多worker部署时，每个worker都有自己的backend_manager。开启共享模式后：
+- 服务器列表和健康状态保存在同一个SQLite数据库（WAL模式）中，注册/注销/状态变化都写入数据库
+- 每个worker定期检查数据库版本号，有变化时同步到本地注册表
+- 通过租约选出一个worker负责健康检测，其余worker只读取检测结果；该worker退出后租约过期，由其他worker接管
+- 每个worker发布自己在各服务器上未完成的请求/任务数，预留转发名额时在同一个事务内加上其他worker的数量，
+  多个worker合计不超过服务器的任务上限；worker退出后它的记录在租约期限后失效
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    server_id TEXT PRIMARY KEY,
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    weight INTEGER NOT NULL DEFAULT 1,
+    is_healthy INTEGER NOT NULL DEFAULT 1,
+    fail_count INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (ip, port)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prober_lease (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS server_load (
+    owner TEXT NOT NULL,
+    url TEXT NOT NULL,
+    in_flight INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (owner, url)
+);
+"""
+
+
+class SharedBackendState:
+    """基于SQLite的共享服务器注册表"""
+
+    def __init__(self, path: str, lease_ttl: float = 10):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._lease_expires = 0.0  # 本进程持有的租约到期时间
+
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', '0')")
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """写事务：提交前递增版本号，通知其他worker同步"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def version(self) -> int:
+        """当前版本号，每次写入后加1"""
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row["value"])
+
+    def load(self) -> List[Dict[str, Any]]:
+        """读取所有服务器"""
+        rows = self._conn().execute(
+            "SELECT server_id, ip, port, weight, is_healthy, fail_count FROM servers ORDER BY server_id"
+        ).fetchall()
+        return [dict(row, is_healthy=bool(row["is_healthy"])) for row in rows]
+
+    def import_servers(self, servers: Iterable[Dict[str, Any]]) -> bool:
+        """首次启用共享模式时导入backend_servers.json中的服务器，已初始化过则忽略"""
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'initialized'").fetchone():
+                return False
+            for data in servers:
+                conn.execute(
+                    "INSERT OR IGNORE INTO servers (server_id, ip, port, weight) VALUES (?, ?, ?, ?)",
+                    (data["server_id"], data["ip"], data["port"], data.get("weight", 1))
+                )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('initialized', '1')")
+            return True
+
+    def register(self, ip: str, port: int, weight: Optional[int] = None,
+                 server_id: Optional[str] = None) -> str:
+        """注册或更新服务器，返回server_id（在事务内分配，多个worker并发注册也不会重复）"""
+        with self._write() as conn:
+            row = conn.execute("SELECT server_id FROM servers WHERE ip = ? AND port = ?", (ip, port)).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE servers SET is_healthy = 1, fail_count = 0, weight = COALESCE(?, weight) "
+                    "WHERE server_id = ?",
+                    (weight, row["server_id"])
+                )
+                return row["server_id"]
+
+            existing_ids = {r["server_id"] for r in conn.execute("SELECT server_id FROM servers")}
+            if not server_id or server_id in existing_ids:
+                server_id = next((f"GPU-{i:03d}" for i in range(1, 1000) if f"GPU-{i:03d}" not in existing_ids), None)
+                if server_id is None:
+                    raise Exception("服务器数量已达上限")
+            conn.execute(
+                "INSERT INTO servers (server_id, ip, port, weight) VALUES (?, ?, ?, ?)",
+                (server_id, ip, port, weight if weight is not None else 1)
+            )
+            return server_id
+
+    def unregister(self, server_id: str) -> bool:
+        """删除服务器"""
+        with self._write() as conn:
+            return conn.execute("DELETE FROM servers WHERE server_id = ?", (server_id,)).rowcount > 0
+
+    def set_health(self, server_id: str, is_healthy: bool, fail_count: int):
+        """写入健康检测结果"""
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE servers SET is_healthy = ?, fail_count = ? WHERE server_id = ?",
+                (int(is_healthy), fail_count, server_id)
+            )
+
+    def try_acquire_lease(self) -> bool:
+        """获取或续期健康检测租约，返回本进程是否负责健康检测"""
+        now = time.time()
+        # 持有租约时每1/3租期续期一次，未持有时只在租约过期后尝试获取，避免频繁写入
+        if self._lease_expires - now > self.lease_ttl * 2 / 3:
+            return True
+        conn = self._conn()
+        row = conn.execute("SELECT owner, expires_at FROM prober_lease WHERE id = 1").fetchone()
+        if row and row["owner"] != self.owner and row["expires_at"] > now:
+            self._lease_expires = 0.0
+            return False
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO prober_lease (id, owner, expires_at) VALUES (1, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE prober_lease.owner = excluded.owner OR prober_lease.expires_at <= ?",
+                (self.owner, now + self.lease_ttl, now)
+            )
+            acquired = conn.execute("SELECT owner FROM prober_lease WHERE id = 1").fetchone()["owner"] == self.owner
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._lease_expires = now + self.lease_ttl if acquired else 0.0
+        return acquired
+
+    def release_lease(self):
+        """进程退出时释放租约，其他worker可以立即接管"""
+        if self._lease_expires:
+            self._conn().execute("DELETE FROM prober_lease WHERE id = 1 AND owner = ?", (self.owner,))
+            self._lease_expires = 0.0
+
+    def _remote_load(self, conn: sqlite3.Connection, now: float) -> Dict[str, int]:
+        """其他worker发布的各服务器未完成数（超过租约期限未更新的记录视为已退出）"""
+        rows = conn.execute(
+            "SELECT url, SUM(in_flight) AS in_flight FROM server_load "
+            "WHERE owner != ? AND updated_at > ? GROUP BY url",
+            (self.owner, now - self.lease_ttl)
+        ).fetchall()
+        return {row["url"]: row["in_flight"] for row in rows}
+
+    def _store_load(self, conn: sqlite3.Connection, loads: Dict[str, int], now: float):
+        conn.executemany(
+            "INSERT INTO server_load (owner, url, in_flight, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (owner, url) DO UPDATE SET in_flight = excluded.in_flight, updated_at = excluded.updated_at",
+            [(self.owner, url, in_flight, now) for url, in_flight in loads.items()]
+        )
+
+    def publish_load(self, loads: Dict[str, int]) -> Dict[str, int]:
+        """发布本进程在各服务器上的未完成数，清理已退出worker的记录，返回其他worker的合计"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._store_load(conn, loads, now)
+            conn.execute("DELETE FROM server_load WHERE updated_at <= ?", (now - self.lease_ttl,))
+            stale = [url for (url,) in conn.execute("SELECT url FROM server_load WHERE owner = ?", (self.owner,))
+                     if url not in loads]
+            conn.executemany("DELETE FROM server_load WHERE owner = ? AND url = ?",
+                             [(self.owner, url) for url in stale])
+            remote = self._remote_load(conn, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return remote
+
+    @contextmanager
+    def reserve_load(self) -> Iterator[Dict[str, int]]:
+        """
+        预留转发名额的写事务：返回其他worker的合计未完成数，调用方选好服务器后用store_reserved写入本进程的新数量；
+        其他worker在事务提交前不能预留，不会同时选中同一台服务器的最后一个名额
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._remote_load(conn, time.time())
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def store_reserved(self, url: str, in_flight: int):
+        """在reserve_load事务内写入本进程在该服务器上的未完成数"""
+        self._store_load(self._conn(), {url: in_flight}, time.time())
+
+    def clear_load(self):
+        """进程退出时删除本进程发布的负载"""
+        self._conn().execute("DELETE FROM server_load WHERE owner = ?", (self.owner,))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态快照
+健康检查、API信息接口被监控和小程序频繁访问，内容只随服务器注册/健康/熔断状态和网关配置变化。
+每个接口的响应预先序列化为JSON并计算ETag，注册表和配置的版本号不变时直接返回同一个快照；
+请求携带的If-None-Match与ETag相同时返回304。
+生成快照只读取注册表（由健康检测维护），不请求后端，也不推进负载均衡的选择位置
+"""
+
+import copy
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable
+
+from backend_manager import backend_manager
+from config import config
+
+
+class StatusSnapshot:
+    """一个接口的响应快照，生成后不再修改"""
+
+    __slots__ = ('body', 'etag', 'content', 'version', 'generated_at')
+
+    def __init__(self, content: Dict[str, Any], version: Hashable, generated_at: float):
+        self.content = content
+        self.version = version
+        self.generated_at = generated_at
+        # timestamp为内容最近一次变化的时间，内容不变时ETag也不变
+        self.body = json.dumps({**content, 'timestamp': generated_at}, ensure_ascii=False).encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()[:20]
+
+    def with_version(self, version: Hashable) -> 'StatusSnapshot':
+        """内容没有变化：沿用响应体和ETag，只更新版本号"""
+        snapshot = copy.copy(self)
+        snapshot.version = version
+        return snapshot
+
+
+class SnapshotCache:
+    """按版本号缓存各接口的响应快照"""
+
+    def __init__(self, get_version: Callable[[], Hashable]):
+        self._get_version = get_version
+        self._builders: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._snapshots: Dict[str, StatusSnapshot] = {}
+        self._lock = threading.Lock()
+
+        # 统计计数
+        self.served = 0  # 返回完整响应
+        self.not_modified = 0  # 返回304
+        self.rebuilds = 0  # 版本号变化后重新生成的次数
+        self.unchanged = 0  # 重新生成后内容没有变化，沿用原快照
+
+    def register(self, name: str, builder: Callable[[], Dict[str, Any]]):
+        """注册接口的内容生成函数（返回可序列化的字典，不含timestamp）"""
+        self._builders[name] = builder
+
+    def get(self, name: str) -> StatusSnapshot:
+        """获取接口的当前快照，版本号变化时重新生成"""
+        version = self._get_version()
+        snapshot = self._snapshots.get(name)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshots.get(name)
+            if snapshot is not None and snapshot.version == version:
+                return snapshot
+            # 先读版本号再生成内容：生成期间状态又变化时，下次请求会再生成一次
+            content = self._builders[name]()
+            self.rebuilds += 1
+            if snapshot is not None and snapshot.content == content:
+                self.unchanged += 1
+                snapshot = snapshot.with_version(version)
+            else:
+                snapshot = StatusSnapshot(content, version, time.time())
+            self._snapshots[name] = snapshot
+            return snapshot
+
+    def record(self, not_modified: bool):
+        """记录一次响应"""
+        if not_modified:
+            self.not_modified += 1
+        else:
+            self.served += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            "served": self.served,
+            "not_modified": self.not_modified,
+            "rebuilds": self.rebuilds,
+            "unchanged": self.unchanged,
+            "snapshots": {
+                name: {"etag": snapshot.etag, "generated_at": snapshot.generated_at}
+                for name, snapshot in list(self._snapshots.items())
+            }
+        }
+
+
+def _state_version() -> Hashable:
+    """注册表和配置的版本号"""
+    servers = backend_manager.servers
+    servers.available()  # 被熔断的服务器到期恢复时重新生成可用服务器快照（版本号随之变化）
+    return (servers.version, config.version)
+
+
+# 全局实例
+status_snapshots = SnapshotCache(_state_version)
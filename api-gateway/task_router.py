@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+任务亲和路由模块
+记录每个task_id由哪台GPU服务器处理，使status/download请求直接路由到该服务器，
+而不是再走一次轮询负载均衡。
+开启共享状态（shared_state）时路由表同时写入共享SQLite数据库，gunicorn多worker部署时
+客户端轮询到其他worker也能找到任务所在的服务器；进程内的路由表作为缓存，命中时不访问数据库
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS task_routes (
+    task_id TEXT PRIMARY KEY,
+    backend_url TEXT NOT NULL,
+    touched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_task_routes_touched ON task_routes (touched);
+"""
+
+
+class TaskRouter:
+    """任务 → GPU服务器 路由表（TTL过期 + 容量上限）"""
+
+    PRUNE_EVERY = 100  # 每记录N个任务清理一次共享路由表
+    TOUCH_FRACTION = 0.25  # 共享路由表的访问时间最多落后ttl的这个比例，避免每次查询都写数据库
+
+    def __init__(self, ttl: int, max_entries: int, path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path  # 共享路由表的SQLite数据库，为空时只在进程内记录
+        # task_id -> (backend_url, 最近访问时间, 最近写入共享路由表的访问时间)，按最近访问时间排序，最旧的在最前面
+        self._entries: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._records = 0
+
+        # 统计计数
+        self.hits = 0  # 命中路由表
+        self.shared_hits = 0  # 进程内未命中、在共享路由表中找到（由其他worker记录）
+        self.misses = 0  # 路由表中没有该任务
+        self.stale = 0  # 记录的服务器已下线
+        self.expirations = 0  # TTL过期淘汰
+        self.evictions = 0  # 超出容量淘汰
+        self.shared_errors = 0  # 访问共享路由表出错
+
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn().executescript(_SCHEMA)
+
+    @property
+    def shared(self) -> bool:
+        """是否使用共享路由表"""
+        return bool(self.path)
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _shared_execute(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Cursor]:
+        """访问共享路由表，出错时记录日志并返回None（按进程内路由表和负载均衡继续处理）"""
+        try:
+            return self._conn().execute(sql, params)
+        except sqlite3.Error as e:
+            logger.warning(f"访问共享任务路由表出错: {e}")
+            with self._lock:
+                self.shared_errors += 1
+            return None
+
+    def _purge_expired(self, now: float):
+        """清理过期记录（调用方需持有锁）"""
+        while self._entries:
+            _, (_, touched, _) = next(iter(self._entries.items()))
+            if now - touched < self.ttl:
+                break
+            self._entries.popitem(last=False)
+            self.expirations += 1
+
+    def bind(self, task_id: str, backend_url: str):
+        """记录任务所属的GPU服务器"""
+        if not task_id or not backend_url:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            self._entries[task_id] = (backend_url, now, now)
+            self._entries.move_to_end(task_id)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._records += 1
+            prune = self._records % self.PRUNE_EVERY == 0
+
+        if self.shared:
+            self._shared_execute(
+                "INSERT OR REPLACE INTO task_routes (task_id, backend_url, touched) VALUES (?, ?, ?)",
+                (task_id, backend_url, now)
+            )
+            if prune:
+                self._prune_shared(now)
+
+        logger.debug(f"任务 {task_id} 绑定到 {backend_url}")
+
+    def _prune_shared(self, now: float):
+        """删除共享路由表中过期和超出容量的最久未访问记录"""
+        self._shared_execute("DELETE FROM task_routes WHERE touched <= ?", (now - self.ttl,))
+        self._shared_execute(
+            "DELETE FROM task_routes WHERE task_id IN "
+            "(SELECT task_id FROM task_routes ORDER BY touched DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def lookup(self, task_id: str) -> Optional[str]:
+        """查找任务所属的GPU服务器地址，找不到返回None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is not None and now - entry[1] >= self.ttl:
+                del self._entries[task_id]
+                self.expirations += 1
+                entry = None
+            if entry is None and not self.shared:
+                self.misses += 1
+                return None
+
+            if entry is not None:
+                # 刷新访问时间，共享路由表中的访问时间落后较多时一起刷新
+                backend_url, _, synced = entry
+                touch_shared = self.shared and now - synced >= self.ttl * self.TOUCH_FRACTION
+                self._entries[task_id] = (backend_url, now, now if touch_shared else synced)
+                self._entries.move_to_end(task_id)
+                self.hits += 1
+        if entry is not None:
+            if touch_shared:
+                self._shared_execute("UPDATE task_routes SET touched = ? WHERE task_id = ?", (now, task_id))
+            return backend_url
+
+        # 可能由其他worker记录
+        cursor = self._shared_execute(
+            "SELECT backend_url FROM task_routes WHERE task_id = ? AND touched > ?", (task_id, now - self.ttl)
+        )
+        row = cursor.fetchone() if cursor is not None else None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        backend_url = row[0]
+        self._shared_execute("UPDATE task_routes SET touched = ? WHERE task_id = ?", (now, task_id))
+        with self._lock:
+            self._entries[task_id] = (backend_url, now, now)
+            self._entries.move_to_end(task_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self.shared_hits += 1
+        return backend_url
+
+    def forget(self, task_id: str):
+        """删除任务记录"""
+        with self._lock:
+            self._entries.pop(task_id, None)
+        if self.shared:
+            self._shared_execute("DELETE FROM task_routes WHERE task_id = ?", (task_id,))
+
+    def _is_routable(self, backend_url: str) -> bool:
+        """
+        检查记录的服务器是否仍在注册表中
+        暂时不健康（健康检查失败、熔断）时保留记录：任务只在该服务器上，换服务器只会得到404
+        """
+        if not config.is_multi_backend_enabled():
+            return True
+        if backend_url == config.config.get("backend_api_base"):
+            return True
+
+        backend_manager = config._get_backend_manager()
+        if not backend_manager:
+            return False
+        return backend_manager.get_server_by_url(backend_url) is not None
+
+    def get_backend_url(self, task_id: str) -> Optional[str]:
+        """获取处理该任务的后端地址，未命中时回退到负载均衡"""
+        backend_url = self.lookup(task_id)
+        if backend_url:
+            if self._is_routable(backend_url):
+                return backend_url
+
+            logger.warning(f"任务 {task_id} 所在服务器 {backend_url} 已下线，回退到负载均衡")
+            with self._lock:
+                self.stale += 1
+            self.forget(task_id)
+
+        return config.get_backend_url()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "backend": "shared" if self.shared else "memory",
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": round((self.hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "shared_errors": self.shared_errors
+            }
+
+
+def create_task_router(affinity_config: Dict[str, Any], ss_config: Dict[str, Any]) -> TaskRouter:
+    """按配置创建路由表；开启共享状态时与服务器列表使用同一个SQLite数据库"""
+    path = None
+    if ss_config["enabled"]:
+        path = ss_config["path"]
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(__file__), path)
+    return TaskRouter(
+        ttl=affinity_config["ttl"],
+        max_entries=affinity_config["max_entries"],
+        path=path
+    )
+
+
+# 全局实例
+task_router = create_task_router(config.get_task_affinity_config(), config.get_shared_state_config())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式上传转发模块
+把客户端的原始请求体按固定大小分块转发到GPU服务器，网关内存中最多只保留一个分块，
+同时在转发过程中检查上传大小，超出限制立即中止。
+需要重试或计算摘要时把请求体缓存下来（SpooledBody），每次转发重新读取
+"""
+
+import logging
+import os
+import tempfile
+import threading
+from typing import AsyncIterator, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLargeError(IOError):
+    """上传内容超出大小限制"""
+
+
+class UploadStream:
+    """
+    限制大小的分块上传流
+
+    requests把带 read()/__iter__ 的对象当作流式请求体：
+    - 已知 Content-Length 时通过 len 属性透传长度，按块读取发送
+    - 未知长度时（客户端使用chunked上传）len 为0，requests改用chunked编码逐块发送
+    """
+
+    def __init__(self, stream, max_size: int, chunk_size: int = 64 * 1024,
+                 content_length: Optional[int] = None):
+        self.stream = stream
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.len = content_length or 0
+        self.bytes_read = 0
+        self.exceeded = False
+
+    def _account(self, chunk: bytes) -> bytes:
+        """累计已读字节数，超出限制时中止上传"""
+        self.bytes_read += len(chunk)
+        if self.bytes_read > self.max_size:
+            self.exceeded = True
+            logger.warning(f"上传内容超过大小限制 {self.max_size} 字节，中止转发")
+            raise UploadTooLargeError(f"上传内容超过 {self.max_size} 字节")
+        return chunk
+
+    def read(self, size: int = -1) -> bytes:
+        """读取一个分块，单次读取不超过chunk_size"""
+        if self.exceeded:
+            raise UploadTooLargeError(f"上传内容超过 {self.max_size} 字节")
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        return self._account(self.stream.read(size))
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class AsyncUploadStream:
+    """UploadStream的异步版本，用于ASGI网关把请求体分块转发给aiohttp"""
+
+    def __init__(self, chunks: AsyncIterator[bytes], max_size: int):
+        self.chunks = chunks
+        self.max_size = max_size
+        self.bytes_read = 0
+        self.exceeded = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.chunks:
+            self.bytes_read += len(chunk)
+            if self.bytes_read > self.max_size:
+                self.exceeded = True
+                logger.warning(f"上传内容超过大小限制 {self.max_size} 字节，中止转发")
+                raise UploadTooLargeError(f"上传内容超过 {self.max_size} 字节")
+            if chunk:
+                yield chunk
+
+
+class SpooledBody:
+    """
+    可重复读取的请求体：不超过max_memory时保存在内存中，超出后写入临时文件
+    open()返回独立的读取流，多个转发可以同时读取（换服务器重试、对冲请求）；
+    关闭后读取会报错，仍在发送的转发随之中止
+    """
+
+    def __init__(self, max_memory: int):
+        self.max_memory = max_memory
+        self.size = 0
+        self._buffer = bytearray()
+        self._file = None
+        self._refs = 1
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def write(self, chunk: bytes):
+        if self._file is None and self.size + len(chunk) > self.max_memory:
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._buffer += chunk
+        self.size += len(chunk)
+
+    def finish(self):
+        """写入完毕"""
+        if self._file is not None:
+            self._file.flush()
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        if self.closed:
+            raise ValueError("请求体已关闭")
+        if self._file is not None:
+            # pread不移动文件位置，多个读取流互不影响
+            return os.pread(self._file.fileno(), size, offset)
+        return bytes(self._buffer[offset:offset + size])
+
+    def open(self, chunk_size: int = 64 * 1024) -> UploadStream:
+        """新的读取流（带长度，requests按Content-Length分块发送）"""
+        return UploadStream(self.reader(), max_size=self.size, chunk_size=chunk_size, content_length=self.size)
+
+    def reader(self) -> "_BodyReader":
+        """新的读取位置，read()不带参数时读取全部（作为requests的multipart文件）"""
+        return _BodyReader(self)
+
+    def share(self) -> "SpooledBody":
+        """增加一个持有者（如转交给排队任务），每个持有者各自close，最后一个close时释放"""
+        with self._lock:
+            self._refs += 1
+        return self
+
+    def close(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0 or self.closed:
+                return
+            self.closed = True
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+
+
+class _BodyReader:
+    """SpooledBody的一个读取位置"""
+
+    def __init__(self, body: SpooledBody):
+        self.body = body
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.body.size - self.offset
+        data = self.body.read_at(self.offset, size)
+        self.offset += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self.offset
@@ -31,9 +31,13 @@ def register_webhook_routes(app):
             ip = data['ip']
             port = data['port']
             secret = data['secret']
+            weight = data.get('weight')  # 可选：声明的GPU算力权重，用于加权负载均衡
+            # bool是int的子类，JSON中的true不能当作权重1
+            if weight is not None and (not isinstance(weight, int) or isinstance(weight, bool) or weight < 1):
+                return jsonify({'success': False, 'error': 'weight必须为正整数'}), 400
             
             # 添加或更新服务器，A服务器自动分配server_id
-            success, assigned_server_id = backend_manager.add_or_update_server(ip, port, secret)
+            success, assigned_server_id = backend_manager.add_or_update_server(ip, port, secret, weight=weight)
             
             if success:
                 logger.info(f"服务器 {assigned_server_id} 注册成功: {ip}:{port}")
@@ -74,11 +78,7 @@ def register_webhook_routes(app):
                 return jsonify({'success': False, 'error': '密码验证失败'}), 401
             
             # 通过IP和端口查找并删除服务器
-            server_id = None
-            for sid, server in backend_manager.servers.items():
-                if server.ip == ip and server.port == port:
-                    server_id = sid
-                    break
+            server_id = backend_manager.servers.find_by_address(ip, port)
             
             if server_id:
                 success = backend_manager.remove_server(server_id)
@@ -1,7 +1,7 @@
 # 微信登录认证模块
-import requests
 import json
 from wechat_pay_config import WeChatPayConfig
+from http_pool import wechat_session
 
 class WeChatAuth:
     """微信登录认证类"""
@@ -10,10 +10,11 @@ class WeChatAuth:
         self.config = WeChatPayConfig()
         self.appid = self.config.APPID
         self.secret = self.config.SECRET
+        self.session_url = "https://api.weixin.qq.com/sns/jscode2session"
     
     def get_openid(self, code):
         """通过code获取openid"""
-        url = "https://api.weixin.qq.com/sns/jscode2session"
+        url = self.session_url
         
         params = {
             'appid': self.appid,
@@ -23,7 +24,7 @@ class WeChatAuth:
         }
         
         try:
-            response = requests.get(url, params=params, timeout=10)
+            response = wechat_session.get(url, params=params, timeout=10)
             result = response.json()
             
             if 'openid' in result:
@@ -91,7 +91,7 @@ def payment_notify():
         
         # 验证签名
         sign = callback_data.pop('sign', '')
-        if not WeChatPayUtils.verify_sign(callback_data, sign, WeChatPayConfig.API_KEY):
+        if not pay_api.signer.verify(callback_data, sign):
             logger.error("支付回调签名验证失败")
             return WeChatPayUtils.dict_to_xml({
                 'return_code': 'FAIL',
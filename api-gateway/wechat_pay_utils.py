@@ -5,10 +5,77 @@ import json
 import random
 import string
 import time
-import xml.etree.ElementTree as ET
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
 from urllib.parse import urlencode
-import requests
 from wechat_pay_config import WeChatPayConfig
+from http_pool import wechat_session
+import wechat_xml
+
+class WeChatPaySigner:
+    """微信支付签名器
+    创建时编码好API密钥、生成HMAC-SHA256的密钥原型，并缓存各字段组合的排序结果，
+    每次签名只需拼接参数和计算一次摘要；验签使用常量时间比较
+    """
+    
+    # 缓存的字段组合数
+    MAX_KEY_ORDERS = 256
+    
+    def __init__(self, api_key):
+        api_key = (api_key or '').encode('utf-8')
+        self._key_suffix = b'&key=' + api_key
+        self._hmac = hmac.new(api_key, digestmod='sha256')
+        self._key_orders: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+    
+    def _sorted_keys(self, keys):
+        # 参数名ASCII码从小到大排序，sign不参与签名
+        order = tuple(sorted(key for key in keys if key != 'sign'))
+        if len(self._key_orders) >= self.MAX_KEY_ORDERS:
+            self._key_orders.clear()
+        self._key_orders[keys] = order
+        return order
+    
+    def _string_sign_temp(self, params) -> bytes:
+        """stringA&key=API密钥（值为空的参数不参与签名）"""
+        keys = tuple(params)
+        order = self._key_orders.get(keys)
+        if order is None:
+            order = self._sorted_keys(keys)
+        string_a = '&'.join([f"{key}={params[key]}" for key in order if params[key]])
+        return string_a.encode('utf-8') + self._key_suffix
+    
+    def sign(self, params, sign_type=WeChatPayConfig.SIGN_TYPE_MD5) -> str:
+        """计算签名"""
+        string_sign_temp = self._string_sign_temp(params)
+        if sign_type == WeChatPayConfig.SIGN_TYPE_MD5:
+            return hashlib.md5(string_sign_temp).hexdigest().upper()
+        if sign_type == WeChatPayConfig.SIGN_TYPE_HMAC_SHA256:
+            mac = self._hmac.copy()
+            mac.update(string_sign_temp)
+            return mac.hexdigest().upper()
+        raise ValueError(f"不支持的签名类型: {sign_type}")
+    
+    def verify(self, data, sign, sign_type=WeChatPayConfig.SIGN_TYPE_MD5) -> bool:
+        """验证签名（常量时间比较）"""
+        if not sign or sign_type not in (WeChatPayConfig.SIGN_TYPE_MD5, WeChatPayConfig.SIGN_TYPE_HMAC_SHA256):
+            return False
+        calculated_sign = self.sign(data, sign_type)
+        return hmac.compare_digest(calculated_sign.encode('ascii'), sign.encode('utf-8'))
+    
+    def sign_many(self, params_list: Iterable[dict], sign_type=WeChatPayConfig.SIGN_TYPE_MD5) -> List[str]:
+        """批量签名"""
+        sign = self.sign
+        return [sign(params, sign_type) for params in params_list]
+    
+    def verify_many(self, items: Iterable[Tuple[dict, str]], sign_type=WeChatPayConfig.SIGN_TYPE_MD5) -> List[bool]:
+        """批量验签，items为 (参数, 签名) 序列"""
+        verify = self.verify
+        return [verify(data, sign, sign_type) for data, sign in items]
+
+
+@lru_cache(maxsize=8)
+def _signer_for(api_key) -> WeChatPaySigner:
+    return WeChatPaySigner(api_key)
 
 class WeChatPayUtils:
     """微信支付工具类"""
@@ -33,79 +100,44 @@ class WeChatPayUtils:
     @staticmethod
     def sign_md5(params, api_key):
         """MD5签名"""
-        # 1. 参数排序
-        sorted_params = sorted(params.items())
-        
-        # 2. 拼接字符串
-        string_a = '&'.join([f"{k}={v}" for k, v in sorted_params if v])
-        string_sign_temp = f"{string_a}&key={api_key}"
-        
-        # 3. MD5加密
-        sign = hashlib.md5(string_sign_temp.encode('utf-8')).hexdigest().upper()
-        return sign
+        return _signer_for(api_key).sign(params, WeChatPayConfig.SIGN_TYPE_MD5)
     
     @staticmethod
     def sign_hmac_sha256(params, api_key):
         """HMAC-SHA256签名"""
-        # 1. 参数排序
-        sorted_params = sorted(params.items())
-        
-        # 2. 拼接字符串
-        string_a = '&'.join([f"{k}={v}" for k, v in sorted_params if v])
-        
-        # 3. HMAC-SHA256加密
-        sign = hmac.new(
-            api_key.encode('utf-8'),
-            string_a.encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest().upper()
-        return sign
+        return _signer_for(api_key).sign(params, WeChatPayConfig.SIGN_TYPE_HMAC_SHA256)
     
     @staticmethod
     def dict_to_xml(data):
         """字典转XML"""
-        xml = "<xml>"
-        for key, value in data.items():
-            xml += f"<{key}><![CDATA[{value}]]></{key}>"
-        xml += "</xml>"
-        return xml
+        return wechat_xml.dumps(data)
     
     @staticmethod
     def xml_to_dict(xml_str):
-        """XML转字典"""
-        root = ET.fromstring(xml_str)
-        result = {}
-        for child in root:
-            result[child.tag] = child.text
-        return result
+        """XML转字典（只接受扁平报文，格式错误时抛出 wechat_xml.WeChatXMLError）"""
+        return wechat_xml.loads(xml_str)
     
     @staticmethod
     def verify_sign(data, sign, api_key, sign_type="MD5"):
         """验证签名"""
-        if sign_type == "MD5":
-            calculated_sign = WeChatPayUtils.sign_md5(data, api_key)
-        elif sign_type == "HMAC-SHA256":
-            calculated_sign = WeChatPayUtils.sign_hmac_sha256(data, api_key)
-        else:
-            return False
-        
-        return calculated_sign == sign
+        return _signer_for(api_key).verify(data, sign, sign_type)
 
 class WeChatPayAPI:
     """微信支付API类"""
     
     def __init__(self):
         self.config = WeChatPayConfig()
+        self.signer = WeChatPaySigner(self.config.API_KEY)
     
-    def create_order(self, openid, total_fee, body, attach=""):
-        """创建支付订单"""
+    def create_order(self, openid, total_fee, body, attach="", out_trade_no=None):
+        """创建支付订单（out_trade_no为本地订单号，不指定时生成新的）"""
         # 构建请求参数
         params = {
             'appid': self.config.APPID,
             'mch_id': self.config.MCH_ID,
             'nonce_str': WeChatPayUtils.generate_nonce_str(),
             'body': body,
-            'out_trade_no': WeChatPayUtils.generate_out_trade_no(),
+            'out_trade_no': out_trade_no or WeChatPayUtils.generate_out_trade_no(),
             'total_fee': total_fee,  # 单位：分
             'spbill_create_ip': '127.0.0.1',
             'notify_url': self.config.NOTIFY_URL,
@@ -115,14 +147,14 @@ class WeChatPayAPI:
         }
         
         # 添加签名
-        params['sign'] = WeChatPayUtils.sign_md5(params, self.config.API_KEY)
+        params['sign'] = self.signer.sign(params)
         
         # 转换为XML
         xml_data = WeChatPayUtils.dict_to_xml(params)
         
         try:
             # 发送请求
-            response = requests.post(
+            response = wechat_session.post(
                 self.config.UNIFIED_ORDER_URL,
                 data=xml_data.encode('utf-8'),
                 headers={'Content-Type': 'application/xml'},
@@ -143,7 +175,7 @@ class WeChatPayAPI:
                 }
                 
                 # 添加签名
-                pay_params['paySign'] = WeChatPayUtils.sign_md5(pay_params, self.config.API_KEY)
+                pay_params['paySign'] = self.signer.sign(pay_params)
                 
                 return {
                     'success': True,
@@ -175,13 +207,13 @@ class WeChatPayAPI:
         }
         
         # 添加签名
-        params['sign'] = WeChatPayUtils.sign_md5(params, self.config.API_KEY)
+        params['sign'] = self.signer.sign(params)
         
         # 转换为XML
         xml_data = WeChatPayUtils.dict_to_xml(params)
         
         try:
-            response = requests.post(
+            response = wechat_session.post(
                 self.config.ORDER_QUERY_URL,
                 data=xml_data.encode('utf-8'),
                 headers={'Content-Type': 'application/xml'},
@@ -204,6 +236,7 @@ class WeChatPayAPI:
             else:
                 return {
                     'success': False,
+                    'err_code': result.get('err_code'),
                     'error': result.get('err_code_des', '查询订单失败')
                 }
                 
@@ -212,3 +245,45 @@ class WeChatPayAPI:
                 'success': False,
                 'error': f'查询失败: {str(e)}'
             }
+    
+    def close_order(self, out_trade_no):
+        """关闭订单（订单创建5分钟后才能关闭）"""
+        params = {
+            'appid': self.config.APPID,
+            'mch_id': self.config.MCH_ID,
+            'out_trade_no': out_trade_no,
+            'nonce_str': WeChatPayUtils.generate_nonce_str()
+        }
+        
+        # 添加签名
+        params['sign'] = self.signer.sign(params)
+        
+        # 转换为XML
+        xml_data = WeChatPayUtils.dict_to_xml(params)
+        
+        try:
+            response = wechat_session.post(
+                self.config.CLOSE_ORDER_URL,
+                data=xml_data.encode('utf-8'),
+                headers={'Content-Type': 'application/xml'},
+                timeout=30
+            )
+            
+            result = WeChatPayUtils.xml_to_dict(response.text)
+            
+            if result.get('return_code') == 'SUCCESS' and result.get('result_code') == 'SUCCESS':
+                return {
+                    'success': True
+                }
+            else:
+                return {
+                    'success': False,
+                    'err_code': result.get('err_code'),
+                    'error': result.get('err_code_des', '关闭订单失败')
+                }
+                
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f'关闭失败: {str(e)}'
+            }
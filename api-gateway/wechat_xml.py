@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信支付XML编解码模块
+微信支付v2接口的报文都是一层扁平结构：<xml><key><![CDATA[value]]></key>...</xml>。
+- dumps: 按字段名组合缓存报文模板，一次格式化生成报文，不再逐个字段做字符串累加
+- loads: 不构建ElementTree，用一次正则split取出所有字段；只接受扁平报文，
+  DOCTYPE/实体声明、嵌套元素、属性、注释等一律拒绝（不会展开任何自定义实体）
+解析结果与 ElementTree 的 {child.tag: child.text} 一致：空字段为None，文本中的预定义实体会被解码
+"""
+
+import re
+from typing import Any, Dict, Optional, Tuple, Union
+
+# 报文最大长度，微信支付报文通常只有几KB
+MAX_MESSAGE_SIZE = 64 * 1024
+# 缓存的报文模板数（按字段名组合）
+MAX_TEMPLATES = 256
+
+_NAME = r'[A-Za-z_][\w.-]*'
+# CDATA内容：到第一个]]>为止（展开写法，不回溯）
+_CDATA_BODY = r'[^\]]*(?:\](?!\]>)[^\]]*)*'
+# 不含<的CDATA内容：split在每个<处尝试匹配，扫描到下一个<就停止，对恶意报文也是线性时间
+_CDATA_BODY_NO_LT = r'[^\]<]*(?:\](?!\]>)[^\]<]*)*'
+
+# 报文头：可选的BOM、XML声明
+_PROLOG = re.compile(r'\ufeff?[ \t\r\n]*(?:<\?xml[^?<>]*\?>[ \t\r\n]*)?<xml>')
+# 常见字段：<key><![CDATA[不含<的值]]></key> 或 <key>不含实体的文本</key>
+_SIMPLE_FIELD = re.compile(rf'<({_NAME})>(?:<!\[CDATA\[({_CDATA_BODY_NO_LT})\]\]>|([^<&]*))</\1>')
+# 任意扁平字段：文本与CDATA混合（从上一个字段结束处逐个匹配）
+_FIELD = re.compile(rf'<({_NAME})>([^<]*(?:<!\[CDATA\[{_CDATA_BODY}\]\]>[^<]*)*)</\1>[ \t\r\n]*')
+_CDATA = re.compile(rf'<!\[CDATA\[({_CDATA_BODY})\]\]>')
+_ENTITY = re.compile(r'&(?:(amp|lt|gt|quot|apos)|#([0-9]{1,7})|#x([0-9a-fA-F]{1,6}));')
+_VALID_NAME = re.compile(rf'{_NAME}\Z')
+
+_PREDEFINED = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+_WHITESPACE = ' \t\r\n'
+
+# 字段名组合 -> 报文模板
+_templates: Dict[Tuple[str, ...], str] = {}
+
+
+class WeChatXMLError(ValueError):
+    """报文不是合法的扁平微信支付XML"""
+
+
+def _entity(match) -> str:
+    name, dec, hexa = match.groups()
+    if name:
+        return _PREDEFINED[name]
+    code = int(dec) if dec else int(hexa, 16)
+    if code > 0x10FFFF:
+        raise WeChatXMLError(f"无效的字符引用: {match.group(0)}")
+    return chr(code)
+
+
+def _unescape(text: str) -> str:
+    if '&' not in text:
+        return text
+    # 只解码预定义实体和字符引用，其他实体不展开
+    if '&' in _ENTITY.sub('', text):
+        raise WeChatXMLError("不支持的实体引用")
+    return _ENTITY.sub(_entity, text)
+
+
+def _decode_value(raw: str) -> Optional[str]:
+    parts = []
+    pos = 0
+    for match in _CDATA.finditer(raw):
+        parts.append(_unescape(raw[pos:match.start()]))
+        parts.append(match.group(1))
+        pos = match.end()
+    parts.append(_unescape(raw[pos:]))
+    return ''.join(parts) or None
+
+
+def _loads_general(body: str) -> Dict[str, Optional[str]]:
+    """逐个字段解析（值中含<或实体、文本与CDATA混合等少见情况）"""
+    result = {}
+    pos = len(body) - len(body.lstrip(_WHITESPACE))
+    while pos < len(body):
+        field = _FIELD.match(body, pos)
+        if field is None:
+            raise WeChatXMLError(f"位置{pos}处不是扁平字段（不支持嵌套元素、属性和注释）")
+        result[field.group(1)] = _decode_value(field.group(2))
+        pos = field.end()
+    return result
+
+
+def loads(xml: Union[str, bytes]) -> Dict[str, Optional[str]]:
+    """解析微信支付XML报文为字典"""
+    if len(xml) > MAX_MESSAGE_SIZE:
+        raise WeChatXMLError(f"报文过大（{len(xml)}）")
+    if isinstance(xml, (bytes, bytearray)):
+        try:
+            xml = xml.decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise WeChatXMLError(f"报文不是UTF-8编码: {e}") from None
+
+    prolog = _PROLOG.match(xml)
+    if prolog is None:
+        raise WeChatXMLError("报文必须以<xml>开始（不支持DOCTYPE）")
+    xml = xml.rstrip(_WHITESPACE)
+    if not xml.endswith('</xml>'):
+        raise WeChatXMLError("报文必须以</xml>结束")
+    body = xml[prolog.end():-6]
+
+    # split结果为 [字段间内容, 字段名, CDATA值, 文本值, 字段间内容, ...]，字段间只能是空白
+    parts = _SIMPLE_FIELD.split(body)
+    if ''.join(parts[0::4]).strip(_WHITESPACE):
+        return _loads_general(body)
+    return {key: cdata or text or None for key, cdata, text in zip(parts[1::4], parts[2::4], parts[3::4])}
+
+
+def _template(keys: Tuple[str, ...]) -> str:
+    for key in keys:
+        if not isinstance(key, str) or not _VALID_NAME.match(key):
+            raise WeChatXMLError(f"无效的字段名: {key!r}")
+    template = "<xml>" + "".join(f"<{key}><![CDATA[%s]]></{key}>" for key in keys) + "</xml>"
+    if len(_templates) >= MAX_TEMPLATES:
+        _templates.clear()
+    _templates[keys] = template
+    return template
+
+
+def dumps(data: Dict[str, Any]) -> str:
+    """字典转微信支付XML报文（值统一放在CDATA中）"""
+    keys = tuple(data)
+    template = _templates.get(keys) or _template(keys)
+    xml = template % tuple(data.values())
+    if xml.count(']]>') != len(keys):
+        # CDATA中不能出现]]>，拆成两个CDATA段
+        xml = template % tuple(str(value).replace(']]>', ']]]]><![CDATA[>') for value in data.values())
+    return xml
@@ -12,6 +12,11 @@ sudo sed -i 's|proxy_pass http://127.0.0.1:5000/api/v1/|proxy_pass https://127.0
 # 在/api/配置之前添加微信支付API配置
 sudo sed -i '/location \/api\/ {/i\    # 微信支付API代理配置\n    location /api/wechat/ {\n        proxy_pass https://127.0.0.1:8443/api/wechat/;\n        proxy_set_header Host $host;\n        proxy_set_header X-Real-IP $remote_addr;\n        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\n        proxy_set_header X-Forwarded-Proto $scheme;\n        \n        # 处理大文件上传\n        client_max_body_size 100M;\n        proxy_read_timeout 300s;\n        proxy_connect_timeout 300s;\n        proxy_send_timeout 300s;\n        \n        # SSL验证\n        proxy_ssl_verify off;\n    }\n' /etc/nginx/sites-enabled/gongjuxiang.work
 
+# 添加结果缓存的内部location（网关配置 result_cache.accel_redirect_prefix 为 "/_result_cache/" 时使用）
+if ! sudo grep -q "location /_result_cache/" /etc/nginx/sites-enabled/gongjuxiang.work; then
+    sudo sed -i '/location \/api\/ {/i\    # 网关结果缓存：由nginx用sendfile直接发送缓存文件\n    location /_result_cache/ {\n        internal;\n        alias /home/ubuntu/PhotoEnhanceAI-web/api-gateway/data/result_cache/;\n        sendfile on;\n        tcp_nopush on;\n    }\n' /etc/nginx/sites-enabled/gongjuxiang.work
+fi
+
 # 测试配置
 if sudo nginx -t; then
     echo "✅ Nginx配置测试通过"